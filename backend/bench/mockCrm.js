@@ -0,0 +1,247 @@
+// Local AMO / Kommo v4 stand-in for the offline benchmark.
+//   - AMO: read-only account built by seedData.buildSeed (leads, contacts, companies, tasks,
+//     notes, pipelines, users, custom fields) with filter / page / limit like the real API
+//   - Kommo: accepts creates / patches / deletes, hands out ids, keeps tasks for lookups
+//   - fault injection per request: latency (+ jitter), 429 with Retry-After, 5xx
+// Runs as a child process of bench_migration.js so its memory does not count towards the
+// measured heap: the parent sends { type: 'stats' } and gets request counters back.
+const express = require('express');
+const { buildSeed } = require('./seedData');
+
+const list = (v) => (v == null ? null : [].concat(v).map(Number));
+
+function page(req, key, items) {
+  const limit = Math.min(Number(req.query.limit) || 50, 250);
+  const pageNo = Number(req.query.page) || 1;
+  const slice = items.slice((pageNo - 1) * limit, pageNo * limit);
+  const body = { _page: pageNo, _embedded: { [key]: slice }, _links: { self: { href: req.originalUrl } } };
+  if (pageNo * limit < items.length) body._links.next = { href: `${req.path}?page=${pageNo + 1}` };
+  return body;
+}
+
+function groupBy(items, key) {
+  const map = new Map();
+  for (const item of items) {
+    if (!map.has(item[key])) map.set(item[key], []);
+    map.get(item[key]).push(item);
+  }
+  return map;
+}
+
+/**
+ * Fault injection + counters. Counters are kept per route pattern ("GET /api/v4/leads").
+ * @param {object} faults - { latency, jitter, p429, p5xx, retryAfter }
+ */
+function instrument(app, stats, faults) {
+  app.use((req, res, next) => {
+    stats.requests++;
+    res.on('finish', () => {
+      if (res.locals.injected) return;
+      const route = `${req.method} ${req.route ? req.baseUrl + req.route.path : 'unmocked'}`;
+      stats.byRoute[route] = (stats.byRoute[route] || 0) + 1;
+    });
+
+    const delay = (faults.latency || 0) + Math.random() * (faults.jitter || 0);
+    setTimeout(() => {
+      const r = Math.random();
+      if (r < (faults.p429 || 0) + (faults.p5xx || 0)) res.locals.injected = true;
+      if (r < (faults.p429 || 0)) {
+        stats.injected429++;
+        res.set('Retry-After', String(faults.retryAfter || 1));
+        return res.status(429).json({ title: 'Too Many Requests', status: 429 });
+      }
+      if (r < (faults.p429 || 0) + (faults.p5xx || 0)) {
+        stats.injected5xx++;
+        return res.status(503).json({ title: 'Service Unavailable', status: 503 });
+      }
+      next();
+    }, delay);
+  });
+}
+
+function emptyStats() {
+  return { requests: 0, injected429: 0, injected5xx: 0, byRoute: {} };
+}
+
+// ─── AMO ──────────────────────────────────────────────────────────────────────
+function amoApp(amo, faults, stats) {
+  const app = express();
+  instrument(app, stats, faults);
+  const r = express.Router();
+
+  const byId = {
+    leads: new Map(amo.leads.map(x => [x.id, x])),
+    contacts: new Map(amo.contacts.map(x => [x.id, x])),
+    companies: new Map(amo.companies.map(x => [x.id, x])),
+  };
+  const tasksByType = groupBy(amo.tasks, 'entity_type');
+  const tasksByEntity = groupBy(amo.tasks, 'entity_id');
+  const notesByEntity = {
+    leads: groupBy(amo.notes.leads, 'entity_id'),
+    contacts: groupBy(amo.notes.contacts, 'entity_id'),
+    companies: groupBy(amo.notes.companies, 'entity_id'),
+  };
+  const updatedFrom = (req, items) => {
+    const from = Number(req.query.filter?.updated_at?.from);
+    return from ? items.filter(x => x.updated_at >= from) : items;
+  };
+
+  r.get('/leads/pipelines', (req, res) => res.json({ _embedded: { pipelines: amo.pipelines } }));
+  r.get('/leads/pipelines/:id', (req, res) => {
+    const p = amo.pipelines.find(x => x.id === Number(req.params.id));
+    return p ? res.json(p) : res.status(404).json({ status: 404 });
+  });
+  r.get('/users', (req, res) => res.json(page(req, 'users', amo.users)));
+  r.get('/:entity(leads|contacts|companies)/custom_fields', (req, res) =>
+    res.json(page(req, 'custom_fields', amo.customFields[req.params.entity])));
+  r.get('/:entity(leads|contacts|companies)/custom_fields/groups', (req, res) =>
+    res.json(page(req, 'custom_field_groups', [])));
+
+  r.get('/:entity(leads|contacts|companies)/notes', (req, res) => {
+    const ids = list(req.query.filter?.entity_id);
+    const notes = ids
+      ? ids.flatMap(id => notesByEntity[req.params.entity].get(id) || [])
+      : amo.notes[req.params.entity];
+    res.json(page(req, 'notes', updatedFrom(req, notes)));
+  });
+  r.get('/:entity(leads|contacts|companies)/:id/notes', (req, res) =>
+    res.json(page(req, 'notes', notesByEntity[req.params.entity].get(Number(req.params.id)) || [])));
+
+  r.get('/:entity(leads|contacts|companies)', (req, res) => {
+    const { entity } = req.params;
+    const f = req.query.filter || {};
+    const ids = list(f.id);
+    let items = ids ? ids.map(id => byId[entity].get(id)).filter(Boolean) : amo[entity];
+    if (f.pipeline_id) items = items.filter(x => x.pipeline_id === Number(f.pipeline_id));
+    const managers = list(f.responsible_user_id);
+    if (managers) items = items.filter(x => managers.includes(x.responsible_user_id));
+    res.json(page(req, entity, updatedFrom(req, items)));
+  });
+
+  r.get('/tasks', (req, res) => {
+    const f = req.query.filter || {};
+    const ids = list(f.entity_id);
+    let items = ids ? ids.flatMap(id => tasksByEntity.get(id) || []) : amo.tasks;
+    if (f.entity_type) items = (ids ? items : tasksByType.get(f.entity_type) || []).filter(t => t.entity_type === f.entity_type);
+    res.json(page(req, 'tasks', updatedFrom(req, items)));
+  });
+
+  app.use('/api/v4', r);
+  app.use((req, res) => res.status(404).json({ status: 404, detail: `not mocked: ${req.method} ${req.path}` }));
+  return app;
+}
+
+// ─── Kommo ────────────────────────────────────────────────────────────────────
+function kommoApp(kommo, faults, stats) {
+  const app = express();
+  app.use(express.json({ limit: '50mb' }));
+  instrument(app, stats, faults);
+  const r = express.Router();
+
+  let nextId = 50000000;
+  const store = { leads: new Map(), contacts: new Map(), companies: new Map(), tasks: new Map() };
+  const notes = new Set();
+
+  const created = (entity, items) => items.map((item, i) => {
+    const id = ++nextId;
+    store[entity]?.set(id, entity === 'tasks' ? { id, entity_id: item.entity_id, entity_type: item.entity_type, is_completed: !!item.is_completed } : { id });
+    return { id, request_id: String(i), _links: { self: { href: `/api/v4/${entity}/${id}` } } };
+  });
+
+  r.get('/leads/pipelines', (req, res) => res.json({ _embedded: { pipelines: kommo.pipelines } }));
+  r.get('/leads/pipelines/:id', (req, res) => {
+    const p = kommo.pipelines.find(x => x.id === Number(req.params.id));
+    return p ? res.json(p) : res.status(404).json({ status: 404 });
+  });
+  r.post('/leads/pipelines/:id/statuses', (req, res) =>
+    res.json({ _embedded: { statuses: req.body.map(s => ({ ...s, id: ++nextId })) } }));
+  r.get('/users', (req, res) => res.json(page(req, 'users', kommo.users)));
+
+  r.get('/:entity(leads|contacts|companies)/custom_fields', (req, res) =>
+    res.json(page(req, 'custom_fields', kommo.customFields[req.params.entity])));
+  r.post('/:entity(leads|contacts|companies)/custom_fields', (req, res) => {
+    const fields = req.body.map(f => ({ ...f, id: ++nextId }));
+    kommo.customFields[req.params.entity].push(...fields);
+    res.json({ _embedded: { custom_fields: fields } });
+  });
+  r.patch('/:entity(leads|contacts|companies)/custom_fields', (req, res) =>
+    res.json({ _embedded: { custom_fields: req.body } }));
+  r.get('/:entity(leads|contacts|companies)/custom_fields/groups', (req, res) =>
+    res.json(page(req, 'custom_field_groups', [])));
+  r.post('/:entity(leads|contacts|companies)/custom_fields/groups', (req, res) =>
+    res.json({ _embedded: { custom_field_groups: req.body.map(g => ({ ...g, id: `bench_${++nextId}` })) } }));
+
+  r.post('/:entity(leads|contacts|companies)/notes', (req, res) => {
+    const out = req.body.map((n, i) => { const id = ++nextId; notes.add(id); return { id, entity_id: n.entity_id, request_id: String(i) }; });
+    res.json({ _embedded: { notes: out } });
+  });
+  r.delete('/:entity(leads|contacts|companies)/:id/notes/:noteId', (req, res) =>
+    res.status(notes.delete(Number(req.params.noteId)) ? 204 : 404).end());
+
+  r.post('/:entity(leads|contacts|companies|tasks)', (req, res) =>
+    res.json({ _embedded: { [req.params.entity]: created(req.params.entity, req.body) } }));
+  r.patch('/:entity(leads|contacts|companies|tasks)', (req, res) => {
+    const map = store[req.params.entity];
+    for (const item of req.body) {
+      const row = map.get(Number(item.id));
+      if (row && item.is_completed != null) row.is_completed = !!item.is_completed;
+    }
+    res.json({ _embedded: { [req.params.entity]: req.body.map(x => ({ id: x.id })) } });
+  });
+  r.delete('/:entity(leads|contacts|companies|tasks)/:id', (req, res) =>
+    res.status(store[req.params.entity].delete(Number(req.params.id)) ? 204 : 404).end());
+
+  r.get('/tasks', (req, res) => {
+    const f = req.query.filter || {};
+    const ids = list(f.entity_id);
+    let items = [...store.tasks.values()];
+    if (ids) items = items.filter(t => ids.includes(Number(t.entity_id)));
+    if (f.entity_type) items = items.filter(t => t.entity_type === f.entity_type);
+    if (f.is_completed != null) items = items.filter(t => t.is_completed === (String(f.is_completed) === '1'));
+    res.json(page(req, 'tasks', items));
+  });
+
+  app.use('/api/v4', r);
+  app.use((req, res) => res.status(404).json({ status: 404, detail: `not mocked: ${req.method} ${req.path}` }));
+  return app;
+}
+
+function listen(app) {
+  return new Promise((resolve) => {
+    const server = app.listen(0, '127.0.0.1', () => resolve(server));
+  });
+}
+
+/**
+ * Start both stand-ins in this process.
+ * @param {object} seed - buildSeed() result
+ * @param {object} faults - { latency, jitter, p429, p5xx, retryAfter }
+ */
+async function startMockCrm(seed, faults = {}) {
+  const stats = { amo: emptyStats(), kommo: emptyStats() };
+  const amoServer = await listen(amoApp(seed.amo, faults, stats.amo));
+  const kommoServer = await listen(kommoApp(seed.kommo, faults, stats.kommo));
+  return {
+    amoUrl: `http://127.0.0.1:${amoServer.address().port}`,
+    kommoUrl: `http://127.0.0.1:${kommoServer.address().port}`,
+    stats,
+    close: () => { amoServer.close(); kommoServer.close(); },
+  };
+}
+
+// Child-process mode: argv[2] = JSON { seed: buildSeed opts, faults }
+if (require.main === module) {
+  const { seed: seedOpts, faults } = JSON.parse(process.argv[2] || '{}');
+  const seed = buildSeed(seedOpts);
+  startMockCrm(seed, faults).then((mock) => {
+    // Everything the app side needs, without the bulk of the account
+    const { amo, kommo, ...setup } = seed;
+    process.send({ type: 'ready', amoUrl: mock.amoUrl, kommoUrl: mock.kommoUrl, ...setup, leadIds: amo.leads.map(l => l.id) });
+    process.on('message', (msg) => {
+      if (msg.type === 'stats') process.send({ type: 'stats', stats: mock.stats });
+    });
+    process.on('disconnect', () => process.exit(0));
+  });
+}
+
+module.exports = { startMockCrm };
@@ -0,0 +1,286 @@
+// Synthetic AMO account + empty Kommo account for the offline benchmark.
+// Shaped like backups/kommo-structure.json: its pipelines/stages, managers and field
+// mappings drive the pipelines, custom fields, stage / field / user mappings.
+// Deterministic for a given seed, so runs are comparable.
+const fs = require('fs');
+const path = require('path');
+
+const DEFAULT_STRUCTURE = path.resolve(__dirname, '../backups/kommo-structure.json');
+
+const DEFAULTS = {
+  leads: 200,
+  contactsPerLead: 1.5,   // average; ~20% of contacts are shared by two leads
+  companyShare: 0.3,      // share of leads with a company
+  tasksPerLead: 2,
+  notesPerLead: 4,
+  tasksPerContact: 0.5,
+  notesPerContact: 1,
+  notesPerCompany: 1,
+  fieldsPerEntity: 12,    // custom fields filled per lead / contact / company
+  seed: 42,
+};
+
+// Used when kommo-structure.json is not available
+const FALLBACK_STRUCTURE = {
+  pipelines: [{
+    amoPipelineId: 1000, kommoPipelineId: 2000,
+    stages: [
+      { amoStageId: 142, kommoStageId: 142, amoStageName: 'Успешно реализовано' },
+      { amoStageId: 143, kommoStageId: 143, amoStageName: 'Закрыто не реализовано' },
+      { amoStageId: 1001, kommoStageId: 2001, amoStageName: 'Первичный контакт' },
+      { amoStageId: 1002, kommoStageId: 2002, amoStageName: 'Переговоры' },
+    ],
+  }],
+  managers: [{ amoUserId: 10, kommoUserId: 20, amoUserName: 'Manager', kommoUserName: 'Manager' }],
+  fieldMappings: {
+    leads: [
+      { amoFieldId: '501', kommoFieldId: 601, amoFieldName: 'Источник', amoFieldType: 'select', kommoFieldType: 'select', enumMap: { 5011: 6011, 5012: 6012 } },
+      { amoFieldId: '502', kommoFieldId: 602, amoFieldName: 'Комментарий', amoFieldType: 'textarea', kommoFieldType: 'textarea', enumMap: {} },
+    ],
+    contacts: [
+      { amoFieldId: '511', kommoFieldId: 611, amoFieldName: 'Телефон', amoFieldType: 'multitext', kommoFieldType: 'multitext', enumMap: {} },
+    ],
+    companies: [
+      { amoFieldId: '521', kommoFieldId: 621, amoFieldName: 'Адрес', amoFieldType: 'text', kommoFieldType: 'text', enumMap: {} },
+    ],
+  },
+};
+
+function loadStructure(file) {
+  const p = file || DEFAULT_STRUCTURE;
+  if (!fs.existsSync(p)) return FALLBACK_STRUCTURE;
+  return JSON.parse(fs.readFileSync(p, 'utf8'));
+}
+
+// mulberry32 — small deterministic PRNG
+function prng(seed) {
+  let a = seed >>> 0;
+  return () => {
+    a = (a + 0x6D2B79F5) >>> 0;
+    let t = a;
+    t = Math.imul(t ^ (t >>> 15), t | 1);
+    t ^= t + Math.imul(t ^ (t >>> 7), t | 61);
+    return ((t ^ (t >>> 14)) >>> 0) / 4294967296;
+  };
+}
+
+/** Poisson-ish count around an average (floor + chance of one more). */
+function countAround(rand, avg) {
+  return Math.floor(avg) + (rand() < avg - Math.floor(avg) ? 1 : 0);
+}
+
+function fieldValue(rand, f, i) {
+  const enumIds = Object.keys(f.enumMap || {});
+  switch (f.amoFieldType) {
+    case 'select':
+    case 'radiobutton':
+      return enumIds.length ? [{ enum_id: Number(enumIds[i % enumIds.length]), value: `Вариант ${i % enumIds.length}` }] : null;
+    case 'multiselect':
+      return enumIds.length ? enumIds.slice(0, 1 + (i % 2)).map((id, k) => ({ enum_id: Number(id), value: `Вариант ${k}` })) : null;
+    case 'checkbox':
+      return [{ value: rand() < 0.5 }];
+    case 'numeric':
+      return [{ value: String(Math.floor(rand() * 100000)) }];
+    case 'date':
+    case 'date_time':
+    case 'birthday':
+      return [{ value: 1600000000 + Math.floor(rand() * 1e8) }];
+    case 'multitext':
+      return [{ value: `+7900${String(1000000 + i).slice(-7)}`, enum_code: 'WORK' }];
+    case 'url':
+      return [{ value: `https://example.com/p/${i}` }];
+    default:
+      return [{ value: `Значение ${i} ${'x'.repeat(Math.floor(rand() * 40))}` }];
+  }
+}
+
+function customFields(rand, mappings, n, i) {
+  if (!mappings.length) return null;
+  const out = [];
+  for (let k = 0; k < Math.min(n, mappings.length); k++) {
+    const f = mappings[(i * 7 + k * 13) % mappings.length];
+    if (out.some(v => v.field_id === Number(f.amoFieldId))) continue;
+    const values = fieldValue(rand, f, i + k);
+    if (values) out.push({ field_id: Number(f.amoFieldId), field_name: f.amoFieldName, field_type: f.amoFieldType, values });
+  }
+  return out;
+}
+
+function amoFieldDefs(mappings, base) {
+  return mappings.map((f, i) => ({
+    id: Number(f.amoFieldId),
+    name: f.amoFieldName || `Field ${f.amoFieldId}`,
+    type: f.amoFieldType,
+    code: null,
+    sort: base + i,
+    group_id: null,
+    is_api_only: false,
+    enums: Object.keys(f.enumMap || {}).map((id, k) => ({ id: Number(id), value: `Вариант ${k}`, sort: k })),
+  }));
+}
+
+function kommoFieldDefs(mappings, base) {
+  return mappings.map((f, i) => ({
+    id: Number(f.kommoFieldId),
+    name: f.kommoFieldName || f.amoFieldName || `Field ${f.kommoFieldId}`,
+    type: f.kommoFieldType || f.amoFieldType,
+    code: null,
+    sort: base + i,
+    group_id: null,
+    is_api_only: false,
+    enums: Object.values(f.enumMap || {}).map((id, k) => ({ id: Number(id), value: `Вариант ${k}`, sort: k })),
+  }));
+}
+
+/**
+ * Build both accounts.
+ * @param {object} opts - DEFAULTS overrides + { structure: path }
+ * @returns {{ amo, kommo, stageMapping, fieldMapping, userMappings, amoPipelineId, kommoPipelineId, counts }}
+ */
+function buildSeed(opts = {}) {
+  const o = { ...DEFAULTS, ...opts };
+  const rand = prng(o.seed);
+  const structure = loadStructure(o.structure);
+  const pipeline = structure.pipelines.find(p => (p.stages || []).length > 2) || structure.pipelines[0];
+  const managers = structure.managers.length ? structure.managers : FALLBACK_STRUCTURE.managers;
+  const fm = structure.fieldMappings || {};
+  const mappingsOf = (entity) => (fm[entity] || []).filter(f => f.amoFieldId && f.kommoFieldId);
+
+  const openStages = pipeline.stages.filter(s => ![142, 143].includes(Number(s.amoStageId)));
+  const now = Math.floor(Date.now() / 1000);
+  const created = () => now - 86400 * 30 - Math.floor(rand() * 86400 * 300);
+
+  let nextId = 10000000;
+  const id = () => ++nextId;
+
+  const leads = [];
+  const contacts = [];
+  const companies = [];
+  const tasks = [];
+  const notes = { leads: [], contacts: [], companies: [] };
+
+  const note = (entity, entityId, i) => notes[entity].push({
+    id: id(), entity_id: entityId, note_type: 'common',
+    params: { text: `Заметка ${i}: ${'lorem ipsum '.repeat(1 + Math.floor(rand() * 8))}` },
+    responsible_user_id: Number(managers[i % managers.length].amoUserId),
+    created_by: Number(managers[i % managers.length].amoUserId),
+    created_at: created(), updated_at: created(),
+  });
+  const task = (entity, entityId, i) => tasks.push({
+    id: id(), entity_id: entityId, entity_type: entity,
+    text: `Задача ${i}`, task_type_id: 1 + (i % 2), is_completed: rand() < 0.3,
+    complete_till: now + 86400 * (1 + (i % 20)), duration: 0,
+    responsible_user_id: Number(managers[i % managers.length].amoUserId),
+    created_at: created(), updated_at: created(), result: {},
+  });
+
+  for (let i = 0; i < o.leads; i++) {
+    const mgr = managers[i % managers.length];
+    const stage = rand() < 0.1
+      ? pipeline.stages.find(s => Number(s.amoStageId) === 143) || openStages[0]
+      : openStages[i % openStages.length];
+    const lead = {
+      id: id(), name: `Сделка ${i}`, price: Math.floor(rand() * 50000),
+      responsible_user_id: Number(mgr.amoUserId),
+      pipeline_id: Number(pipeline.amoPipelineId), status_id: Number(stage.amoStageId),
+      created_at: created(), updated_at: created(), closed_at: null,
+      custom_fields_values: customFields(rand, mappingsOf('leads'), o.fieldsPerEntity, i),
+      _embedded: { tags: [], contacts: [], companies: [] },
+    };
+
+    const nContacts = countAround(rand, o.contactsPerLead);
+    for (let c = 0; c < nContacts; c++) {
+      // Share an existing contact now and then (family members on several deals)
+      if (contacts.length > 0 && rand() < 0.2) {
+        const shared = contacts[Math.floor(rand() * contacts.length)];
+        if (!lead._embedded.contacts.some(x => x.id === shared.id)) {
+          lead._embedded.contacts.push({ id: shared.id, is_main: c === 0 });
+          shared._embedded.leads.push({ id: lead.id });
+        }
+        continue;
+      }
+      const ci = contacts.length;
+      const contact = {
+        id: id(), name: `Контакт ${ci}`, first_name: `Имя${ci}`, last_name: `Фамилия${ci}`,
+        responsible_user_id: Number(mgr.amoUserId),
+        created_at: created(), updated_at: created(),
+        custom_fields_values: customFields(rand, mappingsOf('contacts'), o.fieldsPerEntity, ci),
+        _embedded: { leads: [{ id: lead.id }], companies: [] },
+      };
+      contacts.push(contact);
+      lead._embedded.contacts.push({ id: contact.id, is_main: c === 0 });
+      for (let t = 0; t < countAround(rand, o.tasksPerContact); t++) task('contacts', contact.id, ci + t);
+      for (let n = 0; n < countAround(rand, o.notesPerContact); n++) note('contacts', contact.id, ci + n);
+    }
+
+    if (rand() < o.companyShare) {
+      const ki = companies.length;
+      const company = {
+        id: id(), name: `Компания ${ki}`,
+        responsible_user_id: Number(mgr.amoUserId),
+        created_at: created(), updated_at: created(),
+        custom_fields_values: customFields(rand, mappingsOf('companies'), o.fieldsPerEntity, ki),
+        _embedded: { leads: [{ id: lead.id }], contacts: [] },
+      };
+      companies.push(company);
+      lead._embedded.companies.push({ id: company.id });
+      task('companies', company.id, ki);
+      for (let n = 0; n < countAround(rand, o.notesPerCompany); n++) note('companies', company.id, ki + n);
+    }
+
+    for (let t = 0; t < countAround(rand, o.tasksPerLead); t++) task('leads', lead.id, i + t);
+    for (let n = 0; n < countAround(rand, o.notesPerLead); n++) note('leads', lead.id, i + n);
+    leads.push(lead);
+  }
+
+  const amoStatuses = pipeline.stages.map((s, i) => ({ id: Number(s.amoStageId), name: s.amoStageName || `Этап ${i}`, sort: i * 10 }));
+  const kommoStatuses = pipeline.stages.map((s, i) => ({ id: Number(s.kommoStageId), name: s.kommoStageName || s.amoStageName || `Этап ${i}`, sort: i * 10 }));
+
+  const stageMapping = { _pipeline: { amo: Number(pipeline.amoPipelineId), kommo: Number(pipeline.kommoPipelineId) } };
+  for (const s of pipeline.stages) stageMapping[s.amoStageId] = Number(s.kommoStageId);
+
+  const fieldMapping = {};
+  for (const entity of ['leads', 'contacts', 'companies']) {
+    fieldMapping[entity] = {};
+    for (const { amoFieldId, ...entry } of mappingsOf(entity)) fieldMapping[entity][amoFieldId] = entry;
+  }
+
+  const amo = {
+    pipelines: [{ id: Number(pipeline.amoPipelineId), name: 'Bench', _embedded: { statuses: amoStatuses } }],
+    users: managers.map(m => ({ id: Number(m.amoUserId), name: m.amoUserName || 'Manager', email: m.amoEmail || null })),
+    leads, contacts, companies, tasks, notes,
+    customFields: {
+      leads: amoFieldDefs(mappingsOf('leads'), 0),
+      contacts: amoFieldDefs(mappingsOf('contacts'), 0),
+      companies: amoFieldDefs(mappingsOf('companies'), 0),
+    },
+  };
+  const kommo = {
+    pipelines: [{ id: Number(pipeline.kommoPipelineId), name: 'Bench', _embedded: { statuses: kommoStatuses } }],
+    users: managers.map(m => ({ id: Number(m.kommoUserId), name: m.kommoUserName || 'Manager', email: m.kommoEmail || null })),
+    customFields: {
+      leads: kommoFieldDefs(mappingsOf('leads'), 0),
+      contacts: kommoFieldDefs(mappingsOf('contacts'), 0),
+      companies: kommoFieldDefs(mappingsOf('companies'), 0),
+    },
+  };
+
+  return {
+    amo,
+    kommo,
+    stageMapping,
+    fieldMapping,
+    userMappings: managers.map(m => ({
+      amo_user_id: Number(m.amoUserId), amo_user_name: m.amoUserName || null,
+      kommo_user_id: Number(m.kommoUserId), kommo_user_name: m.kommoUserName || null,
+    })),
+    amoPipelineId: Number(pipeline.amoPipelineId),
+    kommoPipelineId: Number(pipeline.kommoPipelineId),
+    counts: {
+      leads: leads.length, contacts: contacts.length, companies: companies.length, tasks: tasks.length,
+      notes: notes.leads.length + notes.contacts.length + notes.companies.length,
+    },
+  };
+}
+
+module.exports = { buildSeed, DEFAULTS };
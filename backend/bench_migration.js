@@ -0,0 +1,224 @@
+// Offline end-to-end benchmark: fetchAllData → runBatchMigration → runSingleDealsTransfer →
+// rollbackBatch against local AMO / Kommo stand-ins (bench/mockCrm.js, forked child process).
+// Synthetic account shaped like backups/kommo-structure.json (bench/seedData.js).
+// Runs in a temp dir: own BACKUP_DIR, SQLite file and logs — real backups are not touched.
+//
+//   node bench_migration.js [--leads 200] [--single 20] [--rps 7] [--latency 30] [--jitter 20]
+//                           [--p429 0] [--p5xx 0] [--retry-after 1] [--seed 42]
+//                           [--structure backups/kommo-structure.json]
+//                           [--json out.json] [--baseline prev.json] [--tolerance 0.2]
+//
+// --rps raises the client rate limit (CRM_MAX_RPS) to profile CPU / IO instead of pacing.
+// --baseline compares wall time and peak heap per phase with a previous --json report and
+// exits with code 1 when a phase is slower / bigger than tolerance allows.
+const path = require('path');
+const os = require('os');
+const fs = require('fs');
+const { fork } = require('child_process');
+
+// ── CLI ───────────────────────────────────────────────────────────────────────
+function parseArgs(argv) {
+  const opts = {
+    leads: 200, single: 20, rps: 0, latency: 30, jitter: 20, p429: 0, p5xx: 0,
+    retryAfter: 1, seed: 42, structure: null, json: null, baseline: null, tolerance: 0.2,
+  };
+  for (let i = 0; i < argv.length; i++) {
+    const m = argv[i].match(/^--([a-z0-9-]+)$/);
+    if (!m) continue;
+    const key = m[1].replace(/-([a-z])/g, (_, c) => c.toUpperCase());
+    if (!(key in opts)) throw new Error(`Unknown option ${argv[i]}`);
+    const val = argv[++i];
+    opts[key] = typeof opts[key] === 'number' ? Number(val) : val;
+  }
+  opts.single = Math.min(opts.single, opts.leads);
+  return opts;
+}
+
+const opts = parseArgs(process.argv.slice(2));
+
+// ── Mock CRM (child process) ──────────────────────────────────────────────────
+function startMock() {
+  const child = fork(path.join(__dirname, 'bench/mockCrm.js'), [JSON.stringify({
+    seed: { leads: opts.leads, seed: opts.seed, structure: opts.structure || undefined },
+    faults: { latency: opts.latency, jitter: opts.jitter, p429: opts.p429, p5xx: opts.p5xx, retryAfter: opts.retryAfter },
+  })]);
+  let pending = null;
+  child.on('message', (msg) => {
+    if (msg.type === 'stats' && pending) { pending(msg.stats); pending = null; }
+  });
+  return new Promise((resolve, reject) => {
+    child.once('error', reject);
+    child.once('message', (msg) => resolve({
+      ...msg,
+      stats: () => new Promise((res) => { pending = res; child.send({ type: 'stats' }); }),
+      stop: () => child.disconnect(),
+    }));
+  });
+}
+
+// ── Heap sampler ──────────────────────────────────────────────────────────────
+function sampleHeap() {
+  let peak = process.memoryUsage().heapUsed;
+  const timer = setInterval(() => { peak = Math.max(peak, process.memoryUsage().heapUsed); }, 10);
+  return () => { clearInterval(timer); return Math.max(peak, process.memoryUsage().heapUsed); };
+}
+
+function diffStats(before, after) {
+  const out = {};
+  for (const crm of ['amo', 'kommo']) {
+    const byRoute = {};
+    for (const [route, n] of Object.entries(after[crm].byRoute)) {
+      const d = n - (before[crm].byRoute[route] || 0);
+      if (d > 0) byRoute[route] = d;
+    }
+    out[crm] = {
+      requests: after[crm].requests - before[crm].requests,
+      injected429: after[crm].injected429 - before[crm].injected429,
+      injected5xx: after[crm].injected5xx - before[crm].injected5xx,
+      byRoute,
+    };
+  }
+  return out;
+}
+
+async function phase(name, mock, fn) {
+  if (global.gc) global.gc();
+  const before = await mock.stats();
+  const stopHeap = sampleHeap();
+  const started = process.hrtime.bigint();
+  let error = null;
+  let detail = null;
+  try {
+    detail = await fn();
+  } catch (e) {
+    error = e.message;
+  }
+  const wallMs = Number(process.hrtime.bigint() - started) / 1e6;
+  const peakHeap = stopHeap();
+  const requests = diffStats(before, await mock.stats());
+  const total = requests.amo.requests + requests.kommo.requests;
+  return { name, wallMs, peakHeap, rps: total / (wallMs / 1000), requests, detail, error };
+}
+
+const sleep = (ms) => new Promise((r) => setTimeout(r, ms));
+const mb = (n) => (n / 1048576).toFixed(1);
+
+async function main() {
+  const mock = await startMock();
+
+  // Environment for the app — must be set before anything from src/ is required
+  const dir = fs.mkdtempSync(path.join(os.tmpdir(), 'bench-migration-'));
+  const seed = mock; // mappings, pipeline ids, lead ids from the child — the account stays there
+  Object.assign(process.env, {
+    AMO_BASE_URL: mock.amoUrl, AMO_TOKEN: 'bench', AMO_PIPELINE_ID: String(seed.amoPipelineId),
+    KOMMO_BASE_URL: mock.kommoUrl, KOMMO_TOKEN: 'bench', KOMMO_PIPELINE_ID: String(seed.kommoPipelineId),
+    BACKUP_DIR: dir, MIGRATION_DB: path.join(dir, 'migration.db'),
+  });
+  if (opts.rps > 0) process.env.CRM_MAX_RPS = String(opts.rps);
+  fs.writeFileSync(path.join(dir, 'field_mapping.json'), JSON.stringify(seed.fieldMapping));
+  process.chdir(dir); // logs/ go to the temp dir
+
+  const logger = require('./src/utils/logger');
+  logger.level = 'error';
+  const express = require('express');
+  const db = require('./src/db');
+  const batch = require('./src/services/batchMigrationService');
+  const { getRateLimiterStats } = require('./src/utils/rateLimiter');
+  for (const m of seed.userMappings) db.saveUserMapping(m);
+
+  // Data router on a local port — fetchAllData is driven the way the UI drives it
+  const app = express();
+  app.use(express.json());
+  app.use('/api/amo', require('./src/routes/data'));
+  const server = await new Promise((r) => { const s = app.listen(0, '127.0.0.1', () => r(s)); });
+  const base = `http://127.0.0.1:${server.address().port}/api/amo`;
+  const call = (p, body) => fetch(`${base}${p}`, body
+    ? { method: 'POST', headers: { 'Content-Type': 'application/json' }, body: JSON.stringify(body) }
+    : undefined).then((r) => r.json());
+
+  const batchLeads = opts.leads - opts.single;
+  const singleIds = seed.leadIds.slice(batchLeads);
+  const results = [];
+
+  results.push(await phase('fetchAllData', mock, async () => {
+    await call('/fetch', { pipelineId: seed.amoPipelineId, managerIds: [] });
+    let state;
+    do {
+      await sleep(25);
+      state = await call('/fetch-status');
+    } while (state.status === 'loading');
+    if (state.status !== 'done') throw new Error(state.error || `fetch ended with ${state.status}`);
+    return db.getAmoCacheMeta()?.counts || null;
+  }));
+
+  results.push(await phase('runBatchMigration', mock, async () => {
+    batch.setBatchConfig({ batchSize: batchLeads, managerIds: [], offset: 0, migrationMode: 'all', stageMapping: seed.stageMapping });
+    await batch.runBatchMigration(seed.stageMapping);
+    const state = batch.getBatchState();
+    if (state.status !== 'completed') throw new Error(state.errors?.[0]?.message || state.errors?.[0] || `batch ended with ${state.status}`);
+    return Object.fromEntries(Object.entries(state.createdIds).map(([k, v]) => [k, v.length]));
+  }));
+
+  results.push(await phase('runSingleDealsTransfer', mock, async () => {
+    const res = await batch.runSingleDealsTransfer(singleIds, seed.stageMapping);
+    return res?.createdIds ? Object.fromEntries(Object.entries(res.createdIds).map(([k, v]) => [k, v.length])) : null;
+  }));
+
+  results.push(await phase('rollbackBatch', mock, async () => {
+    await batch.rollbackBatch();
+    const state = batch.getBatchState();
+    if (state.status !== 'idle') throw new Error(`rollback ended with ${state.status}`);
+    return null;
+  }));
+
+  server.close();
+  mock.stop();
+
+  // ── Report ──────────────────────────────────────────────────────────────────
+  const report = {
+    at: new Date().toISOString(),
+    node: process.version,
+    options: opts,
+    seed: mock.counts,
+    limiter: getRateLimiterStats(),
+    phases: results,
+  };
+  console.log(`\nSeed: ${Object.entries(mock.counts).map(([k, v]) => `${k} ${v}`).join(', ')}`);
+  console.log(`Faults: latency ${opts.latency}±${opts.jitter} ms, 429 ${opts.p429 * 100}%, 5xx ${opts.p5xx * 100}%; rate limit ${opts.rps || 'default'} req/s\n`);
+  console.log(`${'phase'.padEnd(24)}${'wall ms'.padStart(10)}${'AMO req'.padStart(9)}${'Kommo req'.padStart(11)}${'req/s'.padStart(8)}${'429'.padStart(6)}${'5xx'.padStart(6)}${'peak heap MB'.padStart(14)}`);
+  for (const r of results) {
+    const inj = (k) => r.requests.amo[k] + r.requests.kommo[k];
+    console.log(
+      `${r.name.padEnd(24)}${r.wallMs.toFixed(0).padStart(10)}${String(r.requests.amo.requests).padStart(9)}` +
+      `${String(r.requests.kommo.requests).padStart(11)}${r.rps.toFixed(1).padStart(8)}${String(inj('injected429')).padStart(6)}` +
+      `${String(inj('injected5xx')).padStart(6)}${mb(r.peakHeap).padStart(14)}` +
+      (r.error ? `  ERROR: ${r.error}` : ''));
+  }
+  const unmocked = results.flatMap((r) => ['amo', 'kommo'].flatMap((crm) =>
+    Object.keys(r.requests[crm].byRoute).filter((k) => k.endsWith('unmocked')).map((k) => `${r.name}: ${crm} ${k}`)));
+  if (unmocked.length) console.log(`\nRequests to endpoints the stand-in does not mock:\n  ${unmocked.join('\n  ')}`);
+  console.log(`\nWork dir: ${dir}`);
+
+  if (opts.json) fs.writeFileSync(path.resolve(__dirname, opts.json), JSON.stringify(report, null, 2));
+
+  let regressed = results.some((r) => r.error);
+  if (opts.baseline) {
+    const prev = JSON.parse(fs.readFileSync(path.resolve(__dirname, opts.baseline), 'utf8'));
+    console.log(`\nvs baseline ${prev.at} (tolerance ${opts.tolerance * 100}%):`);
+    for (const r of results) {
+      const p = prev.phases.find((x) => x.name === r.name);
+      if (!p) continue;
+      const dWall = r.wallMs / p.wallMs - 1;
+      const dHeap = r.peakHeap / p.peakHeap - 1;
+      const bad = dWall > opts.tolerance || dHeap > opts.tolerance;
+      if (bad) regressed = true;
+      console.log(`  ${r.name.padEnd(24)} wall ${(dWall * 100).toFixed(1)}%  heap ${(dHeap * 100).toFixed(1)}%${bad ? '  REGRESSION' : ''}`);
+    }
+  }
+  process.exit(regressed ? 1 : 0);
+}
+
+main().catch((e) => {
+  console.error(e);
+  process.exit(1);
+});
@@ -0,0 +1,78 @@
+// Micro-benchmark: compiled field plans vs per-call mapping interpretation.
+// Synthetic cache of N leads / contacts / companies (default 50000 each), no network / DB.
+//   node bench_transform_fields.js [N]
+const { transformMany, transformCustomFields } = require('./src/utils/dataTransformer');
+
+const N = Number(process.argv[2]) || 50000;
+const FIELDS_PER_ENTITY = 12;
+const TYPES = ['text', 'numeric', 'select', 'multiselect', 'date', 'checkbox', 'url'];
+
+// ── Synthetic mapping: 40 fields, ~10% of entity fields left unmapped ─────────
+function buildMapping(base) {
+  const mapping = {};
+  for (let i = 0; i < 40; i++) {
+    const type = TYPES[i % TYPES.length];
+    const entry = { kommoFieldId: base + 500000 + i, kommoFieldType: type };
+    if (type === 'select' || type === 'multiselect') {
+      entry.enumMap = {};
+      for (let e = 0; e < 8; e++) entry.enumMap[base * 10 + i * 100 + e] = base * 10 + 900000 + i * 100 + e;
+    }
+    mapping[base + i] = entry;
+  }
+  return mapping;
+}
+
+function fieldValues(base, i, type) {
+  switch (type) {
+    case 'select':      return [{ enum_id: base * 10 + i * 100 + (i % 8), value: `opt ${i}` }];
+    case 'multiselect': return [{ enum_id: base * 10 + i * 100 + 1 }, { enum_id: base * 10 + i * 100 + 2 }];
+    case 'date':        return [{ value: 1700000000 + i * 86400 }];
+    case 'checkbox':    return [{ value: i % 2 === 0 }];
+    case 'numeric':     return [{ value: i * 3 }];
+    default:            return [{ value: `value ${i}` }];
+  }
+}
+
+function buildEntities(base, n) {
+  const out = new Array(n);
+  for (let k = 0; k < n; k++) {
+    const cf = [];
+    for (let j = 0; j < FIELDS_PER_ENTITY; j++) {
+      const i = (k + j * 3) % 44; // ids 40..43 are not in the mapping
+      cf.push({ field_id: base + i, field_name: `Field ${i}`, values: fieldValues(base, i, TYPES[i % TYPES.length]) });
+    }
+    out[k] = {
+      id: base * 100 + k,
+      name: `Entity ${k}`,
+      responsible_user_id: 1000 + (k % 5),
+      status_id: 34305358,
+      price: k,
+      custom_fields_values: cf,
+    };
+  }
+  return out;
+}
+
+const userMap = { 1000: 2000, 1001: 2001, 1002: 2002, 1003: 2003 };
+
+function time(label, fn) {
+  const t0 = process.hrtime.bigint();
+  const res = fn();
+  const ms = Number(process.hrtime.bigint() - t0) / 1e6;
+  console.log(`  ${label.padEnd(34)} ${ms.toFixed(1).padStart(9)} ms  (${(N / ms * 1000).toFixed(0)} entities/s)`);
+  return res;
+}
+
+console.log(`Synthetic cache: ${N} entities per type, ${FIELDS_PER_ENTITY} custom fields each\n`);
+for (const [type, base] of [['leads', 700000], ['contacts', 800000], ['companies', 900000]]) {
+  const mapping = buildMapping(base);
+  const items = buildEntities(base, N);
+  console.log(type);
+  // Baseline: a fresh mapping object per entity → the mapping is re-interpreted on every call,
+  // as the per-field path did before plans were compiled
+  time('per-entity mapping interpretation', () =>
+    items.map(it => transformCustomFields(it.custom_fields_values, { ...mapping })));
+  time('compiled plan, transformMany', () =>
+    transformMany(type, items, mapping, userMap, {}));
+  console.log('');
+}
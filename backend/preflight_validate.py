@@ -0,0 +1,566 @@
+#!/usr/bin/env python3
+"""Offline pre-flight check of the Kommo payloads a batch migration would send.
+
+Walks the cached AMO snapshot entity by entity, builds every lead / contact / company /
+task / note payload with the same rules as dataTransformer.js (transformLead,
+transformContact, transformCompany, transformTask) and batchMigrationService.js
+(sanitizeNoteParams, SKIP_NOTE_TYPES, _embedded links, entity_id resolution) and
+reports what Kommo would reject or what would be silently dropped — before any API
+request is spent on it.
+
+Sources (nothing is loaded whole):
+  - AMO snapshot: amo_entities in migration.db (row cursor), or a legacy
+    amo_data_cache.json given with --cache (streamed element by element)
+  - migration index: migration_index in migration.db, or --index migration_index.json
+  - field_mapping.json, stage_mapping.json (backups dir), user_mapping in migration.db
+
+Report (backups/preflight_report.json):
+  { summary: { errors, warnings, checked, skipped, elapsedSec },
+    violations: { entity: { field: { rule: { severity, count, samples: [amo ids] } } } } }
+severity "error" — Kommo rejects the payload; "warning" — value dropped / defaulted.
+
+    python3 preflight_validate.py                      # snapshot from migration.db
+    python3 preflight_validate.py --cache backups/amo_data_cache.json --index backups/migration_index.json
+    python3 preflight_validate.py --details violations.jsonl --strict
+"""
+import argparse
+import json
+import os
+import re
+import sqlite3
+import sys
+import time
+from datetime import datetime, timezone
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+BACKUP_DIR = os.environ.get('BACKUP_DIR') or os.path.join(HERE, 'backups')
+# Same default as src/db/index.js
+DB_PATH = os.environ.get('MIGRATION_DB') or os.path.join(HERE, '..', 'backups', 'migration.db')
+TRANSFORMER_JS = os.path.join(HERE, 'src', 'utils', 'dataTransformer.js')
+BATCH_JS = os.path.join(HERE, 'src', 'services', 'batchMigrationService.js')
+
+# Snapshot entity type → (kind, parent entity type = migration index section of the parent)
+ENTITIES = {
+    'leads':        ('lead', None),
+    'contacts':     ('contact', None),
+    'companies':    ('company', None),
+    'leadTasks':    ('task', 'leads'),
+    'contactTasks': ('task', 'contacts'),
+    'companyTasks': ('task', 'companies'),
+    'leadNotes':    ('note', 'leads'),
+    'contactNotes': ('note', 'contacts'),
+}
+
+# Kommo multitext (phone / email) categories
+ENUM_CODES = {'WORK', 'WORKDD', 'MOB', 'FAX', 'HOME', 'OTHER', 'PRIV'}
+# note_type values Kommo accepts on POST /notes (service_message is sent as common)
+NOTE_TYPES = {'common', 'call_in', 'call_out', 'service_message', 'sms_in', 'sms_out',
+              'message_cashier', 'geolocation', 'extended_service_message', 'attachment'}
+CALL_PARAMS = ('uniq', 'duration', 'source', 'phone')
+INT_RE = re.compile(r'^\d+$')
+PARSE_INT_RE = re.compile(r'\s*[+-]?\d')  # parseInt(x, 10) is not NaN
+
+
+# ─── Streaming JSON ───────────────────────────────────────────────────────────
+class JsonStream:
+    """Buffered JSON reader: containers are walked token by token, values inside them
+    are decoded one at a time, so memory is bounded by the largest single element."""
+    WS = re.compile(r'[ \t\n\r]*')
+    DELIMITERS = ' \t\n\r,:]}'
+
+    def __init__(self, path, chunk=1 << 20):
+        self.f = open(path, 'r', encoding='utf-8-sig')
+        self.chunk = chunk
+        self.buf = ''
+        self.pos = 0
+        self.eof = False
+        self.decoder = json.JSONDecoder()
+
+    def close(self):
+        self.f.close()
+
+    def _fill(self):
+        data = self.f.read(self.chunk)
+        if not data:
+            self.eof = True
+            return False
+        self.buf = self.buf[self.pos:] + data
+        self.pos = 0
+        return True
+
+    def peek(self):
+        while True:
+            self.pos = self.WS.match(self.buf, self.pos).end()
+            if self.pos < len(self.buf):
+                return self.buf[self.pos]
+            if not self._fill():
+                return ''
+
+    def _expect(self, ch):
+        c = self.peek()
+        if c != ch:
+            raise ValueError(f'{self.f.name}: expected {ch!r}, got {c!r}')
+        self.pos += 1
+
+    def value(self):
+        """Decode the next complete value."""
+        self.peek()
+        while True:
+            try:
+                val, end = self.decoder.raw_decode(self.buf, self.pos)
+                # A number cut at the buffer edge ("2." of "2.5") still decodes — accept the
+                # value only when a delimiter follows it
+                if self.eof or (end < len(self.buf) and self.buf[end] in self.DELIMITERS):
+                    self.pos = end
+                    return val
+            except json.JSONDecodeError:
+                if self.eof:
+                    raise
+            self._fill()
+
+    def skip(self):
+        c = self.peek()
+        if c == '[':
+            for _ in self.elements():
+                pass
+        elif c == '{':
+            for _ in self.items():
+                self.skip()
+        else:
+            self.value()
+
+    def _next_member(self, close):
+        c = self.peek()
+        self.pos += 1
+        if c == close:
+            return False
+        if c != ',':
+            raise ValueError(f'{self.f.name}: expected "," or {close!r}, got {c!r}')
+        return True
+
+    def elements(self):
+        """Array elements, decoded one by one."""
+        self._expect('[')
+        if self.peek() == ']':
+            self.pos += 1
+            return
+        while True:
+            yield self.value()
+            if not self._next_member(']'):
+                return
+
+    def items(self):
+        """Object keys; the caller consumes each value (value / elements / items / skip)."""
+        self._expect('{')
+        if self.peek() == '}':
+            self.pos += 1
+            return
+        while True:
+            key = self.value()
+            self._expect(':')
+            yield key
+            if not self._next_member('}'):
+                return
+
+
+def stream_object(path):
+    """{ key: value } of a JSON object file, one member at a time."""
+    s = JsonStream(path)
+    try:
+        for key in s.items():
+            yield key, s.value()
+    finally:
+        s.close()
+
+
+# ─── Rules shared with the JS code ────────────────────────────────────────────
+def read_js_rules():
+    """AMO_TO_KOMMO_TASK_TYPE and SKIP_NOTE_TYPES straight from the JS sources, so both
+    sides can't drift apart."""
+    with open(TRANSFORMER_JS, encoding='utf-8') as f:
+        m = re.search(r'const AMO_TO_KOMMO_TASK_TYPE = \{(.*?)\};', f.read(), re.S)
+    if not m:
+        raise SystemExit(f'AMO_TO_KOMMO_TASK_TYPE not found in {TRANSFORMER_JS}')
+    task_types = {int(a): int(b) for a, b in re.findall(r'(\d+)\s*:\s*(\d+)', m.group(1))}
+
+    with open(BATCH_JS, encoding='utf-8') as f:
+        m = re.search(r'const SKIP_NOTE_TYPES = new Set\(\[(.*?)\]\);', f.read(), re.S)
+    if not m:
+        raise SystemExit(f'SKIP_NOTE_TYPES not found in {BATCH_JS}')
+    skip_notes = set()
+    for tok in m.group(1).split(','):
+        tok = tok.strip()
+        if tok:
+            skip_notes.add(int(tok) if tok.isdigit() else tok.strip('\'"'))
+    return task_types, skip_notes
+
+
+def is_int(v):
+    return isinstance(v, int) and not isinstance(v, bool)
+
+
+def int_like(v):
+    return is_int(v) or (isinstance(v, str) and bool(INT_RE.match(v)))
+
+
+def to_kommo_iso(raw):
+    """toKommoIso(): unix seconds (number / digit string) or a date string → ISO, None if invalid."""
+    try:
+        if isinstance(raw, (int, float)) and not isinstance(raw, bool):
+            return datetime.fromtimestamp(int(raw), timezone.utc).isoformat()
+        s = str(raw).strip()
+        if INT_RE.match(s):
+            return datetime.fromtimestamp(int(s), timezone.utc).isoformat()
+        return datetime.fromisoformat(s.replace('Z', '+00:00')).isoformat()
+    except (ValueError, OverflowError, OSError):
+        return None
+
+
+# ─── Report ───────────────────────────────────────────────────────────────────
+class Report:
+    def __init__(self, samples, details_path=None):
+        self.samples = samples
+        self.violations = {}
+        self.errors = 0
+        self.warnings = 0
+        self.checked = {}
+        self.skipped = {}
+        self.details = open(details_path, 'w', encoding='utf-8') if details_path else None
+
+    def add(self, entity, field, rule, severity, amo_id, detail=None):
+        rules = self.violations.setdefault(entity, {}).setdefault(field, {})
+        r = rules.get(rule)
+        if r is None:
+            r = rules[rule] = {'severity': severity, 'count': 0, 'samples': []}
+        r['count'] += 1
+        if len(r['samples']) < self.samples:
+            r['samples'].append(amo_id)
+        if severity == 'error':
+            self.errors += 1
+        else:
+            self.warnings += 1
+        if self.details:
+            self.details.write(json.dumps({'entity': entity, 'field': field, 'rule': rule, 'severity': severity,
+                                           'amoId': amo_id, 'detail': detail}, ensure_ascii=False) + '\n')
+
+    def close(self):
+        if self.details:
+            self.details.close()
+
+
+# ─── Validator ────────────────────────────────────────────────────────────────
+class Validator:
+    def __init__(self, report, field_mapping, stage_mapping, user_map, index, kommo_pipeline_id, task_types, skip_notes):
+        self.r = report
+        self.field_mapping = field_mapping
+        self.stage_mapping = stage_mapping
+        self.user_map = user_map
+        self.index = index  # { 'leads' | 'contacts' | 'companies': { amo id str: kommo id str } }
+        self.kommo_pipeline_id = kommo_pipeline_id
+        self.task_types = task_types
+        self.skip_notes = skip_notes
+        # Resolved after the pass — the snapshot may list children before their parents
+        self.ids = {'leads': set(), 'contacts': set(), 'companies': set()}
+        self.owner = {'leads': {}, 'contacts': {}, 'companies': {}}  # parent id → AMO responsible
+        self.links = []    # (lead id, 'contacts' | 'companies', linked id)
+        self.children = []  # (entity type, amo id, parent type, parent id, responsible mapped)
+
+    def check_index(self):
+        for section, pairs in self.index.items():
+            for amo_id, kommo_id in pairs.items():
+                if not INT_RE.match(str(kommo_id)):
+                    self.r.add('index', section, 'kommo_id_not_int', 'error', amo_id, kommo_id)
+
+    def mapped_user(self, uid):
+        return uid is not None and (uid in self.user_map or str(uid) in self.user_map)
+
+    # transformCustomFields() — compiled plan, one converter per mapped AMO field
+    def check_fields(self, entity, amo_id, cfv):
+        mapping = self.field_mapping.get(entity) or {}
+        for field in cfv or []:
+            fid = field.get('field_id')
+            key = f'custom_fields_values[{fid}]'
+            mapped = mapping.get(str(fid))
+            if not mapped:
+                self.r.add(entity, key, 'field_unmapped', 'warning', amo_id)
+                continue
+            if not int_like(mapped.get('kommoFieldId')):
+                self.r.add(entity, key, 'kommo_field_id_invalid', 'error', amo_id, mapped.get('kommoFieldId'))
+                continue
+            k_type = mapped.get('kommoFieldType') or mapped.get('amoFieldType') or mapped.get('fieldType') or 'text'
+            enum_map = mapped.get('enumMap') or {}
+            values = field.get('values') or []
+            if k_type in ('select', 'radiobutton', 'multiselect'):
+                missing = [v.get('enum_id') for v in values if not enum_map.get(str(v.get('enum_id')))]
+                if missing and (k_type == 'multiselect' or len(missing) == len(values)):
+                    self.r.add(entity, key, 'enum_unmapped', 'warning', amo_id, missing)
+            elif k_type == 'multitext':
+                for v in values:
+                    code = v.get('enum_code')
+                    if v.get('value') and code and code not in ENUM_CODES:
+                        self.r.add(entity, key, 'enum_code_invalid', 'error', amo_id, code)
+            elif k_type in ('birthday', 'date', 'date_time'):
+                for v in values:
+                    if v.get('value') not in (None, '') and to_kommo_iso(v['value']) is None:
+                        self.r.add(entity, key, 'date_invalid', 'warning', amo_id, v['value'])
+            elif k_type == 'numeric':
+                for v in values:
+                    val = v.get('value')
+                    if val in (None, '', False):
+                        continue
+                    try:
+                        float(str(val).replace(',', '.') if isinstance(val, str) else val)
+                    except (TypeError, ValueError):
+                        self.r.add(entity, key, 'numeric_invalid', 'error', amo_id, val)
+
+    def check_main(self, entity, item):
+        amo_id = item.get('id')
+        if not is_int(amo_id):
+            self.r.add(entity, 'id', 'id_not_int', 'error', amo_id)
+            return
+        self.ids[entity].add(amo_id)
+        uid = item.get('responsible_user_id')
+        self.owner[entity][amo_id] = uid
+        if uid and not self.mapped_user(uid):
+            self.r.add(entity, 'responsible_user_id', 'user_unmapped', 'warning', amo_id, uid)
+        name = item.get('name')
+        if name is not None and not isinstance(name, str):
+            self.r.add(entity, 'name', 'not_string', 'error', amo_id, name)
+        self.check_fields(entity, amo_id, item.get('custom_fields_values'))
+
+        if entity != 'leads':
+            return
+        # transformLead(): status via stage mapping, price as is, pipeline from _pipeline / env
+        status = item.get('status_id')
+        if not self.stage_mapping.get(str(status)):
+            self.r.add(entity, 'status_id', 'status_unmapped', 'warning', amo_id, status)
+        price = item.get('price')
+        if price and not is_int(price):
+            self.r.add(entity, 'price', 'price_not_int', 'error', amo_id, price)
+        emb = item.get('_embedded') or {}
+        for rel in ('contacts', 'companies'):
+            for link in emb.get(rel) or []:
+                self.links.append((amo_id, rel, link.get('id')))
+
+    def check_task(self, entity, parent_type, task):
+        amo_id = task.get('id')
+        if task.get('is_completed'):
+            self.r.skipped[entity] = self.r.skipped.get(entity, 0) + 1
+            return
+        parent_id = task.get('entity_id')
+        if not int_like(parent_id):
+            self.r.add(entity, 'entity_id', 'entity_id_not_int', 'error', amo_id, parent_id)
+            return
+        # transformTask(): complete_till > 0 is passed through as is, otherwise tomorrow
+        till = task.get('complete_till')
+        if not till or (is_int(till) and till <= 0):
+            self.r.add(entity, 'complete_till', 'complete_till_defaulted', 'warning', amo_id, till)
+        elif not is_int(till):
+            self.r.add(entity, 'complete_till', 'complete_till_not_int', 'error', amo_id, till)
+        type_id = task.get('task_type_id')
+        if not int_like(type_id) or int(type_id) not in self.task_types:
+            self.r.add(entity, 'task_type_id', 'task_type_defaulted', 'warning', amo_id, type_id)
+        result = task.get('result')
+        if result is not None and not isinstance(result, (dict, str)):
+            self.r.add(entity, 'result', 'result_invalid', 'error', amo_id, result)
+        self.children.append((entity, amo_id, parent_type, int(parent_id), self.mapped_user(task.get('responsible_user_id'))))
+
+    def check_note(self, entity, parent_type, note):
+        amo_id = note.get('id')
+        note_type = note.get('note_type')
+        if note_type in self.skip_notes:
+            self.r.skipped[entity] = self.r.skipped.get(entity, 0) + 1
+            return
+        parent_id = note.get('entity_id')
+        if not int_like(parent_id):
+            self.r.add(entity, 'entity_id', 'entity_id_not_int', 'error', amo_id, parent_id)
+            return
+        if note_type not in NOTE_TYPES:
+            self.r.add(entity, 'note_type', 'note_type_unsupported', 'error', amo_id, note_type)
+        # sanitizeNoteParams(): nulls dropped, duration → int, service_message → common
+        params = note.get('params')
+        if not isinstance(params, dict):
+            params = {}
+        params = {k: v for k, v in params.items() if v is not None}
+        if note_type in ('common', 'service_message') and not (isinstance(params.get('text'), str) and params['text'].strip()):
+            self.r.add(entity, 'params.text', 'text_empty', 'error', amo_id)
+        if note_type in ('call_in', 'call_out'):
+            for p in CALL_PARAMS:
+                if p not in params:
+                    self.r.add(entity, f'params.{p}', 'call_param_missing', 'error', amo_id)
+        if 'duration' in params and not PARSE_INT_RE.match(str(params['duration'])):
+            self.r.add(entity, 'params.duration', 'duration_zeroed', 'warning', amo_id, params['duration'])
+        self.children.append((entity, amo_id, parent_type, int(parent_id), True))
+
+    def check(self, entity, item):
+        kind, parent_type = ENTITIES[entity]
+        self.r.checked[entity] = self.r.checked.get(entity, 0) + 1
+        if not isinstance(item, dict):
+            self.r.add(entity, '(record)', 'not_object', 'error', None)
+        elif kind == 'task':
+            self.check_task(entity, parent_type, item)
+        elif kind == 'note':
+            self.check_note(entity, parent_type, item)
+        else:
+            self.check_main(entity, item)
+
+    def resolve(self):
+        """Checks that need the whole snapshot: links and parents (snapshot or index)."""
+        if not int_like(self.kommo_pipeline_id):
+            self.r.add('leads', 'pipeline_id', 'pipeline_missing', 'error', None, self.kommo_pipeline_id)
+
+        def kommo_id(section, amo_id):
+            return self.index.get(section, {}).get(str(amo_id))
+
+        # Lead _embedded links — a link to a record neither in the snapshot nor migrated is dropped
+        for lead_id, rel, linked in self.links:
+            if linked not in self.ids[rel] and not kommo_id(rel, linked):
+                self.r.add('leads', f'_embedded.{rel}', 'link_unresolved', 'warning', lead_id, linked)
+
+        for entity, amo_id, parent_type, parent_id, user_ok in self.children:
+            if parent_id not in self.ids[parent_type]:
+                # Not in the snapshot: never reaches a batch (task / note is lost)
+                if not kommo_id(parent_type, parent_id):
+                    self.r.add(entity, 'entity_id', 'parent_unresolved', 'warning', amo_id, parent_id)
+                continue
+            # transformTask(): unmapped responsible falls back to the parent's manager
+            if not user_ok and not self.mapped_user(self.owner[parent_type].get(parent_id)):
+                self.r.add(entity, 'responsible_user_id', 'user_unmapped', 'warning', amo_id)
+
+
+# ─── Sources ──────────────────────────────────────────────────────────────────
+def open_db(path):
+    if not path or not os.path.exists(path):
+        return None
+    conn = sqlite3.connect(f'file:{path}?mode=ro', uri=True)
+    tables = {r[0] for r in conn.execute("SELECT name FROM sqlite_master WHERE type='table'")}
+    return conn, tables
+
+
+def load_json_small(path, default):
+    if not path or not os.path.exists(path):
+        return default
+    return dict(stream_object(path))
+
+
+def load_index(args, db):
+    sections = ('leads', 'contacts', 'companies')
+    index = {s: {} for s in sections}
+    if args.index:
+        s = JsonStream(args.index)
+        try:
+            for section in s.items():
+                if section in index:
+                    for amo_id in s.items():
+                        index[section][amo_id] = str(s.value())
+                else:
+                    s.skip()
+        finally:
+            s.close()
+    elif db and 'migration_index' in db[1]:
+        cur = db[0].execute("SELECT entity, amo_id, kommo_id FROM migration_index WHERE entity IN ('leads', 'contacts', 'companies')")
+        for entity, amo_id, kommo_id in cur:
+            index[entity][amo_id] = kommo_id
+    return index
+
+
+def load_user_map(db):
+    if not db or 'user_mapping' not in db[1]:
+        return {}
+    return {str(a): k for a, k in db[0].execute('SELECT amo_user_id, kommo_user_id FROM user_mapping') if k}
+
+
+def iter_snapshot(args, db):
+    """(entity type, record) pairs in snapshot order."""
+    if args.cache:
+        s = JsonStream(args.cache)
+        try:
+            for key in s.items():
+                if key in ENTITIES and s.peek() == '[':
+                    for item in s.elements():
+                        yield key, item
+                else:
+                    s.skip()
+        finally:
+            s.close()
+        return
+    if not db or 'amo_entities' not in db[1]:
+        raise SystemExit('No AMO snapshot: migration.db has no amo_entities — load data first or pass --cache')
+    for entity in ENTITIES:
+        cur = db[0].execute('SELECT data FROM amo_entities WHERE entity_type=? ORDER BY id', (entity,))
+        for (data,) in cur:
+            yield entity, json.loads(data)
+
+
+def main():
+    ap = argparse.ArgumentParser(description='Offline pre-flight validation of Kommo payloads over the cached AMO snapshot.')
+    ap.add_argument('--db', default=DB_PATH, help='migration.db (snapshot, migration index, user mapping)')
+    ap.add_argument('--cache', help='legacy amo_data_cache.json instead of amo_entities')
+    ap.add_argument('--index', help='legacy migration_index.json instead of the migration_index table')
+    ap.add_argument('--field-mapping', default=os.path.join(BACKUP_DIR, 'field_mapping.json'))
+    ap.add_argument('--stage-mapping', default=os.path.join(BACKUP_DIR, 'stage_mapping.json'))
+    ap.add_argument('--out', default=os.path.join(BACKUP_DIR, 'preflight_report.json'))
+    ap.add_argument('--details', help='also write every violation as JSON lines to this file')
+    ap.add_argument('--samples', type=int, default=20, help='AMO ids kept per rule (default 20)')
+    ap.add_argument('--strict', action='store_true', help='exit code 1 if any error-level violation is found')
+    args = ap.parse_args()
+
+    started = time.time()
+    db = open_db(args.db)
+    task_types, skip_notes = read_js_rules()
+    stage_mapping = load_json_small(args.stage_mapping, {})
+    pipeline = stage_mapping.get('_pipeline') or {}
+    report = Report(args.samples, args.details)
+    v = Validator(
+        report,
+        field_mapping=load_json_small(args.field_mapping, {}),
+        stage_mapping=stage_mapping,
+        user_map=load_user_map(db),
+        index=load_index(args, db),
+        kommo_pipeline_id=pipeline.get('kommo') or os.environ.get('KOMMO_PIPELINE_ID'),
+        task_types=task_types,
+        skip_notes=skip_notes,
+    )
+    if not v.field_mapping:
+        report.add('mapping', 'field_mapping.json', 'missing', 'warning', None, args.field_mapping)
+
+    v.check_index()
+    for entity, item in iter_snapshot(args, db):
+        v.check(entity, item)
+    v.resolve()
+    report.close()
+
+    elapsed = round(time.time() - started, 2)
+    out = {
+        'generatedAt': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+        'sources': {
+            'snapshot': args.cache or args.db,
+            'index': args.index or args.db,
+            'fieldMapping': args.field_mapping,
+            'stageMapping': args.stage_mapping,
+        },
+        'summary': {
+            'errors': report.errors,
+            'warnings': report.warnings,
+            'checked': report.checked,
+            'skipped': report.skipped,
+            'elapsedSec': elapsed,
+        },
+        'violations': report.violations,
+    }
+    os.makedirs(os.path.dirname(os.path.abspath(args.out)), exist_ok=True)
+    with open(args.out, 'w', encoding='utf-8') as f:
+        json.dump(out, f, ensure_ascii=False, indent=2)
+
+    print(f"Checked {sum(report.checked.values())} records in {elapsed}s: "
+          f"{report.errors} errors, {report.warnings} warnings → {args.out}")
+    for entity, fields in report.violations.items():
+        for field, rules in fields.items():
+            for rule, r in rules.items():
+                print(f"  [{r['severity']}] {entity}.{field}: {rule} ×{r['count']}")
+    if args.strict and report.errors:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
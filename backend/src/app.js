@@ -19,6 +19,9 @@ const cors = require('cors');
 const fs = require('fs-extra');
 const config = require('./config');
 const logger = require('./utils/logger');
+const { getRateLimiterStats } = require('./utils/rateLimiter');
+const metrics = require('./utils/metrics');
+const { getTransportStats } = require('./utils/crmTransport');
 
 const migrationRoutes = require('./routes/migration');
 const pipelineRoutes  = require('./routes/pipelines');
@@ -80,9 +83,16 @@ app.get('/api/health', (req, res) => {
     timestamp: new Date().toISOString(),
     amo: { baseUrl: config.amo.baseUrl, pipelineId: config.amo.pipelineId },
     kommo: { baseUrl: config.kommo.baseUrl, pipelineId: config.kommo.pipelineId },
+    rateLimits: getRateLimiterStats(),
+    transport: getTransportStats(),
   });
 });
 
+// Prometheus scrape endpoint — CRM request latency, throttle waits, retries, phase spans
+app.get('/api/metrics', (req, res) => {
+  res.type('text/plain; version=0.0.4').send(metrics.render());
+});
+
 // Global error handler
 app.use((err, req, res, next) => {
   logger.error(`Unhandled error: ${err.message}`, { stack: err.stack });
@@ -92,6 +102,23 @@ app.use((err, req, res, next) => {
   });
 });
 
+// Graceful shutdown — a signal kills the process without 'exit', so buffered writes
+// (session log, migration counters, blocked attempts) are flushed here, once
+for (const [signal, code] of [['SIGTERM', 143], ['SIGINT', 130]]) {
+  process.once(signal, () => {
+    logger.info(`${signal} received, flushing buffers`);
+    const flushers = [
+      ['session log', () => require('./db').flushLog()],
+      ['migration counters', () => require('./utils/migrationCounters').flush()],
+      ['blocked attempts', () => require('./utils/safetyGuard').flushBlockedAttempts(true)],
+    ];
+    for (const [name, flush] of flushers) {
+      try { flush(); } catch (e) { console.error(`[shutdown] Cannot flush ${name}:`, e.message); }
+    }
+    process.exit(code);
+  });
+}
+
 app.listen(config.port, () => {
   logger.info(`CRM Migration Server started on port ${config.port}`);
   logger.info(`AMO: ${config.amo.baseUrl} pipeline ${config.amo.pipelineId}`);
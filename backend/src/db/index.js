@@ -1,12 +1,16 @@
 /**
  * SQLite database for session management and ID mapping.
- * Stores: sessions, id_mapping, amo_cache, session_log, stage_mapping, user_mapping
+ * Stores: sessions, id_mapping, amo_cache, session_log, stage_mapping, user_mapping,
+ * amo_entities (AMO snapshot for batch migration — replaces amo_data_cache.json) + amo_entity_links,
+ * migration_index (safetyGuard dedup index AMO id → Kommo id — replaces migration_index.json)
  */
 const Database = require('better-sqlite3');
 const path = require('path');
 const fs = require('fs-extra');
+const logger = require('../utils/logger');
 
-const DB_PATH = path.join(__dirname, '../../../backups/migration.db');
+// MIGRATION_DB — separate database file (offline benchmark, bench_migration.js)
+const DB_PATH = process.env.MIGRATION_DB || path.join(__dirname, '../../../backups/migration.db');
 fs.ensureDirSync(path.dirname(DB_PATH));
 
 const db = new Database(DB_PATH);
@@ -96,6 +100,71 @@ db.exec(`
     updated_at        TEXT DEFAULT (datetime('now'))
   );
 
+  -- AMO snapshot for batch migration (one row per cached entity, insertion order = id)
+  CREATE TABLE IF NOT EXISTS amo_entities (
+    id                  INTEGER PRIMARY KEY AUTOINCREMENT,
+    entity_type         TEXT NOT NULL,
+    -- leads | contacts | companies | leadTasks | contactTasks | companyTasks | leadNotes | contactNotes
+    amo_id              INTEGER NOT NULL,
+    entity_id           INTEGER,
+    responsible_user_id INTEGER,
+    pipeline_id         INTEGER,
+    status_id           INTEGER,
+    note_type           TEXT,
+    name_lc             TEXT,
+    data                TEXT NOT NULL,
+    UNIQUE(entity_type, amo_id)
+  );
+
+  -- Lead → contact/company links from the snapshot (rebuilt with amo_entities)
+  CREATE TABLE IF NOT EXISTS amo_entity_links (
+    lead_id  INTEGER NOT NULL,
+    rel_type TEXT NOT NULL,   -- contacts | companies
+    rel_id   INTEGER NOT NULL,
+    PRIMARY KEY (lead_id, rel_type, rel_id)
+  );
+
+  CREATE TABLE IF NOT EXISTS amo_entities_meta (
+    id   INTEGER PRIMARY KEY CHECK (id = 1),
+    data TEXT NOT NULL
+  );
+
+  -- Permanent dedup index (safetyGuard): one row per migrated AMO object, append-only
+  CREATE TABLE IF NOT EXISTS migration_index (
+    entity     TEXT NOT NULL,
+    -- leads | contacts | companies | tasks_leads | tasks_contacts | tasks_companies | notes_leads | ...
+    amo_id     TEXT NOT NULL,
+    kommo_id   TEXT NOT NULL,
+    created_at TEXT NOT NULL DEFAULT (datetime('now')),
+    PRIMARY KEY (entity, amo_id)
+  );
+
+  -- Records Kommo rejected on create (400), kept with the payload for a later retry
+  CREATE TABLE IF NOT EXISTS kommo_quarantine (
+    entity     TEXT NOT NULL,             -- leads | contacts | companies
+    amo_id     TEXT NOT NULL,
+    payload    TEXT NOT NULL,             -- Kommo create payload (JSON)
+    error      TEXT,                      -- Kommo validation errors (JSON)
+    attempts   INTEGER NOT NULL DEFAULT 1,
+    created_at TEXT NOT NULL DEFAULT (datetime('now')),
+    updated_at TEXT NOT NULL DEFAULT (datetime('now')),
+    PRIMARY KEY (entity, amo_id)
+  );
+
+  -- Migrated entities changed in AMO since (delta sync), until a fix pass handles them.
+  -- Outside the snapshot meta: a full fetch replaces the snapshot, not the need to fix
+  CREATE TABLE IF NOT EXISTS amo_needs_fix (
+    entity     TEXT NOT NULL,             -- leads | contacts | companies
+    amo_id     INTEGER NOT NULL,
+    flagged_at TEXT NOT NULL DEFAULT (datetime('now')),
+    PRIMARY KEY (entity, amo_id)
+  );
+
+  CREATE INDEX IF NOT EXISTS idx_migration_index_kommo ON migration_index(entity, kommo_id);
+  CREATE INDEX IF NOT EXISTS idx_amo_entities_entity ON amo_entities(entity_type, entity_id);
+  CREATE INDEX IF NOT EXISTS idx_amo_entities_resp ON amo_entities(entity_type, responsible_user_id);
+  CREATE INDEX IF NOT EXISTS idx_amo_entities_status ON amo_entities(entity_type, pipeline_id, status_id);
+  CREATE INDEX IF NOT EXISTS idx_amo_entity_links_rel ON amo_entity_links(rel_type, rel_id);
   CREATE INDEX IF NOT EXISTS idx_id_mapping_session ON id_mapping(session_id);  
   CREATE INDEX IF NOT EXISTS idx_id_mapping_amo ON id_mapping(session_id, entity_type, amo_id);
   CREATE INDEX IF NOT EXISTS idx_amo_cache_session ON amo_cache(session_id, entity_type);
@@ -149,6 +218,10 @@ const rollbackAllMappings = db.prepare(
   `UPDATE id_mapping SET status='rolled_back' WHERE session_id=? AND status='created'`
 );
 
+const rollbackMappingByKommoStmt = db.prepare(
+  `UPDATE id_mapping SET status='rolled_back' WHERE session_id=? AND entity_type=? AND kommo_id=?`
+);
+
 const getLastCreatedMappingStmt = db.prepare(
   `SELECT * FROM id_mapping WHERE session_id=? AND entity_type=? AND status='created' ORDER BY id DESC LIMIT 1`
 );
@@ -161,6 +234,10 @@ const getMappingsCreatedAfterStmt = db.prepare(
   `SELECT * FROM id_mapping WHERE session_id=? AND entity_type=? AND id > ? AND status='created'`
 );
 
+const countMappingsByStatusStmt = db.prepare(
+  'SELECT status, COUNT(*) AS cnt FROM id_mapping WHERE session_id=? AND entity_type=? GROUP BY status'
+);
+
 // ─── AMO Cache ───────────────────────────────────────────────────────────────
 const insertCache = db.prepare(`
   INSERT OR REPLACE INTO amo_cache (session_id, entity_type, amo_id, data)
@@ -179,6 +256,97 @@ const countCacheByType = db.prepare(
   'SELECT COUNT(*) as cnt FROM amo_cache WHERE session_id=? AND entity_type=?'
 );
 
+// Keyset page of cached entities with their mapping (c.id = cursor)
+const getCachePageStmt = db.prepare(`
+  SELECT c.id AS cursor, c.data, m.status, m.kommo_id, m.error_msg
+  FROM amo_cache c
+  LEFT JOIN id_mapping m
+    ON m.session_id = c.session_id AND m.entity_type = c.entity_type AND m.amo_id = c.amo_id
+  WHERE c.session_id=? AND c.entity_type=? AND c.id > ?
+  ORDER BY c.id LIMIT ?
+`);
+
+// SQLite lower() folds ASCII only — Cyrillic names need JS toLowerCase
+db.function('lower_u', { deterministic: true }, (s) => (s == null ? null : String(s).toLowerCase()));
+
+// Same page filtered by a substring of the name or the AMO id
+const searchCachePageStmt = db.prepare(`
+  SELECT c.id AS cursor, c.data, m.status, m.kommo_id, m.error_msg
+  FROM amo_cache c
+  LEFT JOIN id_mapping m
+    ON m.session_id = c.session_id AND m.entity_type = c.entity_type AND m.amo_id = c.amo_id
+  WHERE c.session_id=? AND c.entity_type=? AND c.id > ?
+    AND (instr(lower_u(json_extract(c.data, '$.name')), ?) > 0 OR instr(CAST(c.amo_id AS TEXT), ?) > 0)
+  ORDER BY c.id LIMIT ?
+`);
+
+// ─── AMO Entity Store ────────────────────────────────────────────────────────
+const AMO_ENTITY_TYPES = [
+  'leads', 'contacts', 'companies',
+  'leadTasks', 'contactTasks', 'companyTasks',
+  'leadNotes', 'contactNotes',
+];
+
+const insertAmoEntity = db.prepare(`
+  INSERT OR REPLACE INTO amo_entities
+    (entity_type, amo_id, entity_id, responsible_user_id, pipeline_id, status_id, note_type, name_lc, data)
+  VALUES (@entity_type, @amo_id, @entity_id, @responsible_user_id, @pipeline_id, @status_id, @note_type, @name_lc, @data)
+`);
+// Delta merge: update in place so existing rows keep their position (id), new rows append
+const upsertAmoEntityStmt = db.prepare(`
+  INSERT INTO amo_entities
+    (entity_type, amo_id, entity_id, responsible_user_id, pipeline_id, status_id, note_type, name_lc, data)
+  VALUES (@entity_type, @amo_id, @entity_id, @responsible_user_id, @pipeline_id, @status_id, @note_type, @name_lc, @data)
+  ON CONFLICT(entity_type, amo_id) DO UPDATE SET
+    entity_id=excluded.entity_id, responsible_user_id=excluded.responsible_user_id,
+    pipeline_id=excluded.pipeline_id, status_id=excluded.status_id, note_type=excluded.note_type,
+    name_lc=excluded.name_lc, data=excluded.data
+`);
+const countAmoByTypeStmt = db.prepare('SELECT entity_type, COUNT(*) AS cnt FROM amo_entities GROUP BY entity_type');
+const deleteLeadLinksStmt = db.prepare('DELETE FROM amo_entity_links WHERE lead_id = ?');
+const clearAmoEntitiesStmt = db.prepare('DELETE FROM amo_entities');
+const getAmoMetaStmt = db.prepare('SELECT data FROM amo_entities_meta WHERE id = 1');
+const upsertAmoMetaStmt = db.prepare(`
+  INSERT INTO amo_entities_meta (id, data) VALUES (1, ?)
+  ON CONFLICT(id) DO UPDATE SET data=excluded.data
+`);
+const insertAmoLinkStmt = db.prepare('INSERT OR IGNORE INTO amo_entity_links (lead_id, rel_type, rel_id) VALUES (?, ?, ?)');
+const clearAmoLinksStmt = db.prepare('DELETE FROM amo_entity_links');
+const countAmoLinksStmt = db.prepare('SELECT COUNT(*) FROM amo_entity_links').pluck();
+const countAmoLeadsStmt = db.prepare("SELECT COUNT(*) FROM amo_entities WHERE entity_type='leads'").pluck();
+const allAmoLeadsStmt = db.prepare("SELECT data FROM amo_entities WHERE entity_type='leads'").pluck();
+const countAmoByRespStmt = db.prepare(
+  'SELECT responsible_user_id AS uid, COUNT(*) AS cnt FROM amo_entities WHERE entity_type=? GROUP BY responsible_user_id'
+);
+const countAmoByPipelineStmt = db.prepare(
+  'SELECT pipeline_id AS pipelineId, COUNT(*) AS cnt FROM amo_entities WHERE entity_type=? GROUP BY pipeline_id'
+);
+
+// ─── Migration Index ─────────────────────────────────────────────────────────
+const upsertIndexPairStmt = db.prepare(`
+  INSERT INTO migration_index (entity, amo_id, kommo_id) VALUES (?, ?, ?)
+  ON CONFLICT(entity, amo_id) DO UPDATE SET kommo_id=excluded.kommo_id
+`);
+const getAllIndexPairsStmt = db.prepare('SELECT entity, amo_id, kommo_id FROM migration_index');
+const deleteIndexPairStmt = db.prepare('DELETE FROM migration_index WHERE entity=? AND amo_id=?');
+const clearIndexStmt = db.prepare('DELETE FROM migration_index');
+const countIndexStmt = db.prepare('SELECT COUNT(*) FROM migration_index').pluck();
+
+// ─── Kommo Quarantine ────────────────────────────────────────────────────────
+const upsertQuarantineStmt = db.prepare(`
+  INSERT INTO kommo_quarantine (entity, amo_id, payload, error) VALUES (?, ?, ?, ?)
+  ON CONFLICT(entity, amo_id) DO UPDATE SET
+    payload=excluded.payload, error=excluded.error,
+    attempts=attempts + 1, updated_at=datetime('now')
+`);
+const deleteQuarantineStmt = db.prepare('DELETE FROM kommo_quarantine WHERE entity=? AND amo_id=?');
+const countQuarantineStmt = db.prepare('SELECT entity, COUNT(*) AS cnt FROM kommo_quarantine GROUP BY entity');
+
+// ─── Needs Fix ───────────────────────────────────────────────────────────────
+const insertNeedsFixStmt = db.prepare('INSERT OR IGNORE INTO amo_needs_fix (entity, amo_id) VALUES (?, ?)');
+const deleteNeedsFixStmt = db.prepare('DELETE FROM amo_needs_fix WHERE entity=? AND amo_id=?');
+const listNeedsFixStmt = db.prepare('SELECT entity, amo_id FROM amo_needs_fix ORDER BY entity, amo_id');
+
 // ─── Session Log ─────────────────────────────────────────────────────────────
 const insertLog = db.prepare(`
   INSERT INTO session_log (session_id, level, message, details)
@@ -189,6 +357,11 @@ const getSessionLog = db.prepare(
   'SELECT * FROM session_log WHERE session_id=? ORDER BY id DESC LIMIT ?'
 );
 
+// Keyset page, newest first: rows older than the cursor (idx_session_log covers session_id + rowid)
+const getSessionLogBeforeStmt = db.prepare(
+  'SELECT * FROM session_log WHERE session_id=? AND id < ? ORDER BY id DESC LIMIT ?'
+);
+
 // ─── Stage Mapping ───────────────────────────────────────────────────────────
 const upsertStageMapping = db.prepare(`
   INSERT INTO stage_mapping (amo_pipeline_id, kommo_pipeline_id, amo_stage_id, kommo_stage_id, amo_stage_name, kommo_stage_name)
@@ -242,13 +415,56 @@ const getUserMappingByAmo = db.prepare('SELECT * FROM user_mapping WHERE amo_use
 const deleteUserMapping = db.prepare('DELETE FROM user_mapping WHERE amo_user_id=?');
 
 // ─── Exported helpers ────────────────────────────────────────────────────────
+// Session log is write-behind: lines are buffered and inserted in one transaction
+// every LOG_FLUSH_ROWS lines or LOG_FLUSH_MS — not one synchronous commit per line
+// in the middle of a copy. Reads flush first, so a reader always sees every line.
+const LOG_FLUSH_ROWS = 200;
+const LOG_FLUSH_MS = 500;
+let logBuffer = [];
+let logTimer = null;
+
+const insertLogs = db.transaction((rows) => {
+  for (const row of rows) insertLog.run(row);
+});
+
+function flushLog() {
+  if (logTimer) { clearTimeout(logTimer); logTimer = null; }
+  if (logBuffer.length === 0) return;
+  const batch = logBuffer;
+  logBuffer = [];
+  try {
+    insertLogs(batch);
+  } catch (e) {
+    // one bad row (e.g. unknown session_id) must not drop the whole batch
+    for (const row of batch) {
+      try { insertLog.run(row); } catch (err) { logger.error('[db] Cannot write session log: ' + err.message); }
+    }
+  }
+}
+
+// Signals don't fire 'exit': app.js flushes on SIGTERM/SIGINT before exiting
+process.on('exit', flushLog);
+
 function log(sessionId, level, message, details = null) {
-  insertLog.run({
+  logBuffer.push({
     session_id: sessionId,
     level,
     message,
     details: details ? JSON.stringify(details) : null,
   });
+  if (logBuffer.length >= LOG_FLUSH_ROWS) {
+    flushLog();
+  } else if (!logTimer) {
+    logTimer = setTimeout(flushLog, LOG_FLUSH_MS);
+    if (logTimer.unref) logTimer.unref();
+  }
+}
+
+function getSessionLogPage(sessionId, { before = null, limit = 100 } = {}) {
+  flushLog();
+  return before
+    ? getSessionLogBeforeStmt.all(sessionId, before, limit)
+    : getSessionLog.all(sessionId, limit);
 }
 
 function cacheEntities(sessionId, entityType, items) {
@@ -273,10 +489,333 @@ function countCached(sessionId, entityType) {
   return countCacheByType.get(sessionId, entityType).cnt;
 }
 
+/**
+ * Keyset page of cached entities, in fetch order, each with its id_mapping row.
+ * @returns {{ rows: Array<{ item, status, kommo_id, error_msg }>, nextAfter: number|null }}
+ */
+function getCachedPage(sessionId, entityType, { after = 0, limit = 200, search = '' } = {}) {
+  const q = String(search || '').trim().toLowerCase();
+  const rows = q
+    ? searchCachePageStmt.all(sessionId, entityType, after, q, q, limit)
+    : getCachePageStmt.all(sessionId, entityType, after, limit);
+  return {
+    rows: rows.map((r) => ({ item: JSON.parse(r.data), status: r.status, kommo_id: r.kommo_id, error_msg: r.error_msg })),
+    nextAfter: rows.length === limit ? rows[rows.length - 1].cursor : null,
+  };
+}
+
+// ─── AMO Entity Store helpers ────────────────────────────────────────────────
+function amoEntityRow(entityType, item) {
+  return {
+    entity_type: entityType,
+    amo_id: item.id,
+    entity_id: item.entity_id != null ? item.entity_id : null,
+    responsible_user_id: item.responsible_user_id != null ? item.responsible_user_id : null,
+    pipeline_id: item.pipeline_id != null ? item.pipeline_id : null,
+    status_id: item.status_id != null ? item.status_id : null,
+    note_type: item.note_type != null ? String(item.note_type) : null,
+    name_lc: item.name ? String(item.name).toLowerCase() : null,
+    data: JSON.stringify(item),
+  };
+}
+
+function insertAmoLinks(lead) {
+  for (const relType of ['contacts', 'companies']) {
+    for (const rel of (lead._embedded?.[relType] || [])) {
+      if (rel && rel.id != null) insertAmoLinkStmt.run(lead.id, relType, rel.id);
+    }
+  }
+}
+
+/**
+ * Replace the whole AMO snapshot in one transaction.
+ * @param {object} meta   - { fetchedAt, pipelineId, managerIds, ... } (counts are recomputed)
+ * @param {object} byType - { leads: [...], contacts: [...], ... }
+ */
+function replaceAmoEntities(meta, byType) {
+  importMetaNeedsFix(); // legacy flags outlive the meta they were kept in
+  const run = db.transaction(() => {
+    clearAmoEntitiesStmt.run();
+    clearAmoLinksStmt.run();
+    const counts = {};
+    for (const type of AMO_ENTITY_TYPES) {
+      const list = byType[type] || [];
+      for (const item of list) insertAmoEntity.run(amoEntityRow(type, item));
+      counts[type] = list.length;
+    }
+    for (const lead of (byType.leads || [])) insertAmoLinks(lead);
+    upsertAmoMetaStmt.run(JSON.stringify({ ...meta, counts }));
+  });
+  run();
+}
+
+/**
+ * Replace the children (tasks / notes) of some parent entities, e.g. notes refetched
+ * for entities changed after the snapshot. Snapshot counts in meta are left as is.
+ */
+const replaceAmoChildren = db.transaction((entityType, entityIds, items) => {
+  const { where, params } = amoEntityWhere(entityType, { entityIds });
+  db.prepare(`DELETE FROM amo_entities WHERE ${where}`).run(...params);
+  for (const item of items) insertAmoEntity.run(amoEntityRow(entityType, item));
+});
+
+/**
+ * Merge a delta (entities changed since fetchedAt) into the snapshot in one transaction:
+ * upsert items, refresh links of changed leads, recompute counts, patch meta.
+ * @param {object} metaPatch - e.g. { fetchedAt, baseFetchedAt, lastDelta }
+ * @param {object} byType    - { leads: [...], contactNotes: [...], ... } changed items only
+ */
+function mergeAmoEntities(metaPatch, byType) {
+  const run = db.transaction(() => {
+    for (const type of AMO_ENTITY_TYPES) {
+      for (const item of (byType[type] || [])) upsertAmoEntityStmt.run(amoEntityRow(type, item));
+    }
+    for (const lead of (byType.leads || [])) {
+      deleteLeadLinksStmt.run(lead.id);
+      insertAmoLinks(lead);
+    }
+    const counts = {};
+    for (const type of AMO_ENTITY_TYPES) counts[type] = 0;
+    for (const { entity_type: type, cnt } of countAmoByTypeStmt.all()) counts[type] = cnt;
+    upsertAmoMetaStmt.run(JSON.stringify({ ...(getAmoCacheMeta() || {}), ...metaPatch, counts }));
+  });
+  run();
+}
+
+function getAmoCacheMeta() {
+  const row = getAmoMetaStmt.get();
+  return row ? JSON.parse(row.data) : null;
+}
+
+/**
+ * Build WHERE clause for amo_entities. Array filters are passed as JSON and expanded
+ * with json_each() so one prepared statement shape serves any number of ids.
+ * opts: { ids, entityIds, responsibleUserIds, pipelineId, statusIds, excludeNoteTypes, search }
+ */
+function amoEntityWhere(entityType, opts = {}) {
+  const clauses = ['entity_type = ?'];
+  const params = [entityType];
+  const inList = (col, arr) => {
+    clauses.push(`${col} IN (SELECT value FROM json_each(?))`);
+    params.push(JSON.stringify(arr.map(Number)));
+  };
+  if (Array.isArray(opts.ids)) inList('amo_id', opts.ids);
+  if (Array.isArray(opts.entityIds)) inList('entity_id', opts.entityIds);
+  if (Array.isArray(opts.responsibleUserIds) && opts.responsibleUserIds.length > 0) {
+    inList('responsible_user_id', opts.responsibleUserIds);
+  }
+  if (opts.pipelineId) { clauses.push('pipeline_id = ?'); params.push(Number(opts.pipelineId)); }
+  if (Array.isArray(opts.statusIds)) inList('status_id', opts.statusIds);
+  if (opts.excludeNoteTypes && opts.excludeNoteTypes.length > 0) {
+    clauses.push('(note_type IS NULL OR note_type NOT IN (SELECT value FROM json_each(?)))');
+    params.push(JSON.stringify(opts.excludeNoteTypes.map(String)));
+  }
+  if (opts.search) { clauses.push('instr(name_lc, ?) > 0'); params.push(String(opts.search).toLowerCase()); }
+  return { where: clauses.join(' AND '), params };
+}
+
+/** Read cached AMO entities of one type — optional filters + offset/limit slice, insertion order. */
+function queryAmoEntities(entityType, opts = {}) {
+  const { where, params } = amoEntityWhere(entityType, opts);
+  let sql = `SELECT data FROM amo_entities WHERE ${where} ORDER BY id`;
+  if (opts.limit != null) { sql += ' LIMIT ? OFFSET ?'; params.push(Number(opts.limit), Number(opts.offset || 0)); }
+  else if (opts.offset) { sql += ' LIMIT -1 OFFSET ?'; params.push(Number(opts.offset)); }
+  return db.prepare(sql).pluck().all(...params).map((d) => JSON.parse(d));
+}
+
+/**
+ * Items of one type grouped by their parent entity (tasks / notes), index lookup only.
+ * @returns {Map<number, object[]>} entity_id → items in snapshot order
+ */
+function groupAmoEntitiesByEntity(entityType, entityIds) {
+  const map = new Map();
+  if (!entityIds || entityIds.length === 0) return map;
+  const { where, params } = amoEntityWhere(entityType, { entityIds });
+  const rows = db.prepare(`SELECT entity_id, data FROM amo_entities WHERE ${where} ORDER BY id`).all(...params);
+  for (const { entity_id: entityId, data } of rows) {
+    if (!map.has(entityId)) map.set(entityId, []);
+    map.get(entityId).push(JSON.parse(data));
+  }
+  return map;
+}
+
+/**
+ * Lead → contact/company ids from amo_entity_links (no lead JSON parsing).
+ * @returns {{ byLead: Map<number, {contacts: number[], companies: number[]}>, contactIds: number[], companyIds: number[] }}
+ */
+function getAmoLeadLinks(leadIds) {
+  const byLead = new Map();
+  const contactIds = new Set();
+  const companyIds = new Set();
+  if (leadIds && leadIds.length > 0) {
+    const rows = db.prepare(
+      'SELECT lead_id, rel_type, rel_id FROM amo_entity_links WHERE lead_id IN (SELECT value FROM json_each(?)) ORDER BY rowid'
+    ).all(JSON.stringify(leadIds.map(Number)));
+    for (const { lead_id: leadId, rel_type: relType, rel_id: relId } of rows) {
+      if (!byLead.has(leadId)) byLead.set(leadId, { contacts: [], companies: [] });
+      byLead.get(leadId)[relType].push(relId);
+      (relType === 'contacts' ? contactIds : companyIds).add(relId);
+    }
+  }
+  return { byLead, contactIds: [...contactIds], companyIds: [...companyIds] };
+}
+
+/**
+ * Reverse of getAmoLeadLinks: leads that reference the given contacts/companies.
+ * @param {'contacts'|'companies'} relType
+ * @returns {Array<{ leadId: number, relId: number }>}
+ */
+function getAmoLinkedLeads(relType, relIds) {
+  if (!relIds || relIds.length === 0) return [];
+  return db.prepare(
+    'SELECT lead_id AS leadId, rel_id AS relId FROM amo_entity_links WHERE rel_type = ? AND rel_id IN (SELECT value FROM json_each(?)) ORDER BY rowid'
+  ).all(relType, JSON.stringify(relIds.map(Number)));
+}
+
+// Snapshots stored before amo_entity_links existed: build the links once from lead JSON
+const backfillAmoLinks = db.transaction(() => {
+  for (const data of allAmoLeadsStmt.all()) insertAmoLinks(JSON.parse(data));
+});
+if (countAmoLinksStmt.get() === 0 && countAmoLeadsStmt.get() > 0) backfillAmoLinks();
+
+function countAmoEntities(entityType, opts = {}) {
+  const { where, params } = amoEntityWhere(entityType, opts);
+  return db.prepare(`SELECT COUNT(*) FROM amo_entities WHERE ${where}`).pluck().get(...params);
+}
+
+/** AMO ids only (no JSON parsing) — for membership checks against the migration index. */
+function listAmoEntityIds(entityType, opts = {}) {
+  const { where, params } = amoEntityWhere(entityType, opts);
+  return db.prepare(`SELECT amo_id FROM amo_entities WHERE ${where} ORDER BY id`).pluck().all(...params);
+}
+
+/**
+ * AMO ids with their row ids, in row order — keyset for cursors over the snapshot.
+ * Delta upserts keep a row's id and new rows get larger ones, so a row id stays a
+ * valid position while the filtered list around it changes.
+ * @returns {{ rowIds: number[], ids: number[] }}
+ */
+function listAmoEntityKeys(entityType, opts = {}) {
+  const { where, params } = amoEntityWhere(entityType, opts);
+  const rows = db.prepare(`SELECT id, amo_id FROM amo_entities WHERE ${where} ORDER BY id`).raw().all(...params);
+  return { rowIds: rows.map(r => r[0]), ids: rows.map(r => r[1]) };
+}
+
+/**
+ * Full snapshot in the legacy amo_data_cache.json shape, or null if nothing is cached.
+ * @param {string[]} [types] - load only these entity types (others are returned as [])
+ */
+function loadAmoEntityCache(types) {
+  const meta = getAmoCacheMeta();
+  if (!meta) return null;
+  const cache = { ...meta };
+  for (const type of AMO_ENTITY_TYPES) {
+    cache[type] = (!types || types.includes(type)) ? queryAmoEntities(type) : [];
+  }
+  return cache;
+}
+
+// ─── Migration Index helpers ─────────────────────────────────────────────────
+/** Append/overwrite [{amoId, kommoId}] pairs for one entity in a single transaction. */
+const addIndexPairs = db.transaction((entity, pairs) => {
+  for (const { amoId, kommoId } of pairs) upsertIndexPairStmt.run(entity, String(amoId), String(kommoId));
+});
+
+const removeIndexPairs = db.transaction((entity, amoIds) => {
+  for (const amoId of amoIds) deleteIndexPairStmt.run(entity, String(amoId));
+});
+
+/** @param {Array<{ amoId, payload, error }>} items - a repeated amoId bumps attempts */
+const addQuarantine = db.transaction((entity, items) => {
+  for (const { amoId, payload, error } of items) {
+    upsertQuarantineStmt.run(entity, String(amoId), JSON.stringify(payload), error != null ? JSON.stringify(error) : null);
+  }
+});
+
+const removeQuarantine = db.transaction((entity, amoIds) => {
+  for (const amoId of amoIds) deleteQuarantineStmt.run(entity, String(amoId));
+});
+
+// Flags kept in the snapshot meta before amo_needs_fix existed: moved on first use
+let needsFixImported = false;
+function importMetaNeedsFix() {
+  if (needsFixImported) return;
+  needsFixImported = true;
+  const meta = getAmoCacheMeta();
+  if (!meta?.needsFix) return;
+  const { needsFix, ...rest } = meta;
+  db.transaction(() => {
+    for (const [entity, ids] of Object.entries(needsFix)) {
+      for (const amoId of ids || []) insertNeedsFixStmt.run(entity, Number(amoId));
+    }
+    upsertAmoMetaStmt.run(JSON.stringify(rest));
+  })();
+}
+
+const flagNeedsFixTx = db.transaction((entity, amoIds) => {
+  for (const amoId of amoIds) insertNeedsFixStmt.run(entity, Number(amoId));
+});
+function flagNeedsFix(entity, amoIds) {
+  importMetaNeedsFix();
+  flagNeedsFixTx(entity, amoIds);
+}
+
+const clearNeedsFixTx = db.transaction((entity, amoIds) => {
+  for (const amoId of amoIds) deleteNeedsFixStmt.run(entity, Number(amoId));
+});
+function clearNeedsFix(entity, amoIds) {
+  importMetaNeedsFix();
+  clearNeedsFixTx(entity, amoIds);
+}
+
+/** @returns {{ leads: number[], contacts: number[], companies: number[] }} */
+function listNeedsFix() {
+  importMetaNeedsFix();
+  const out = { leads: [], contacts: [], companies: [] };
+  for (const { entity, amo_id: amoId } of listNeedsFixStmt.all()) (out[entity] = out[entity] || []).push(amoId);
+  return out;
+}
+
+function listQuarantine(entity) {
+  const rows = entity
+    ? db.prepare('SELECT * FROM kommo_quarantine WHERE entity=? ORDER BY created_at').all(entity)
+    : db.prepare('SELECT * FROM kommo_quarantine ORDER BY entity, created_at').all();
+  return rows.map((r) => ({ ...r, payload: JSON.parse(r.payload), error: r.error ? JSON.parse(r.error) : null }));
+}
+
+/** Replace the whole index with { entity: { amoId: kommoId } } (reset / legacy import). */
+const replaceIndex = db.transaction((idx) => {
+  clearIndexStmt.run();
+  for (const [entity, section] of Object.entries(idx || {})) {
+    if (!section || typeof section !== 'object' || Array.isArray(section)) continue;
+    for (const [amoId, kommoId] of Object.entries(section)) {
+      if (kommoId) upsertIndexPairStmt.run(entity, String(amoId), String(kommoId));
+    }
+  }
+});
+
 function setMapping(sessionId, entityType, amoId, kommoId, status = 'created', errorMsg = null) {
   upsertMapping.run({ session_id: sessionId, entity_type: entityType, amo_id: amoId, kommo_id: kommoId, status, error_msg: errorMsg });
 }
 
+/**
+ * Upsert many mappings of one session in a single transaction.
+ * @param {Array<{ entityType, amoId, kommoId, status?, errorMsg? }>} rows
+ */
+const setMappings = db.transaction((sessionId, rows) => {
+  for (const r of rows) {
+    upsertMapping.run({
+      session_id: sessionId, entity_type: r.entityType, amo_id: r.amoId, kommo_id: r.kommoId,
+      status: r.status || 'created', error_msg: r.errorMsg || null,
+    });
+  }
+});
+
+/** Mark mappings rolled back by Kommo id (bulk rollback). */
+const rollbackMappingsByKommo = db.transaction((sessionId, entityType, kommoIds) => {
+  for (const kommoId of kommoIds) rollbackMappingByKommoStmt.run(sessionId, entityType, kommoId);
+});
+
 function resolveKommoId(sessionId, entityType, amoId) {
   const row = getMapping.get(sessionId, entityType, amoId);
   return row?.kommo_id || null;
@@ -385,26 +924,62 @@ module.exports = {
   patchSessionStatus: (id, status) => patchSessionStatus.run(status, id),
   // mapping
   setMapping,
+  setMappings,
   getMapping: (sid, type, amoId) => getMapping.get(sid, type, amoId),
   getSessionMappings: (sid, type) => getSessionMappings.all(sid, type),
   getCreatedMappings: (sid) => getCreatedMappings.all(sid),
   rollbackMapping: (sid, type, amoId) => rollbackMapping.run(sid, type, amoId),
   rollbackAllMappings: (sid) => rollbackAllMappings.run(sid),
+  rollbackMappingsByKommo,
   getLastCreatedMapping: (sid, type) => getLastCreatedMappingStmt.get(sid, type),
   getMappingsByStatus: (sid, type, status) => getMappingsByStatusStmt.all(sid, type, status),
   getMappingsCreatedAfter: (sid, type, afterId) => getMappingsCreatedAfterStmt.all(sid, type, afterId),
+  countMappingsByStatus: (sid, type) => Object.fromEntries(countMappingsByStatusStmt.all(sid, type).map((r) => [r.status, r.cnt])),
   resolveKommoId,
   // cache
   cacheEntities,
   getCached,
+  getCachedPage,
   countCached,
   getCacheItem: (sid, type, amoId) => {
     const r = getCacheItem.get(sid, type, amoId);
     return r ? JSON.parse(r.data) : null;
   },
+  // AMO entity store (batch migration snapshot)
+  AMO_ENTITY_TYPES,
+  replaceAmoEntities,
+  mergeAmoEntities,
+  replaceAmoChildren,
+  getAmoCacheMeta,
+  queryAmoEntities,
+  countAmoEntities,
+  listAmoEntityIds,
+  listAmoEntityKeys,
+  groupAmoEntitiesByEntity,
+  getAmoLeadLinks,
+  getAmoLinkedLeads,
+  countAmoEntitiesByResponsible: (type) => countAmoByRespStmt.all(type),
+  countAmoEntitiesByPipeline: (type) => countAmoByPipelineStmt.all(type),
+  loadAmoEntityCache,
+  // migration index (safetyGuard)
+  getIndexPairs: () => getAllIndexPairsStmt.all(),
+  countIndexPairs: () => countIndexStmt.get(),
+  addIndexPairs,
+  removeIndexPairs,
+  replaceIndex,
+  // quarantine (records rejected by Kommo on create)
+  addQuarantine,
+  flagNeedsFix,
+  clearNeedsFix,
+  listNeedsFix,
+  removeQuarantine,
+  listQuarantine,
+  countQuarantine: () => Object.fromEntries(countQuarantineStmt.all().map((r) => [r.entity, r.cnt])),
   // log
   log,
-  getSessionLog: (sid, limit = 100) => getSessionLog.all(sid, limit),
+  flushLog,
+  getSessionLog: (sid, limit = 100) => getSessionLogPage(sid, { limit }),
+  getSessionLogPage,
   // stage mapping
   saveStageMapping,
   getStageMapping,
@@ -7,6 +7,7 @@ const db      = require('../db');
 const path    = require('path');
 const fse     = require('fs-extra');
 const cfg     = require('../config');
+const safety  = require('../utils/safetyGuard');
 const {
   registerSSE,
   unregisterSSE,
@@ -67,8 +68,8 @@ router.post('/:id/start', async (req, res) => {
     });
 });
 
-// Helper: count entries in a migration_index.json field
-// The field can be: object {amo_id: kommo_id}, array, number, or missing
+// Helper: count entries in a migration index section
+// idx is safety.getIndexCounts() ({ section: number }); legacy shapes: object {amo_id: kommo_id}, array
 function countField(idx, key) {
   const val = idx[key];
   if (!val) return 0;
@@ -78,13 +79,12 @@ function countField(idx, key) {
   return 0;
 }
 
-// GET /api/copy/totals — absolute totals from migration_index.json (never subtracted)
-// migration_index.json is the permanent dedup record — NEVER cleared
+// GET /api/copy/totals — absolute totals from the migration index (never subtracted)
+// the migration index is the permanent dedup record — NEVER cleared
 // Counter resets ONLY when user explicitly clicks "Сбросить счётчик" button
 router.get('/totals', (req, res) => {
   try {
-    const indexPath = path.resolve(cfg.backupDir, 'migration_index.json');
-    const idx = fse.existsSync(indexPath) ? fse.readJsonSync(indexPath) : {};
+    const idx = safety.getIndexCounts();
 
     const totals = {
       leads:        countField(idx, 'leads'),
@@ -106,13 +106,12 @@ router.get('/totals', (req, res) => {
 });
 
 // POST /api/copy/reset-counter — save current totals as display baseline
-// NEVER modifies migration_index.json — only writes counter_reset_baseline.json
+// NEVER modifies the migration index — only writes counter_reset_baseline.json
 router.post('/reset-counter', (req, res) => {
   try {
-    const indexPath    = path.resolve(cfg.backupDir, 'migration_index.json');
     const baselinePath = path.resolve(cfg.backupDir, 'counter_reset_baseline.json');
 
-    const idx = fse.existsSync(indexPath) ? fse.readJsonSync(indexPath) : {};
+    const idx = safety.getIndexCounts();
 
     const baseline = {
       leads:        countField(idx, 'leads'),
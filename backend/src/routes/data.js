@@ -6,6 +6,11 @@ const amoApi = require('../services/amoApi');
 const config = require('../config');
 const logger = require('../utils/logger');
 
+const db = require('../db');
+const safety = require('../utils/safetyGuard');
+const progressStream = require('../services/progressStream');
+
+// Legacy snapshot file — imported once into the SQLite entity store (db.amo_entities)
 const CACHE_FILE = path.resolve(config.backupDir, 'amo_data_cache.json');
 
 // fetchState: idle | loading | done | error
@@ -20,25 +25,41 @@ let fetchState = {
   error: null,
   updatedAt: null,
 };
+// Live updates for dashboards (GET /api/migration/stream); counters mutated in place are sampled
+progressStream.register('fetch', () => fetchState);
+
+// Delta sync re-reads this many seconds before fetchedAt (clock skew between us and AMO)
+const DELTA_OVERLAP_SEC = 120;
 
-// In-memory cache for quick reads
-let memCache = null;
+// Note types not counted as migrateable (phone calls etc.)
+const SKIP_NOTE_TYPES = [10, 11, 'amomail_message', 'extended_service_message', 'lead_auto_created'];
 
-function loadCacheFromDisk() {
-  if (fs.existsSync(CACHE_FILE)) {
-    try {
-      memCache = fs.readJsonSync(CACHE_FILE);
-      return memCache;
-    } catch (e) {
-      return null;
+// One-time import of amo_data_cache.json into the entity store (pre-SQLite installs)
+function importLegacyCacheFile() {
+  if (db.getAmoCacheMeta() || !fs.existsSync(CACHE_FILE)) return;
+  try {
+    const legacy = fs.readJsonSync(CACHE_FILE);
+    const { fetchedAt, pipelineId, managerIds } = legacy;
+    // Very old snapshots keep all tasks in one `tasks` array
+    if (Array.isArray(legacy.tasks) && !legacy.leadTasks) {
+      legacy.leadTasks    = legacy.tasks.filter(t => t.entity_type === 'leads');
+      legacy.contactTasks = legacy.contactTasks || legacy.tasks.filter(t => t.entity_type === 'contacts');
     }
+    db.replaceAmoEntities({ fetchedAt, pipelineId, managerIds, importedFrom: path.basename(CACHE_FILE) }, legacy);
+    logger.info(`[data] legacy ${path.basename(CACHE_FILE)} imported into SQLite entity store`);
+  } catch (e) {
+    logger.error(`[data] legacy cache import failed: ${e.message}`);
   }
-  return null;
+}
+
+// Snapshot metadata ({ fetchedAt, pipelineId, managerIds, counts }) — no entity bodies
+function loadCacheMeta() {
+  try { return db.getAmoCacheMeta(); } catch (e) { return null; }
 }
 
 // Restore fetchState from disk cache on module start (survives PM2 restarts)
 function initFetchStateFromDisk() {
-  const cached = loadCacheFromDisk();
+  const cached = loadCacheMeta();
   if (cached) {
     const c = cached.counts || {};
     fetchState = {
@@ -52,11 +73,16 @@ function initFetchStateFromDisk() {
           leadTasks:    c.leadTasks    != null ? c.leadTasks    : (c.tasks || 0),
           contactTasks: c.contactTasks != null ? c.contactTasks : 0,
           companyTasks: c.companyTasks != null ? c.companyTasks : 0,
-          leadNotes:    c.leadNotes    != null ? c.leadNotes    : 0,
-          contactNotes: c.contactNotes != null ? c.contactNotes : 0,
+          leadNotes:    db.countAmoEntities('leadNotes',    { excludeNoteTypes: SKIP_NOTE_TYPES }),
+          contactNotes: db.countAmoEntities('contactNotes', { excludeNoteTypes: SKIP_NOTE_TYPES }),
         },
         pipelineId: cached.pipelineId || null,
         managerIds: cached.managerIds || [],
+        // Last delta sync + migrated entities changed since (see fetchDeltaData)
+        delta: cached.lastDelta ? {
+          ...cached.lastDelta,
+          needsFix: Object.fromEntries(Object.entries(db.listNeedsFix()).map(([k, v]) => [k, v.length])),
+        } : null,
       },
       error: null,
       updatedAt: cached.fetchedAt || null,
@@ -66,6 +92,7 @@ function initFetchStateFromDisk() {
 }
 
 // Eager init — restore state when module is loaded (PM2 restart safe)
+importLegacyCacheFile();
 initFetchStateFromDisk();
 
 // Background fetch all amo CRM data
@@ -88,108 +115,268 @@ async function fetchAllData(pipelineId, managerIds) {
     error: null,
     updatedAt: null,
   };
-  memCache = null;
+  const progress = fetchState.progress;
+  progressStream.notify('fetch');
+  const pending = new Set();
 
   try {
-    fetchState.progress.step = 'Загрузка сделок...';
-    const leads = await amoApi.getAllLeads(effectivePipelineId, effectiveManagerIds);
-    logger.info(`Data fetch: loaded ${leads.length} leads (pipeline: ${effectivePipelineId}, managers: [${effectiveManagerIds.join(',')||'all'}])`);
-    fetchState.progress.loaded.leads = leads.length;
+    // Pipelined fetch: each page of leads immediately feeds the downstream fetchers
+    // (contacts/companies by ID, lead tasks/notes), contacts feed contact tasks/notes,
+    // companies feed company tasks. All requests share the AMO scheduler (rateLimiter),
+    // so the concurrency is bounded there; here we only keep the dependency order.
+    const skipNoteTypes = new Set(SKIP_NOTE_TYPES);
+    const out = {
+      contacts: [], companies: [],
+      leadTasks: [], contactTasks: [], companyTasks: [],
+      leadNotes: [], contactNotes: [],
+    };
+    const entities = progress.entities = {};
+    for (const key of Object.keys(EMPTY_LOADED())) {
+      entities[key] = { status: 'pending', loaded: 0, pendingJobs: 0 };
+    }
+    let firstError = null;
 
-    // Collect contact IDs and company IDs referenced by the filtered leads
-    const linkedContactIds = new Set();
-    const linkedCompanyIds = new Set();
-    const leadIds = new Set(leads.map(l => l.id));
-    for (const lead of leads) {
-      const embedded = lead._embedded;
-      if (embedded?.contacts) embedded.contacts.forEach(c => linkedContactIds.add(c.id));
-      if (embedded?.companies) embedded.companies.forEach(c => linkedCompanyIds.add(c.id));
+    function setStep() {
+      const active = Object.entries(entities).filter(([, e]) => e.status === 'loading').map(([k]) => k);
+      progress.step = active.length
+        ? `Загрузка (параллельно): ${active.join(', ')}...`
+        : 'Завершение...';
     }
 
-    fetchState.progress.step = 'Загрузка контактов...';
-    // Fetch ONLY contacts that are linked to the filtered leads — by ID
-    const contacts = await amoApi.getContactsByIds([...linkedContactIds]);
-    fetchState.progress.loaded.contacts = contacts.length;
-    logger.info(`Data fetch: loaded ${contacts.length} contacts (by ID, linked to ${leadIds.size} leads)`);
-
-    fetchState.progress.step = 'Загрузка компаний...';
-    // Fetch ONLY companies that are linked to the filtered leads — by ID
-    const companies = await amoApi.getCompaniesByIds([...linkedCompanyIds]);
-    fetchState.progress.loaded.companies = companies.length;
-    logger.info(`Data fetch: loaded ${companies.length} companies (by ID, linked to ${leadIds.size} leads)`);
-
-    const contactIds = new Set(contacts.map(c => c.id));
-
-    fetchState.progress.step = 'Загрузка задач (deals)...';
-    // Fetch only tasks for the loaded leads — by entity_id
-    const leadTasks = await amoApi.getLeadTasksByEntityIds([...leadIds]);
-    fetchState.progress.loaded.leadTasks = leadTasks.length;
-    logger.info(`Data fetch: loaded ${leadTasks.length} lead tasks`);
-
-    fetchState.progress.step = 'Загрузка задач (contacts)...';
-    // Fetch only tasks for the loaded contacts — by entity_id
-    const contactTasks = await amoApi.getContactTasksByEntityIds([...contactIds]);
-    fetchState.progress.loaded.contactTasks = contactTasks.length;
-    logger.info(`Data fetch: loaded ${contactTasks.length} contact tasks`);
-
-    fetchState.progress.step = 'Загрузка задач (companies)...';
-    const companyIds = new Set(companies.map(c => c.id));
-    const companyTasks = await amoApi.getCompanyTasksByEntityIds([...companyIds]);
-    fetchState.progress.loaded.companyTasks = companyTasks.length;
-    logger.info(`Data fetch: loaded ${companyTasks.length} company tasks`);
-
-    fetchState.progress.step = 'Загрузка комментариев (deals)...';
-    // Fetch only notes for the loaded leads — by entity_id
-    const leadNotes = await amoApi.getLeadNotesByEntityIds([...leadIds]);
-    const SKIP_NOTE_TYPES = new Set([10, 11, 'amomail_message', 'extended_service_message', 'lead_auto_created']); // phone calls skipped during migration
-    fetchState.progress.loaded.leadNotes = leadNotes.filter(n => !SKIP_NOTE_TYPES.has(n.note_type)).length;
-    logger.info(`Data fetch: loaded ${leadNotes.length} lead notes (migrateable: ${fetchState.progress.loaded.leadNotes})`);
-
-    fetchState.progress.step = 'Загрузка комментариев (contacts)...';
-    // Fetch only notes for the loaded contacts — by entity_id
-    const contactNotes = await amoApi.getContactNotesByEntityIds([...contactIds]);
-    fetchState.progress.loaded.contactNotes = contactNotes.filter(n => !SKIP_NOTE_TYPES.has(n.note_type)).length;
-    logger.info(`Data fetch: loaded ${contactNotes.length} contact notes (migrateable: ${fetchState.progress.loaded.contactNotes})`);
-
-    const data = {
-      fetchedAt: new Date().toISOString(),
-      pipelineId: effectivePipelineId,
-      managerIds: effectiveManagerIds,
-      counts: {
-        leads: leads.length,
-        contacts: contacts.length,
-        companies: companies.length,
-        leadTasks: leadTasks.length,
-        contactTasks: contactTasks.length,
-        companyTasks: companyTasks.length,
-        leadNotes: leadNotes.length,
-        contactNotes: contactNotes.length,
-      },
-      leads,
-      contacts,
-      companies,
-      leadTasks,
-      contactTasks,
-      companyTasks,
-      leadNotes,
-      contactNotes,
-    };
+    // Run fetcher(ids) for one entity key; results are appended to out[key]
+    function dispatch(key, fetcher, ids, then) {
+      if (firstError || !ids.length) return;
+      const ent = entities[key];
+      ent.status = 'loading';
+      ent.pendingJobs++;
+      setStep();
+      const job = fetcher(ids)
+        .then((items) => {
+          out[key].push(...items);
+          ent.loaded = (key === 'leadNotes' || key === 'contactNotes')
+            ? ent.loaded + items.filter(n => !skipNoteTypes.has(n.note_type)).length
+            : out[key].length;
+          progress.loaded[key] = ent.loaded;
+          if (then) then(items);
+        })
+        .catch((err) => { if (!firstError) firstError = err; })
+        .finally(() => {
+          ent.pendingJobs--;
+          if (ent.pendingJobs === 0) ent.status = 'done';
+          pending.delete(job);
+          setStep();
+        });
+      pending.add(job);
+    }
 
-    await fs.writeJson(CACHE_FILE, data, { spaces: 2 });
-    memCache = data;
+    const seenContactIds = new Set();
+    const seenCompanyIds = new Set();
+    function onLeadsPage(pageLeads) {
+      if (firstError) throw firstError; // stop paging leads — a downstream fetch failed
+      progress.loaded.leads += pageLeads.length;
+      entities.leads.loaded = progress.loaded.leads;
+      const pageLeadIds = pageLeads.map(l => l.id);
+      const newContactIds = [];
+      const newCompanyIds = [];
+      for (const lead of pageLeads) {
+        const embedded = lead._embedded;
+        if (embedded?.contacts) embedded.contacts.forEach((c) => {
+          if (!seenContactIds.has(c.id)) { seenContactIds.add(c.id); newContactIds.push(c.id); }
+        });
+        if (embedded?.companies) embedded.companies.forEach((c) => {
+          if (!seenCompanyIds.has(c.id)) { seenCompanyIds.add(c.id); newCompanyIds.push(c.id); }
+        });
+      }
+      // Fetch ONLY contacts/companies linked to the filtered leads — by ID
+      dispatch('contacts', amoApi.getContactsByIds, newContactIds, (contacts) => {
+        const ids = contacts.map(c => c.id);
+        dispatch('contactTasks', amoApi.getContactTasksByEntityIds, ids);
+        dispatch('contactNotes', amoApi.getContactNotesByEntityIds, ids);
+      });
+      dispatch('companies', amoApi.getCompaniesByIds, newCompanyIds, (companies) => {
+        dispatch('companyTasks', amoApi.getCompanyTasksByEntityIds, companies.map(c => c.id));
+      });
+      // Tasks and notes for this page of leads — by entity_id
+      dispatch('leadTasks', amoApi.getLeadTasksByEntityIds, pageLeadIds);
+      dispatch('leadNotes', amoApi.getLeadNotesByEntityIds, pageLeadIds);
+    }
+
+    entities.leads.status = 'loading';
+    setStep();
+    const leads = await amoApi.getAllLeads(effectivePipelineId, effectiveManagerIds, onLeadsPage);
+    entities.leads.status = 'done';
+    progress.loaded.leads = leads.length;
+    entities.leads.loaded = leads.length;
+    logger.info(`Data fetch: loaded ${leads.length} leads (pipeline: ${effectivePipelineId}, managers: [${effectiveManagerIds.join(',')||'all'}])`);
 
+    // Drain downstream jobs (new jobs may be added while waiting — contacts → contact tasks/notes)
+    while (pending.size > 0) await Promise.all([...pending]);
+    if (firstError) throw firstError;
+    for (const ent of Object.values(entities)) ent.status = 'done';
+
+    const { contacts, companies, leadTasks, contactTasks, companyTasks, leadNotes, contactNotes } = out;
+    logger.info(`Data fetch: loaded ${contacts.length} contacts, ${companies.length} companies (by ID, linked to ${leads.length} leads)`);
+    logger.info(`Data fetch: loaded tasks leads=${leadTasks.length} contacts=${contactTasks.length} companies=${companyTasks.length}`);
+    logger.info(`Data fetch: loaded ${leadNotes.length} lead notes (migrateable: ${progress.loaded.leadNotes}), ${contactNotes.length} contact notes (migrateable: ${progress.loaded.contactNotes})`);
+
+    const fetchedAt = new Date().toISOString();
+    progress.step = 'Сохранение в хранилище...';
+    db.replaceAmoEntities(
+      { fetchedAt, pipelineId: effectivePipelineId, managerIds: effectiveManagerIds },
+      { leads, contacts, companies, leadTasks, contactTasks, companyTasks, leadNotes, contactNotes }
+    );
     fetchState.status = 'done';
     fetchState.progress.step = 'Готово';
-    fetchState.updatedAt = data.fetchedAt;
+    fetchState.updatedAt = fetchedAt;
+    progressStream.notify('fetch');
     logger.info('Data fetch completed and saved to cache');
   } catch (err) {
+    // Let in-flight downstream jobs settle so a new fetch doesn't start while they still run
+    while (pending.size > 0) await Promise.allSettled([...pending]);
     fetchState.status = 'error';
     fetchState.error = err.message;
     fetchState.progress.step = 'Ошибка';
+    progressStream.notify('fetch');
     logger.error(`Data fetch error: ${err.message}`);
   }
 }
 
+function sameIds(a, b) {
+  const x = (a || []).map(Number).sort((p, q) => p - q);
+  const y = (b || []).map(Number).sort((p, q) => p - q);
+  return x.length === y.length && x.every((v, i) => v === y[i]);
+}
+
+// Merge items into Map<id, item> (later items win) — tasks/notes may come from two queries
+function byId(...lists) {
+  const map = new Map();
+  for (const list of lists) for (const item of list) map.set(item.id, item);
+  return [...map.values()];
+}
+
+/**
+ * Delta sync: fetch only entities changed since the snapshot's fetchedAt and merge them
+ * into the entity store. Changed leads come from the pipeline/manager filter of the snapshot;
+ * contacts/companies/tasks/notes are limited to entities the snapshot contains, plus
+ * everything linked to leads that are new to it. Migrated entities that changed are
+ * flagged in amo_needs_fix for a fix pass (kept across full fetches, cleared by the pass).
+ * Not covered: deletions in AMO and leads that left the pipeline (stay in the snapshot).
+ */
+async function fetchDeltaData(meta) {
+  if (fetchState.status === 'loading') return;
+
+  const pipelineId = meta.pipelineId || config.amo.pipelineId;
+  const managerIds = meta.managerIds || [];
+  const since = Math.floor(Date.parse(meta.fetchedAt) / 1000) - DELTA_OVERLAP_SEC;
+  const fetchedAt = new Date().toISOString();
+
+  fetchState = {
+    status: 'loading',
+    progress: { step: 'Изменённые сделки...', loaded: EMPTY_LOADED(), pipelineId, managerIds, mode: 'delta' },
+    error: null,
+    updatedAt: null,
+  };
+  const progress = fetchState.progress;
+  progressStream.notify('fetch');
+
+  try {
+    const leadFilter = { pipeline_id: pipelineId };
+    if (managerIds.length > 0) leadFilter.responsible_user_id = managerIds;
+    const leads = await amoApi.getAllUpdatedSince('/api/v4/leads', 'leads', since,
+      { filter: leadFilter, with: 'contacts,companies,tags', limit: 50 });
+    progress.loaded.leads = leads.length;
+
+    // Snapshot membership (ids only) + entities linked to changed leads that are new to it
+    const knownLeads     = new Set(db.listAmoEntityIds('leads'));
+    const knownContacts  = new Set(db.listAmoEntityIds('contacts'));
+    const knownCompanies = new Set(db.listAmoEntityIds('companies'));
+    const newLeadIds = leads.filter(l => !knownLeads.has(l.id)).map(l => l.id);
+    const newContactIds = new Set();
+    const newCompanyIds = new Set();
+    for (const lead of leads) {
+      for (const c of (lead._embedded?.contacts  || [])) if (!knownContacts.has(c.id))  newContactIds.add(c.id);
+      for (const c of (lead._embedded?.companies || [])) if (!knownCompanies.has(c.id)) newCompanyIds.add(c.id);
+    }
+
+    progress.step = 'Изменённые контакты и компании...';
+    const [changedContacts, changedCompanies] = await Promise.all([
+      amoApi.getUpdatedEntityIds('contacts', since),
+      amoApi.getUpdatedEntityIds('companies', since),
+    ]);
+    const contactIds = [...newContactIds, ...[...changedContacts.keys()].filter(id => knownContacts.has(id))];
+    const companyIds = [...newCompanyIds, ...[...changedCompanies.keys()].filter(id => knownCompanies.has(id))];
+    const [contacts, companies] = await Promise.all([
+      amoApi.getContactsByIds(contactIds),
+      amoApi.getCompaniesByIds(companyIds),
+    ]);
+    progress.loaded.contacts = contacts.length;
+    progress.loaded.companies = companies.length;
+
+    // Tasks/notes: changed ones of known entities + all of the entities new to the snapshot
+    progress.step = 'Изменённые задачи и заметки...';
+    const [
+      changedTasks, changedLeadNotes, changedContactNotes,
+      newLeadTasks, newLeadNotes, newContactTasks, newContactNotes, newCompanyTasks,
+    ] = await Promise.all([
+      amoApi.getAllUpdatedSince('/api/v4/tasks', 'tasks', since),
+      amoApi.getAllUpdatedSince('/api/v4/leads/notes', 'notes', since),
+      amoApi.getAllUpdatedSince('/api/v4/contacts/notes', 'notes', since),
+      amoApi.getLeadTasksByEntityIds(newLeadIds),
+      amoApi.getLeadNotesByEntityIds(newLeadIds),
+      amoApi.getContactTasksByEntityIds([...newContactIds]),
+      amoApi.getContactNotesByEntityIds([...newContactIds]),
+      amoApi.getCompanyTasksByEntityIds([...newCompanyIds]),
+    ]);
+    const inStore = (known) => (item) => known.has(item.entity_id);
+    const changedOf = (type) => changedTasks.filter(t => t.entity_type === type);
+    const delta = {
+      leads, contacts, companies,
+      leadTasks:    byId(changedOf('leads').filter(inStore(knownLeads)), newLeadTasks),
+      contactTasks: byId(changedOf('contacts').filter(inStore(knownContacts)), newContactTasks),
+      companyTasks: byId(changedOf('companies').filter(inStore(knownCompanies)), newCompanyTasks),
+      leadNotes:    byId(changedLeadNotes.filter(inStore(knownLeads)), newLeadNotes),
+      contactNotes: byId(changedContactNotes.filter(inStore(knownContacts)), newContactNotes),
+    };
+    for (const key of ['leadTasks', 'contactTasks', 'companyTasks']) progress.loaded[key] = delta[key].length;
+    const skipNoteTypes = new Set(SKIP_NOTE_TYPES);
+    for (const key of ['leadNotes', 'contactNotes']) {
+      progress.loaded[key] = delta[key].filter(n => !skipNoteTypes.has(n.note_type)).length;
+    }
+
+    // Already migrated + changed since → needs a fix pass (accumulates until the pass handles it)
+    const needsFix = { leads: new Set(), contacts: new Set(), companies: new Set() };
+    const flag = (entity, id) => { if (safety.isMigrated(entity, id)) needsFix[entity].add(Number(id)); };
+    leads.forEach(l => flag('leads', l.id));
+    contacts.forEach(c => flag('contacts', c.id));
+    companies.forEach(c => flag('companies', c.id));
+    [...delta.leadTasks, ...delta.leadNotes].forEach(x => flag('leads', x.entity_id));
+    [...delta.contactTasks, ...delta.contactNotes].forEach(x => flag('contacts', x.entity_id));
+    delta.companyTasks.forEach(x => flag('companies', x.entity_id));
+
+    const lastDelta = { at: fetchedAt, since: new Date(since * 1000).toISOString(), loaded: { ...progress.loaded } };
+    progress.step = 'Сохранение изменений...';
+    db.mergeAmoEntities({
+      fetchedAt,
+      baseFetchedAt: meta.baseFetchedAt || meta.fetchedAt,
+      lastDelta,
+    }, delta);
+    for (const [entity, ids] of Object.entries(needsFix)) db.flagNeedsFix(entity, [...ids]);
+
+    // Counters on the dashboard show the whole store, the delta itself goes to progress.delta
+    initFetchStateFromDisk();
+    progressStream.notify('fetch');
+    logger.info(`Delta sync done: leads=${leads.length} contacts=${contacts.length} companies=${companies.length}` +
+      ` tasks=${delta.leadTasks.length + delta.contactTasks.length + delta.companyTasks.length}` +
+      ` notes=${delta.leadNotes.length + delta.contactNotes.length}, flagged for fix leads=${needsFix.leads.size}`);
+  } catch (err) {
+    fetchState.status = 'error';
+    fetchState.error = err.message;
+    fetchState.progress.step = 'Ошибка';
+    progressStream.notify('fetch');
+    logger.error(`Delta sync error: ${err.message}`);
+  }
+}
+
 // GET /api/amo/fetch-status — current fetch status
 router.get('/fetch-status', (req, res) => {
   // Safety fallback: if fetchState is still idle but cache exists on disk
@@ -204,44 +391,44 @@ router.post('/fetch', (req, res) => {
   if (fetchState.status === 'loading') {
     return res.json({ message: 'Загрузка уже выполняется', state: fetchState });
   }
-  const { pipelineId, managerIds } = req.body || {};
+  const { pipelineId, managerIds, mode } = req.body || {};
+  // mode=delta: only changes since the last snapshot of the same pipeline/managers
+  if (mode === 'delta') {
+    const meta = loadCacheMeta();
+    const samePipeline = !pipelineId || Number(pipelineId) === Number(meta?.pipelineId);
+    const sameManagers = !Array.isArray(managerIds) || sameIds(managerIds, meta?.managerIds);
+    if (meta && meta.fetchedAt && samePipeline && sameManagers) {
+      fetchDeltaData(meta); // fire and forget
+      return res.json({ message: 'Загрузка изменений запущена', state: fetchState });
+    }
+    logger.info('[data] delta sync not possible (no snapshot or other pipeline/managers) — full fetch');
+  }
   fetchAllData(pipelineId, managerIds); // fire and forget
   res.json({ message: 'Загрузка данных запущена', state: fetchState });
 });
 
 // GET /api/amo/entities?type=leads&page=1&limit=50&search=
 router.get('/entities', (req, res) => {
-  if (!memCache) loadCacheFromDisk();
-  if (!memCache) return res.status(404).json({ error: 'Данные не загружены. Запустите загрузку.' });
+  const meta = loadCacheMeta();
+  if (!meta) return res.status(404).json({ error: 'Данные не загружены. Запустите загрузку.' });
 
   const { type = 'leads', page = 1, limit = 50, search = '', managersOnly = '0', managerIds = '' } = req.query;
   const validTypes = ['leads', 'contacts', 'companies', 'tasks', 'leadTasks', 'contactTasks', 'leadNotes', 'contactNotes'];
   if (!validTypes.includes(type)) return res.status(400).json({ error: 'Invalid type' });
 
-  let items = memCache[type] || [];
-
+  const filter = {};
   // Manager filter (only for leads)
   if (type === 'leads' && managersOnly === '1' && managerIds) {
     const ids = managerIds.split(',').map(Number).filter(Boolean);
-    if (ids.length > 0) {
-      items = items.filter(item => ids.includes(item.responsible_user_id));
-    }
+    if (ids.length > 0) filter.responsibleUserIds = ids;
   }
-
   // Search filter
-  if (search) {
-    const q = search.toLowerCase();
-    items = items.filter((item) => {
-      const name = (item.name || '').toLowerCase();
-      return name.includes(q);
-    });
-  }
+  if (search) filter.search = search;
 
-  const total = items.length;
   const pageNum = parseInt(page);
   const limitNum = parseInt(limit);
-  const start = (pageNum - 1) * limitNum;
-  const paginated = items.slice(start, start + limitNum);
+  const total = db.countAmoEntities(type, filter);
+  const paginated = db.queryAmoEntities(type, { ...filter, offset: (pageNum - 1) * limitNum, limit: limitNum });
 
   res.json({
     type,
@@ -249,15 +436,26 @@ router.get('/entities', (req, res) => {
     page: pageNum,
     pages: Math.ceil(total / limitNum),
     items: paginated,
-    fetchedAt: memCache.fetchedAt,
+    fetchedAt: meta.fetchedAt,
   });
 });
 
 // GET /api/amo/stats — entity counts
 router.get('/stats', (req, res) => {
-  if (!memCache) loadCacheFromDisk();
-  if (!memCache) return res.json({ counts: null, fetchedAt: null });
-  res.json({ counts: memCache.counts, fetchedAt: memCache.fetchedAt });
+  const meta = loadCacheMeta();
+  if (!meta) return res.json({ counts: null, fetchedAt: null });
+  res.json({ counts: meta.counts, fetchedAt: meta.fetchedAt, lastDelta: meta.lastDelta || null });
+});
+
+// GET /api/amo/needs-fix — migrated entities changed in AMO since migration (delta sync)
+router.get('/needs-fix', (req, res) => {
+  const meta = loadCacheMeta();
+  const needsFix = db.listNeedsFix();
+  res.json({
+    counts: Object.fromEntries(Object.entries(needsFix).map(([k, v]) => [k, v.length])),
+    ...needsFix,
+    lastDelta: meta?.lastDelta || null,
+  });
 });
 
 module.exports = router;
@@ -4,550 +4,40 @@ const path = require('path');
 const fs = require('fs-extra');
 const migrationService = require('../services/migrationService');
 const batchService = require('../services/batchMigrationService');
+const migrationJobs = require('../services/migrationJobs');
 const backupService = require('../services/backupService');
 const logger = require('../utils/logger');
 const amoApi = require('../services/amoApi');
 const kommoApi = require('../services/kommoApi');
-
-// Note types excluded from dashboard counts (not transferable via API)
-const SKIP_NOTE_TYPES = new Set([10, 11, 'amomail_message', 'extended_service_message', 'lead_auto_created', 'attachment', 'link_followed']);
-const filterEligibleNotes = (notes) => (notes || []).filter(n => !SKIP_NOTE_TYPES.has(n.note_type)).length;
+const db = require('../db');
+const safety = require('../utils/safetyGuard');
+const counters = require('../utils/migrationCounters');
+const fieldSchemaCache = require('../services/fieldSchemaCache');
+const {
+  ENUM_TYPES, AMO_KOMMO_GROUP_NAME_MAP, compareFields, buildKommoFieldIndex, findCrossLangMatch,
+} = require('../utils/fieldMatcher');
+const progressStream = require('../services/progressStream');
 
 // ─── Helpers for persistent stats (survive server crash) ─────────────────────
+// Materialized in migrationCounters (persisted, maintained on fetch / register / rollback)
 function getCacheStats() {
-  try {
-    const cfg = require('../config');
-    const cachePath = path.resolve(cfg.backupDir, 'amo_data_cache.json');
-    if (!fs.existsSync(cachePath)) return null;
-    const c = fs.readJsonSync(cachePath);
-    const leads        = (c.leads        || []).length;
-    const contacts     = (c.contacts     || []).length;
-    const companies    = (c.companies    || []).length;
-    const leadTasks    = (c.leadTasks    || []).length;
-    const contactTasks = (c.contactTasks || []).length;
-    const companyTasks = (c.companyTasks || []).length;
-    const leadNotes    = filterEligibleNotes(c.leadNotes);
-    const contactNotes = filterEligibleNotes(c.contactNotes);
-    return { leads, contacts, companies, leadTasks, contactTasks, companyTasks, leadNotes, contactNotes, fetchedAt: c.fetchedAt || null };
-  } catch { return null; }
+  try { return counters.getCacheStats(); } catch { return null; }
 }
 
 function getMigrationTotals() {
-  try {
-    const cfg = require('../config');
-    const idxPath  = path.resolve(cfg.backupDir, 'migration_index.json');
-    const basePath = path.resolve(cfg.backupDir, 'session_baseline.json');
-    if (!fs.existsSync(idxPath)) return null;
-    const idx = fs.readJsonSync(idxPath);
-    const count = (obj) => obj ? Object.keys(obj).length : 0;
-    // Load baseline (saved at last reset); default all zeros if absent
-    let base = { leads: 0, contacts: 0, companies: 0, leadTasks: 0, contactTasks: 0, leadNotes: 0, contactNotes: 0 };
-    if (fs.existsSync(basePath)) {
-      try { base = { ...base, ...fs.readJsonSync(basePath) }; } catch {}
-    }
-    return {
-      leads:        Math.max(0, count(idx.leads)          - (base.leads        || 0)),
-      contacts:     Math.max(0, count(idx.contacts)       - (base.contacts     || 0)),
-      companies:    Math.max(0, count(idx.companies)      - (base.companies    || 0)),
-      leadTasks:    Math.max(0, count(idx.tasks_leads)    - (base.leadTasks    || 0)),
-      contactTasks: Math.max(0, count(idx.tasks_contacts) - (base.contactTasks || 0)),
-      companyTasks: Math.max(0, count(idx.tasks_companies) - (base.companyTasks || 0)),
-      leadNotes:    Math.max(0, count(idx.notes_leads)    - (base.leadNotes    || 0)),
-      contactNotes: Math.max(0, count(idx.notes_contacts) - (base.contactNotes || 0)),
-    };
-  } catch { return null; }
+  try { return counters.getMigrationTotals(); } catch { return null; }
 }
 
 // pending = items in cache that have NOT been migrated yet
-// Direct check: count cache items whose ID is absent from safety index
 function getPendingStats() {
-  try {
-    const cfg = require('../config');
-    const cachePath = path.resolve(cfg.backupDir, 'amo_data_cache.json');
-    const idxPath   = path.resolve(cfg.backupDir, 'migration_index.json');
-    if (!fs.existsSync(cachePath)) return null;
-    const c   = fs.readJsonSync(cachePath);
-    const idx = fs.existsSync(idxPath) ? fs.readJsonSync(idxPath) : {};
-    const has = (section, id) => !!(idx[section] && idx[section][String(id)]);
-    const eligibleNotes = (notes) => (notes || []).filter(n => !SKIP_NOTE_TYPES.has(n.note_type));
-    return {
-      leads:        (c.leads        || []).filter(x => !has('leads', x.id)).length,
-      contacts:     (c.contacts     || []).filter(x => !has('contacts', x.id)).length,
-      companies:    (c.companies    || []).filter(x => !has('companies', x.id)).length,
-      leadTasks:    (c.leadTasks    || []).filter(x => !has('tasks_leads', x.id)).length,
-      contactTasks: (c.contactTasks || []).filter(x => !has('tasks_contacts', x.id)).length,
-      companyTasks: (c.companyTasks || []).filter(x => !has('tasks_companies', x.id)).length,
-      leadNotes:    eligibleNotes(c.leadNotes).filter(x => !has('notes_leads', x.id)).length,
-      contactNotes: eligibleNotes(c.contactNotes).filter(x => !has('notes_contacts', x.id)).length,
-    };
-  } catch { return null; }
+  try { return counters.getPendingStats(); } catch { return null; }
 }
 
 function saveSessionBaseline() {
-  try {
-    const cfg = require('../config');
-    const idxPath  = path.resolve(cfg.backupDir, 'migration_index.json');
-    const basePath = path.resolve(cfg.backupDir, 'session_baseline.json');
-    const count = (obj) => obj ? Object.keys(obj).length : 0;
-    let baseline = { leads: 0, contacts: 0, companies: 0, leadTasks: 0, contactTasks: 0, leadNotes: 0, contactNotes: 0 };
-    if (fs.existsSync(idxPath)) {
-      const idx = fs.readJsonSync(idxPath);
-      baseline = {
-        leads:        count(idx.leads),
-        contacts:     count(idx.contacts),
-        companies:    count(idx.companies),
-        leadTasks:    count(idx.tasks_leads),
-        contactTasks: count(idx.tasks_contacts),
-        companyTasks: count(idx.tasks_companies),
-        leadNotes:    count(idx.notes_leads),
-        contactNotes: count(idx.notes_contacts),
-      };
-    }
-    fs.writeJsonSync(basePath, baseline);
-  } catch {}
+  try { counters.saveBaseline(); } catch {}
 }
 
 // GET /api/migration/status
-/**
- * compareFields — сравнивает поле AMO с полем Kommo и возвращает статус совпадения.
- * Статусы: 'synced' (полностью совпадает), 'matched' (совпадает основное),
- *          'different' (отличия есть), 'missing' (поле не найдено в Kommo).
- */
-const ENUM_TYPES = ['select', 'multiselect', 'radiobutton'];
-
-// Пары типов, которые считаются «мягко совместимыми»:
-// при несовпадении типа поле показывается как matched/partial, а не missing.
-const SOFT_TYPE_COMPAT = [
-  ['text','textarea'], ['text','url'], ['textarea','url'],
-  ['select','radiobutton'],
-  ['select','multiselect'], ['radiobutton','multiselect'],
-  ['date','date_time'],
-];
-function isSoftTypeCompat(a, b) {
-  if (a === b) return true;
-  return SOFT_TYPE_COMPAT.some(([x, y]) => (a === x && b === y) || (a === y && b === x));
-}
-
-// ── Кросс-языковые кластеры значений перечислений ───────────────────────────
-// Если AMO-значение и Kommo-значение попадают в один кластер — они считаются
-// семантически эквивалентными (не нужно добавлять в Kommo).
-const ENUM_VALUE_ALIASES = [
-  // Пол / Gender
-  ['м', 'мужской', 'мужчина', 'male', 'man', 'boy', 'm'],
-  ['ж', 'женский', 'женщина', 'female', 'woman', 'girl', 'f'],
-  // Роль / Relationship
-  ['мама', 'мать', 'mother', 'mom'],
-  ['папа', 'отец', 'father', 'dad'],
-  ['бабушка', 'grandmother', 'grandma'],
-  ['дедушка', 'grandfather', 'grandpa'],
-  ['няня', 'nanny', 'babysitter'],
-  ['опекун', 'guardian'],
-  // Да / Нет
-  ['да', 'yes', 'true', 'верно'],
-  ['нет', 'no', 'false', 'неверно'],
-  // Источники трафика
-  ['вконтакте', 'вк', 'vk', 'vkontakte'],
-  ['instagram', 'инстаграм', 'инста'],
-  ['facebook', 'фейсбук', 'fb'],
-  ['telegram', 'телеграм', 'tg'],
-  ['whatsapp', 'вотсап', 'wa', 'whats app'],
-  ['viber', 'вайбер'],
-  ['рекомендация', 'recommendation', 'referral', 'сарафанное радио'],
-  ['другое', 'other', 'иное', 'прочее', 'другая'],
-  ['с сайта', 'landing', 'лендинг', 'website', 'сайт'],
-  ['blogger', 'блогер', 'блогеры', 'инфлюенсер'],
-  // Роль / Relationship (ребенок = student himself OR infant как причина отказа)
-  ['ребенок', 'ребёнок', 'child', 'student himself', 'kid', 'сам ученик', 'infant'],
-  // Продукты
-  ['репетиторство', 'репетиторство рф', 'репетиторство мш', 'tutoring', 'tutor', 'репетитор'],
-  ['школа рф', 'school'],
-  ['лагерь', 'camp', 'summer camp'],
-  ['международная школа', 'international school'],
-  // Качество лида
-  ['целевой', 'qualified', 'a (целевой)'],
-  ['не срочный', 'b (не срочный)', 'potential'],
-  ['не целевой', 'c (не целевой)', 'unqualified'],
-  // ── Причина закрытия / Cause of loss ──────────────────────────────
-  ['слишком дорого', 'too expensive', 'дорого', 'цена высокая'],
-  ['не устроили условия', 'the terms were not acceptable', 'условия не устроили', 'условия не подошли'],
-  ['выбрали других', 'chose others', 'выбрали конкурента', 'выбрали конкурентов'],
-  ['нет подходящей услуги', 'there is no suitable product', 'no suitable product', 'нет нужного продукта'],
-  ['нет ответа', 'no answer', 'no response', 'не отвечает'],
-  ['негатив не звонить', 'негатив, не звонить', 'negative feedback, do not call', 'negative feedback do not call', 'не звонить'],
-  ['работа сотрудничество спам', 'работа, сотрудничество, спам', 'spam', 'спам', 'рассылка'],
-  ['текущий ученик', 'current student', 'действующий клиент', 'текущий клиент'],
-  ['дубль', 'duplicate', 'дублирует', 'дубликат'],
-  ['не оставляли заявку', 'did not submit an application', 'не подавали заявку', 'не подавал заявку'],
-  ['это организация', 'this is an organisation', 'this is an organization', 'организация'],
-  ['пропала потребность', 'no longer needed', 'lost interest', 'потребность отпала'],
-  // Месяцы
-  ['январь', 'january', 'jan'],
-  ['февраль', 'february', 'feb'],
-  ['март', 'march', 'mar'],
-  ['апрель', 'april', 'apr'],
-  ['май', 'may'],
-  ['июнь', 'june', 'jun'],
-  ['июль', 'july', 'jul'],
-  ['август', 'august', 'aug'],
-  ['сентябрь', 'september', 'sep'],
-  ['октябрь', 'october', 'oct'],
-  ['ноябрь', 'november', 'nov'],
-  ['декабрь', 'december', 'dec'],
-];
-
-/**
- * Возвращает true, если AMO-значение семантически эквивалентно
- * хотя бы одному значению из множества Kommo (kValSet — нормализованные строки,
- * kValArr — массив { norm } для кластерного поиска).
- */
-/** Нормализует enum-значение: lower, убирает пунктуацию, схлопывает пробелы */
-function normEnumVal(v) {
-  return (v || '').toLowerCase()
-    .replace(/[,;.()\[\]\/#!?«»"'`]/g, ' ')
-    .replace(/\s+/g, ' ')
-    .trim();
-}
-
-function enumValueSemanticMatch(amoVal, kValSet, kValNorms) {
-  const aNorm = normEnumVal(amoVal);
-  if (!aNorm) return false;
-
-  // 1. Точное совпадение (нормализованное)
-  if (kValSet.has(aNorm)) return true;
-  // Также проверяем нормализованную версию каждого Kommo-значения
-  const kNormsNorm = kValNorms.map(normEnumVal);
-  const kSetNorm = new Set(kNormsNorm);
-  if (kSetNorm.has(aNorm)) return true;
-
-  // 2. Кросс-языковой кластер — полная нормализованная строка
-  for (const cluster of ENUM_VALUE_ALIASES) {
-    if (!cluster.includes(aNorm)) continue;
-    for (const kn of kNormsNorm) {
-      if (cluster.includes(kn)) return true;
-    }
-  }
-
-  // 3. Кросс-языковой кластер — по токенам AMO-значения
-  // (срабатывает только если токен длинный >= 4 символа, чтобы не было ложных совпадений)
-  const aTokens = aNorm.split(/\s+/).filter(t => t.length >= 4);
-  for (const tok of aTokens) {
-    for (const cluster of ENUM_VALUE_ALIASES) {
-      if (!cluster.includes(tok)) continue;
-      for (const kn of kNormsNorm) {
-        if (cluster.includes(kn)) return true;
-      }
-    }
-  }
-
-  return false;
-}
-
-function compareFields(amoField, kommoField, mappingEntry) {
-  if (!kommoField) return { status: 'missing', differences: [] };
-
-  const typesMatch = amoField.type === kommoField.type;
-  if (!typesMatch && !isSoftTypeCompat(amoField.type, kommoField.type)) {
-    // Принципиально несовместимые типы → создать новое поле
-    return { status: 'missing', differences: ['type'], typeConflict: true };
-  }
-
-  const diffs = [];
-  if (!typesMatch) diffs.push('type'); // мягко совместимые — отличие фиксируем, но не конфликт
-
-  // Видимость через API — не для системных (is_predefined) полей AMO.
-  if (!amoField.is_predefined && !!amoField.is_api_only !== !!kommoField.is_api_only) {
-    diffs.push('is_api_only');
-  }
-
-  // Enum-поля (select/multiselect/radiobutton): проверяем что все AMO-значения
-  // семантически присутствуют в Kommo (с кросс-языковым сравнением).
-  // Если в AMO есть значения без семантического эквивалента в Kommo → partial.
-  if (ENUM_TYPES.includes(amoField.type)) {
-    const kValNorms = (kommoField.enums || [])
-      .map(e => normEnumVal(e.value)).filter(Boolean);
-    const kValSet = new Set(kValNorms);
-    const missingInKommo = (amoField.enums || []).filter(
-      e => e.value && !enumValueSemanticMatch(e.value, kValSet, kValNorms)
-    );
-    if (missingInKommo.length > 0) {
-      return {
-        status: 'partial',
-        differences: ['enums'],
-        missingEnums: missingInKommo,
-        missingCount: missingInKommo.length,
-      };
-    }
-    // Все AMO-значения есть в Kommo — enums не является различием
-  }
-
-  // Вложенные списки (chained_lists): аналогично — ищем значения AMO, которых нет в Kommo
-  if (amoField.type === 'chained_lists') {
-    const aItems = amoField.nested_values || amoField.enums || amoField.values || [];
-    const kItems = kommoField.nested_values || kommoField.enums || kommoField.values || [];
-    const kTopSet = new Set(kItems.map(v => (v.value || v.name || '').toLowerCase().trim()));
-    const missingTop = aItems.filter(v => {
-      const nm = (v.value || v.name || '').toLowerCase().trim();
-      return nm && !kTopSet.has(nm);
-    });
-    // Проверяем вложенные уровни для совпадающих вершин
-    let missingNested = 0;
-    aItems.forEach(av => {
-      const kv = kItems.find(k =>
-        (k.value || k.name || '').toLowerCase().trim() ===
-        (av.value || av.name || '').toLowerCase().trim()
-      );
-      if (kv) {
-        const kNestedSet = new Set((kv.nested || []).map(n => (n.value || n.name || '').toLowerCase().trim()));
-        missingNested += (av.nested || []).filter(n => {
-          const nm = (n.value || n.name || '').toLowerCase().trim();
-          return nm && !kNestedSet.has(nm);
-        }).length;
-      }
-    });
-    if (missingTop.length > 0 || missingNested > 0) {
-      return {
-        status: 'partial',
-        differences: ['nested'],
-        missingEnums: missingTop,
-        missingCount: missingTop.length + missingNested,
-      };
-    }
-  }
-
-  // exactMatch: true — значит поля полностью идентичны.
-  // Финальный статус 'synced' определяется не здесь, а в fields-analysis
-  // (только если поле уже подтверждено/создано через маппинг).
-  if (diffs.length === 0) return { status: 'matched', differences: [], exactMatch: true };
-  return { status: 'matched', differences: diffs };
-}
-
-
-// ── Кросс-языковой словарь синонимов ────────────────────────────────────────
-// ВАЖНО: каждый кластер должен быть достаточно специфичен.
-// Матчинг только по ТОЧНОМУ совпадению токена с одним из алиасов кластера.
-const FIELD_ALIASES = [
-  // Контактные
-  ['телефон','phone','тел','tel','mobile','моб','мобильный','сотовый','cell','phones'],
-  ['email','почта','e-mail','mail','эл почта','электронная почта','emails'],
-  ['сайт','website','site','веб','web','www','homepage'],
-  ['skype','скайп'],
-  ['instagram','инстаграм','инста'],
-  ['facebook','фейсбук','fb'],
-  ['вконтакте','вк','vk','vkontakte'],
-  ['telegram','телеграм','tg'],
-  ['whatsapp','вотсап','wa'],
-  ['viber','вайбер'],
-  // Персональные
-  ['имя','name','наименование','название','fullname'],
-  ['фамилия','lastname','surname'],
-  ['день рождения','birthday','birthdate','дата рождения'],
-  ['пол','gender','sex','male female','malefemale','пол контакта'],
-  ['возраст','age'],
-  // Профессиональные
-  ['должность','position','jobtitle','профессия','occupation'],
-  ['отдел','department','dept','division'],
-  ['компания','company','организация','organization','фирма','firm'],
-  // Адресные
-  ['адрес','address','addr'],
-  ['город','city','town'],
-  ['страна','country'],
-  ['регион','region','область','край','province','state'],
-  ['индекс','zip','postal','postcode','почтовый'],
-  ['улица','street'],
-  // Финансовые
-  ['бюджет','budget','сумма','amount','стоимость','cost','price','цена','sum'],
-  ['скидка','discount'],
-  ['налог','tax','ндс','vat','nds'],
-  ['счёт','счет','invoice','bill','оплата','payment'],
-  ['выручка','revenue','доход','income'],
-  // UTM — КАЖДОЕ ПОЛЕ ОТДЕЛЬНЫМ КЛАСТЕРОМ
-  ['utm source','utm_source','utmsource','источник рекламы','рекламный источник','источник трафика'],
-  ['utm medium','utm_medium','utmmedium','канал рекламы','рекламный канал','тип трафика'],
-  ['utm campaign','utm_campaign','utmcampaign','рекламная кампания','кампания'],
-  ['utm content','utm_content','utmcontent','содержание объявления','содержание рекламы'],
-  ['utm term','utm_term','utmterm','ключевое слово','ключевые слова'],
-  // Источник сделки/лида (ОТДЕЛЬНО от utm)
-  ['источник','source','leadsource','trafficsource','источник лида','источник сделки'],
-  // Продукт / услуга
-  ['продукт','product','товар','услуга','service','item','goods'],
-  // Канал (общий) — ОТДЕЛЬНО от utm-medium
-  ['канал','channel','маркетинговый канал'],
-  // Даты
-  ['дата создания','created','createdat','дата добавления'],
-  ['дата обновления','updated','updatedat','изменён','modified'],
-  ['дата закрытия','closed','closing','closedate','дата завершения','deadline'],
-  ['дата','date'],
-  // Качество и оценки — ОТДЕЛЬНЫЕ КЛАСТЕРЫ
-  ['качество лида','lead quality','лид скор','lead score'],
-  ['качество','quality','оценка качества'],
-  ['лид','lead','потенциальный клиент'],
-  ['рейтинг','rating','score','оценка'],
-  // Общие
-  ['описание','description','desc','подробности','details'],
-  ['комментарий','comment','notes','заметки','примечание','remarks'],
-  ['тег','tag','метка','label','теги'],
-  ['статус','status','состояние','stage'],
-  ['приоритет','priority','важность'],
-  ['ответственный','owner','responsible','manager','менеджер','assigned'],
-  // Реквизиты
-  ['инн','inn'],
-  ['кпп','kpp'],
-  ['огрн','ogrn'],
-  ['бик','bik'],
-  // Ссылки
-  ['ссылка','link','url','href'],
-  // Авто
-  ['автомобиль','car','vehicle','транспорт','transport'],
-  ['vin','вин'],
-  // Трекинг (общий)
-  ['трекинг','tracking','отслеживание','аналитика'],
-  // Квалификация лида
-  ['квалифицирован','qualified','is qualified','квалификация лида','квалифицирован контакт'],
-  // Ученик / Student
-  ['ученик','student','учащийся','pupil'],
-  // Роль / Relationship (кем является контакт по отношению к ученику)
-  ['роль','role','relationship','роль в семье','relationship to student','relationship to the student'],
-  // Пробное занятие — дата и время
-  ['дата и время пробного урока','date and time of demo','дата пробного урока','trial lesson datetime','demo datetime','date and time of the demo','дата время пробный'],
-  // Пробное занятие — запись
-  ['записан на пробное','registered for demo','registered for the demo','registered demo','записан пробный','запись на пробный урок'],
-  // Пробное занятие — посещение
-  ['был на пробном','attended demo','attended the demo','посещение пробного','был на пробном занятии'],
-  // Оценка после пробного урока
-  ['оценка после пробного','grade after demo','grade received after demo','grade recived after demo','оценка пробного урока'],
-  // Проверка качества сделки
-  ['прошла проверку','deal reviewed','the deal has been reviewed','проверка сделки','deal has been reviewed'],
-  // Комментарий проверяющего
-  ['кто проверил','who reviewed','quality control comment','контроль качества комментарий'],
-  // Отписка от рассылки
-  ['отписался','unsubscribed','отписалась','отписан от рассылки','unsubscribe'],
-  // Причина закрытия / потери
-  ['причина закрытия','cause of loss','причина отказа','loss reason','причина потери'],
-  // Комментарий к причине закрытия
-  ['комментарий к причине','cause of loss commentary','ответственный за закрытие'],
-];
-
-// Кросс-языковой маппинг групп AMO → Kommo
-const AMO_KOMMO_GROUP_NAME_MAP = {
-  'основное':      'main',
-  'main':          'основное',
-  'статистика':    'statistics',
-  'statistics':    'статистика',
-  'без группы':    'main',
-  'general':       'основное',
-  'счета/покупки': 'invoices',
-  'покупки':       'invoices',
-  'all leads':     'все сделки',
-  'все сделки':    'all leads',
-};
-
-/** Нормализует строку → массив токенов */
-function normalizeTokens(str) {
-  return (str || '')
-    .toLowerCase()
-    .replace(/[_\-\.\/ ,;:@#*+(\)[\]]/g, ' ')
-    .replace(/[^а-яёa-z0-9\s]/g, '')
-    .split(/\s+/)
-    .filter(t => t.length > 0);
-}
-
-/**
- * findAliasCluster — СТРОГИЙ поиск кластера.
- * Только ТОЧНОЕ совпадение токена ИЛИ полного нормализованного имени с alias.
- * Никаких вхождений substr (alias.includes(tok)) — это вызывало багги.
- */
-function findAliasCluster(tokens, fullNorm) {
-  // Проверяем полное нормализованное имя как единую фразу
-  if (fullNorm) {
-    for (const cluster of FIELD_ALIASES) {
-      if (cluster.includes(fullNorm)) return cluster;
-    }
-  }
-  // Проверяем каждый токен — только ТОЧНОЕ совпадение
-  for (const cluster of FIELD_ALIASES) {
-    for (const tok of tokens) {
-      if (cluster.includes(tok)) return cluster;
-    }
-  }
-  return null;
-}
-
-/** Типы полей, совместимые при сопоставлении */
-const TYPE_COMPAT = {
-  text:          ['text','textarea','url','multitext'],
-  textarea:      ['text','textarea'],
-  url:           ['url','text'],
-  multitext:     ['multitext','text'],
-  numeric:       ['numeric'],
-  select:        ['select','radiobutton'],
-  radiobutton:   ['select','radiobutton'],
-  multiselect:   ['multiselect','select'],
-  checkbox:      ['checkbox'],
-  date:          ['date','date_time'],
-  date_time:     ['date','date_time'],
-  tracking_data: ['tracking_data'],
-  smart_address: ['smart_address'],
-  chained_lists: ['chained_lists'],
-};
-
-/**
- * findCrossLangMatch — строгий кросс-языковой матчинг.
- * Возвращает { field, via: 'translation', score } или null.
- * 
- * ПРАВИЛА (чтобы не было ложных совпадений):
- * 1. Оба поля должны попасть в один и тот же кластер FIELD_ALIASES
- * 2. Оба поля должны иметь совместимые типы
- * 3. Матчинг — только через точное совпадение токена или полного имени с alias
- * 4. kommoFields должны быть предфильтрованы (только ещё не занятые)
- * 
- * Порог: score >= 80 (чтобы отсечь совпадения вида "источник" vs все поля с токеном "source")
- * Если у AMO-поля несколько токенов и только часть из них совпадает с кластером — штраф.
- */
-function findCrossLangMatch(amoField, availableKommoFields) {
-  const amoTokens  = normalizeTokens(amoField.name);
-  const amoFull    = amoTokens.join(' ');
-  const amoCluster = findAliasCluster(amoTokens, amoFull);
-  if (!amoCluster) return null;
-
-  const compatTypes = TYPE_COMPAT[amoField.type] || [amoField.type];
-  let best = null;
-
-  for (const kf of availableKommoFields) {
-    if (!compatTypes.includes(kf.type)) continue;
-    const kTokens  = normalizeTokens(kf.name);
-    const kFull    = kTokens.join(' ');
-    const kCluster = findAliasCluster(kTokens, kFull);
-
-    // Оба поля должны быть в одном кластере
-    if (!kCluster || kCluster !== amoCluster) continue;
-
-    // Базовый score = 100 при совпадении кластера
-    let score = 100;
-
-    // Бонус за точное совпадение типа (важен при нескольких кандидатах в кластере)
-    if (kf.type === amoField.type) score += 30;
-
-    // Штраф если AMO-поле длинное (>2 токенов), но только один из них попал в кластер.
-    // Применяем ТОЛЬКО если тип не совпадает точно (чтобы не штрафовать верные пары)
-    // -25 (не -20) чтобы итоговый score 75 < 80 отсекал ложные совпадения вида
-    // "Комментарий" (1 токен) → "Комментарий для отложенных" (3 токена, 1 в кластере)
-    const amoMatchCount = amoTokens.filter(t => amoCluster.includes(t)).length;
-    const amoFullMatch  = amoCluster.includes(amoFull);
-    if (!amoFullMatch && amoTokens.length > 2 && amoMatchCount < 2 && kf.type !== amoField.type) score -= 25;
-
-    // Аналогично для Kommo
-    const kMatchCount = kTokens.filter(t => kCluster.includes(t)).length;
-    const kFullMatch  = kCluster.includes(kFull);
-    if (!kFullMatch && kTokens.length > 2 && kMatchCount < 2 && kf.type !== amoField.type) score -= 25;
-
-    if (score >= 80 && score > (best?.score || 0)) {
-      best = { field: kf, via: 'translation', score };
-    }
-  }
-  return best || null;
-}
-
-
 router.get('/status', (req, res) => {
   res.json(migrationService.getState());
 });
@@ -607,16 +97,15 @@ router.get('/backups', async (req, res) => {
 // POST /api/migration/backups/create — create manual backup from current AMO cache
 router.post('/backups/create', async (req, res) => {
   try {
-    const cacheFile = pathMod.resolve(cfg.backupDir, 'amo_data_cache.json');
     let data = {};
-    if (fs.existsSync(cacheFile)) {
-      const raw = await fs.readJson(cacheFile);
+    const raw = db.loadAmoEntityCache(['leads', 'contacts', 'companies', 'leadTasks', 'contactTasks', 'companyTasks']);
+    if (raw) {
       data = {
         leads:     raw.leads     || [],
         contacts:  raw.contacts  || [],
         companies: raw.companies || [],
-        tasks:     raw.tasks     || [],
-        pipeline:  raw.pipeline  || null,
+        tasks:     [...raw.leadTasks, ...raw.contactTasks, ...raw.companyTasks],
+        pipeline:  raw.pipelineId || null,
       };
     }
     const result = await backupService.createFullBackup(data);
@@ -626,6 +115,24 @@ router.post('/backups/create', async (req, res) => {
   }
 });
 
+// GET /api/migration/backups/:snapshot/records?type=leads&from=100&to=200 (or &ids=1,2,3)
+// — records of one snapshot, only the requested type / id range is unpacked
+router.get('/backups/:snapshot/records', async (req, res) => {
+  try {
+    const { type, from, to, ids } = req.query;
+    const result = await backupService.restoreRecords(req.params.snapshot, {
+      types: type ? String(type).split(',') : undefined,
+      from: from != null && from !== '' ? Number(from) : undefined,
+      to: to != null && to !== '' ? Number(to) : undefined,
+      ids: ids ? String(ids).split(',').filter(Boolean) : undefined,
+    });
+    res.json(result);
+  } catch (e) {
+    const status = /not found|has no/.test(e.message) ? 404 : 500;
+    res.status(status).json({ error: e.message });
+  }
+});
+
 
 // GET /api/migration/amo-stages
 router.get('/amo-stages', (req, res) => {
@@ -673,6 +180,7 @@ router.get('/batch-status', (req, res) => {
     batchPosition:   { offset: cfg.offset, batchSize: cfg.batchSize },
     fixStats:        { processed: cfg.fixProcessed || 0, eligible: cfg.fixEligible || 0 },
     autoRunActive:   batchService.isAutoRunActive(),
+    pendingRollback: batchService.getPendingRollback(),
   });
 });
 
@@ -683,25 +191,31 @@ router.get('/batch-stats', (req, res) => {
   res.json(stats);
 });
 
+// Last saved stage_mapping.json (written by sync in Voronki tab) → { stageMapping, stageCount } or { error }
+function loadSavedStageMapping() {
+  const cfg2 = require('../config');
+  const stagePath = path.resolve(cfg2.backupDir, 'stage_mapping.json');
+  if (!fs.existsSync(stagePath)) {
+    return { error: 'stage_mapping.json не найден. Выполните Синхронизировать этапы во вкладке Воронки.' };
+  }
+  let stageMapping;
+  try {
+    stageMapping = fs.readJsonSync(stagePath);
+  } catch (e) {
+    return { error: 'Ошибка чтения stage_mapping.json: ' + e.message };
+  }
+  const stageCount = Object.keys(stageMapping).filter(k => k !== '_pipeline').length;
+  if (stageCount === 0) {
+    return { error: 'stage_mapping.json пуст. Выполните Синхронизировать этапы во вкладке Воронки.' };
+  }
+  return { stageMapping, stageCount };
+}
+
 // POST /api/migration/batch-start
 router.post('/batch-start', async (req, res) => {
   try {
-    const cfg2 = require('../config');
-    // Always use last saved stage_mapping.json (written by sync in Voronki tab)
-    const stagePath = path.resolve(cfg2.backupDir, 'stage_mapping.json');
-    let stageMapping = {};
-    if (!fs.existsSync(stagePath)) {
-      return res.status(400).json({ error: 'stage_mapping.json не найден. Выполните Синхронизировать этапы во вкладке Воронки.' });
-    }
-    try {
-      stageMapping = fs.readJsonSync(stagePath);
-    } catch (e) {
-      return res.status(400).json({ error: 'Ошибка чтения stage_mapping.json: ' + e.message });
-    }
-    const stageCount = Object.keys(stageMapping).filter(k => k !== '_pipeline').length;
-    if (stageCount === 0) {
-      return res.status(400).json({ error: 'stage_mapping.json пуст. Выполните Синхронизировать этапы во вкладке Воронки.' });
-    }
+    const { stageMapping, stageCount, error } = loadSavedStageMapping();
+    if (error) return res.status(400).json({ error });
     logger.info('[batch-start] Stage mapping loaded from disk: ' + stageCount + ' stages, pipeline ' + JSON.stringify(stageMapping._pipeline));
         // Start batch in background
     batchService.runBatchMigration(stageMapping).catch(e => {
@@ -725,6 +239,63 @@ router.post('/batch-rollback', async (req, res) => {
   }
 });
 
+// ─── Parallel batch jobs (partitioned by manager / pipeline) ─────────────────
+// GET /api/migration/batch-jobs — jobs summary (also SSE channel 'jobs')
+router.get('/batch-jobs', (req, res) => {
+  res.json(migrationJobs.getJobs());
+});
+
+// GET /api/migration/batch-jobs/partitions?by=managers|pipeline — partitions with lead counts
+router.get('/batch-jobs/partitions', (req, res) => {
+  try {
+    res.json({ partitions: migrationJobs.listPartitions(req.query.by === 'pipeline' ? 'pipeline' : 'managers') });
+  } catch (e) {
+    res.status(500).json({ error: e.message });
+  }
+});
+
+// POST /api/migration/batch-jobs — { by, partitions?, batchSize?, migrationMode?, maxParallel? }
+router.post('/batch-jobs', (req, res) => {
+  try {
+    const { stageMapping, stageCount, error } = loadSavedStageMapping();
+    if (error) return res.status(400).json({ error });
+    logger.info('[batch-jobs] Stage mapping loaded from disk: ' + stageCount + ' stages');
+    res.json(migrationJobs.startJobs(req.body || {}, stageMapping));
+  } catch (e) {
+    res.status(400).json({ error: e.message });
+  }
+});
+
+// POST /api/migration/batch-jobs/stop — stop all jobs at their next checkpoint
+router.post('/batch-jobs/stop', (req, res) => {
+  res.json(migrationJobs.stopAll());
+});
+
+// POST /api/migration/batch-jobs/:id/pause
+router.post('/batch-jobs/:id/pause', (req, res) => {
+  try {
+    res.json(migrationJobs.pauseJob(req.params.id));
+  } catch (e) {
+    res.status(400).json({ error: e.message });
+  }
+});
+
+// POST /api/migration/batch-jobs/:id/rollback — roll back the job's last batch
+router.post('/batch-jobs/:id/rollback', async (req, res) => {
+  try {
+    const run = migrationJobs.rollbackJob(req.params.id);
+    run.catch(e => logger.error('Background job rollback error:', e));
+    res.json({ message: 'Job rollback started' });
+  } catch (e) {
+    res.status(400).json({ error: e.message });
+  }
+});
+
+// GET /api/migration/stream?channels=batch,fetch — SSE: batchState / fetchState snapshots + deltas
+router.get('/stream', (req, res) => {
+  progressStream.subscribe(req, res);
+});
+
 // POST /api/migration/batch-pause
 router.post('/batch-pause', (req, res) => {
   try {
@@ -788,27 +359,19 @@ router.post('/batch-reset', (req, res) => {
 });
 
 // POST /api/migration/filter-cache-unprocessed
-// Filters amo_data_cache.json to keep ONLY entries not yet in migration_index.json
+// Filters the AMO entity store to keep ONLY entries not yet in the migration index
 router.post('/filter-cache-unprocessed', (req, res) => {
   try {
-    const cfg = require('../config');
-    const cachePath = path.resolve(cfg.backupDir, 'amo_data_cache.json');
-    const idxPath   = path.resolve(cfg.backupDir, 'migration_index.json');
-
-    if (!fs.existsSync(cachePath)) {
+    const cache = db.loadAmoEntityCache();
+    if (!cache) {
       return res.status(400).json({ error: 'Кэш AMO не найден. Сначала загрузите данные.' });
     }
 
-    const cache = fs.readJsonSync(cachePath);
-    const idx   = fs.existsSync(idxPath) ? fs.readJsonSync(idxPath) : {};
-
-    // Set of already-migrated IDs (stored as string keys)
-    const migratedLeadIds    = new Set(Object.keys(idx.leads    || {}).map(Number));
-    const migratedContactIds = new Set(Object.keys(idx.contacts || {}).map(Number));
-    const migratedCompanyIds = new Set(Object.keys(idx.companies || {}).map(Number));
+    // Already-migrated checks — O(1) lookups in the safety index
+    const isMigratedLead = (id) => safety.isMigrated('leads', id);
 
     // Filter leads
-    const filteredLeads = (cache.leads || []).filter(l => !migratedLeadIds.has(l.id));
+    const filteredLeads = (cache.leads || []).filter(l => !isMigratedLead(l.id));
 
     // Collect IDs of contacts/companies referenced by remaining leads
     const neededContactIds = new Set();
@@ -819,10 +382,10 @@ router.post('/filter-cache-unprocessed', (req, res) => {
     });
 
     // Filter related entities
-    const filteredContacts     = (cache.contacts  || []).filter(c => neededContactIds.has(c.id) && !migratedContactIds.has(c.id));
-    const filteredCompanies    = (cache.companies  || []).filter(c => neededCompanyIds.has(c.id) && !migratedCompanyIds.has(c.id));
-    const filteredLeadTasks    = (cache.leadTasks  || []).filter(t => !migratedLeadIds.has(t.entity_id));
-    const filteredLeadNotes    = (cache.leadNotes  || []).filter(n => !migratedLeadIds.has(n.entity_id));
+    const filteredContacts     = (cache.contacts  || []).filter(c => neededContactIds.has(c.id) && !safety.isMigrated('contacts', c.id));
+    const filteredCompanies    = (cache.companies  || []).filter(c => neededCompanyIds.has(c.id) && !safety.isMigrated('companies', c.id));
+    const filteredLeadTasks    = (cache.leadTasks  || []).filter(t => !isMigratedLead(t.entity_id));
+    const filteredLeadNotes    = (cache.leadNotes  || []).filter(n => !isMigratedLead(n.entity_id));
     const filteredContactIds   = new Set(filteredContacts.map(c => c.id));
     const filteredContactTasks = (cache.contactTasks || []).filter(t => filteredContactIds.has(t.entity_id));
     const filteredContactNotes = (cache.contactNotes || []).filter(n => filteredContactIds.has(n.entity_id));
@@ -846,7 +409,12 @@ router.post('/filter-cache-unprocessed', (req, res) => {
       filteredAt:   new Date().toISOString(),
     };
 
-    fs.writeJsonSync(cachePath, newCache);
+    db.replaceAmoEntities({
+      fetchedAt:  cache.fetchedAt,
+      pipelineId: cache.pipelineId,
+      managerIds: cache.managerIds,
+      filteredAt: newCache.filteredAt,
+    }, newCache);
 
     // Reset batch offset to 0 — the filtered list is now a new sequence
     batchService.resetOffset();
@@ -874,7 +442,7 @@ let _stageNamesCache = {};
 // GET /api/migration/deals-list — список сделок из кэша AMO
 router.get('/deals-list', async (req, res) => {
   try {
-    const cache = batchService.loadAmoCache();
+    const cache = batchService.loadAmoCache(['leads', 'contacts', 'companies']);
 
     // Build contact id → name map from cached contacts
     const contactMap = {};
@@ -997,6 +565,9 @@ router.get('/fields-analysis', async (req, res) => {
     const skipPath   = pathM.resolve(cfg.backupDir, 'skipped_fields.json');
     const skippedIds = fse.existsSync(skipPath) ? fse.readJsonSync(skipPath) : {};
 
+    // «Обновить» во вкладке полей — перечитать схемы обеих CRM
+    if (req.query.refresh === '1') fieldSchemaCache.invalidate();
+
     const entities = ['leads', 'contacts', 'companies'];
     const ENTITY_LABELS = { leads: 'Сделки', contacts: 'Контакты', companies: 'Компании' };
     const result = {};
@@ -1004,19 +575,14 @@ router.get('/fields-analysis', async (req, res) => {
 
     for (const entity of entities) {
       const [amoFields, kommoFields, amoGroups, kommoGroups] = await Promise.all([
-        amoApi.getCustomFields(entity),
-        kommoApi.getCustomFields(entity),
-        amoApi.getCustomFieldGroups ? amoApi.getCustomFieldGroups(entity) : Promise.resolve([]),
-        kommoApi.getCustomFieldGroups ? kommoApi.getCustomFieldGroups(entity) : Promise.resolve([]),
+        fieldSchemaCache.getFields('amo', entity),
+        fieldSchemaCache.getFields('kommo', entity),
+        fieldSchemaCache.getGroups('amo', entity),
+        fieldSchemaCache.getGroups('kommo', entity),
       ]);
 
-      // Индексируем Kommo-поля
-      const kByCode = {};
-      const kByName = {};
-      kommoFields.forEach(f => {
-        if (f.code) kByCode[f.code.toUpperCase()] = f;
-        kByName[(f.name || '').toLowerCase().trim()] = f;
-      });
+      // Индексируем Kommo-поля (code / имя / id / кластер синонимов → тип)
+      const kIndex = buildKommoFieldIndex(kommoFields);
 
       // Индексируем Kommo-группы по name
       const kGroupByName = {};
@@ -1048,11 +614,10 @@ router.get('/fields-analysis', async (req, res) => {
 
       // Очищаем устаревшие маппинги: если kommoFieldId исчез из Kommo (поле удалено),
       // убираем запись, чтобы поле показывалось как 'missing', а не 'synced'.
-      const kIdSet = new Set(kommoFields.map(f => f.id));
       let mappingDirty = false;
       Object.keys(entityMapping).forEach(amoId => {
         const kommoId = entityMapping[amoId]?.kommoFieldId;
-        if (kommoId && !kIdSet.has(kommoId)) {
+        if (kommoId && !kIndex.byId.has(kommoId)) {
           logger.info(`[fields-analysis] Stale mapping ${entity}.${amoId} → kommoFieldId ${kommoId} (not in Kommo), removing`);
           delete entityMapping[amoId];
           if (!existingMapping[entity]) existingMapping[entity] = {};
@@ -1109,19 +674,19 @@ router.get('/fields-analysis', async (req, res) => {
 
         // 1a. По code
         if (!groupHasNoKommo && af.code) {
-          const cand = kByCode[af.code.toUpperCase()];
+          const cand = kIndex.byCode.get(af.code.toUpperCase());
           if (cand && !usedKommoIds.has(cand.id)) { kf = cand; via = 'code'; }
         }
         // 1b. По name (точное совпадение, case-insensitive)
         if (!groupHasNoKommo && !kf) {
-          const cand = kByName[(af.name || '').toLowerCase().trim()];
+          const cand = kIndex.byName.get((af.name || '').toLowerCase().trim());
           if (cand && !usedKommoIds.has(cand.id)) { kf = cand; via = 'name'; }
         }
         // 1c. По сохранённому маппингу (ранее созданные поля) — разрешён всегда
         if (!kf) {
           const mappedId = entityMapping[af.id]?.kommoFieldId || null;
           if (mappedId) {
-            const cand = kommoFields.find(f => f.id === mappedId);
+            const cand = kIndex.byId.get(mappedId);
             if (cand && !usedKommoIds.has(cand.id)) { kf = cand; via = 'mapped'; }
           }
         }
@@ -1133,25 +698,18 @@ router.get('/fields-analysis', async (req, res) => {
       });
 
       // ── Проход 2: кросс-языковой анализ для незанятых Kommo-полей ──
-      const availableKommoFields = kommoFields.filter(kf => !usedKommoIds.has(kf.id));
-
+      // Кандидаты — из индекса по кластеру и типу; занятые пропускаются по usedKommoIds
       allAmoFields.forEach(af => {
         if (skippedIds[entity + '_' + af.id]) return;
         if (matchMap[af.id]) return; // уже найдено надёжным способом
         // Группы без аналога в Kommo — кросс-языковой матчинг не применяем
         if (af.group_id && amoGroupsWithNoKommo.has(af.group_id)) return;
 
-        const clm = findCrossLangMatch(af, availableKommoFields);
+        const clm = findCrossLangMatch(af, kIndex, usedKommoIds);
         if (clm) {
-          // Проверяем что этот Kommo-результат ещё не занят другим AMO-полем
-          // (возможно, если два AMO-поля в одном кластере)
-          if (!usedKommoIds.has(clm.field.id)) {
-            usedKommoIds.add(clm.field.id);
-            // Удаляем из available чтобы следующие поля не получили его
-            const idx = availableKommoFields.findIndex(f => f.id === clm.field.id);
-            if (idx >= 0) availableKommoFields.splice(idx, 1);
-            matchMap[af.id] = { kf: clm.field, via: clm.via, score: clm.score };
-          }
+          // Занимаем Kommo-поле, чтобы следующие AMO-поля того же кластера его не получили
+          usedKommoIds.add(clm.field.id);
+          matchMap[af.id] = { kf: clm.field, via: clm.via, score: clm.score };
         }
       });
       // ────────────────────────────────────────────────────────────────────
@@ -1259,12 +817,12 @@ router.post('/create-field', async (req, res) => {
     const kommoPipelineId = cfg.kommo.pipelineId;
 
     // Получаем определение поля из AMO
-    const amoFields = await amoApi.getCustomFields(entityType);
+    const amoFields = await fieldSchemaCache.getFields('amo', entityType);
     const amoField  = amoFields.find(f => f.id === Number(amoFieldId));
     if (!amoField) return res.status(404).json({ ok: false, error: 'AMO field not found' });
 
     // Проверяем, нет ли уже такого поля в Kommo
-    const kommoFields = await kommoApi.getCustomFields(entityType);
+    const kommoFields = await fieldSchemaCache.getFields('kommo', entityType, { fresh: true });
     const kByCode = {};
     const kByName = {};
     kommoFields.forEach(f => {
@@ -1341,9 +899,7 @@ router.post('/create-field', async (req, res) => {
     let targetGroupId = null;
     let groupCreated = null;
     try {
-      const amoGroups = amoApi.getCustomFieldGroups
-        ? await amoApi.getCustomFieldGroups(entityType)
-        : [];
+      const amoGroups = await fieldSchemaCache.getGroups('amo', entityType);
       const amoGroup = amoField.group_id
         ? amoGroups.find(g => g.id === amoField.group_id)
         : null;
@@ -1364,7 +920,7 @@ router.post('/create-field', async (req, res) => {
           // 3. Мы первые — создаём группу и регистрируем Promise, чтобы параллельные запросы ждали нас
           const creationPromise = (async () => {
             try {
-              const kommoGroups = await kommoApi.getCustomFieldGroups(entityType);
+              const kommoGroups = await fieldSchemaCache.getGroups('kommo', entityType, { fresh: true });
               const kGroupByName = {};
               kommoGroups.forEach(g => { kGroupByName[(g.name || '').toLowerCase().trim()] = g; });
               let kommoGroup = kGroupByName[mappedName] || kGroupByName[groupNameLc] || null;
@@ -1535,6 +1091,30 @@ router.get('/task-counts', async (req, res) => {
   }
 });
 
+/* ── Quarantine: records Kommo rejected on create ───────────────────── */
+router.get('/quarantine', (req, res) => {
+  try {
+    const items = db.listQuarantine(req.query.entity || null).map(r => ({
+      entity: r.entity, amoId: r.amo_id, name: r.payload?.name || null,
+      error: r.error, attempts: r.attempts, createdAt: r.created_at, updatedAt: r.updated_at,
+    }));
+    res.json({ ok: true, counts: db.countQuarantine(), items });
+  } catch (e) {
+    res.status(500).json({ ok: false, error: e.message });
+  }
+});
+
+router.post('/quarantine/retry', async (req, res) => {
+  try {
+    // Follow-up of created leads only PATCHes fields/links, so a missing mapping is not fatal
+    const { stageMapping = {} } = loadSavedStageMapping();
+    const summary = await batchService.retryQuarantine(stageMapping);
+    res.json({ ok: true, summary, counts: db.countQuarantine() });
+  } catch (e) {
+    res.status(500).json({ ok: false, error: e.message });
+  }
+});
+
 /* ── Reset safety index (admin only) ────────────────────────────────── */
 router.post('/safety-reset', (req, res) => {
   try {
@@ -56,19 +56,24 @@ router.get('/:id', (req, res) => {
   res.json({ session });
 });
 
-// GET /api/sessions/:id/preview — full preview data for modal
+const pageLimit = (value, def, max) => Math.min(Math.max(Number(value) || def, 1), max);
+
+// GET /api/sessions/:id/preview?limit=200&after=<next_after>&search= — preview data for modal, leads paged
 router.get('/:id/preview', (req, res) => {
-  const preview = getSessionPreview(req.params.id);
+  const preview = getSessionPreview(req.params.id, {
+    after: Number(req.query.after) || 0,
+    limit: pageLimit(req.query.limit, 200, 1000),
+    search: String(req.query.search || ''),
+  });
   if (!preview) return res.status(404).json({ error: 'Session not found' });
   res.json(preview);
 });
 
-// GET /api/sessions/:id/log — session log entries
+// GET /api/sessions/:id/log?limit=100&before=<next_before> — session log entries, newest first
 router.get('/:id/log', (req, res) => {
-  const limit  = Number(req.query.limit)  || 100;
-  const offset = Number(req.query.offset) || 0;
-  const logs = db.getSessionLog(req.params.id, limit, offset);
-  res.json({ logs });
+  const limit = pageLimit(req.query.limit, 100, 1000);
+  const logs = db.getSessionLogPage(req.params.id, { before: Number(req.query.before) || null, limit });
+  res.json({ logs, next_before: logs.length === limit ? logs[logs.length - 1].id : null });
 });
 
 // POST /api/sessions/:id/rollback-last — rollback last copied deal
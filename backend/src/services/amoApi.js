@@ -1,18 +1,16 @@
-const axios = require('axios');
-const config = require('../config');
 const logger = require('../utils/logger');
+const { getRateLimiter } = require('../utils/rateLimiter');
+const { createClient } = require('../utils/crmTransport');
+const metrics = require('../utils/metrics');
 // Note types to skip: 10 = incoming call, 11 = outgoing call (null params.link)
 const SKIP_NOTE_TYPES = new Set([10, 11]);
 
 
-const amoClient = axios.create({
-  baseURL: config.amo.baseUrl,
-  headers: {
-    Authorization: `Bearer ${config.amo.token}`,
-    'Content-Type': 'application/json',
-  },
-  timeout: 30000,
-});
+// Shared keep-alive transport (same socket pool as amoApiV2)
+const amoClient = createClient('amo');
+
+// Shared AMO scheduler (token bucket, 7 req/s, several requests in flight) — same instance as amoApiV2
+getRateLimiter('AMO').attach(amoClient);
 
 // 429 retry interceptor — wait Retry-After (or 2s) then retry up to 3 times
 amoClient.interceptors.response.use(null, async (error) => {
@@ -24,6 +22,8 @@ amoClient.interceptors.response.use(null, async (error) => {
     const retryAfter = parseInt(error.response.headers['retry-after'] || '2', 10);
     const delay = Math.max(retryAfter * 1000, 2000);
     logger.warn(`[amoApi] 429 received, retry #${cfg.__retryCount} after ${delay}ms`);
+    metrics.countRetry('AMO', '429');
+    metrics.addThrottleWait('AMO', 'retry_after', delay);
     await new Promise(r => setTimeout(r, delay));
     return amoClient(cfg);
   }
@@ -42,33 +42,17 @@ amoClient.interceptors.request.use((cfg) => {
   return cfg;
 });
 
-// Rate limiter: max 7 requests/sec for amo CRM API
-let lastRequestTime = 0;
-const MIN_INTERVAL = 300; // ms — 300ms gap = ~3 req/sec, well below 7/sec limit // ms
-
-async function rateLimit() {
-  const now = Date.now();
-  const elapsed = now - lastRequestTime;
-  if (elapsed < MIN_INTERVAL) {
-    await new Promise((r) => setTimeout(r, MIN_INTERVAL - elapsed));
-  }
-  lastRequestTime = Date.now();
-}
-
 async function getPipelines() {
-  await rateLimit();
   const res = await amoClient.get('/api/v4/leads/pipelines');
   return res.data._embedded?.pipelines || [];
 }
 
 async function getPipeline(pipelineId) {
-  await rateLimit();
   const res = await amoClient.get(`/api/v4/leads/pipelines/${pipelineId}`);
   return res.data;
 }
 
 async function getLeads(pipelineId, page = 1, limit = 50, managerIds = []) {
-  await rateLimit();
   const filter = { pipeline_id: pipelineId };
   if (Array.isArray(managerIds) && managerIds.length > 0) {
     filter.responsible_user_id = managerIds;
@@ -89,13 +73,15 @@ async function getLeads(pipelineId, page = 1, limit = 50, managerIds = []) {
   };
 }
 
-async function getAllLeads(pipelineId, managerIds = []) {
+// onPage(leads, page) — optional callback per page (pipelined fetch in routes/data.js)
+async function getAllLeads(pipelineId, managerIds = [], onPage = null) {
   const allLeads = [];
   let page = 1;
 
   while (true) {
     const { leads, hasNext } = await getLeads(pipelineId, page, 50, managerIds);
     allLeads.push(...leads);
+    if (onPage && leads.length > 0) onPage(leads, page);
     logger.info(`AMO: fetched leads page ${page}, total so far: ${allLeads.length}`);
     if (!hasNext || leads.length === 0) break;
     page++;
@@ -105,7 +91,6 @@ async function getAllLeads(pipelineId, managerIds = []) {
 }
 
 async function getContacts(page = 1, limit = 50) {
-  await rateLimit();
   const res = await amoClient.get('/api/v4/contacts', {
     params: { page, limit, with: 'leads' },
   });
@@ -139,7 +124,6 @@ async function getContactsByIds(ids) {
   const idArray = Array.from(ids);
   for (let i = 0; i < idArray.length; i += batchSize) {
     const batch = idArray.slice(i, i + batchSize);
-    await rateLimit();
     const res = await amoClient.get('/api/v4/contacts', {
       params: { filter: { id: batch }, limit: batchSize, with: 'leads' },
     });
@@ -151,7 +135,6 @@ async function getContactsByIds(ids) {
 }
 
 async function getCompanies(page = 1, limit = 50) {
-  await rateLimit();
   const res = await amoClient.get('/api/v4/companies', {
     params: { page, limit },
   });
@@ -185,7 +168,6 @@ async function getCompaniesByIds(ids) {
   const idArray = Array.from(ids);
   for (let i = 0; i < idArray.length; i += batchSize) {
     const batch = idArray.slice(i, i + batchSize);
-    await rateLimit();
     const res = await amoClient.get('/api/v4/companies', {
       params: { filter: { id: batch }, limit: batchSize },
     });
@@ -197,7 +179,6 @@ async function getCompaniesByIds(ids) {
 }
 
 async function getTasks(entityType = 'leads', entityId = null, page = 1, limit = 50) {
-  await rateLimit();
   const params = { page, limit };
   if (entityType) params.filter = { entity_type: entityType };
   if (entityId) params.filter = { ...params.filter, entity_id: entityId };
@@ -259,7 +240,6 @@ async function getLeadTasksByEntityIds(entityIds) {
   const idArray = Array.from(entityIds);
   for (let i = 0; i < idArray.length; i += batchSize) {
     const batch = idArray.slice(i, i + batchSize);
-    await rateLimit();
     const res = await amoClient.get('/api/v4/tasks', {
       params: { filter: { entity_type: 'leads', entity_id: batch }, limit: 250 },
     });
@@ -269,7 +249,6 @@ async function getLeadTasksByEntityIds(entityIds) {
     let hasNext = !!res.data._links?.next;
     let page = 2;
     while (hasNext) {
-      await rateLimit();
       const r2 = await amoClient.get('/api/v4/tasks', {
         params: { filter: { entity_type: 'leads', entity_id: batch }, limit: 250, page },
       });
@@ -291,7 +270,6 @@ async function getCompanyTasksByEntityIds(entityIds) {
   const idArray = Array.from(entityIds);
   for (let i = 0; i < idArray.length; i += batchSize) {
     const batch = idArray.slice(i, i + batchSize);
-    await rateLimit();
     const res = await amoClient.get('/api/v4/tasks', {
       params: { filter: { entity_type: 'companies', entity_id: batch }, limit: 250 },
     });
@@ -300,7 +278,6 @@ async function getCompanyTasksByEntityIds(entityIds) {
     let hasNext = !!res.data._links?.next;
     let page = 2;
     while (hasNext) {
-      await rateLimit();
       const r2 = await amoClient.get('/api/v4/tasks', {
         params: { filter: { entity_type: 'companies', entity_id: batch }, limit: 250, page },
       });
@@ -322,7 +299,6 @@ async function getContactTasksByEntityIds(entityIds) {
   const idArray = Array.from(entityIds);
   for (let i = 0; i < idArray.length; i += batchSize) {
     const batch = idArray.slice(i, i + batchSize);
-    await rateLimit();
     const res = await amoClient.get('/api/v4/tasks', {
       params: { filter: { entity_type: 'contacts', entity_id: batch }, limit: 250 },
     });
@@ -331,7 +307,6 @@ async function getContactTasksByEntityIds(entityIds) {
     let hasNext = !!res.data._links?.next;
     let page = 2;
     while (hasNext) {
-      await rateLimit();
       const r2 = await amoClient.get('/api/v4/tasks', {
         params: { filter: { entity_type: 'contacts', entity_id: batch }, limit: 250, page },
       });
@@ -349,7 +324,6 @@ async function getAllLeadNotes() {
   const all = [];
   let page = 1;
   while (true) {
-    await rateLimit();
     const res = await amoClient.get('/api/v4/leads/notes', { params: { page, limit: 250 } });
     const notes = res.data._embedded?.notes || [];
     const hasNext = !!res.data._links?.next;
@@ -365,7 +339,6 @@ async function getAllContactNotes() {
   const all = [];
   let page = 1;
   while (true) {
-    await rateLimit();
     const res = await amoClient.get('/api/v4/contacts/notes', { params: { page, limit: 250 } });
     const notes = res.data._embedded?.notes || [];
     const hasNext = !!res.data._links?.next;
@@ -387,7 +360,6 @@ async function getLeadNotesByEntityIds(entityIds) {
     const batch = idArray.slice(i, i + batchSize);
     let page = 1;
     while (true) {
-      await rateLimit();
       const res = await amoClient.get('/api/v4/leads/notes', {
         params: { filter: { entity_id: batch }, limit: 250, page },
       });
@@ -412,7 +384,6 @@ async function getContactNotesByEntityIds(entityIds) {
     const batch = idArray.slice(i, i + batchSize);
     let page = 1;
     while (true) {
-      await rateLimit();
       const res = await amoClient.get('/api/v4/contacts/notes', {
         params: { filter: { entity_id: batch }, limit: 250, page },
       });
@@ -427,8 +398,65 @@ async function getContactNotesByEntityIds(entityIds) {
   return allNotes;
 }
 
+// Fetch company notes only for specific entity IDs (batch by 50)
+async function getCompanyNotesByEntityIds(entityIds) {
+  if (!entityIds || entityIds.length === 0) return [];
+  const allNotes = [];
+  const batchSize = 50;
+  const idArray = Array.from(entityIds);
+  for (let i = 0; i < idArray.length; i += batchSize) {
+    const batch = idArray.slice(i, i + batchSize);
+    let page = 1;
+    while (true) {
+      const res = await amoClient.get('/api/v4/companies/notes', {
+        params: { filter: { entity_id: batch }, limit: 250, page },
+      });
+      const notes = res.data._embedded?.notes || [];
+      const hasNext = !!res.data._links?.next;
+      allNotes.push(...notes);
+      if (!hasNext || notes.length === 0) break;
+      page++;
+    }
+    logger.info(`AMO: fetched company notes for batch ${Math.floor(i / batchSize) + 1}/${Math.ceil(idArray.length / batchSize)}`);
+  }
+  return allNotes;
+}
+
+/**
+ * All items of a list endpoint changed since a moment (filter[updated_at][from]) — delta sync.
+ * @param {string} url - e.g. '/api/v4/leads', '/api/v4/tasks', '/api/v4/contacts/notes'
+ * @param {string} key - _embedded key: 'leads', 'tasks', 'notes', ...
+ * @param {number} since - unix seconds
+ * @param {object} [params] - extra query params (params.filter is merged with updated_at)
+ */
+async function getAllUpdatedSince(url, key, since, params = {}) {
+  const all = [];
+  let page = 1;
+  while (true) {
+    const res = await amoClient.get(url, {
+      params: { limit: 250, ...params, filter: { ...(params.filter || {}), updated_at: { from: since } }, page },
+    });
+    const items = res.data?._embedded?.[key] || [];
+    all.push(...items);
+    if (!res.data?._links?.next || items.length === 0) break;
+    page++;
+  }
+  logger.info(`AMO: ${all.length} ${key} from ${url} updated since ${new Date(since * 1000).toISOString()}`);
+  return all;
+}
+
+/**
+ * IDs of entities changed since a moment (updated_at >= since), account-wide.
+ * @param {string} entityType - 'leads' | 'contacts' | 'companies'
+ * @param {number} since - unix seconds
+ * @returns {Promise<Map<number, number>>} id → updated_at
+ */
+async function getUpdatedEntityIds(entityType, since) {
+  const items = await getAllUpdatedSince(`/api/v4/${entityType}`, entityType, since);
+  return new Map(items.map(item => [item.id, item.updated_at]));
+}
+
 async function getNotes(entityType, entityId, page = 1, limit = 50) {
-  await rateLimit();
   const res = await amoClient.get(`/api/v4/${entityType}/${entityId}/notes`, {
     params: { page, limit },
   });
@@ -464,7 +492,6 @@ async function getContactNotes(contactId) {
 }
 
 async function getCustomFields(entityType = 'leads') {
-  await rateLimit();
   const res = await amoClient.get(`/api/v4/${entityType}/custom_fields`, { params: { limit: 250 } });
   return res.data._embedded?.custom_fields || [];
 }
@@ -474,7 +501,6 @@ async function getCustomFields(entityType = 'leads') {
  * Группы используются для структурирования полей в UI (Основное, Технические и т.д.)
  */
 async function getCustomFieldGroups(entityType = 'leads') {
-  await rateLimit();
   const res = await amoClient.get(`/api/v4/${entityType}/custom_fields/groups`, {
     params: { limit: 250 }
   });
@@ -482,7 +508,6 @@ async function getCustomFieldGroups(entityType = 'leads') {
 }
 
 async function getUsers() {
-  await rateLimit();
   const res = await amoClient.get('/api/v4/users', { params: { limit: 250 } });
   return res.data._embedded?.users || [];
 }
@@ -512,6 +537,9 @@ module.exports = {
   getAllContactNotes,
   getLeadNotesByEntityIds,
   getContactNotesByEntityIds,
+  getCompanyNotesByEntityIds,
+  getUpdatedEntityIds,
+  getAllUpdatedSince,
   getCustomFields,
   getCustomFieldGroups,
   getUsers,
@@ -2,21 +2,13 @@
  * AMO CRM API client — enhanced version for deal copying.
  * All calls are rate-limited and auto-retried.
  */
-const axios = require('axios');
-const config = require('../config');
 const logger = require('../utils/logger');
-const { createRateLimiter } = require('../utils/rateLimiter');
+const { getRateLimiter } = require('../utils/rateLimiter');
+const { createClient } = require('../utils/crmTransport');
 
-const { execute } = createRateLimiter('AMO');
+const { execute } = getRateLimiter('AMO');
 
-const client = axios.create({
-  baseURL: `${config.amo.baseUrl}/api/v4`,
-  headers: {
-    Authorization: `Bearer ${config.amo.token}`,
-    'Content-Type': 'application/json',
-  },
-  timeout: 30000,
-});
+const client = createClient('amo', '/api/v4');
 
 // Generic paginated fetcher
 async function fetchAllPages(endpoint, params = {}) {
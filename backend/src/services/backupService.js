@@ -1,7 +1,11 @@
 const fs = require('fs-extra');
 const path = require('path');
+const zlib = require('zlib');
+const { Readable } = require('stream');
+const { pipeline } = require('stream/promises');
 const config = require('../config');
 const logger = require('../utils/logger');
+const snapshots = require('./snapshotStore');
 
 async function ensureBackupDir() {
   await fs.ensureDir(config.backupDir);
@@ -9,30 +13,74 @@ async function ensureBackupDir() {
 
 function getBackupPath(name) {
   const timestamp = new Date().toISOString().replace(/[:.]/g, '-');
-  return path.join(config.backupDir, `${name}_${timestamp}.json`);
+  return path.join(config.backupDir, `${name}_${timestamp}.json.gz`);
+}
+
+// Compact JSON in pieces: top-level arrays element by element, so a large dump is
+// never one string in memory
+function* jsonChunks(data) {
+  if (!data || typeof data !== 'object' || Array.isArray(data)) {
+    yield JSON.stringify(data ?? null);
+    return;
+  }
+  let first = true;
+  yield '{';
+  for (const [key, value] of Object.entries(data)) {
+    if (value === undefined) continue;
+    yield `${first ? '' : ','}${JSON.stringify(key)}:`;
+    first = false;
+    if (Array.isArray(value)) {
+      yield '[';
+      for (let i = 0; i < value.length; i++) yield (i ? ',' : '') + JSON.stringify(value[i] ?? null);
+      yield ']';
+    } else {
+      yield JSON.stringify(value);
+    }
+  }
+  yield '}';
 }
 
 async function saveBackup(name, data) {
   await ensureBackupDir();
   const filePath = getBackupPath(name);
-  await fs.writeJson(filePath, data, { spaces: 2 });
-  logger.info(`Backup saved: ${filePath} (${JSON.stringify(data).length} bytes)`);
+  await pipeline(Readable.from(jsonChunks(data)), zlib.createGzip(), fs.createWriteStream(filePath));
+  const { size } = await fs.stat(filePath);
+  logger.info(`Backup saved: ${filePath} (${size} bytes gzip)`);
   return filePath;
 }
 
+/**
+ * Load a backup: snapshot manifest (whole snapshot restored), .json.gz or legacy .json.
+ */
 async function loadBackup(filePath) {
+  if (snapshots.isSnapshotFile(filePath)) {
+    const { meta, ...records } = await snapshots.restoreSnapshot(filePath);
+    delete records.created;
+    return { ...meta, ...records };
+  }
   if (!await fs.pathExists(filePath)) {
     throw new Error(`Backup file not found: ${filePath}`);
   }
+  if (filePath.endsWith('.gz')) {
+    return JSON.parse(zlib.gunzipSync(await fs.readFile(filePath)).toString('utf8'));
+  }
   return fs.readJson(filePath);
 }
 
+/**
+ * Restore part of a snapshot — one entity type and/or an id range — without unpacking the rest.
+ * @see snapshotStore.restoreSnapshot
+ */
+async function restoreRecords(snapshotRef, opts) {
+  return snapshots.restoreSnapshot(snapshotRef, opts);
+}
+
 async function listBackups() {
   await ensureBackupDir();
   const files = await fs.readdir(config.backupDir);
   const backups = [];
 
-  for (const file of files.filter((f) => f.endsWith('.json'))) {
+  for (const file of files.filter((f) => f.endsWith('.json') || f.endsWith('.json.gz'))) {
     const filePath = path.join(config.backupDir, file);
     const stat = await fs.stat(filePath);
     backups.push({
@@ -42,34 +90,37 @@ async function listBackups() {
       created: stat.birthtime,
     });
   }
+  backups.push(...await snapshots.listSnapshots());
 
   return backups.sort((a, b) => new Date(b.created) - new Date(a.created));
 }
 
+/**
+ * Full backup of the AMO data as a deduplicated snapshot: records unchanged since an
+ * earlier snapshot are not written again.
+ */
 async function createFullBackup(data) {
-  const backupData = {
-    timestamp: new Date().toISOString(),
-    source: 'amo CRM',
-    target: 'Kommo CRM',
+  const collections = {
     leads: data.leads || [],
     contacts: data.contacts || [],
     companies: data.companies || [],
     tasks: data.tasks || [],
+  };
+  const meta = {
+    timestamp: new Date().toISOString(),
+    source: 'amo CRM',
+    target: 'Kommo CRM',
     pipeline: data.pipeline || null,
   };
 
-  const filePath = await saveBackup('full_backup', backupData);
-  return { filePath, stats: {
-    leads: backupData.leads.length,
-    contacts: backupData.contacts.length,
-    companies: backupData.companies.length,
-    tasks: backupData.tasks.length,
-  }};
+  const { filePath, stats } = await snapshots.createSnapshot('full_backup', collections, meta);
+  return { filePath, stats };
 }
 
 module.exports = {
   saveBackup,
   loadBackup,
+  restoreRecords,
   listBackups,
   createFullBackup,
 };
@@ -9,96 +9,39 @@ const kommoApi = require('./kommoApi');
 const config = require('../config');
 const logger = require('../utils/logger');
 const { loadFieldMapping, buildAllFieldMappings, saveFieldMapping } = require('../utils/fieldMapping');
-const { fmtDatePrefix } = require('../utils/dataTransformer');
+const { fmtDatePrefix, compileFieldPlan } = require('../utils/dataTransformer');
 const safety = require('../utils/safetyGuard');
-
-const CACHE_FILE = path.resolve(config.backupDir, 'amo_data_cache.json');
-const BATCH_CONFIG_FILE = path.resolve(config.backupDir, 'batch_config.json');
-
-// ─── State ────────────────────────────────────────────────────────────────────
-let pauseRequestedFlag = false;
-let autoRunEnabled = false;    // auto-run cycle active
-let autoRunStopFlag = false;   // user pressed stop during countdown
-let autoRunContinueFlag = false; // frontend signals: countdown done, start next batch
-
-let batchState = {
-  status: 'idle', // idle | running | completed | error | rolling_back | paused | auto-waiting
-  step: null,
-  progress: { current: 0, total: 0 },
-  errors: [],
-  warnings: [],
-  createdIds: { contacts: [], companies: [], leads: [], tasks: [], notes: [] },
-  stats: { totalEligible: 0, totalTransferred: 0, remainingLeads: 0 },
-  startedAt: null,
-  completedAt: null,
-};
-
-let batchConfig = {
-  managerIds: [],   // [] = all managers
-  batchSize: 10,
-  offset: 0,        // number of eligible leads already transferred
-  stageMapping: {},
-  migrationMode: 'all', // 'all' | 'fix-existing' | 'new-only'
-  fixProcessed: 0,  // cumulative deals processed in fix-existing mode
-  fixEligible: 0,   // total eligible for fix-existing at last count
-};
-
-// ─── Config helpers ───────────────────────────────────────────────────────────
-function loadBatchConfig() {
-  if (fs.existsSync(BATCH_CONFIG_FILE)) {
-    try { batchConfig = { ...batchConfig, ...fs.readJsonSync(BATCH_CONFIG_FILE) }; } catch {}
-  }
-  return batchConfig;
-}
-
-function saveBatchConfig() {
-  fs.ensureDirSync(path.dirname(BATCH_CONFIG_FILE));
-  fs.writeJsonSync(BATCH_CONFIG_FILE, batchConfig, { spaces: 2 });
-}
-
-function getBatchConfig() { loadBatchConfig(); return { ...batchConfig }; }
-
-function setBatchConfig(updates) {
-  loadBatchConfig();
-  batchConfig = { ...batchConfig, ...updates };
-  saveBatchConfig();
-}
-
-function getBatchState() { return { ...batchState }; }
-
-// ─── State helpers ────────────────────────────────────────────────────────────
-function updateState(u) { batchState = { ...batchState, ...u }; }
-
-function addError(message, recommendation) {
-  batchState.errors.push({ timestamp: new Date().toISOString(), message, recommendation: recommendation || null });
-  logger.error(`[batch] ${message}`);
-}
-
-function addWarning(message, recommendation, details) {
-  const entry = { timestamp: new Date().toISOString(), message, recommendation: recommendation || null };
-  if (details && details.length > 0) entry.details = details;
-  batchState.warnings.push(entry);
-  logger.warn(`[batch] ${message}`);
-}
+const counters = require('../utils/migrationCounters');
+const db = require('../db');
+const batchSource = require('./batchSource');
+const noteSource = require('./noteSource');
+const rollbackEngine = require('./rollbackEngine');
+const progressStream = require('./progressStream');
+const metrics = require('../utils/metrics');
 
 // ─── Cache helpers ────────────────────────────────────────────────────────────
-function loadAmoCache() {
-  if (!fs.existsSync(CACHE_FILE)) {
-    throw new Error('Данные не загружены. Перейдите на вкладку "Данные amo" и нажмите "Загрузить данные".');
-  }
-  return fs.readJsonSync(CACHE_FILE);
+const NO_CACHE_MESSAGE = 'Данные не загружены. Перейдите на вкладку "Данные amo" и нажмите "Загрузить данные".';
+
+// Snapshot metadata only ({ fetchedAt, pipelineId, managerIds, counts }) — cheap
+function loadAmoCacheMeta() {
+  const meta = db.getAmoCacheMeta();
+  if (!meta) throw new Error(NO_CACHE_MESSAGE);
+  return meta;
 }
 
-function getEligibleLeads(leads, managerIds) {
-  if (!managerIds || managerIds.length === 0) return leads;
-  const idSet = new Set(managerIds.map(Number));
-  return leads.filter(l => idSet.has(l.responsible_user_id));
+/**
+ * Full AMO snapshot from the SQLite entity store (legacy amo_data_cache.json shape).
+ * @param {string[]} [types] - load only these entity types, e.g. ['leads', 'contacts']
+ */
+function loadAmoCache(types) {
+  const cache = db.loadAmoEntityCache(types);
+  if (!cache) throw new Error(NO_CACHE_MESSAGE);
+  return cache;
 }
 
 // ─── Analyse managers ─────────────────────────────────────────────────────────
 async function analyzeManagers() {
-  const cache = loadAmoCache();
-  const leads = cache.leads || [];
+  const cache = loadAmoCacheMeta();
 
   let usersMap = {};
   try {
@@ -109,26 +52,22 @@ async function analyzeManagers() {
   }
 
   const counts = {};
-  leads.forEach(lead => {
-    const uid = lead.responsible_user_id;
+  db.countAmoEntitiesByResponsible('leads').forEach(({ uid, cnt }) => {
     if (!uid) return;
-    if (!counts[uid]) {
-      counts[uid] = {
-        id: uid,
-        name: usersMap[uid]?.name || `Менеджер #${uid}`,
-        email: usersMap[uid]?.email || '',
-        leadCount: 0,
-      };
-    }
-    counts[uid].leadCount++;
+    counts[uid] = {
+      id: uid,
+      name: usersMap[uid]?.name || `Менеджер #${uid}`,
+      email: usersMap[uid]?.email || '',
+      leadCount: cnt,
+    };
   });
 
   const cfg = getBatchConfig();
   const managers = Object.values(counts).sort((a, b) => b.leadCount - a.leadCount);
-  const eligibleCount = getEligibleLeads(leads, cfg.managerIds).length;
+  const eligibleCount = counters.getEligibleLeads(cfg.managerIds);
 
   return {
-    totalLeads: leads.length,
+    totalLeads: db.countAmoEntities('leads'),
     managers,
     currentManagerIds: cfg.managerIds,
     eligibleCount,
@@ -140,41 +79,42 @@ async function analyzeManagers() {
 function getStats() {
   const cfg = getBatchConfig();
   let cache = null;
-  try { cache = loadAmoCache(); } catch { return null; }
+  try { cache = loadAmoCacheMeta(); } catch { return null; }
 
-  const leads = cache?.leads || [];
-  const eligible = getEligibleLeads(leads, cfg.managerIds);
+  // Both counts are materialized (migrationCounters), no snapshot / file reads per call.
+  const eligibleCount = counters.getEligibleLeads(cfg.managerIds);
 
-  // Use migration_index.json minus session baseline to get "already migrated THIS funnel session".
-  // The baseline is snap-shotted when: (1) new AMO data is loaded, (2) "Сбросить счётчик" is pressed.
+  // Use the migration index minus session baseline to get "already migrated THIS funnel session".
+  // The baseline is snap-shotted when "Сбросить счётчик" is pressed.
   // This prevents stale counts from old funnels leaking into the new funnel display.
   let alreadyMigrated = 0;
-  try {
-    const idxPath  = path.resolve(config.backupDir, 'migration_index.json');
-    const basePath = path.resolve(config.backupDir, 'session_baseline.json');
-    if (fs.existsSync(idxPath)) {
-      const idx = fs.readJsonSync(idxPath);
-      const totalInIndex = idx.leads ? Object.keys(idx.leads).length : 0;
-      let baseLeads = 0;
-      if (fs.existsSync(basePath)) {
-        try { baseLeads = (fs.readJsonSync(basePath)).leads || 0; } catch {}
-      }
-      alreadyMigrated = Math.max(0, totalInIndex - baseLeads);
-    }
-  } catch {}
+  try { alreadyMigrated = counters.getMigrationTotals().leads; } catch {}
 
   return {
-    totalEligible: eligible.length,
+    totalEligible: eligibleCount,
     totalTransferred: cfg.offset,          // batch cursor for this session (used for paging)
     alreadyMigrated,                        // total ever migrated (all sessions)
-    remainingLeads: Math.max(0, eligible.length - alreadyMigrated),
+    remainingLeads: Math.max(0, eligibleCount - alreadyMigrated),
     batchSize: cfg.batchSize,
     managerIds: cfg.managerIds,
     dataFetchedAt: cache?.fetchedAt,
+    quarantine: db.countQuarantine(),       // { leads, contacts, companies } rejected by Kommo on create
   };
 }
 
 // ─── Main batch migration ─────────────────────────────────────────────────────
+/** Log aggregated unmapped-field warnings left by per-item transforms (PATCH of existing entities). */
+function flushFieldWarnings(fieldMapping, label) {
+  const plan = compileFieldPlan(fieldMapping);
+  if (plan) plan.flushUnmapped(label);
+}
+
+/** Warning about records Kommo rejected on create (kommoApi keeps them in the quarantine). */
+function quarantineNote(label, total, createdCount) {
+  const n = total - createdCount;
+  return n > 0 ? `${n} ${label} отклонены Kommo при создании и помещены в карантин — повтор кнопкой «☣ Карантин — повторить»` : null;
+}
+
 /**
  * Sanitize AMO note for Kommo API.
  * - Removes null/undefined values from params (causes 400).
@@ -223,811 +163,190 @@ function sanitizeNoteParams(note) {
 // Note types to skip: 10 = incoming call, 11 = outgoing call (have null params.link)
 const SKIP_NOTE_TYPES = new Set([10, 11, 'amomail_message', 'extended_service_message', 'lead_auto_created', 'attachment', 'link_followed']);
 
-async function runBatchMigration(stageMapping) {
-  if (batchState.status === 'running') throw new Error('Пакетная миграция уже выполняется');
-
-  // Reset stale flags from previous stop (prevents phantom pause on new batch)
-  pauseRequestedFlag = false;
-  if (!autoRunEnabled) autoRunStopFlag = false;
+// Quarantine retry and single-deal transfers run outside any batch engine: nothing else
+// keeps two of them (or one and a running batch / parallel jobs) from POSTing the same records
+const QUARANTINE_OWNER = 'quarantine';
+let quarantineRetryRunning = false;
+let singleTransfers = 0;
 
-  loadBatchConfig();
-
-  updateState({
-    status: 'running',
-    step: 'Инициализация пакета...',
-    errors: [], warnings: [],
-    progress: { current: 0, total: 0 },
-    createdIds: { contacts: [], companies: [], leads: [], tasks: [], notes: [] },
-    stats: { totalEligible: 0, totalTransferred: batchConfig.offset, remainingLeads: 0 },
-    startedAt: new Date().toISOString(),
-    completedAt: null,
-  });
+function otherMigrationRunning() {
+  if (['running', 'rolling_back'].includes(getBatchState().status)) return 'пакетная миграция';
+  if (require('./migrationJobs').isActive()) return 'параллельные задания';
+  return null;
+}
 
+/**
+ * Retry records Kommo rejected on create, with payloads rebuilt from the snapshot and
+ * the current mappings. Companies and contacts go first so that leads' _embedded links
+ * point to existing entities. Records that fail again stay in the quarantine with
+ * attempts + 1.
+ * The batch stages never saw what is created here, so afterwards contacts/companies
+ * are linked to their already migrated leads, and created leads go through
+ * the single-deal transfer (as migrated leads: links, tasks, notes).
+ * @param {object} [stageMapping] - stage_mapping.json
+ * @returns {Promise<object>} { leads: { retried, created, left }, ..., relinked, followUp }
+ */
+async function retryQuarantine(stageMapping = {}) {
+  if (quarantineRetryRunning) throw new Error('Повтор карантина уже выполняется');
+  if (singleTransfers > 0) throw new Error('Выполняется перенос выбранных сделок — повторите позже');
+  const busy = otherMigrationRunning();
+  if (busy) throw new Error(`Выполняется ${busy} — повторите карантин после её завершения`);
+  quarantineRetryRunning = true;
   try {
-    /* ── 1. Load cache ─────────────────────────────────────────────── */
-    let cache;
-    try { cache = loadAmoCache(); } catch (e) {
-      addError(e.message, 'Перейдите на вкладку "Данные amo" и нажмите "Загрузить данные".');
-      updateState({ status: 'error', completedAt: new Date().toISOString() });
-      return;
-    }
-
-    const allLeads     = cache.leads     || [];
-    const allContacts  = cache.contacts  || [];
-    const allCompanies = cache.companies || [];
-    // Support both new format (leadTasks/contactTasks) and legacy (tasks)
-    const allTasks = [
-      ...(cache.leadTasks    || []),
-      ...(cache.contactTasks || []),
-      ...(cache.companyTasks || []),
-      ...(cache.tasks        || []),
-    ];
-
-    /* ── 2. Filter by managers ──────────────────────────────────────── */
-    let eligible = getEligibleLeads(allLeads, batchConfig.managerIds);
-
-    /* ── 2b. Filter by migration mode ───────────────────────────────── */
-    const _mode = batchConfig.migrationMode || 'all';
-    const _skipCreate = (_mode === 'fix-existing');  // don't create new entities, only PATCH existing
-    const _skipPatch  = (_mode === 'new-only');       // don't patch existing, only create new
-    if (_mode === 'fix-existing' || _mode === 'new-only') {
-      const _modeIdx = safety.loadIndex();
-      const _modeIdxLeads = _modeIdx.leads || {};
-      if (_mode === 'fix-existing') {
-        eligible = eligible.filter(l => !!_modeIdxLeads[String(l.id)]);
-        logger.info(`[batch] Mode=fix-existing: ${eligible.length} leads already in index`);
-      } else {
-        eligible = eligible.filter(l => !_modeIdxLeads[String(l.id)]);
-        logger.info(`[batch] Mode=new-only: ${eligible.length} leads NOT in index`);
-      }
-    }
-
-    batchState.stats.totalEligible = eligible.length;
-    batchState.stats.remainingLeads = Math.max(0, eligible.length - batchConfig.offset);
-
-    if (eligible.length === 0) {
-      addWarning(
-        batchConfig.managerIds.length === 0
-          ? 'Нет сделок для переноса. Данные могут быть не загружены.'
-          : 'Нет сделок для выбранных менеджеров.',
-        'Выберите других менеджеров или загрузите актуальные данные из amo CRM.'
-      );
-      updateState({ status: 'completed', step: 'Нет данных для переноса', completedAt: new Date().toISOString() });
-      return;
-    }
-
-    /* ── 3. Get current batch ───────────────────────────────────────── */
-    const from = batchConfig.offset;
-    // batchSize === 0 means "transfer ALL remaining"
-    const batchLeads = batchConfig.batchSize === 0
-      ? eligible.slice(from)
-      : eligible.slice(from, from + batchConfig.batchSize);
-
-    if (batchLeads.length === 0) {
-      addWarning(
-        `Все ${eligible.length} сделок уже перенесены (смещение: ${from}).`,
-        'Для нового цикла переноса нажмите "Сбросить счётчик".'
-      );
-      updateState({ status: 'completed', step: 'Все сделки перенесены', completedAt: new Date().toISOString() });
-      return;
-    }
-
-    updateState({ step: `Пакет: сделки ${from + 1}–${from + batchLeads.length} из ${eligible.length}`, progress: { current: 0, total: batchLeads.length } });
-    logger.info(`Batch: migrating leads ${from}–${from + batchLeads.length - 1} / ${eligible.length}`);
-
-    /* ── 4. Validate stages ─────────────────────────────────────────── */
-    if (!stageMapping || Object.keys(stageMapping).length === 0) {
-      addWarning('Маппинг этапов пустой.', 'Нажмите "Синхронизировать этапы" перед запуском миграции.');
-    } else {
-      const unmapped = new Set();
-      batchLeads.forEach(l => {
-        if (l.status_id && !stageMapping[l.status_id] && ![142, 143].includes(l.status_id))
-          unmapped.add(l.status_id);
-      });
-      if (unmapped.size > 0) {
-        addWarning(
-          `Этапы [${[...unmapped].join(', ')}] отсутствуют в маппинге — сделки попадут в первый доступный этап.`,
-          'Выполните "Синхронизировать этапы" для создания недостающих этапов в Kommo CRM.'
-        );
-      }
-    }
-
-    /* ── 5. Validate contacts ───────────────────────────────────────── */
-    const leadsNoContact = batchLeads.filter(l => !l._embedded?.contacts?.length);
-    if (leadsNoContact.length > 0) {
-      const _safetyIdx = safety.loadIndex();
-      const _ncDetails = leadsNoContact.map(l => {
-        const _kId = (_safetyIdx.leads || {})[String(l.id)];
-        const _kPart = _kId ? ' \u2192 Kommo#' + _kId : '';
-        return 'Сделка AMO#' + l.id + _kPart + ' (' + (l.name || 'без названия').substring(0, 40) + ')';
-      });
-      addWarning(
-        `${leadsNoContact.length} сделок не имеют привязанных контактов.`,
-        'Убедитесь, что это корректно. Сделки без контактов будут перенесены как есть.',
-        _ncDetails
-      );
-    }
-
-    /* ── 6. Collect related entities ────────────────────────────────── */
-    const neededContactIds  = new Set(batchLeads.flatMap(l => (l._embedded?.contacts  || []).map(c => c.id)));
-    const neededCompanyIds  = new Set(batchLeads.flatMap(l => (l._embedded?.companies || []).map(c => c.id)));
-    const batchContacts  = allContacts.filter(c => neededContactIds.has(c.id));
-    const batchCompanies = allCompanies.filter(c => neededCompanyIds.has(c.id));
-
-    /* ── 6b. Load field mappings ────────────────────────────────────── */
-    let fieldMappings = loadFieldMapping();
-    if (!fieldMappings) {
-      addWarning(
-        'Маппинг кастомных полей не найден.',
-        'Выполните "Синхронизировать поля" для переноса кастомных полей. Без маппинга кастомные поля переноситься не будут.'
-      );
-      fieldMappings = { leads: null, contacts: null, companies: null };
-    }
+    return await retryQuarantineRecords(stageMapping);
+  } finally {
+    safety.releaseClaims(QUARANTINE_OWNER);
+    quarantineRetryRunning = false;
+  }
+}
 
-      // --- User mapping for batch ---
-      const userMap = {};
-      try {
-        const db = require('../db');
-        const ums = db.getUserMappings ? db.getUserMappings() : [];
-        ums.forEach(m => { userMap[m.amo_user_id] = m.kommo_user_id; userMap[String(m.amo_user_id)] = m.kommo_user_id; });
-      } catch (e) { /* proceed without user mapping */ }
-
-    /* ── 7. Migrate companies ───────────────────────────────────────── */
-        // pause before companies (safe: nothing written to Kommo yet)
-    if (pauseRequestedFlag) {
-      pauseRequestedFlag = false;
-      saveBatchConfig();
-      updateState({ status: 'paused', step: '⏸ Пауза перед переносом компаний', completedAt: new Date().toISOString() });
-      logger.info('Batch paused before companies');
-      return;
-    }
-    updateState({ step: `Перенос компаний (${batchCompanies.length})...` });
-    const companyIdMap = {};
-    if (batchCompanies.length > 0) {
-      const { transformCompany } = require('../utils/dataTransformer');
-      // ═ САФЕТИ: исключаем уже перенесённые компании ════════
-      const { toCreate: companiesToCreate, skipped: companiesSkipped } =
-        safety.filterNotMigrated('companies', batchCompanies, c => c.id);
-      if (companiesSkipped.length > 0) {
-        const _csIdx = safety.loadIndex();
-        const _csDetails = companiesSkipped.map(({ item, amoId, kommoId }) => {
-          const allLinkedLeads = (item && item._embedded && item._embedded.leads) ? item._embedded.leads.map(l => l.id) : [];
-          const linkedLeads = allLinkedLeads.map(lid => {
-            const _kLid = (_csIdx.leads || {})[String(lid)];
-            return 'AMO#' + lid + (_kLid ? '/Kommo#' + _kLid : '');
-          }).join(', ');
-          return `Компания AMO#${amoId} → Kommo#${kommoId}` + (linkedLeads ? ` (привязана к сделкам: ${linkedLeads})` : '');
-        });
-        addWarning(
-          `▶️ ${companiesSkipped.length} компаний уже перенесены ранее — пропущены (перезапись запрещена).`,
-          'Данные в Kommo не изменены. Если перенос нужно повторить — сбросьте индекс через вкладку Бэкапы.',
-          _csDetails
-        );
-        // Добавляем уже известные пары в idMap из индекса
-        companiesSkipped.forEach(({ amoId, kommoId }) => { companyIdMap[amoId] = kommoId; });
-      }
-      try {
-        if (companiesToCreate.length > 0) {
-          const created = await kommoApi.createCompaniesBatch(companiesToCreate.map(c => transformCompany(c, fieldMappings.companies, userMap)));
-          const pairs = [];
-          created.forEach((k, i) => {
-            if (k && companiesToCreate[i]) {
-              companyIdMap[companiesToCreate[i].id] = k.id;
-              batchState.createdIds.companies.push(k.id);
-              pairs.push({ amoId: companiesToCreate[i].id, kommoId: k.id });
-            }
-          });
-          safety.registerMigratedBatch('companies', pairs);
-        }
-      } catch (e) {
-        if (e.isSafetyError) {
-          addError(`⛔ ${e.message}`);
-        } else {
-          addError(`Ошибка переноса компаний: ${e.message}`, 'Проверьте API-токен Kommo CRM и повторите попытку.');
-        }
-        updateState({ status: 'error', completedAt: new Date().toISOString() }); return;
-      }
+/**
+ * Create payloads for quarantined records, rebuilt from the snapshot with the current
+ * field / user / stage mapping: most rejections are validation errors that the stored
+ * payload (kept for diagnostics) would repeat until the mapping is fixed. Records no
+ * longer in the snapshot fall back to the stored payload.
+ */
+function rebuildQuarantinePayloads(entity, rows, stageMapping) {
+  const { transformMany } = require('../utils/dataTransformer');
+  const fieldMappings = loadFieldMapping() || { leads: null, contacts: null, companies: null };
+  const userMap = {};
+  try {
+    const ums = db.getUserMappings ? db.getUserMappings() : [];
+    ums.forEach(m => { userMap[m.amo_user_id] = m.kommo_user_id; userMap[String(m.amo_user_id)] = m.kommo_user_id; });
+  } catch (e) { /* proceed without user mapping */ }
+
+  const items = db.queryAmoEntities(entity, { ids: rows.map(r => Number(r.amo_id)) });
+  const byId = new Map(items.map(item => [String(item.id), item]));
+  const found = rows.filter(r => byId.has(String(r.amo_id))).map(r => byId.get(String(r.amo_id)));
+  const rebuilt = new Map();
+  transformMany(entity, found, fieldMappings[entity], userMap, stageMapping).forEach((t, i) => {
+    const item = found[i];
+    if (entity === 'leads') {
+      t.pipeline_id = (stageMapping && stageMapping._pipeline && stageMapping._pipeline.kommo) ? stageMapping._pipeline.kommo : config.kommo.pipelineId;
+      const link = (type) => ((item._embedded && item._embedded[type]) || [])
+        .map(c => safety.getKommoId(type, c.id)).filter(Boolean).map(id => ({ id: Number(id) }));
+      const emb = { ...(t._embedded || {}) };
+      const contacts = link('contacts');
+      const companies = link('companies');
+      if (contacts.length > 0)  emb.contacts  = contacts;
+      if (companies.length > 0) emb.companies = companies;
+      t._embedded = emb;
     }
+    rebuilt.set(String(item.id), t);
+  });
+  const stale = rows.length - rebuilt.size;
+  if (stale > 0) logger.warn(`[quarantine] ${entity}: ${stale} records not in the snapshot — retried with the stored payload`);
+  return rows.map(r => rebuilt.get(String(r.amo_id)) || r.payload);
+}
 
-    /* ── 7b. Build contact→lead manager fallback map ────────────────── */
-    // For contacts whose AMO user is not in userMap, fall back to lead's mapped manager
-    const contactLeadManagerMap = {};
-    for (const lead of batchLeads) {
-      const amoLeadUid = lead.responsible_user_id;
-      const kommoLeadUid = amoLeadUid ? (userMap[amoLeadUid] || userMap[String(amoLeadUid)]) : null;
-      if (kommoLeadUid) {
-        for (const c of (lead._embedded?.contacts || [])) {
-          if (!contactLeadManagerMap[c.id]) contactLeadManagerMap[c.id] = Number(kommoLeadUid);
-        }
-      }
+async function retryQuarantineRecords(stageMapping) {
+  const createFns = {
+    companies: kommoApi.createCompaniesBatch,
+    contacts:  kommoApi.createContactsBatch,
+    leads:     kommoApi.createLeadsBatch,
+  };
+  const summary = {};
+  const createdIds = { companies: [], contacts: [], leads: [] };
+  for (const entity of ['companies', 'contacts', 'leads']) {
+    const rows = db.listQuarantine(entity);
+    // A batch job starting meanwhile waits for these ids instead of creating them too
+    await safety.claimIds(entity, rows.map(r => r.amo_id), QUARANTINE_OWNER);
+    // Already migrated by a later run — nothing to retry
+    const done = rows.filter(r => safety.isMigrated(entity, r.amo_id)).map(r => r.amo_id);
+    if (done.length > 0) db.removeQuarantine(entity, done);
+    const pending = rows.filter(r => !safety.isMigrated(entity, r.amo_id));
+    summary[entity] = { retried: pending.length, created: 0, left: pending.length };
+    if (pending.length === 0) continue;
+
+    const payloads = rebuildQuarantinePayloads(entity, pending, stageMapping);
+    const created = await createFns[entity](payloads, pending.map(r => r.amo_id));
+    const pairs = [];
+    created.forEach((k, i) => { if (k) pairs.push({ amoId: pending[i].amo_id, kommoId: k.id }); });
+    if (pairs.length > 0) {
+      safety.registerMigratedBatch(entity, pairs);
+      db.removeQuarantine(entity, pairs.map(p => p.amoId));
     }
+    summary[entity].created = pairs.length;
+    summary[entity].left = pending.length - pairs.length;
+    createdIds[entity] = pairs.map(p => Number(p.amoId)); // kommo_quarantine keeps amo_id as text
+    logger.info(`[quarantine] ${entity}: retried ${pending.length}, created ${pairs.length}`);
+  }
 
-    /* ── 8. Migrate contacts ────────────────────────────────────────── */
-    updateState({ step: `Перенос контактов (${batchContacts.length})...` });
-    const contactIdMap = {};
-    if (batchContacts.length > 0) {
-      const { transformContact } = require('../utils/dataTransformer');
-      // ═ САФЕТИ: исключаем уже перенесённые контакты ════════
-      const { toCreate: contactsToCreate, skipped: contactsSkipped } =
-        safety.filterNotMigrated('contacts', batchContacts, c => c.id);
-      if (contactsSkipped.length > 0) {
-        const _ctIdx = safety.loadIndex();
-        const _ctDetails = contactsSkipped.map(({ item, amoId, kommoId }) => {
-          const allLinkedLeads = (item && item._embedded && item._embedded.leads) ? item._embedded.leads.map(l => l.id) : [];
-          const linkedLeads = allLinkedLeads.map(lid => {
-            const _kLid = (_ctIdx.leads || {})[String(lid)];
-            return 'AMO#' + lid + (_kLid ? '/Kommo#' + _kLid : '');
-          }).join(', ');
-          return `Контакт AMO#${amoId} → Kommo#${kommoId}` + (linkedLeads ? ` (нужен для сделок: ${linkedLeads})` : '');
-        });
-        addWarning(
-          `▶️ ${contactsSkipped.length} контактов уже перенесены ранее — пропущены (перезапись запрещена).`,
-          'Данные в Kommo не изменены. Контакт остаётся привязан к ранее перенесённым сделкам и будет также привязан к новым.',
-          _ctDetails
-        );
-        contactsSkipped.forEach(({ amoId, kommoId }) => { contactIdMap[amoId] = kommoId; });
-      }
+  // Contacts/companies created now: link them to leads that were migrated without them
+  const retriedLeads = new Set(createdIds.leads);
+  const linkFns = { contacts: kommoApi.linkContactToLead, companies: kommoApi.linkCompanyToLead };
+  summary.relinked = { contacts: 0, companies: 0, errors: [] };
+  for (const relType of ['contacts', 'companies']) {
+    for (const { leadId, relId } of db.getAmoLinkedLeads(relType, createdIds[relType])) {
+      if (retriedLeads.has(leadId)) continue; // linked by runSingleDealsTransfer below
+      const kLeadId = safety.getKommoId('leads', leadId);
+      if (!kLeadId) continue; // not migrated yet — the lead is created with its links
       try {
-        if (contactsToCreate.length > 0) {
-          const created = await kommoApi.createContactsBatch(contactsToCreate.map(c => {
-            const t = transformContact(c, fieldMappings.contacts, userMap);
-            // Fallback: if contact has no mapped manager, use lead's manager
-            if (!t.responsible_user_id && contactLeadManagerMap[c.id]) {
-              t.responsible_user_id = contactLeadManagerMap[c.id];
-            }
-            return t;
-          }));
-          const pairs = [];
-          created.forEach((k, i) => {
-            if (k && contactsToCreate[i]) {
-              contactIdMap[contactsToCreate[i].id] = k.id;
-              batchState.createdIds.contacts.push(k.id);
-              pairs.push({ amoId: contactsToCreate[i].id, kommoId: k.id });
-            }
-          });
-          safety.registerMigratedBatch('contacts', pairs);
-        }
+        await linkFns[relType](kLeadId, safety.getKommoId(relType, relId));
+        summary.relinked[relType]++;
       } catch (e) {
-        if (e.isSafetyError) {
-          addError(`⛔ ${e.message}`);
-        } else {
-          addError(`Ошибка переноса контактов: ${e.message}`, 'Проверьте API-токен Kommo CRM и повторите попытку.');
-        }
-        updateState({ status: 'error', completedAt: new Date().toISOString() }); return;
+        summary.relinked.errors.push(`Привязка ${relType} #${relId} к сделке AMO#${leadId}: ${e.message}`);
       }
     }
+  }
 
-    /* ── 9. Migrate leads ───────────────────────────────────────────── */
-    updateState({ step: `Перенос сделок (${batchLeads.length})...` });
-    const { transformLead } = require('../utils/dataTransformer');
-
-    // ╔ SAFE: исключаем уже перенесённые сделки ════════════════════════
-    const { toCreate: newLeads, skipped: skippedLeads } =
-      safety.filterNotMigrated('leads', batchLeads, l => l.id);
-    if (skippedLeads.length > 0) {
-      const _slDetails = skippedLeads.map(({ item, amoId, kommoId }) => {
-        const _name = (item && item.name) ? ' (' + item.name.substring(0, 40) + ')' : '';
-        return 'Сделка AMO#' + amoId + ' \u2192 Kommo#' + kommoId + _name;
-      });
-      addWarning(
-        `▶️ ${skippedLeads.length} сделок уже перенесены ранее — пропущены (перезапись запрещена).`,
-        'Данные в Kommo не изменены. Чтобы перенести повторно — сбросьте индекс через вкладку Бэкап.',
-        _slDetails
-      );
-    }
-    // Pre-populate leadIdMap для skipped сделок (нужно для задач/заметок)
-    const leadIdMap = {};
-    skippedLeads.forEach(({ amoId, kommoId }) => { leadIdMap[Number(amoId)] = Number(kommoId); });
-
-    const leadsToCreate = newLeads.map(lead => {
-      const t = transformLead(lead, stageMapping || {}, fieldMappings.leads, userMap);
-      t.pipeline_id = (stageMapping && stageMapping._pipeline && stageMapping._pipeline.kommo) ? stageMapping._pipeline.kommo : config.kommo.pipelineId;
-      // Embed contacts + companies directly in lead creation payload (bulk, no separate link calls)
-      const embContacts = (lead._embedded?.contacts || [])
-        .map(c => contactIdMap[c.id]).filter(Boolean).map(id => ({ id: Number(id) }));
-      const embCompanies = (lead._embedded?.companies || [])
-        .map(c => companyIdMap[c.id]).filter(Boolean).map(id => ({ id: Number(id) }));
-      if (embContacts.length > 0 || embCompanies.length > 0) {
-        t._embedded = {};
-        if (embContacts.length > 0) t._embedded.contacts = embContacts;
-        if (embCompanies.length > 0) t._embedded.companies = embCompanies;
-      }
-      return t;
-    });
-
-    let createdLeads = [];
-    if (newLeads.length > 0) {
+  // Leads created now: tasks, notes and links as for any migrated lead
+  if (createdIds.leads.length > 0) {
     try {
-      createdLeads = await kommoApi.createLeadsBatch(leadsToCreate);
+      const r = await transferSelectedDeals(createdIds.leads, stageMapping);
+      summary.followUp = { leads: r.found, tasks: r.transferred.tasks, notes: r.transferred.notes, errors: r.errors, warnings: r.warnings };
     } catch (e) {
-      addError(`Ошибка переноса сделок: ${e.message}`, 'Уменьшите размер пакета или проверьте лимиты API Kommo CRM.');
-      updateState({ status: 'error', completedAt: new Date().toISOString() }); return;
-    }
-    } // end if (newLeads.length > 0)
-
-    // leadIdMap declared above (see SAFE dedup block)
-    const leadPairs = [];
-    for (let idx = 0; idx < createdLeads.length; idx++) {
-      const kLead = createdLeads[idx];
-      const aLead = newLeads[idx];       // ← только новые (не skipped)
-      if (!kLead || !aLead) continue;
-      leadIdMap[aLead.id] = kLead.id;
-      batchState.createdIds.leads.push(kLead.id);
-      leadPairs.push({ amoId: aLead.id, kommoId: kLead.id });
-      batchState.progress.current = idx + 1;
-    }
-    // Регистрируем все перенесённые сделки в индексе безопасности
-    if (leadPairs.length > 0) safety.registerMigratedBatch('leads', leadPairs);
-
-    // Reverse map: Kommo lead ID -> AMO lead ID (for warning messages)
-    const kommoToAmoLead = {};
-    for (const [aId, kId] of Object.entries(leadIdMap)) kommoToAmoLead[kId] = aId;
-
-
-    // Pause check after leads (saves offset, stops before tasks)
-    if (pauseRequestedFlag) {
-      pauseRequestedFlag = false;
-      batchConfig.offset = from + batchLeads.length;
-      batchState.stats.totalTransferred = batchConfig.offset;
-      batchState.stats.remainingLeads   = Math.max(0, eligible.length - batchConfig.offset);
-      saveBatchConfig();
-      updateState({ status: 'paused', step: '⏸ Пауза после сделок. Задачи/заметки будут при следующем запуске', completedAt: new Date().toISOString() });
-      logger.info('Batch paused after leads, offset=' + batchConfig.offset);
-      return;
-    }
-        /* ── 10. Migrate tasks ──────────────────────────────────────────── */
-    const batchAmoIds = new Set(batchLeads.map(l => l.id));
-    const _batchTasksRaw = allTasks.filter(t => t.entity_type === 'leads' && batchAmoIds.has(t.entity_id) && !t.is_completed);
-    // Dedup by task ID to prevent duplicate tasks if batch is re-run
-    const { toCreate: _batchTasksFiltered, skipped: _batchTasksSkipped } = safety.filterNotMigrated('tasks_leads', _batchTasksRaw, t => t.id);
-    const batchTasks = _batchTasksFiltered;
-
-    if (batchTasks.length > 0) {
-      updateState({ step: `Перенос задач (${batchTasks.length})...` });
-      const { transformTask } = require('../utils/dataTransformer');
-      // Build lead responsible_user_id map (AMO lead id → kommo user id)
-      const leadKommoUserById = {};
-      for (const lead of batchLeads) {
-        const amoUid = lead.responsible_user_id;
-        const kommoUid = amoUid ? (userMap[amoUid] || userMap[String(amoUid)]) : null;
-        if (kommoUid) leadKommoUserById[lead.id] = Number(kommoUid);
-      }
-      const tasksToCreate = batchTasks.map(t => {
-        const entityKommoUser = leadKommoUserById[t.entity_id] || null;
-        const tt = transformTask(t, userMap, entityKommoUser);
-        tt.entity_id = leadIdMap[t.entity_id];
-        tt.entity_type = 'leads';
-        tt._wasCompleted = !!t.is_completed;
-        tt._amoTaskId = t.id;
-        return tt;
-      }).filter(t => t.entity_id);
-
-      if (tasksToCreate.length < batchTasks.length) {
-        addWarning(
-          `${batchTasks.length - tasksToCreate.length} задач потеряли привязку к сделкам.`,
-          'Это ожидаемо, если сделки не попали в текущий пакет. Задачи перенесутся при переносе соответствующих сделок.'
-        );
-      }
-      try {
-        const created = await kommoApi.createTasksBatch(tasksToCreate);
-        const _batchTaskPairs = [];
-        const _completedBatchLeadTaskIds = [];
-        created.forEach((k, idx) => {
-          if (k) {
-            batchState.createdIds.tasks.push(k.id);
-            if (tasksToCreate[idx]?._wasCompleted) _completedBatchLeadTaskIds.push(k.id);
-            if (tasksToCreate[idx]?._amoTaskId) _batchTaskPairs.push({ amoId: Number(tasksToCreate[idx]._amoTaskId), kommoId: k.id });
-          }
-        });
-        if (_completedBatchLeadTaskIds.length > 0) await kommoApi.completeTasksBatch(_completedBatchLeadTaskIds);
-        if (_batchTaskPairs.length > 0) safety.registerMigratedBatch('tasks_leads', _batchTaskPairs);
-        const _ltSuccessCount = created.filter(x => x !== null).length;
-        if (_ltSuccessCount < tasksToCreate.length) {
-          logger.warn(`[batch] Задачи лидов: перенесено ${_ltSuccessCount}/${tasksToCreate.length}`);
-          if (_ltSuccessCount === 0) addWarning('Задачи лидов: 0 перенесено после retry.', 'Попробуйте повтор пакета.');
-        }
-      } catch (e) {
-        logger.error('[batch] Неожиданная ошибка задач лидов: ' + e.message);
-      }
-    }
-
-    /* ── 10-fix. PATCH task_type_id + text for already-migrated lead tasks ──────── */
-    if (!_skipPatch && _batchTasksSkipped.length > 0) {
-      const { AMO_TO_KOMMO_TASK_TYPE, fmtDatePrefix: _fmtDP } = require('../utils/dataTransformer');
-      const _taskTypeUpdates = [];
-      for (const s of _batchTasksSkipped) {
-        const amoTask = s.item;
-        if (amoTask.is_completed) continue; // only active tasks
-        const kommoTaskId = s.kommoId;
-        const amoTypeId = amoTask.task_type_id;
-        const kommoTypeId = AMO_TO_KOMMO_TASK_TYPE[amoTypeId];
-        const upd = { id: kommoTaskId, task_type_id: kommoTypeId || 1 };
-        // МОЯ ЗАДАЧА prefix for self-assigned tasks
-        if (amoTask.created_by && amoTask.responsible_user_id && amoTask.created_by === amoTask.responsible_user_id) {
-          const _tb = _fmtDP(amoTask.created_at) + ((amoTask.text && amoTask.text.trim()) ? amoTask.text : 'Задача');
-          upd.text = 'МОЯ ЗАДАЧА: ' + _tb;
-        }
-        _taskTypeUpdates.push(upd);
-      }
-      if (_taskTypeUpdates.length > 0) {
-        updateState({ step: `Обновление типов задач лидов (${_taskTypeUpdates.length})...` });
-        try {
-          const _updatedLT = await kommoApi.updateTasksBatch(_taskTypeUpdates);
-          logger.info(`[batch] PATCH task_type_id for lead tasks: ${_updatedLT}/${_taskTypeUpdates.length}`);
-        } catch (e) {
-          logger.error('[batch] Ошибка PATCH типов задач лидов: ' + e.message);
-        }
-      } else {
-        logger.info(`[batch] Skipped lead tasks: ${_batchTasksSkipped.length}, all type=1, no PATCH needed`);
-      }
-    }
-
-    /* -- 10b. Batch: Contact tasks ----------------------------------------- */
-    let _batchContactTasksSkipped = [];
-    {
-      const _batchContactIdsSet = new Set(Object.keys(contactIdMap).map(Number));
-      const _batchContactTasksRaw = allTasks.filter(
-        t => t.entity_type === 'contacts' && _batchContactIdsSet.has(Number(t.entity_id)) && !t.is_completed
-      );
-      const { toCreate: _batchContactTasksFiltered, skipped: _ctSkipped } = safety.filterNotMigrated('tasks_contacts', _batchContactTasksRaw, t => t.id);
-      _batchContactTasksSkipped = _ctSkipped;
-      if (_batchContactTasksFiltered.length > 0) {
-        updateState({ step: 'Перенос задач контактов (' + _batchContactTasksFiltered.length + ')...' });
-        const { transformTask: _transformTaskCT } = require('../utils/dataTransformer');
-        const _ctKommoUserById = {};
-        for (const contact of allContacts) {
-          const uid = contact.responsible_user_id;
-          const kuid = uid ? (userMap[uid] || userMap[String(uid)]) : null;
-          if (kuid) _ctKommoUserById[contact.id] = Number(kuid);
-        }
-        const _ctTasksToCreate = _batchContactTasksFiltered.map(t => {
-          const kContactId = contactIdMap[String(t.entity_id)];
-          if (!kContactId) return null;
-          const entityUser = _ctKommoUserById[t.entity_id] || null;
-          const tt = _transformTaskCT(t, userMap, entityUser);
-          tt.entity_id = Number(kContactId);
-          tt.entity_type = 'contacts';
-          tt._wasCompleted = !!t.is_completed;
-          tt._amoTaskId = t.id;
-          return tt;
-        }).filter(Boolean);
-        if (_ctTasksToCreate.length > 0) {
-          try {
-            const _createdCT = await kommoApi.createTasksBatch(_ctTasksToCreate);
-            const _completedCTIds = [];
-            const _ctPairs = [];
-            _createdCT.forEach((k, idx) => {
-              if (k) {
-                batchState.createdIds.tasks.push(k.id);
-                if (_ctTasksToCreate[idx]?._wasCompleted) _completedCTIds.push(k.id);
-                if (_ctTasksToCreate[idx]?._amoTaskId) _ctPairs.push({ amoId: Number(_ctTasksToCreate[idx]._amoTaskId), kommoId: k.id });
-              }
-            });
-            if (_completedCTIds.length > 0) await kommoApi.completeTasksBatch(_completedCTIds);
-            if (_ctPairs.length > 0) safety.registerMigratedBatch('tasks_contacts', _ctPairs);
-            const _ctSuccessCount = _createdCT.filter(x => x !== null).length;
-            if (_ctSuccessCount < _ctTasksToCreate.length) {
-              logger.warn(`[batch] Задачи контактов: перенесено ${_ctSuccessCount}/${_ctTasksToCreate.length}`);
-              if (_ctSuccessCount === 0) addWarning('Задачи контактов: 0 перенесено после retry.', 'Попробуйте повтор пакета.');
-            }
-          } catch (e) {
-            logger.error('[batch] Неожиданная ошибка задач контактов: ' + e.message);
-          }
-        }
-      }
-    }
-
-    /* ── 10b-fix. PATCH task_type_id + text for already-migrated contact tasks ── */
-    if (!_skipPatch && _batchContactTasksSkipped && _batchContactTasksSkipped.length > 0) {
-      const { AMO_TO_KOMMO_TASK_TYPE: _ctTypeMap, fmtDatePrefix: _fmtDP2 } = require('../utils/dataTransformer');
-      const _ctTypeUpdates = [];
-      for (const s of _batchContactTasksSkipped) {
-        const amoTask = s.item;
-        if (amoTask.is_completed) continue; // only active tasks
-        const amoTypeId = amoTask.task_type_id;
-        const kommoTypeId = _ctTypeMap[amoTypeId];
-        const upd = { id: s.kommoId, task_type_id: kommoTypeId || 1 };
-        if (amoTask.created_by && amoTask.responsible_user_id && amoTask.created_by === amoTask.responsible_user_id) {
-          const _tb = _fmtDP2(amoTask.created_at) + ((amoTask.text && amoTask.text.trim()) ? amoTask.text : 'Задача');
-          upd.text = 'МОЯ ЗАДАЧА: ' + _tb;
-        }
-        _ctTypeUpdates.push(upd);
-      }
-      if (_ctTypeUpdates.length > 0) {
-        try {
-          const _ctUpd = await kommoApi.updateTasksBatch(_ctTypeUpdates);
-          logger.info(`[batch] PATCH task_type_id for contact tasks: ${_ctUpd}/${_ctTypeUpdates.length}`);
-        } catch (e) {
-          logger.error('[batch] Ошибка PATCH типов задач контактов: ' + e.message);
-        }
-      }
-    }
-
-    /* -- 10c. Batch: Company tasks ----------------------------------------- */
-    let _batchCompanyTasksSkipped = [];
-    {
-      const _batchCompanyIdsSet = new Set(Object.keys(companyIdMap).map(Number));
-      const _batchCompanyTasksRaw = allTasks.filter(
-        t => t.entity_type === 'companies' && _batchCompanyIdsSet.has(Number(t.entity_id)) && !t.is_completed
-      );
-      const { toCreate: _batchCompanyTasksFiltered, skipped: _coSkipped } = safety.filterNotMigrated('tasks_companies', _batchCompanyTasksRaw, t => t.id);
-      _batchCompanyTasksSkipped = _coSkipped;
-      if (_batchCompanyTasksFiltered.length > 0) {
-        updateState({ step: 'Перенос задач компаний (' + _batchCompanyTasksFiltered.length + ')...' });
-        const { transformTask: _transformTaskCo } = require('../utils/dataTransformer');
-        const _coKommoUserById = {};
-        for (const company of allCompanies) {
-          const uid = company.responsible_user_id;
-          const kuid = uid ? (userMap[uid] || userMap[String(uid)]) : null;
-          if (kuid) _coKommoUserById[company.id] = Number(kuid);
-        }
-        const _coTasksToCreate = _batchCompanyTasksFiltered.map(t => {
-          const kCompanyId = companyIdMap[String(t.entity_id)];
-          if (!kCompanyId) return null;
-          const entityUser = _coKommoUserById[t.entity_id] || null;
-          const tt = _transformTaskCo(t, userMap, entityUser);
-          tt.entity_id = Number(kCompanyId);
-          tt.entity_type = 'companies';
-          tt._wasCompleted = !!t.is_completed;
-          tt._amoTaskId = t.id;
-          return tt;
-        }).filter(Boolean);
-        if (_coTasksToCreate.length > 0) {
-          try {
-            const _createdCo = await kommoApi.createTasksBatch(_coTasksToCreate);
-            const _completedCoIds = [];
-            const _coPairs = [];
-            _createdCo.forEach((k, idx) => {
-              if (k) {
-                batchState.createdIds.tasks.push(k.id);
-                if (_coTasksToCreate[idx]?._wasCompleted) _completedCoIds.push(k.id);
-                if (_coTasksToCreate[idx]?._amoTaskId) _coPairs.push({ amoId: Number(_coTasksToCreate[idx]._amoTaskId), kommoId: k.id });
-              }
-            });
-            if (_completedCoIds.length > 0) await kommoApi.completeTasksBatch(_completedCoIds);
-            if (_coPairs.length > 0) safety.registerMigratedBatch('tasks_companies', _coPairs);
-          } catch (e) {
-            addWarning('Ошибка переноса задач компаний: ' + e.message, 'Повторите пакет.');
-          }
-        }
-      }
-    }
-
-    /* ── 10c-fix. PATCH task_type_id + text for already-migrated company tasks ── */
-    if (!_skipPatch && _batchCompanyTasksSkipped && _batchCompanyTasksSkipped.length > 0) {
-      const { AMO_TO_KOMMO_TASK_TYPE: _coTypeMap, fmtDatePrefix: _fmtDP3 } = require('../utils/dataTransformer');
-      const _coTypeUpdates = [];
-      for (const s of _batchCompanyTasksSkipped) {
-        const amoTask = s.item;
-        if (amoTask.is_completed) continue; // only active tasks
-        const amoTypeId = amoTask.task_type_id;
-        const kommoTypeId = _coTypeMap[amoTypeId];
-        const upd = { id: s.kommoId, task_type_id: kommoTypeId || 1 };
-        if (amoTask.created_by && amoTask.responsible_user_id && amoTask.created_by === amoTask.responsible_user_id) {
-          const _tb = _fmtDP3(amoTask.created_at) + ((amoTask.text && amoTask.text.trim()) ? amoTask.text : 'Задача');
-          upd.text = 'МОЯ ЗАДАЧА: ' + _tb;
-        }
-        _coTypeUpdates.push(upd);
-      }
-      if (_coTypeUpdates.length > 0) {
-        try {
-          const _coUpd = await kommoApi.updateTasksBatch(_coTypeUpdates);
-          logger.info(`[batch] PATCH task_type_id for company tasks: ${_coUpd}/${_coTypeUpdates.length}`);
-        } catch (e) {
-          logger.error('[batch] Ошибка PATCH типов задач компаний: ' + e.message);
-        }
-      }
-    }
-
-    /* ── 11. Migrate notes / timeline (leads + contacts) ────────────────────────── */
-    updateState({ step: 'Перенос комментариев сделок...' });
-    {
-      const leadAmoIds = batchLeads.map(l => l.id);
-      try {
-        const allLeadNotes = await amoApi.getLeadNotesByEntityIds(leadAmoIds);
-        const _batchLeadNotesTyped = allLeadNotes.filter(note => !SKIP_NOTE_TYPES.has(note.note_type));
-        const { toCreate: _batchLeadNotesToCreate } = safety.filterNotMigrated('notes_leads', _batchLeadNotesTyped, n => n.id);
-        // Build flat array: all notes for all leads in one bulk call
-        const _allLeadNotesMapped = [];
-        const _allLeadNoteAmoIds = [];
-        for (const note of _batchLeadNotesToCreate) {
-          const kId = leadIdMap[note.entity_id];
-          if (!kId) continue;
-          const s = sanitizeNoteParams(note);
-          _allLeadNotesMapped.push({ entity_id: Number(kId), note_type: s.note_type, params: s.params, created_by: 12739795 });
-          _allLeadNoteAmoIds.push(note.id);
-        }
-        if (_allLeadNotesMapped.length > 0) {
-          const created = await kommoApi.createNotesBatch('leads', _allLeadNotesMapped);
-          const _batchLeadNotePairs = [];
-          created.forEach((cn, idx) => {
-            if (cn) {
-              batchState.createdIds.notes.push(cn.id);
-              if (_allLeadNoteAmoIds[idx]) _batchLeadNotePairs.push({ amoId: Number(_allLeadNoteAmoIds[idx]), kommoId: cn.id });
-            }
-          });
-          if (_batchLeadNotePairs.length > 0) safety.registerMigratedBatch('notes_leads', _batchLeadNotePairs);
-          const _leadSuccessCount = created.filter(x => x !== null).length;
-          if (_leadSuccessCount < _allLeadNotesMapped.length) {
-            logger.warn(`[batch] Заметки сделок: перенесено ${_leadSuccessCount}/${_allLeadNotesMapped.length}`);
-          }
-        }
-      } catch (e) {
-        addWarning('Не удалось загрузить заметки сделок: ' + e.message, 'Попробуйте повторить пакет.');
-      }
-    }
-
-    updateState({ step: 'Перенос комментариев контактов...' });
-    {
-      // Collect unique contact IDs from this batch
-      const batchContactAmoIds = [];
-      const seenContactIds = new Set();
-      for (const aLead of batchLeads) {
-        for (const c of (aLead._embedded?.contacts || [])) {
-          const aContactId = c.id;
-          if (!contactIdMap[aContactId] || seenContactIds.has(aContactId)) continue;
-          seenContactIds.add(aContactId);
-          batchContactAmoIds.push(aContactId);
-        }
-      }
-      try {
-        // Bulk-fetch all contact notes in one API call (batches of 50 inside)
-        const allContactNotes = await amoApi.getContactNotesByEntityIds(batchContactAmoIds);
-        // Filter out skipped types + dedup via safety
-        const _bCNotesTyped = allContactNotes.filter(note => !SKIP_NOTE_TYPES.has(note.note_type));
-        const { toCreate: _bCNotesToCreate } = safety.filterNotMigrated('notes_contacts', _bCNotesTyped, n => n.id);
-        // Group by kommo contact ID
-        const _bCNotesGrouped = {};
-        for (const note of _bCNotesToCreate) {
-          const kId = contactIdMap[note.entity_id];
-          if (!kId) continue;
-          if (!_bCNotesGrouped[kId]) _bCNotesGrouped[kId] = [];
-          _bCNotesGrouped[kId].push(note);
-        }
-        // Build flat array: all contact notes in one bulk call
-        const _allContactNotesMapped = [];
-        const _allContactNoteAmoIds = [];
-        for (const [kId, notes] of Object.entries(_bCNotesGrouped)) {
-          for (const note of notes) {
-            const s = sanitizeNoteParams(note);
-            _allContactNotesMapped.push({ entity_id: Number(kId), note_type: s.note_type, params: s.params, created_by: 12739795 });
-            _allContactNoteAmoIds.push(note.id);
-          }
-        }
-        if (_allContactNotesMapped.length > 0) {
-          const created = await kommoApi.createNotesBatch('contacts', _allContactNotesMapped);
-          const _batchContactNotePairs = [];
-          created.forEach((cn, idx) => {
-            if (cn) {
-              batchState.createdIds.notes.push(cn.id);
-              if (_allContactNoteAmoIds[idx]) _batchContactNotePairs.push({ amoId: Number(_allContactNoteAmoIds[idx]), kommoId: cn.id });
-            }
-          });
-          if (_batchContactNotePairs.length > 0) safety.registerMigratedBatch('notes_contacts', _batchContactNotePairs);
-          const _cSuccessCount = created.filter(x => x !== null).length;
-          if (_cSuccessCount < _allContactNotesMapped.length) {
-            logger.warn(`[batch] Заметки контактов: перенесено ${_cSuccessCount}/${_allContactNotesMapped.length}`);
-          }
-        }
-      } catch (e) {
-        addWarning('Не удалось загрузить заметки контактов: ' + e.message, 'Попробуйте повторить пакет.');
-      }
-    }
-
-    /* ── 12. Update offset ──────────────────────────────────────────── */
-    batchConfig.offset = from + batchLeads.length;
-    batchState.stats.totalTransferred = batchConfig.offset;
-    batchState.stats.remainingLeads   = Math.max(0, eligible.length - batchConfig.offset);
-    // ── Fix mode: накапливаем отдельный счётчик ──────────────────────
-    if (_mode === 'fix-existing') {
-      batchConfig.fixProcessed = (batchConfig.fixProcessed || 0) + batchLeads.length;
-      batchConfig.fixEligible  = eligible.length;
-      batchState.stats.fixProcessed = batchConfig.fixProcessed;
-      batchState.stats.fixEligible  = batchConfig.fixEligible;
+      summary.followUp = { leads: 0, tasks: 0, notes: 0, errors: [e.message], warnings: [] };
+      logger.error('[quarantine] follow-up transfer failed:', e.message);
     }
-    // Save last batch position for retry feature
-    batchState.lastBatch = { from, size: batchLeads.length };
-    // Store AMO→Kommo deal pairs for verification UI
-    batchState.dealPairs = Object.entries(leadIdMap).map(([amo, kommo]) => ({ amoId: Number(amo), kommoId: Number(kommo) }));
-    saveBatchConfig();
-
-    updateState({
-      status: batchState.errors.length > 0 ? 'error' : 'completed',
-      step: `✅ Пакет завершён: +${batchLeads.length} сделок. Всего: ${batchConfig.offset}/${eligible.length}`,
-      completedAt: new Date().toISOString(),
-    });
-
-    logger.info(`Batch done: +${batchLeads.length} leads, total ${batchConfig.offset}/${eligible.length}`);
-
-  } catch (err) {
-    addError(`Критическая ошибка: ${err.message}`, 'Проверьте логи сервера. При необходимости выполните откат последнего пакета.');
-    updateState({ status: 'error', completedAt: new Date().toISOString() });
-    logger.error('Batch migration fatal error:', err);
   }
+  logger.info(`[quarantine] relinked contacts=${summary.relinked.contacts} companies=${summary.relinked.companies}` +
+    (summary.followUp ? `, follow-up leads=${summary.followUp.leads} tasks=${summary.followUp.tasks} notes=${summary.followUp.notes}` : ''));
+  return summary;
 }
 
-// ─── Rollback ─────────────────────────────────────────────────────────────────
-async function rollbackBatch() {
-  const ids = batchState.createdIds;
-  updateState({ status: 'rolling_back' });
+// ─── Single / selective deals transfer ───────────────────────────────────────
+// Notes of many entities in one read (noteSource), grouped by AMO entity id
+async function loadNotesGrouped(entityType, entityIds, cached, warnings) {
+  const grouped = new Map();
   try {
-    // ═ САФЕТИ: при откате удаляем ТОЛЬКО те записи, которые создали САМИ
-    // (batchState.createdIds). Записи, которых нет в createdIds, не трогаем.
-    if (ids.leads?.length) {
-      const { safe: safeLeads, blocked: blockedLeads } =
-        safety.validateRollbackIds('leads', ids.leads, ids.leads);
-      if (blockedLeads.length > 0)
-        addWarning(`⛔ Откат: ${blockedLeads.length} сделок заблокированы (не созданы в этом пакете).`);
-      if (safeLeads.length > 0) await kommoApi.deleteLeadsBatch(safeLeads);
-    }
-    if (ids.contacts?.length) {
-      const { safe: safeContacts, blocked: blockedContacts } =
-        safety.validateRollbackIds('contacts', ids.contacts, ids.contacts);
-      if (blockedContacts.length > 0)
-        addWarning(`⛔ Откат: ${blockedContacts.length} контактов заблокированы.`);
-      if (safeContacts.length > 0) await kommoApi.deleteContactsBatch(safeContacts);
-    }
-    if (ids.companies?.length) {
-      const { safe: safeCompanies, blocked: blockedCompanies } =
-        safety.validateRollbackIds('companies', ids.companies, ids.companies);
-      if (blockedCompanies.length > 0)
-        addWarning(`⛔ Откат: ${blockedCompanies.length} компаний заблокированы.`);
-      if (safeCompanies.length > 0) await kommoApi.deleteCompaniesBatch(safeCompanies);
+    const { notes } = await noteSource.getNotesForEntities(entityType, entityIds, cached ? { cached } : {});
+    for (const n of notes) {
+      const key = Number(n.entity_id);
+      if (!grouped.has(key)) grouped.set(key, []);
+      grouped.get(key).push(n);
     }
-
-    // Убираем откаченные сделки из индекса
-    if (ids.leads?.length) {
-      const idx = safety.loadIndex();
-      for (const kommoId of ids.leads) {
-        const entry = Object.entries(idx.leads || {}).find(([_a, k]) => k === String(kommoId));
-        if (entry) delete idx.leads[entry[0]];
-      }
-      require('../utils/safetyGuard'); // re-save via module
-      const fs2 = require('fs-extra');
-      const p2  = require('path');
-      const cfg2 = require('../config');
-      fs2.writeJsonSync(p2.resolve(cfg2.backupDir, 'migration_index.json'), idx, { spaces: 2 });
-    }
-
-    batchConfig.offset = Math.max(0, batchConfig.offset - (ids.leads?.length || 0));
-    saveBatchConfig();
-
-    updateState({ status: 'idle', step: null, createdIds: { contacts: [], companies: [], leads: [], tasks: [], notes: [] } });
-    logger.info('Batch rollback complete');
   } catch (e) {
-    addError(`Ошибка отката: ${e.message}`, 'Часть данных могла не удалиться. Проверьте Kommo CRM вручную.');
-    updateState({ status: 'error' });
+    warnings.push(`Пакетная загрузка заметок (${entityType}): ${e.message}`);
+    logger.error(`[transfer] ошибка загрузки заметок ${entityType}:`, e.message);
   }
+  return grouped;
 }
 
-function resetOffset() {
-  loadBatchConfig();
-  batchConfig.offset = 0;
-  saveBatchConfig();
-}
-
-// ─── Single / selective deals transfer ───────────────────────────────────────
 /**
  * Transfer a specific set of leads (by AMO id) from cache to Kommo.
  * Unlike runBatchMigration this is synchronous (returns result directly).
- * Notes are fetched live from AMO API just like the batch process.
+ * Notes come from the snapshot via noteSource, just like the batch process.
  */
 async function runSingleDealsTransfer(leadIds, stageMapping) {
+  if (quarantineRetryRunning) throw new Error('Выполняется повтор карантина — повторите перенос позже');
+  singleTransfers++;
+  try {
+    return await transferSelectedDeals(leadIds, stageMapping);
+  } finally {
+    singleTransfers--;
+  }
+}
+
+async function transferSelectedDeals(leadIds, stageMapping) {
   const idSet = new Set(leadIds.map(Number));
-  const cache = loadAmoCache();
-
-  const allLeads     = cache.leads     || [];
-  const allContacts  = cache.contacts  || [];
-  const allCompanies = cache.companies || [];
-  // Support both old (tasks) and new (leadTasks/contactTasks) cache format
-  const allTasks = [
-    ...(cache.tasks || []),
-    ...(cache.leadTasks || []),
-    ...(cache.contactTasks || []),
-    ...(cache.companyTasks || []),
-  ];
-
-  const selectedLeads = allLeads.filter(l => idSet.has(l.id));
+  loadAmoCacheMeta();
+
+  // Leads + linked contacts/companies/tasks via the relation index (cost ~ selected leads)
+  const bundle = batchSource.loadLeadBundle([...idSet]);
+  const selectedLeads = bundle.leads;
+  const allContacts  = bundle.contacts;
+  const allCompanies = bundle.companies;
   if (selectedLeads.length === 0) {
     throw new Error('Указанные сделки не найдены в кэше. Обновите данные AMO на вкладке "Данные AMO".');
   }
@@ -1072,7 +391,6 @@ async function runSingleDealsTransfer(leadIds, stageMapping) {
   // --- User mapping (AMO responsible_user_id → Kommo responsible_user_id) ---
   const userMap = {};
   try {
-    const db = require('../db');
     const ums = db.getUserMappings ? db.getUserMappings() : [];
     ums.forEach(m => { userMap[m.amo_user_id] = m.kommo_user_id; userMap[String(m.amo_user_id)] = m.kommo_user_id; });
   } catch (e) { /* db not available — proceed without user mapping */ }
@@ -1107,11 +425,13 @@ async function runSingleDealsTransfer(leadIds, stageMapping) {
         catch (e) { result.warnings.push(`Обновление менеджера компании AMO#${amoId}: ${e.message}`); }
       }
     }
+    flushFieldWarnings(fieldMappings.companies, 'fix companies');
     if (toCreate.length > 0) {
       try {
-        const { transformCompany } = require('../utils/dataTransformer');
+        const { transformMany } = require('../utils/dataTransformer');
         const created = await kommoApi.createCompaniesBatch(
-          toCreate.map(c => transformCompany(c, fieldMappings.companies, userMap))
+          transformMany('companies', toCreate, fieldMappings.companies, userMap),
+          toCreate.map(c => c.id)
         );
         const pairs = [];
         created.forEach((k, i) => {
@@ -1124,7 +444,9 @@ async function runSingleDealsTransfer(leadIds, stageMapping) {
           }
         });
         safety.registerMigratedBatch('companies', pairs);
-      } catch (e) { result.errors.push('Компании: ' + e.message); }
+        const qn = quarantineNote('компаний', toCreate.length, pairs.length);
+        if (qn) result.warnings.push(qn);
+      } catch (e) { if (e.code === 'INDEX_UNAVAILABLE') throw e; result.errors.push('Компании: ' + e.message); }
     }
   }
 
@@ -1170,11 +492,13 @@ async function runSingleDealsTransfer(leadIds, stageMapping) {
         catch (e) { result.warnings.push(`Обновление менеджера контакта AMO#${amoId}: ${e.message}`); }
       }
     }
+    flushFieldWarnings(fieldMappings.contacts, 'fix contacts');
     if (toCreate.length > 0) {
       try {
-        const { transformContact } = require('../utils/dataTransformer');
+        const { transformMany } = require('../utils/dataTransformer');
         const created = await kommoApi.createContactsBatch(
-          toCreate.map(c => transformContact(c, fieldMappings.contacts, userMap))
+          transformMany('contacts', toCreate, fieldMappings.contacts, userMap),
+          toCreate.map(c => c.id)
         );
         const pairs = [];
         created.forEach((k, i) => {
@@ -1187,7 +511,9 @@ async function runSingleDealsTransfer(leadIds, stageMapping) {
           }
         });
         safety.registerMigratedBatch('contacts', pairs);
-      } catch (e) { result.errors.push('Контакты: ' + e.message); }
+        const qn = quarantineNote('контактов', toCreate.length, pairs.length);
+        if (qn) result.warnings.push(qn);
+      } catch (e) { if (e.code === 'INDEX_UNAVAILABLE') throw e; result.errors.push('Контакты: ' + e.message); }
     }
   }
 
@@ -1233,11 +559,12 @@ async function runSingleDealsTransfer(leadIds, stageMapping) {
       }
     }
   }
+  flushFieldWarnings(fieldMappings.leads, 'fix leads');
     if (leadsToCreate.length > 0) {
       try {
-        const { transformLead } = require('../utils/dataTransformer');
-        const leadsForKommo = leadsToCreate.map(lead => {
-          const t = transformLead(lead, stageMapping || {}, fieldMappings.leads, userMap);
+        const { transformMany } = require('../utils/dataTransformer');
+        const leadsForKommo = transformMany('leads', leadsToCreate, fieldMappings.leads, userMap, stageMapping).map((t, i) => {
+          const lead = leadsToCreate[i];
           t.pipeline_id = (stageMapping && stageMapping._pipeline && stageMapping._pipeline.kommo) ? stageMapping._pipeline.kommo : config.kommo.pipelineId;
           // ── Передаём contacts и companies в _embedded при СОЗДАНИИ сделки ──
           // В Kommo API PATCH _embedded.contacts работает ненадёжно;
@@ -1266,7 +593,7 @@ async function runSingleDealsTransfer(leadIds, stageMapping) {
           t._embedded = emb;
           return t;
         });
-        const created = await kommoApi.createLeadsBatch(leadsForKommo);
+        const created = await kommoApi.createLeadsBatch(leadsForKommo, leadsToCreate.map(l => l.id));
         const pairs = [];
         for (let i = 0; i < created.length; i++) {
           const k = created[i], a = leadsToCreate[i];
@@ -1279,16 +606,15 @@ async function runSingleDealsTransfer(leadIds, stageMapping) {
           logger.info(`[transfer] Lead AMO#${a.id} → Kommo#${k.id}: contacts=${(a._embedded?.contacts||[]).length}, companies=${(a._embedded?.companies||[]).length}`);
         }
         safety.registerMigratedBatch('leads', pairs);
-      } catch (e) { result.errors.push('Сделки: ' + e.message); }
+        const qn = quarantineNote('сделок', leadsToCreate.length, pairs.length);
+        if (qn) result.warnings.push(qn);
+      } catch (e) { if (e.code === 'INDEX_UNAVAILABLE') throw e; result.errors.push('Сделки: ' + e.message); }
     }
 
     // ── Tasks (from cache) ───────────────────────────────────────────────────────
     // Dedup: filter individual tasks by task ID (not by lead ID)
     // This ensures: if task creation failed on previous run, it will be retried
-    const _allSelectedLeadIds = new Set(selectedLeads.map(l => l.id));
-    const _allDealTasksRaw = allTasks.filter(
-      t => t.entity_type === 'leads' && _allSelectedLeadIds.has(Number(t.entity_id))
-    );
+    const _allDealTasksRaw = selectedLeads.flatMap(l => bundle.tasks.leads.get(l.id) || []);
     const { toCreate: dealTasksFiltered } = safety.filterNotMigrated(
       'tasks_leads', _allDealTasksRaw, t => t.id);
     const dealTasks = dealTasksFiltered;
@@ -1345,6 +671,7 @@ async function runSingleDealsTransfer(leadIds, stageMapping) {
           logger.info('[transfer] выполненных задач сделок помечено: ' + completedLeadTaskIds.length);
         }
       } catch (e) {
+        if (e.code === 'INDEX_UNAVAILABLE') throw e; // пары не сохранены — не продолжать
         result.warnings.push('Задачи сделок: ' + e.message);
         logger.error('[transfer] ошибка задач сделок:', e.message);
       }
@@ -1353,9 +680,7 @@ async function runSingleDealsTransfer(leadIds, stageMapping) {
     // ── Tasks: contact tasks (from cache) ────────────────────────────────────
       // Dedup: filter individual contact tasks by task ID (not by contact ID)
       const _allContactIdsSet = new Set(Object.keys(contactIdMap).map(Number));
-      const _allContactTasksRaw = allTasks.filter(
-        t => t.entity_type === 'contacts' && _allContactIdsSet.has(Number(t.entity_id))
-      );
+      const _allContactTasksRaw = [..._allContactIdsSet].flatMap(id => bundle.tasks.contacts.get(id) || []);
       const { toCreate: contactTasksFiltered } = safety.filterNotMigrated(
         'tasks_contacts', _allContactTasksRaw, t => t.id);
       const contactTasks = contactTasksFiltered;
@@ -1417,6 +742,7 @@ async function runSingleDealsTransfer(leadIds, stageMapping) {
           }
         }
       } catch (e) {
+        if (e.code === 'INDEX_UNAVAILABLE') throw e; // пары не сохранены — не продолжать
         result.warnings.push('Задачи контактов: ' + e.message);
         logger.error('[transfer] ошибка задач контактов:', e.message);
       }
@@ -1425,9 +751,7 @@ async function runSingleDealsTransfer(leadIds, stageMapping) {
     // ── Tasks: company tasks (from cache) ──────────────────────────────────────────
       // Dedup: filter individual company tasks by task ID (not by company ID)
       const _allCompanyIdsSet = new Set(Object.keys(companyIdMap).map(Number));
-      const _allCompanyTasksRaw = allTasks.filter(
-        t => t.entity_type === 'companies' && _allCompanyIdsSet.has(Number(t.entity_id))
-      );
+      const _allCompanyTasksRaw = [..._allCompanyIdsSet].flatMap(id => bundle.tasks.companies.get(id) || []);
       const { toCreate: companyTasksFiltered } = safety.filterNotMigrated(
         'tasks_companies', _allCompanyTasksRaw, t => t.id);
       const companyTasksToTransfer = companyTasksFiltered;
@@ -1489,6 +813,7 @@ async function runSingleDealsTransfer(leadIds, stageMapping) {
           }
         }
       } catch (e) {
+        if (e.code === 'INDEX_UNAVAILABLE') throw e; // пары не сохранены — не продолжать
         result.warnings.push('Задачи компаний: ' + e.message);
         logger.error('[transfer] ошибка задач компаний:', e.message);
       }
@@ -1500,8 +825,8 @@ async function runSingleDealsTransfer(leadIds, stageMapping) {
       const _allLeadNoteIds = selectedLeads.map(l => l.id);
       if (_allLeadNoteIds.length > 0) {
         try {
-          const _allLeadNotesFetched = await amoApi.getLeadNotesByEntityIds(_allLeadNoteIds);
-          logger.info(`[transfer] getLeadNotesByEntityIds: ${_allLeadNotesFetched.length} заметок для ${_allLeadNoteIds.length} сделок`);
+          const { notes: _allLeadNotesFetched } = await noteSource.getNotesForEntities('leads', _allLeadNoteIds, { cached: bundle.notes.leads });
+          logger.info(`[transfer] заметки сделок: ${_allLeadNotesFetched.length} заметок для ${_allLeadNoteIds.length} сделок`);
           result.notesDetail.leads.fetched += _allLeadNotesFetched.length;
           // Filter by note type, then dedup by note ID
           const _leadNotesTyped = _allLeadNotesFetched.filter(n => !SKIP_NOTE_TYPES.has(n.note_type));
@@ -1543,14 +868,17 @@ async function runSingleDealsTransfer(leadIds, stageMapping) {
             logger.info('[transfer] notes_leads registered by note ID: ' + _notePairsLeads.length);
           }
         } catch (e) {
+          if (e.code === 'INDEX_UNAVAILABLE') throw e; // пары не сохранены — не продолжать
           result.warnings.push('Пакетная загрузка заметок сделок: ' + e.message);
-          logger.error('[transfer] ошибка getLeadNotesByEntityIds:', e.message);
+          logger.error('[transfer] ошибка загрузки заметок сделок:', e.message);
         }
       }
     }
 
-  // ── Notes: contact notes (live fetch from AMO — индивидуальные заметки по контакту) ───────
+  // ── Notes: contact notes (snapshot + AMO for changed/missing contacts, one bulk read) ───────
   // Проходимся по всем контактам, связанным со сделками выборки
+  const _contactNotesByContact = await loadNotesGrouped('contacts',
+    Object.keys(contactIdMap).map(Number), bundle.notes.contacts, result.warnings);
   const transferredContactIds = new Set();
   for (const aLead of selectedLeads) {
     for (const c of ((aLead._embedded && aLead._embedded.contacts) || [])) {
@@ -1559,7 +887,7 @@ async function runSingleDealsTransfer(leadIds, stageMapping) {
       if (!kContactId || transferredContactIds.has(aContactId)) continue; // не дублируем
       transferredContactIds.add(aContactId);
       try {
-        const _allContactNotes = await amoApi.getContactNotes(aContactId);
+        const _allContactNotes = _contactNotesByContact.get(Number(aContactId)) || [];
         result.notesDetail.contacts.fetched += _allContactNotes.length;
         // Dedup by note ID
         const _contactNotesTyped = _allContactNotes.filter(n => !SKIP_NOTE_TYPES.has(n.note_type));
@@ -1582,11 +910,13 @@ async function runSingleDealsTransfer(leadIds, stageMapping) {
           });
           if (_cNotePairs.length > 0) safety.registerMigratedBatch('notes_contacts', _cNotePairs);
         }
-      } catch (e) { result.warnings.push('Заметки контакта AMO#' + aContactId + ': ' + e.message); }
+      } catch (e) { if (e.code === 'INDEX_UNAVAILABLE') throw e; result.warnings.push('Заметки контакта AMO#' + aContactId + ': ' + e.message); }
     }
   }
 
-  // ── Notes: company notes (live fetch from AMO) ─────────────────────────────────
+  // ── Notes: company notes (not in the snapshot — one bulk AMO read for all companies) ─────
+  const _companyNotesByCompany = await loadNotesGrouped('companies',
+    Object.keys(companyIdMap).map(Number), null, result.warnings);
   const transferredCompanyIds = new Set();
   for (const aLead of selectedLeads) {
     for (const c of ((aLead._embedded && aLead._embedded.companies) || [])) {
@@ -1595,7 +925,7 @@ async function runSingleDealsTransfer(leadIds, stageMapping) {
       if (!kCompanyId || transferredCompanyIds.has(aCompanyId)) continue;
       transferredCompanyIds.add(aCompanyId);
       try {
-        const { notes: _allCompanyNotes } = await amoApi.getNotes('companies', aCompanyId);
+        const _allCompanyNotes = _companyNotesByCompany.get(Number(aCompanyId)) || [];
         result.notesDetail.companies.fetched += _allCompanyNotes.length;
         // Dedup by note ID
         const _coNotesTyped = _allCompanyNotes.filter(n => !SKIP_NOTE_TYPES.has(n.note_type));
@@ -1618,7 +948,7 @@ async function runSingleDealsTransfer(leadIds, stageMapping) {
           });
           if (_coNotePairs.length > 0) safety.registerMigratedBatch('notes_companies', _coNotePairs);
         }
-      } catch (e) { result.warnings.push('Заметки компании AMO#' + aCompanyId + ': ' + e.message); }
+      } catch (e) { if (e.code === 'INDEX_UNAVAILABLE') throw e; result.warnings.push('Заметки компании AMO#' + aCompanyId + ': ' + e.message); }
     }
   }
 
@@ -1635,183 +965,1169 @@ async function runSingleDealsTransfer(leadIds, stageMapping) {
   return result;
 }
 
-function pauseBatch() {
-  if (batchState.status !== 'running') throw new Error('Миграция не выполняется');
-  pauseRequestedFlag = true;
-  updateState({ step: '⏸ Запрос паузы...' });
-  return { ok: true, message: 'Пауза будет применена на ближайшей контрольной точке' };
-}
-
-async function retryLastBatch() {
-  if (batchState.status === 'running') throw new Error('Миграция уже выполняется');
-  const last = batchState.lastBatch;
-  if (!last || last.from === undefined) throw new Error('Нет данных о последнем пакете. Сначала выполните обычный перенос.');
-  loadBatchConfig();
-  batchConfig.offset = last.from;
-  saveBatchConfig();
-  logger.info('[retry] Retrying last batch from offset ' + last.from);
-  const cfg2 = require('../config');
-  const stagePath = path.resolve(cfg2.backupDir, 'stage_mapping.json');
-  let stageMapping = {};
-  if (fs.existsSync(stagePath)) stageMapping = fs.readJsonSync(stagePath);
-  return runBatchMigration(stageMapping);
-}
-
-// ─── Auto-run cycle ───────────────────────────────────────────────────────────
+// ─── Batch engine ─────────────────────────────────────────────────────────────
 /**
- * Starts an auto-run cycle: runs batches one after another with a 60-second
- * pause between them (to allow the user to review and press Stop).
- * The migration logic itself (runBatchMigration) is NOT changed.
+ * One batch migration stream: config file (managers / pipeline, batch size, cursor),
+ * state, pause and auto-run flags, rollback journal and SSE channel. The module exports
+ * the default engine ('batch' — the batch tab); migrationJobs creates one per partition.
+ * Engines share the per-CRM rate limiters and the migration index.
+ * @param {string} [id] - progress channel, rollback journal scope, index claim owner
+ * @param {object} [opts] - { configFile }
  */
-async function startAutoRun() {
-  if (autoRunEnabled) throw new Error('Автозапуск уже работает');
-  if (batchState.status === 'running') throw new Error('Пакетная миграция уже выполняется');
+function createBatchEngine(id = 'batch', opts = {}) {
+  const BATCH_CONFIG_FILE = opts.configFile || path.resolve(config.backupDir, 'batch_config.json');
+
+  // ─── State ────────────────────────────────────────────────────────────────────
+  let pauseRequestedFlag = false;
+  let autoRunEnabled = false;    // auto-run cycle active
+  let autoRunStopFlag = false;   // user pressed stop during countdown
+  let autoRunContinueFlag = false; // frontend signals: countdown done, start next batch
+
+  let batchState = {
+    status: 'idle', // idle | running | completed | error | rolling_back | paused | auto-waiting
+    step: null,
+    progress: { current: 0, total: 0 },
+    errors: [],
+    warnings: [],
+    createdIds: { contacts: [], companies: [], leads: [], tasks: [], notes: [] },
+    stats: { totalEligible: 0, totalTransferred: 0, remainingLeads: 0 },
+    stages: {},     // per-stage progress of tasks/notes phases: { leadTasks: { status, step, total, done }, ... }
+    metrics: null,  // last batch: { wallMs, phases: { companies: ms, ... }, crm: { AMO: { requests, throttleWaitMs, retries }, ... } }
+    startedAt: null,
+    completedAt: null,
+  };
+
+  let batchConfig = {
+    managerIds: [],   // [] = all managers
+    batchSize: 10,
+    offset: 0,        // number of eligible leads already transferred
+    stageMapping: {},
+    migrationMode: 'all', // 'all' | 'fix-existing' | 'fix-changed' | 'new-only'
+    fixProcessed: 0,  // cumulative deals processed in fix-existing mode
+    fixEligible: 0,   // total eligible for fix-existing at last count
+    cursor: null,     // batchSource cursor: { key, after: amo_entities row id } (rebuilt from offset when key changes)
+    parallelStages: true, // run lead/contact/company tasks + notes concurrently (false = sequential)
+    pipelineId: null, // only leads of this AMO pipeline (partitioned jobs); null = whole snapshot
+  };
 
-  autoRunEnabled = true;
-  autoRunStopFlag = false;
-  pauseRequestedFlag = false;
-  logger.info('[auto-run] Auto-run cycle started, batchSize=' + batchConfig.batchSize);
+  // ─── Config helpers ───────────────────────────────────────────────────────────
+  function loadBatchConfig() {
+    if (fs.existsSync(BATCH_CONFIG_FILE)) {
+      try { batchConfig = { ...batchConfig, ...fs.readJsonSync(BATCH_CONFIG_FILE) }; } catch {}
+    }
+    return batchConfig;
+  }
 
-  // Load stage mapping once
-  const cfg2 = require('../config');
-  const stagePath = path.resolve(cfg2.backupDir, 'stage_mapping.json');
-  let stageMapping = {};
-  if (fs.existsSync(stagePath)) stageMapping = fs.readJsonSync(stagePath);
+  function saveBatchConfig() {
+    fs.ensureDirSync(path.dirname(BATCH_CONFIG_FILE));
+    fs.writeJsonSync(BATCH_CONFIG_FILE, batchConfig, { spaces: 2 });
+  }
 
-  try {
-    while (autoRunEnabled && !autoRunStopFlag) {
-      loadBatchConfig();
-      const cache = loadAmoCache();
-      const eligible = getEligibleLeads(cache.leads || [], batchConfig.managerIds);
-      const remaining = eligible.length - batchConfig.offset;
-
-      if (remaining <= 0) {
-        logger.info('[auto-run] All deals migrated. Stopping auto-run.');
-        updateState({
-          status: 'completed',
-          step: `✅ Автозапуск завершён: все ${eligible.length} сделок перенесены`,
-          completedAt: new Date().toISOString(),
-        });
-        break;
+  function getBatchConfig() { loadBatchConfig(); return { ...batchConfig }; }
+
+  function setBatchConfig(updates) {
+    loadBatchConfig();
+    // Manual offset change: drop the cursor so batchSource rebuilds it from offset
+    const offsetChanged = updates.offset !== undefined && updates.offset !== batchConfig.offset;
+    batchConfig = { ...batchConfig, ...updates };
+    if (offsetChanged) batchConfig.cursor = null;
+    saveBatchConfig();
+  }
+
+  function getBatchState() { return { ...batchState }; }
+  progressStream.register(id, () => batchState);
+
+  // ─── State helpers ────────────────────────────────────────────────────────────
+  function updateState(u) { batchState = { ...batchState, ...u }; progressStream.notify(id); }
+
+  function addError(message, recommendation) {
+    batchState.errors.push({ timestamp: new Date().toISOString(), message, recommendation: recommendation || null });
+    logger.error(`[${id}] ${message}`);
+    progressStream.notify(id);
+  }
+
+  function addWarning(message, recommendation, details) {
+    const entry = { timestamp: new Date().toISOString(), message, recommendation: recommendation || null };
+    if (details && details.length > 0) entry.details = details;
+    batchState.warnings.push(entry);
+    logger.warn(`[${id}] ${message}`);
+    progressStream.notify(id);
+  }
+
+  // ─── Stage helpers (tasks / notes after leads) ────────────────────────────────
+  const BATCH_STAGES = ['leadTasks', 'contactTasks', 'companyTasks', 'leadNotes', 'contactNotes'];
+  // Migration index section each stage writes — its claims are released when the stage ends
+  const STAGE_SECTIONS = {
+    leadTasks: 'tasks_leads', contactTasks: 'tasks_contacts', companyTasks: 'tasks_companies',
+    leadNotes: 'notes_leads', contactNotes: 'notes_contacts',
+  };
+
+  function initStages(keys) {
+    const stages = {};
+    for (const k of keys) stages[k] = { status: 'pending', step: null, total: 0, done: 0 };
+    updateState({ stages });
+  }
+
+  // Patch one stage; the combined step line lists every stage still running
+  function setStage(key, patch) {
+    batchState.stages[key] = { ...batchState.stages[key], ...patch };
+    const running = Object.values(batchState.stages).filter(s => s.status === 'running' && s.step).map(s => s.step);
+    if (running.length > 0) updateState({ step: running.join(' · ') });
+  }
+
+  /**
+   * filterNotMigrated for a stream that may run next to others: the AMO ids are claimed
+   * first, so a record two jobs share (a contact on deals of two managers) is created once
+   * and the second job links it.
+   */
+  async function filterClaimed(section, items, getAmoId) {
+    await safety.claimIds(section, items.map(getAmoId), id);
+    return safety.filterNotMigrated(section, items, getAmoId);
+  }
+
+  // Pause/stop checkpoint: true → stage must return without further writes
+  function stageCheckpoint(key) {
+    if (!pauseRequestedFlag) return false;
+    setStage(key, { status: 'paused' });
+    return true;
+  }
+
+  /**
+   * Run stage functions concurrently (parallel=true) or one after another.
+   * A failing stage is recorded as a warning and does not abort the others.
+   * @param {object} stageFns - { stageKey: async () => {} }
+   * @param {object} [spans] - metrics run; each stage is timed as a phase of its key
+   */
+  async function runStages(stageFns, parallel, spans) {
+    let fatal = null; // index write failed: later stages would create untracked copies
+    const run = async ([key, fn]) => {
+      if (fatal || stageCheckpoint(key)) return;
+      setStage(key, { status: 'running', startedAt: new Date().toISOString() });
+      const endSpan = spans ? spans.phase(key) : () => {};
+      try {
+        await fn();
+        if (batchState.stages[key].status === 'running') setStage(key, { status: 'done', completedAt: new Date().toISOString() });
+      } catch (e) {
+        setStage(key, { status: 'error', error: e.message, completedAt: new Date().toISOString() });
+        if (e.code === 'INDEX_UNAVAILABLE') fatal = fatal || e;
+        else addWarning(`Этап ${key}: ${e.message}`, 'Повторите пакет — уже перенесённые задачи/заметки не будут продублированы.');
+      } finally {
+        endSpan();
+        safety.releaseClaims(id, STAGE_SECTIONS[key]);
       }
+    };
+    const entries = Object.entries(stageFns);
+    if (parallel) {
+      await Promise.all(entries.map(run));
+    } else {
+      for (const entry of entries) await run(entry);
+    }
+    if (fatal) throw fatal;
+  }
+
+  async function runBatchMigration(stageMapping) {
+    if (batchState.status === 'running') throw new Error('Пакетная миграция уже выполняется');
+
+    // Reset stale flags from previous stop (prevents phantom pause on new batch)
+    pauseRequestedFlag = false;
+    if (!autoRunEnabled) autoRunStopFlag = false;
+
+    loadBatchConfig();
 
-      // ── Run one batch ──
-      const offsetBefore = batchConfig.offset;
-      await runBatchMigration(stageMapping);
+    updateState({
+      status: 'running',
+      step: 'Инициализация пакета...',
+      errors: [], warnings: [],
+      progress: { current: 0, total: 0 },
+      createdIds: { contacts: [], companies: [], leads: [], tasks: [], notes: [] },
+      stats: { totalEligible: 0, totalTransferred: batchConfig.offset, remainingLeads: 0 },
+      stages: {},
+      metrics: null,
+      startedAt: new Date().toISOString(),
+      completedAt: null,
+    });
 
-      // ── Check result ──
-      loadBatchConfig();
-      const offsetAfter = batchConfig.offset;
-      const transferred = offsetAfter - offsetBefore;
-      const expectedSize = Math.min(batchConfig.batchSize || remaining, remaining);
+    // Phase spans + CRM request / throttle / retry counters of this batch → batchState.metrics
+    const spans = metrics.startRun(id);
+    let endPhase = spans.phase('prepare');
+    const enterPhase = (name) => { endPhase(); safety.releaseClaims(id); endPhase = spans.phase(name); };
 
-      if (batchState.status === 'error') {
-        logger.warn('[auto-run] Batch ended with error. Stopping auto-run.');
-        autoRunEnabled = false;
-        break;
+    try {
+      /* ── 1. Load cache ─────────────────────────────────────────────── */
+      try { loadAmoCacheMeta(); } catch (e) {
+        addError(e.message, 'Перейдите на вкладку "Данные amo" и нажмите "Загрузить данные".');
+        updateState({ status: 'error', completedAt: new Date().toISOString() });
+        return;
       }
 
-      if (batchState.status === 'paused') {
-        logger.info('[auto-run] Batch was paused manually. Stopping auto-run.');
-        autoRunEnabled = false;
-        break;
+      /* ── 2. Batch source: eligible leads at the cursor ──────────────────── */
+      // Ordered lead ids are prepared once per snapshot/managers/mode (batchSource);
+      // only this batch's leads and related rows are read from the store.
+      const _mode = batchConfig.migrationMode || 'all';
+      const _skipCreate = (_mode === 'fix-existing' || _mode === 'fix-changed');  // don't create new entities, only PATCH existing
+      const _skipPatch  = (_mode === 'new-only');       // don't patch existing, only create new
+      // batchSize === 0 means "transfer ALL remaining"
+      const batch = batchSource.next(batchConfig, batchConfig.batchSize);
+      const eligibleTotal = batch.eligible;
+      if (_mode !== 'all') logger.info(`[${id}] Mode=${_mode}: ${eligibleTotal} eligible leads`);
+
+      batchState.stats.totalEligible = eligibleTotal;
+      batchState.stats.remainingLeads = batch.remaining;
+
+      if (eligibleTotal === 0) {
+        addWarning(
+          batchConfig.managerIds.length === 0
+            ? 'Нет сделок для переноса. Данные могут быть не загружены.'
+            : 'Нет сделок для выбранных менеджеров.',
+          'Выберите других менеджеров или загрузите актуальные данные из amo CRM.'
+        );
+        updateState({ status: 'completed', step: 'Нет данных для переноса', completedAt: new Date().toISOString() });
+        return;
       }
 
-      // Counter verification: transferred must match expected batch size
-      if (transferred !== expectedSize) {
-        logger.warn(`[auto-run] Counter mismatch! Expected ${expectedSize}, got ${transferred}. Stopping.`);
-        updateState({
-          status: 'auto-stopped',
-          step: `⚠️ Расхождение счётчиков: ожидалось ${expectedSize}, перенесено ${transferred}. Автозапуск остановлен.`,
-          completedAt: new Date().toISOString(),
+      /* ── 3. Get current batch ───────────────────────────────────────── */
+      const from = batch.from;
+      const batchLeads = batch.leads;
+
+      if (batchLeads.length === 0) {
+        addWarning(
+          `Все ${eligibleTotal} сделок уже перенесены (смещение: ${from}).`,
+          'Для нового цикла переноса нажмите "Сбросить счётчик".'
+        );
+        updateState({ status: 'completed', step: 'Все сделки перенесены', completedAt: new Date().toISOString() });
+        return;
+      }
+
+      updateState({ step: `Пакет: сделки ${from + 1}–${from + batchLeads.length} из ${eligibleTotal}`, progress: { current: 0, total: batchLeads.length } });
+      logger.info(`Batch: migrating leads ${from}–${from + batchLeads.length - 1} / ${eligibleTotal}`);
+
+      /* ── 4. Validate stages ─────────────────────────────────────────── */
+      if (!stageMapping || Object.keys(stageMapping).length === 0) {
+        addWarning('Маппинг этапов пустой.', 'Нажмите "Синхронизировать этапы" перед запуском миграции.');
+      } else {
+        const unmapped = new Set();
+        batchLeads.forEach(l => {
+          if (l.status_id && !stageMapping[l.status_id] && ![142, 143].includes(l.status_id))
+            unmapped.add(l.status_id);
         });
-        autoRunEnabled = false;
-        break;
+        if (unmapped.size > 0) {
+          addWarning(
+            `Этапы [${[...unmapped].join(', ')}] отсутствуют в маппинге — сделки попадут в первый доступный этап.`,
+            'Выполните "Синхронизировать этапы" для создания недостающих этапов в Kommo CRM.'
+          );
+        }
       }
 
-      // Check if all done after this batch
-      const remainingAfter = eligible.length - offsetAfter;
-      if (remainingAfter <= 0) {
-        logger.info('[auto-run] All deals migrated after this batch. Done.');
-        updateState({
-          status: 'completed',
-          step: `✅ Автозапуск завершён: все ${eligible.length} сделок перенесены`,
-          completedAt: new Date().toISOString(),
+      /* ── 5. Validate contacts ───────────────────────────────────────── */
+      const leadsNoContact = batchLeads.filter(l => !l._embedded?.contacts?.length);
+      if (leadsNoContact.length > 0) {
+        const _ncDetails = leadsNoContact.map(l => {
+          const _kId = safety.getKommoId('leads', l.id);
+          const _kPart = _kId ? ' \u2192 Kommo#' + _kId : '';
+          return 'Сделка AMO#' + l.id + _kPart + ' (' + (l.name || 'без названия').substring(0, 40) + ')';
         });
-        break;
+        addWarning(
+          `${leadsNoContact.length} сделок не имеют привязанных контактов.`,
+          'Убедитесь, что это корректно. Сделки без контактов будут перенесены как есть.',
+          _ncDetails
+        );
       }
 
-      // ── Wait for frontend to signal "continue" (client-side 60s countdown) ──
-      logger.info(`[auto-run] Batch done (+${transferred}). Waiting for frontend continue signal. Remaining: ${remainingAfter}`);
-      autoRunContinueFlag = false;
+      /* ── 6. Related entities (pre-grouped by the batch source) ───────────── */
+      const batchContacts  = batch.contacts;
+      const batchCompanies = batch.companies;
+
+      /* ── 6b. Load field mappings ────────────────────────────────────── */
+      let fieldMappings = loadFieldMapping();
+      if (!fieldMappings) {
+        addWarning(
+          'Маппинг кастомных полей не найден.',
+          'Выполните "Синхронизировать поля" для переноса кастомных полей. Без маппинга кастомные поля переноситься не будут.'
+        );
+        fieldMappings = { leads: null, contacts: null, companies: null };
+      }
+
+        // --- User mapping for batch ---
+        const userMap = {};
+        try {
+          const ums = db.getUserMappings ? db.getUserMappings() : [];
+          ums.forEach(m => { userMap[m.amo_user_id] = m.kommo_user_id; userMap[String(m.amo_user_id)] = m.kommo_user_id; });
+        } catch (e) { /* proceed without user mapping */ }
+
+      /* ── 7. Migrate companies ───────────────────────────────────────── */
+          // pause before companies (safe: nothing written to Kommo yet)
+      if (pauseRequestedFlag) {
+        pauseRequestedFlag = false;
+        saveBatchConfig();
+        updateState({ status: 'paused', step: '⏸ Пауза перед переносом компаний', completedAt: new Date().toISOString() });
+        logger.info('Batch paused before companies');
+        return;
+      }
+      updateState({ step: `Перенос компаний (${batchCompanies.length})...` });
+      enterPhase('companies');
+      const companyIdMap = {};
+      if (batchCompanies.length > 0) {
+        const { transformMany } = require('../utils/dataTransformer');
+        // ═ САФЕТИ: исключаем уже перенесённые компании ════════
+        const { toCreate: companiesToCreate, skipped: companiesSkipped } =
+          await filterClaimed('companies', batchCompanies, c => c.id);
+        if (companiesSkipped.length > 0) {
+          const _csDetails = companiesSkipped.map(({ item, amoId, kommoId }) => {
+            const allLinkedLeads = (item && item._embedded && item._embedded.leads) ? item._embedded.leads.map(l => l.id) : [];
+            const linkedLeads = allLinkedLeads.map(lid => {
+              const _kLid = safety.getKommoId('leads', lid);
+              return 'AMO#' + lid + (_kLid ? '/Kommo#' + _kLid : '');
+            }).join(', ');
+            return `Компания AMO#${amoId} → Kommo#${kommoId}` + (linkedLeads ? ` (привязана к сделкам: ${linkedLeads})` : '');
+          });
+          addWarning(
+            `▶️ ${companiesSkipped.length} компаний уже перенесены ранее — пропущены (перезапись запрещена).`,
+            'Данные в Kommo не изменены. Если перенос нужно повторить — сбросьте индекс через вкладку Бэкапы.',
+            _csDetails
+          );
+          // Добавляем уже известные пары в idMap из индекса
+          companiesSkipped.forEach(({ amoId, kommoId }) => { companyIdMap[amoId] = kommoId; });
+        }
+        try {
+          if (companiesToCreate.length > 0) {
+            const created = await kommoApi.createCompaniesBatch(
+              spans.measure('transform', () => transformMany('companies', companiesToCreate, fieldMappings.companies, userMap)),
+              companiesToCreate.map(c => c.id)
+            );
+            const pairs = [];
+            created.forEach((k, i) => {
+              if (k && companiesToCreate[i]) {
+                companyIdMap[companiesToCreate[i].id] = k.id;
+                batchState.createdIds.companies.push(k.id);
+                pairs.push({ amoId: companiesToCreate[i].id, kommoId: k.id });
+              }
+            });
+            spans.measure('index', () => safety.registerMigratedBatch('companies', pairs));
+            const qn = quarantineNote('компаний', companiesToCreate.length, pairs.length);
+            if (qn) addWarning(qn);
+          }
+        } catch (e) {
+          if (e.isSafetyError) {
+            addError(`⛔ ${e.message}`);
+          } else {
+            addError(`Ошибка переноса компаний: ${e.message}`, 'Проверьте API-токен Kommo CRM и повторите попытку.');
+          }
+          updateState({ status: 'error', completedAt: new Date().toISOString() }); return;
+        }
+      }
+
+      /* ── 7b. Build contact→lead manager fallback map ────────────────── */
+      // For contacts whose AMO user is not in userMap, fall back to lead's mapped manager
+      const contactLeadManagerMap = {};
+      for (const lead of batchLeads) {
+        const amoLeadUid = lead.responsible_user_id;
+        const kommoLeadUid = amoLeadUid ? (userMap[amoLeadUid] || userMap[String(amoLeadUid)]) : null;
+        if (kommoLeadUid) {
+          for (const c of (lead._embedded?.contacts || [])) {
+            if (!contactLeadManagerMap[c.id]) contactLeadManagerMap[c.id] = Number(kommoLeadUid);
+          }
+        }
+      }
+
+      /* ── 8. Migrate contacts ────────────────────────────────────────── */
+      updateState({ step: `Перенос контактов (${batchContacts.length})...` });
+      enterPhase('contacts');
+      const contactIdMap = {};
+      if (batchContacts.length > 0) {
+        const { transformMany } = require('../utils/dataTransformer');
+        // ═ САФЕТИ: исключаем уже перенесённые контакты ════════
+        const { toCreate: contactsToCreate, skipped: contactsSkipped } =
+          await filterClaimed('contacts', batchContacts, c => c.id);
+        if (contactsSkipped.length > 0) {
+          const _ctDetails = contactsSkipped.map(({ item, amoId, kommoId }) => {
+            const allLinkedLeads = (item && item._embedded && item._embedded.leads) ? item._embedded.leads.map(l => l.id) : [];
+            const linkedLeads = allLinkedLeads.map(lid => {
+              const _kLid = safety.getKommoId('leads', lid);
+              return 'AMO#' + lid + (_kLid ? '/Kommo#' + _kLid : '');
+            }).join(', ');
+            return `Контакт AMO#${amoId} → Kommo#${kommoId}` + (linkedLeads ? ` (нужен для сделок: ${linkedLeads})` : '');
+          });
+          addWarning(
+            `▶️ ${contactsSkipped.length} контактов уже перенесены ранее — пропущены (перезапись запрещена).`,
+            'Данные в Kommo не изменены. Контакт остаётся привязан к ранее перенесённым сделкам и будет также привязан к новым.',
+            _ctDetails
+          );
+          contactsSkipped.forEach(({ amoId, kommoId }) => { contactIdMap[amoId] = kommoId; });
+        }
+        try {
+          if (contactsToCreate.length > 0) {
+            const created = await kommoApi.createContactsBatch(
+              spans.measure('transform', () => transformMany('contacts', contactsToCreate, fieldMappings.contacts, userMap)).map((t, i) => {
+                // Fallback: if contact has no mapped manager, use lead's manager
+                const c = contactsToCreate[i];
+                if (!t.responsible_user_id && contactLeadManagerMap[c.id]) {
+                  t.responsible_user_id = contactLeadManagerMap[c.id];
+                }
+                return t;
+              }),
+              contactsToCreate.map(c => c.id)
+            );
+            const pairs = [];
+            created.forEach((k, i) => {
+              if (k && contactsToCreate[i]) {
+                contactIdMap[contactsToCreate[i].id] = k.id;
+                batchState.createdIds.contacts.push(k.id);
+                pairs.push({ amoId: contactsToCreate[i].id, kommoId: k.id });
+              }
+            });
+            spans.measure('index', () => safety.registerMigratedBatch('contacts', pairs));
+            const qn = quarantineNote('контактов', contactsToCreate.length, pairs.length);
+            if (qn) addWarning(qn);
+          }
+        } catch (e) {
+          if (e.isSafetyError) {
+            addError(`⛔ ${e.message}`);
+          } else {
+            addError(`Ошибка переноса контактов: ${e.message}`, 'Проверьте API-токен Kommo CRM и повторите попытку.');
+          }
+          updateState({ status: 'error', completedAt: new Date().toISOString() }); return;
+        }
+      }
+
+      /* ── 9. Migrate leads ───────────────────────────────────────────── */
+      updateState({ step: `Перенос сделок (${batchLeads.length})...` });
+      enterPhase('leads');
+      const { transformMany } = require('../utils/dataTransformer');
+
+      // ╔ SAFE: исключаем уже перенесённые сделки ════════════════════════
+      const { toCreate: newLeads, skipped: skippedLeads } =
+        await filterClaimed('leads', batchLeads, l => l.id);
+      if (skippedLeads.length > 0) {
+        const _slDetails = skippedLeads.map(({ item, amoId, kommoId }) => {
+          const _name = (item && item.name) ? ' (' + item.name.substring(0, 40) + ')' : '';
+          return 'Сделка AMO#' + amoId + ' \u2192 Kommo#' + kommoId + _name;
+        });
+        addWarning(
+          `▶️ ${skippedLeads.length} сделок уже перенесены ранее — пропущены (перезапись запрещена).`,
+          'Данные в Kommo не изменены. Чтобы перенести повторно — сбросьте индекс через вкладку Бэкап.',
+          _slDetails
+        );
+      }
+      // Pre-populate leadIdMap для skipped сделок (нужно для задач/заметок)
+      const leadIdMap = {};
+      skippedLeads.forEach(({ amoId, kommoId }) => { leadIdMap[Number(amoId)] = Number(kommoId); });
+
+      const leadsToCreate = spans.measure('transform', () => transformMany('leads', newLeads, fieldMappings.leads, userMap, stageMapping)).map((t, i) => {
+        const lead = newLeads[i];
+        t.pipeline_id = (stageMapping && stageMapping._pipeline && stageMapping._pipeline.kommo) ? stageMapping._pipeline.kommo : config.kommo.pipelineId;
+        // Embed contacts + companies directly in lead creation payload (bulk, no separate link calls)
+        const embContacts = (lead._embedded?.contacts || [])
+          .map(c => contactIdMap[c.id]).filter(Boolean).map(id => ({ id: Number(id) }));
+        const embCompanies = (lead._embedded?.companies || [])
+          .map(c => companyIdMap[c.id]).filter(Boolean).map(id => ({ id: Number(id) }));
+        if (embContacts.length > 0 || embCompanies.length > 0) {
+          t._embedded = {};
+          if (embContacts.length > 0) t._embedded.contacts = embContacts;
+          if (embCompanies.length > 0) t._embedded.companies = embCompanies;
+        }
+        return t;
+      });
+
+      let createdLeads = [];
+      if (newLeads.length > 0) {
+      try {
+        createdLeads = await kommoApi.createLeadsBatch(leadsToCreate, newLeads.map(l => l.id));
+      } catch (e) {
+        addError(`Ошибка переноса сделок: ${e.message}`, 'Уменьшите размер пакета или проверьте лимиты API Kommo CRM.');
+        updateState({ status: 'error', completedAt: new Date().toISOString() }); return;
+      }
+      } // end if (newLeads.length > 0)
+
+      // leadIdMap declared above (see SAFE dedup block)
+      const leadPairs = [];
+      for (let idx = 0; idx < createdLeads.length; idx++) {
+        const kLead = createdLeads[idx];
+        const aLead = newLeads[idx];       // ← только новые (не skipped)
+        if (!kLead || !aLead) continue;
+        leadIdMap[aLead.id] = kLead.id;
+        batchState.createdIds.leads.push(kLead.id);
+        leadPairs.push({ amoId: aLead.id, kommoId: kLead.id });
+        batchState.progress.current = idx + 1;
+      }
+      // Регистрируем все перенесённые сделки в индексе безопасности
+      if (leadPairs.length > 0) spans.measure('index', () => safety.registerMigratedBatch('leads', leadPairs));
+      const leadsQn = quarantineNote('сделок', newLeads.length, leadPairs.length);
+      if (leadsQn) addWarning(leadsQn);
+
+      // Reverse map: Kommo lead ID -> AMO lead ID (for warning messages)
+      const kommoToAmoLead = {};
+      for (const [aId, kId] of Object.entries(leadIdMap)) kommoToAmoLead[kId] = aId;
+
+
+      // Pause check after leads (saves offset, stops before tasks)
+      if (pauseRequestedFlag) {
+        pauseRequestedFlag = false;
+        batchSource.commit(batchConfig, batch);
+        batchState.stats.totalTransferred = batchConfig.offset;
+        batchState.stats.remainingLeads   = Math.max(0, eligibleTotal - batchConfig.offset);
+        saveBatchConfig();
+        updateState({ status: 'paused', step: '⏸ Пауза после сделок. Задачи/заметки будут при следующем запуске', completedAt: new Date().toISOString() });
+        logger.info('Batch paused after leads, offset=' + batchConfig.offset);
+        return;
+      }
+
+      /* ── 10–11. Tasks / notes: concurrent stages ────────────────────── */
+      // Stages depend only on leadIdMap / contactIdMap / companyIdMap built above, so they
+      // can overlap; AMO/Kommo pacing is enforced by the shared per-CRM scheduler.
+      initStages(BATCH_STAGES);
+      enterPhase('stages');
+
+      const runLeadTasksStage = async () => {
+        const _batchTasksRaw = batchLeads.flatMap(l => batch.tasks.leads.get(l.id) || []).filter(t => !t.is_completed);
+        // Dedup by task ID to prevent duplicate tasks if batch is re-run
+        const { toCreate: _batchTasksFiltered, skipped: _batchTasksSkipped } = await filterClaimed('tasks_leads', _batchTasksRaw, t => t.id);
+        const batchTasks = _batchTasksFiltered;
+
+        if (batchTasks.length > 0) {
+          setStage('leadTasks', { step: `Перенос задач (${batchTasks.length})...`, total: batchTasks.length });
+          const { transformTask } = require('../utils/dataTransformer');
+          // Build lead responsible_user_id map (AMO lead id → kommo user id)
+          const leadKommoUserById = {};
+          for (const lead of batchLeads) {
+            const amoUid = lead.responsible_user_id;
+            const kommoUid = amoUid ? (userMap[amoUid] || userMap[String(amoUid)]) : null;
+            if (kommoUid) leadKommoUserById[lead.id] = Number(kommoUid);
+          }
+          const tasksToCreate = batchTasks.map(t => {
+            const entityKommoUser = leadKommoUserById[t.entity_id] || null;
+            const tt = transformTask(t, userMap, entityKommoUser);
+            tt.entity_id = leadIdMap[t.entity_id];
+            tt.entity_type = 'leads';
+            tt._wasCompleted = !!t.is_completed;
+            tt._amoTaskId = t.id;
+            return tt;
+          }).filter(t => t.entity_id);
+
+          if (tasksToCreate.length < batchTasks.length) {
+            addWarning(
+              `${batchTasks.length - tasksToCreate.length} задач потеряли привязку к сделкам.`,
+              'Это ожидаемо, если сделки не попали в текущий пакет. Задачи перенесутся при переносе соответствующих сделок.'
+            );
+          }
+          try {
+            const created = await kommoApi.createTasksBatch(tasksToCreate);
+            const _batchTaskPairs = [];
+            const _completedBatchLeadTaskIds = [];
+            created.forEach((k, idx) => {
+              if (k) {
+                batchState.createdIds.tasks.push(k.id);
+                if (tasksToCreate[idx]?._wasCompleted) _completedBatchLeadTaskIds.push(k.id);
+                if (tasksToCreate[idx]?._amoTaskId) _batchTaskPairs.push({ amoId: Number(tasksToCreate[idx]._amoTaskId), kommoId: k.id });
+              }
+            });
+            if (_completedBatchLeadTaskIds.length > 0) await kommoApi.completeTasksBatch(_completedBatchLeadTaskIds);
+            if (_batchTaskPairs.length > 0) safety.registerMigratedBatch('tasks_leads', _batchTaskPairs);
+            const _ltSuccessCount = created.filter(x => x !== null).length;
+            setStage('leadTasks', { done: _ltSuccessCount });
+            if (_ltSuccessCount < tasksToCreate.length) {
+              logger.warn(`[${id}] Задачи лидов: перенесено ${_ltSuccessCount}/${tasksToCreate.length}`);
+              if (_ltSuccessCount === 0) addWarning('Задачи лидов: 0 перенесено после retry.', 'Попробуйте повтор пакета.');
+            }
+          } catch (e) {
+            if (e.code === 'INDEX_UNAVAILABLE') throw e; // пары не сохранены — не продолжать
+            logger.error(`[${id}] Неожиданная ошибка задач лидов: ` + e.message);
+          }
+        }
+
+        if (stageCheckpoint('leadTasks')) return;
+
+        /* ── 10-fix. PATCH task_type_id + text for already-migrated lead tasks ──────── */
+        if (!_skipPatch && _batchTasksSkipped.length > 0) {
+          const { AMO_TO_KOMMO_TASK_TYPE, fmtDatePrefix: _fmtDP } = require('../utils/dataTransformer');
+          const _taskTypeUpdates = [];
+          for (const s of _batchTasksSkipped) {
+            const amoTask = s.item;
+            if (amoTask.is_completed) continue; // only active tasks
+            const kommoTaskId = s.kommoId;
+            const amoTypeId = amoTask.task_type_id;
+            const kommoTypeId = AMO_TO_KOMMO_TASK_TYPE[amoTypeId];
+            const upd = { id: kommoTaskId, task_type_id: kommoTypeId || 1 };
+            // МОЯ ЗАДАЧА prefix for self-assigned tasks
+            if (amoTask.created_by && amoTask.responsible_user_id && amoTask.created_by === amoTask.responsible_user_id) {
+              const _tb = _fmtDP(amoTask.created_at) + ((amoTask.text && amoTask.text.trim()) ? amoTask.text : 'Задача');
+              upd.text = 'МОЯ ЗАДАЧА: ' + _tb;
+            }
+            _taskTypeUpdates.push(upd);
+          }
+          if (_taskTypeUpdates.length > 0) {
+            setStage('leadTasks', { step: `Обновление типов задач лидов (${_taskTypeUpdates.length})...` });
+            try {
+              const _updatedLT = await kommoApi.updateTasksBatch(_taskTypeUpdates);
+              logger.info(`[${id}] PATCH task_type_id for lead tasks: ${_updatedLT}/${_taskTypeUpdates.length}`);
+            } catch (e) {
+              logger.error(`[${id}] Ошибка PATCH типов задач лидов: ` + e.message);
+            }
+          } else {
+            logger.info(`[${id}] Skipped lead tasks: ${_batchTasksSkipped.length}, all type=1, no PATCH needed`);
+          }
+        }
+      };
+
+      const runContactTasksStage = async () => {
+        /* -- 10b. Batch: Contact tasks ----------------------------------------- */
+        let _batchContactTasksSkipped = [];
+        {
+          const _batchContactIdsSet = new Set(Object.keys(contactIdMap).map(Number));
+          const _batchContactTasksRaw = [..._batchContactIdsSet].flatMap(id => batch.tasks.contacts.get(id) || []).filter(t => !t.is_completed);
+          const { toCreate: _batchContactTasksFiltered, skipped: _ctSkipped } = await filterClaimed('tasks_contacts', _batchContactTasksRaw, t => t.id);
+          _batchContactTasksSkipped = _ctSkipped;
+          if (_batchContactTasksFiltered.length > 0) {
+            setStage('contactTasks', { step: 'Перенос задач контактов (' + _batchContactTasksFiltered.length + ')...', total: _batchContactTasksFiltered.length });
+            const { transformTask: _transformTaskCT } = require('../utils/dataTransformer');
+            const _ctKommoUserById = {};
+            for (const contact of batchContacts) {
+              const uid = contact.responsible_user_id;
+              const kuid = uid ? (userMap[uid] || userMap[String(uid)]) : null;
+              if (kuid) _ctKommoUserById[contact.id] = Number(kuid);
+            }
+            const _ctTasksToCreate = _batchContactTasksFiltered.map(t => {
+              const kContactId = contactIdMap[String(t.entity_id)];
+              if (!kContactId) return null;
+              const entityUser = _ctKommoUserById[t.entity_id] || null;
+              const tt = _transformTaskCT(t, userMap, entityUser);
+              tt.entity_id = Number(kContactId);
+              tt.entity_type = 'contacts';
+              tt._wasCompleted = !!t.is_completed;
+              tt._amoTaskId = t.id;
+              return tt;
+            }).filter(Boolean);
+            if (_ctTasksToCreate.length > 0) {
+              try {
+                const _createdCT = await kommoApi.createTasksBatch(_ctTasksToCreate);
+                const _completedCTIds = [];
+                const _ctPairs = [];
+                _createdCT.forEach((k, idx) => {
+                  if (k) {
+                    batchState.createdIds.tasks.push(k.id);
+                    if (_ctTasksToCreate[idx]?._wasCompleted) _completedCTIds.push(k.id);
+                    if (_ctTasksToCreate[idx]?._amoTaskId) _ctPairs.push({ amoId: Number(_ctTasksToCreate[idx]._amoTaskId), kommoId: k.id });
+                  }
+                });
+                if (_completedCTIds.length > 0) await kommoApi.completeTasksBatch(_completedCTIds);
+                if (_ctPairs.length > 0) safety.registerMigratedBatch('tasks_contacts', _ctPairs);
+                const _ctSuccessCount = _createdCT.filter(x => x !== null).length;
+                setStage('contactTasks', { done: _ctSuccessCount });
+                if (_ctSuccessCount < _ctTasksToCreate.length) {
+                  logger.warn(`[${id}] Задачи контактов: перенесено ${_ctSuccessCount}/${_ctTasksToCreate.length}`);
+                  if (_ctSuccessCount === 0) addWarning('Задачи контактов: 0 перенесено после retry.', 'Попробуйте повтор пакета.');
+                }
+              } catch (e) {
+                if (e.code === 'INDEX_UNAVAILABLE') throw e; // пары не сохранены — не продолжать
+                logger.error(`[${id}] Неожиданная ошибка задач контактов: ` + e.message);
+              }
+            }
+          }
+        }
+
+        if (stageCheckpoint('contactTasks')) return;
+
+        /* ── 10b-fix. PATCH task_type_id + text for already-migrated contact tasks ── */
+        if (!_skipPatch && _batchContactTasksSkipped && _batchContactTasksSkipped.length > 0) {
+          const { AMO_TO_KOMMO_TASK_TYPE: _ctTypeMap, fmtDatePrefix: _fmtDP2 } = require('../utils/dataTransformer');
+          const _ctTypeUpdates = [];
+          for (const s of _batchContactTasksSkipped) {
+            const amoTask = s.item;
+            if (amoTask.is_completed) continue; // only active tasks
+            const amoTypeId = amoTask.task_type_id;
+            const kommoTypeId = _ctTypeMap[amoTypeId];
+            const upd = { id: s.kommoId, task_type_id: kommoTypeId || 1 };
+            if (amoTask.created_by && amoTask.responsible_user_id && amoTask.created_by === amoTask.responsible_user_id) {
+              const _tb = _fmtDP2(amoTask.created_at) + ((amoTask.text && amoTask.text.trim()) ? amoTask.text : 'Задача');
+              upd.text = 'МОЯ ЗАДАЧА: ' + _tb;
+            }
+            _ctTypeUpdates.push(upd);
+          }
+          if (_ctTypeUpdates.length > 0) {
+            try {
+              const _ctUpd = await kommoApi.updateTasksBatch(_ctTypeUpdates);
+              logger.info(`[${id}] PATCH task_type_id for contact tasks: ${_ctUpd}/${_ctTypeUpdates.length}`);
+            } catch (e) {
+              logger.error(`[${id}] Ошибка PATCH типов задач контактов: ` + e.message);
+            }
+          }
+        }
+      };
+
+      const runCompanyTasksStage = async () => {
+        /* -- 10c. Batch: Company tasks ----------------------------------------- */
+        let _batchCompanyTasksSkipped = [];
+        {
+          const _batchCompanyIdsSet = new Set(Object.keys(companyIdMap).map(Number));
+          const _batchCompanyTasksRaw = [..._batchCompanyIdsSet].flatMap(id => batch.tasks.companies.get(id) || []).filter(t => !t.is_completed);
+          const { toCreate: _batchCompanyTasksFiltered, skipped: _coSkipped } = await filterClaimed('tasks_companies', _batchCompanyTasksRaw, t => t.id);
+          _batchCompanyTasksSkipped = _coSkipped;
+          if (_batchCompanyTasksFiltered.length > 0) {
+            setStage('companyTasks', { step: 'Перенос задач компаний (' + _batchCompanyTasksFiltered.length + ')...', total: _batchCompanyTasksFiltered.length });
+            const { transformTask: _transformTaskCo } = require('../utils/dataTransformer');
+            const _coKommoUserById = {};
+            for (const company of batchCompanies) {
+              const uid = company.responsible_user_id;
+              const kuid = uid ? (userMap[uid] || userMap[String(uid)]) : null;
+              if (kuid) _coKommoUserById[company.id] = Number(kuid);
+            }
+            const _coTasksToCreate = _batchCompanyTasksFiltered.map(t => {
+              const kCompanyId = companyIdMap[String(t.entity_id)];
+              if (!kCompanyId) return null;
+              const entityUser = _coKommoUserById[t.entity_id] || null;
+              const tt = _transformTaskCo(t, userMap, entityUser);
+              tt.entity_id = Number(kCompanyId);
+              tt.entity_type = 'companies';
+              tt._wasCompleted = !!t.is_completed;
+              tt._amoTaskId = t.id;
+              return tt;
+            }).filter(Boolean);
+            if (_coTasksToCreate.length > 0) {
+              try {
+                const _createdCo = await kommoApi.createTasksBatch(_coTasksToCreate);
+                const _completedCoIds = [];
+                const _coPairs = [];
+                _createdCo.forEach((k, idx) => {
+                  if (k) {
+                    batchState.createdIds.tasks.push(k.id);
+                    if (_coTasksToCreate[idx]?._wasCompleted) _completedCoIds.push(k.id);
+                    if (_coTasksToCreate[idx]?._amoTaskId) _coPairs.push({ amoId: Number(_coTasksToCreate[idx]._amoTaskId), kommoId: k.id });
+                  }
+                });
+                if (_completedCoIds.length > 0) await kommoApi.completeTasksBatch(_completedCoIds);
+                if (_coPairs.length > 0) safety.registerMigratedBatch('tasks_companies', _coPairs);
+                setStage('companyTasks', { done: _createdCo.filter(x => x !== null).length });
+              } catch (e) {
+                if (e.code === 'INDEX_UNAVAILABLE') throw e; // пары не сохранены — не продолжать
+                addWarning('Ошибка переноса задач компаний: ' + e.message, 'Повторите пакет.');
+              }
+            }
+          }
+        }
+
+        if (stageCheckpoint('companyTasks')) return;
+
+        /* ── 10c-fix. PATCH task_type_id + text for already-migrated company tasks ── */
+        if (!_skipPatch && _batchCompanyTasksSkipped && _batchCompanyTasksSkipped.length > 0) {
+          const { AMO_TO_KOMMO_TASK_TYPE: _coTypeMap, fmtDatePrefix: _fmtDP3 } = require('../utils/dataTransformer');
+          const _coTypeUpdates = [];
+          for (const s of _batchCompanyTasksSkipped) {
+            const amoTask = s.item;
+            if (amoTask.is_completed) continue; // only active tasks
+            const amoTypeId = amoTask.task_type_id;
+            const kommoTypeId = _coTypeMap[amoTypeId];
+            const upd = { id: s.kommoId, task_type_id: kommoTypeId || 1 };
+            if (amoTask.created_by && amoTask.responsible_user_id && amoTask.created_by === amoTask.responsible_user_id) {
+              const _tb = _fmtDP3(amoTask.created_at) + ((amoTask.text && amoTask.text.trim()) ? amoTask.text : 'Задача');
+              upd.text = 'МОЯ ЗАДАЧА: ' + _tb;
+            }
+            _coTypeUpdates.push(upd);
+          }
+          if (_coTypeUpdates.length > 0) {
+            try {
+              const _coUpd = await kommoApi.updateTasksBatch(_coTypeUpdates);
+              logger.info(`[${id}] PATCH task_type_id for company tasks: ${_coUpd}/${_coTypeUpdates.length}`);
+            } catch (e) {
+              logger.error(`[${id}] Ошибка PATCH типов задач компаний: ` + e.message);
+            }
+          }
+        }
+      };
+
+      const runLeadNotesStage = async () => {
+        setStage('leadNotes', { step: 'Перенос комментариев сделок...' });
+        {
+          const leadAmoIds = batchLeads.map(l => l.id);
+          try {
+            const { notes: allLeadNotes } = await noteSource.getNotesForEntities('leads', leadAmoIds, { cached: batch.notes.leads });
+            const _batchLeadNotesTyped = allLeadNotes.filter(note => !SKIP_NOTE_TYPES.has(note.note_type));
+            const { toCreate: _batchLeadNotesToCreate } = await filterClaimed('notes_leads', _batchLeadNotesTyped, n => n.id);
+            // Build flat array: all notes for all leads in one bulk call
+            const _allLeadNotesMapped = [];
+            const _allLeadNoteAmoIds = [];
+            for (const note of _batchLeadNotesToCreate) {
+              const kId = leadIdMap[note.entity_id];
+              if (!kId) continue;
+              const s = sanitizeNoteParams(note);
+              _allLeadNotesMapped.push({ entity_id: Number(kId), note_type: s.note_type, params: s.params, created_by: 12739795 });
+              _allLeadNoteAmoIds.push(note.id);
+            }
+            setStage('leadNotes', { total: _allLeadNotesMapped.length });
+            if (_allLeadNotesMapped.length > 0) {
+              const created = await kommoApi.createNotesBatch('leads', _allLeadNotesMapped);
+              const _batchLeadNotePairs = [];
+              created.forEach((cn, idx) => {
+                if (cn) {
+                  batchState.createdIds.notes.push(cn.id);
+                  if (_allLeadNoteAmoIds[idx]) _batchLeadNotePairs.push({ amoId: Number(_allLeadNoteAmoIds[idx]), kommoId: cn.id });
+                }
+              });
+              if (_batchLeadNotePairs.length > 0) safety.registerMigratedBatch('notes_leads', _batchLeadNotePairs);
+              const _leadSuccessCount = created.filter(x => x !== null).length;
+              setStage('leadNotes', { done: _leadSuccessCount });
+              if (_leadSuccessCount < _allLeadNotesMapped.length) {
+                logger.warn(`[${id}] Заметки сделок: перенесено ${_leadSuccessCount}/${_allLeadNotesMapped.length}`);
+              }
+            }
+          } catch (e) {
+            if (e.code === 'INDEX_UNAVAILABLE') throw e; // пары не сохранены — не продолжать
+            addWarning('Не удалось загрузить заметки сделок: ' + e.message, 'Попробуйте повторить пакет.');
+          }
+        }
+      };
+
+      const runContactNotesStage = async () => {
+        setStage('contactNotes', { step: 'Перенос комментариев контактов...' });
+        {
+          // Unique migrated contact IDs of this batch (relation index, lead order)
+          const batchContactAmoIds = [...new Set(batchLeads.flatMap(l => batch.links.get(l.id)?.contacts || []))]
+            .filter(id => contactIdMap[id]);
+          try {
+            // Snapshot notes; AMO API only for contacts changed since fetchedAt or missing in the snapshot
+            const { notes: allContactNotes } = await noteSource.getNotesForEntities('contacts', batchContactAmoIds, { cached: batch.notes.contacts });
+            // Filter out skipped types + dedup via safety
+            const _bCNotesTyped = allContactNotes.filter(note => !SKIP_NOTE_TYPES.has(note.note_type));
+            const { toCreate: _bCNotesToCreate } = await filterClaimed('notes_contacts', _bCNotesTyped, n => n.id);
+            // Build flat array: all contact notes in one bulk call
+            const _allContactNotesMapped = [];
+            const _allContactNoteAmoIds = [];
+            for (const note of _bCNotesToCreate) {
+              const kId = contactIdMap[note.entity_id];
+              if (!kId) continue;
+              const s = sanitizeNoteParams(note);
+              _allContactNotesMapped.push({ entity_id: Number(kId), note_type: s.note_type, params: s.params, created_by: 12739795 });
+              _allContactNoteAmoIds.push(note.id);
+            }
+            setStage('contactNotes', { total: _allContactNotesMapped.length });
+            if (_allContactNotesMapped.length > 0) {
+              const created = await kommoApi.createNotesBatch('contacts', _allContactNotesMapped);
+              const _batchContactNotePairs = [];
+              created.forEach((cn, idx) => {
+                if (cn) {
+                  batchState.createdIds.notes.push(cn.id);
+                  if (_allContactNoteAmoIds[idx]) _batchContactNotePairs.push({ amoId: Number(_allContactNoteAmoIds[idx]), kommoId: cn.id });
+                }
+              });
+              if (_batchContactNotePairs.length > 0) safety.registerMigratedBatch('notes_contacts', _batchContactNotePairs);
+              const _cSuccessCount = created.filter(x => x !== null).length;
+              setStage('contactNotes', { done: _cSuccessCount });
+              if (_cSuccessCount < _allContactNotesMapped.length) {
+                logger.warn(`[${id}] Заметки контактов: перенесено ${_cSuccessCount}/${_allContactNotesMapped.length}`);
+              }
+            }
+          } catch (e) {
+            if (e.code === 'INDEX_UNAVAILABLE') throw e; // пары не сохранены — не продолжать
+            addWarning('Не удалось загрузить заметки контактов: ' + e.message, 'Попробуйте повторить пакет.');
+          }
+        }
+      };
+
+      await runStages({
+        leadTasks:    runLeadTasksStage,
+        contactTasks: runContactTasksStage,
+        companyTasks: runCompanyTasksStage,
+        leadNotes:    runLeadNotesStage,
+        contactNotes: runContactNotesStage,
+      }, batchConfig.parallelStages !== false, spans);
+      enterPhase('finalize');
+
+      // Pause/stop checkpoint hit inside a stage: save offset, retry of the batch picks up the rest
+      if (Object.values(batchState.stages).some(s => s.status === 'paused')) {
+        pauseRequestedFlag = false;
+        batchSource.commit(batchConfig, batch);
+        batchState.stats.totalTransferred = batchConfig.offset;
+        batchState.stats.remainingLeads   = Math.max(0, eligibleTotal - batchConfig.offset);
+        batchState.lastBatch = { from, size: batchLeads.length, after: batch.after, cursorKey: batch.key };
+        saveBatchConfig();
+        updateState({ status: 'paused', step: '⏸ Пауза на этапе задач/заметок. Недостающее перенесёт «Повтор пакета»', completedAt: new Date().toISOString() });
+        logger.info('Batch paused during task/note stages, offset=' + batchConfig.offset);
+        return;
+      }
+
+      /* ── 12. Update offset ──────────────────────────────────────────── */
+      batchSource.commit(batchConfig, batch);
+      batchState.stats.totalTransferred = batchConfig.offset;
+      batchState.stats.remainingLeads   = Math.max(0, eligibleTotal - batchConfig.offset);
+      // ── Fix mode: накапливаем отдельный счётчик ──────────────────────
+      if (_mode === 'fix-existing' || _mode === 'fix-changed') {
+        // Changed-since-migration flags (delta sync) of what this batch has just re-patched
+        db.clearNeedsFix('leads', batchLeads.map(l => l.id));
+        db.clearNeedsFix('contacts', batchContacts.map(c => c.id));
+        db.clearNeedsFix('companies', batchCompanies.map(c => c.id));
+        batchConfig.fixProcessed = (batchConfig.fixProcessed || 0) + batchLeads.length;
+        batchConfig.fixEligible  = eligibleTotal;
+        batchState.stats.fixProcessed = batchConfig.fixProcessed;
+        batchState.stats.fixEligible  = batchConfig.fixEligible;
+      }
+      // Save last batch position for retry feature
+      batchState.lastBatch = { from, size: batchLeads.length, after: batch.after, cursorKey: batch.key };
+      // Store AMO→Kommo deal pairs for verification UI
+      batchState.dealPairs = Object.entries(leadIdMap).map(([amo, kommo]) => ({ amoId: Number(amo), kommoId: Number(kommo) }));
+      saveBatchConfig();
+
       updateState({
-        status: 'auto-waiting',
-        step: `⏳ Пауза перед следующим пакетом. Перенесено: ${offsetAfter}/${eligible.length}. Нажмите «Стоп» для отмены.`,
-        autoRunCountdown: 60,
+        status: batchState.errors.length > 0 ? 'error' : 'completed',
+        step: `✅ Пакет завершён: +${batchLeads.length} сделок. Всего: ${batchConfig.offset}/${eligibleTotal}`,
+        completedAt: new Date().toISOString(),
       });
 
-      // Poll every 500ms for stop or continue signal (no heavy work — just flag checks)
-      let stopped = false;
-      while (!autoRunContinueFlag) {
-        if (autoRunStopFlag || !autoRunEnabled) {
-          stopped = true;
-          break;
+      logger.info(`Batch done: +${batchLeads.length} leads, total ${batchConfig.offset}/${eligibleTotal}`);
+
+    } catch (err) {
+      addError(`Критическая ошибка: ${err.message}`, 'Проверьте логи сервера. При необходимости выполните откат последнего пакета.');
+      updateState({ status: 'error', completedAt: new Date().toISOString() });
+      logger.error('Batch migration fatal error:', err);
+    } finally {
+      safety.releaseClaims(id);
+      const summary = spans.finish();
+      updateState({ metrics: summary });
+      logger.info(`[metrics] ${id} ${summary.wallMs}ms: ${Object.entries(summary.phases).map(([k, ms]) => `${k} ${ms}ms`).join(', ')}`);
+    }
+  }
+
+  // ─── Rollback ─────────────────────────────────────────────────────────────────
+  async function rollbackBatch() {
+    updateState({ status: 'rolling_back' });
+    try {
+      // Interrupted rollback (restart / API error) resumes from its journal
+      let journal = rollbackEngine.pending(id);
+      if (journal) {
+        loadBatchConfig();
+        addWarning(`Продолжение прерванного отката от ${journal.startedAt}`);
+      } else {
+        const ids = batchState.createdIds;
+        // ═ САФЕТИ: при откате удаляем ТОЛЬКО те записи, которые создали САМИ
+        // (batchState.createdIds). Записи, которых нет в createdIds, не трогаем.
+        const plan = { tasks: ids.tasks || [], notes: ids.notes || [] };
+        for (const [entity, label] of [['leads', 'сделок'], ['contacts', 'контактов'], ['companies', 'компаний']]) {
+          const { safe, blocked } = safety.validateRollbackIds(entity, ids[entity] || [], ids[entity] || []);
+          if (blocked.length > 0) addWarning(`⛔ Откат: ${blocked.length} ${label} заблокированы (не созданы в этом пакете).`);
+          plan[entity] = safe;
         }
-        await new Promise(r => setTimeout(r, 500));
+        journal = await rollbackEngine.begin(id, {
+          ids: plan,
+          meta: { lastBatch: batchState.lastBatch || null, leads: (ids.leads || []).length },
+        });
+      }
+
+      const { failed } = await rollbackEngine.run(journal, ({ kind, done, total }) => {
+        updateState({ step: `Откат: ${kind} ${done}/${total}` });
+      });
+      for (const [kind, list] of Object.entries(failed)) {
+        if (list.length > 0) addWarning(`Откат: ${list.length} ${kind} не удалось удалить в Kommo`, 'Удалите их вручную', list.slice(0, 50));
+      }
+
+      // Cursor back to the start of the rolled-back batch (already-indexed leads are skipped on re-run)
+      const lastBatch = journal.meta?.lastBatch;
+      if (lastBatch?.cursorKey != null) {
+        batchSource.rewind(batchConfig, lastBatch);
+      } else {
+        batchConfig.offset = Math.max(0, batchConfig.offset - (journal.meta?.leads || 0));
+        batchConfig.cursor = null;
       }
+      saveBatchConfig();
+
+      updateState({ status: 'idle', step: null, createdIds: { contacts: [], companies: [], leads: [], tasks: [], notes: [] } });
+      logger.info('Batch rollback complete');
+    } catch (e) {
+      addError(`Ошибка отката: ${e.message}`, 'Прогресс сохранён — повторный «Откат» продолжит с места остановки.');
+      updateState({ status: 'error' });
+    }
+  }
+
+  /** Interrupted batch rollback waiting to be resumed: { startedAt, error, steps: [{ kind, done, total }] } or null. */
+  function getPendingRollback() {
+    const journal = rollbackEngine.pending(id);
+    if (!journal) return null;
+    return {
+      startedAt: journal.startedAt,
+      error: journal.error || null,
+      steps: journal.steps.map(s => ({ kind: s.kind, done: s.done, total: s.ids.length })),
+    };
+  }
+
+  function resetOffset() {
+    loadBatchConfig();
+    batchSource.reset(batchConfig);
+    saveBatchConfig();
+  }
+
+  function pauseBatch() {
+    if (batchState.status !== 'running') throw new Error('Миграция не выполняется');
+    pauseRequestedFlag = true;
+    updateState({ step: '⏸ Запрос паузы...' });
+    return { ok: true, message: 'Пауза будет применена на ближайшей контрольной точке' };
+  }
+
+  async function retryLastBatch() {
+    if (batchState.status === 'running') throw new Error('Миграция уже выполняется');
+    const last = batchState.lastBatch;
+    if (!last || last.from === undefined) throw new Error('Нет данных о последнем пакете. Сначала выполните обычный перенос.');
+    loadBatchConfig();
+    batchSource.rewind(batchConfig, last);
+    saveBatchConfig();
+    logger.info('[retry] Retrying last batch from offset ' + last.from);
+    const cfg2 = require('../config');
+    const stagePath = path.resolve(cfg2.backupDir, 'stage_mapping.json');
+    let stageMapping = {};
+    if (fs.existsSync(stagePath)) stageMapping = fs.readJsonSync(stagePath);
+    return runBatchMigration(stageMapping);
+  }
+
+  // ─── Auto-run cycle ───────────────────────────────────────────────────────────
+  /**
+   * Starts an auto-run cycle: runs batches one after another with a 60-second
+   * pause between them (to allow the user to review and press Stop).
+   * The migration logic itself (runBatchMigration) is NOT changed.
+   */
+  async function startAutoRun() {
+    if (autoRunEnabled) throw new Error('Автозапуск уже работает');
+    if (batchState.status === 'running') throw new Error('Пакетная миграция уже выполняется');
+
+    autoRunEnabled = true;
+    autoRunStopFlag = false;
+    pauseRequestedFlag = false;
+    logger.info('[auto-run] Auto-run cycle started, batchSize=' + batchConfig.batchSize);
+
+    // Load stage mapping once
+    const cfg2 = require('../config');
+    const stagePath = path.resolve(cfg2.backupDir, 'stage_mapping.json');
+    let stageMapping = {};
+    if (fs.existsSync(stagePath)) stageMapping = fs.readJsonSync(stagePath);
+
+    try {
+      while (autoRunEnabled && !autoRunStopFlag) {
+        loadBatchConfig();
+        // Cursor-based totals: no lead rows are read between batches
+        const { eligible: eligibleCount, remaining } = batchSource.peek(batchConfig);
+
+        if (remaining <= 0) {
+          logger.info('[auto-run] All deals migrated. Stopping auto-run.');
+          updateState({
+            status: 'completed',
+            step: `✅ Автозапуск завершён: все ${eligibleCount} сделок перенесены`,
+            completedAt: new Date().toISOString(),
+          });
+          break;
+        }
+
+        // ── Run one batch ──
+        const offsetBefore = batchConfig.offset;
+        await runBatchMigration(stageMapping);
+
+        // ── Check result ──
+        loadBatchConfig();
+        const offsetAfter = batchConfig.offset;
+        const transferred = offsetAfter - offsetBefore;
+        const expectedSize = Math.min(batchConfig.batchSize || remaining, remaining);
+
+        if (batchState.status === 'error') {
+          logger.warn('[auto-run] Batch ended with error. Stopping auto-run.');
+          autoRunEnabled = false;
+          break;
+        }
+
+        if (batchState.status === 'paused') {
+          logger.info('[auto-run] Batch was paused manually. Stopping auto-run.');
+          autoRunEnabled = false;
+          break;
+        }
+
+        // Counter verification: transferred must match expected batch size
+        if (transferred !== expectedSize) {
+          logger.warn(`[auto-run] Counter mismatch! Expected ${expectedSize}, got ${transferred}. Stopping.`);
+          updateState({
+            status: 'auto-stopped',
+            step: `⚠️ Расхождение счётчиков: ожидалось ${expectedSize}, перенесено ${transferred}. Автозапуск остановлен.`,
+            completedAt: new Date().toISOString(),
+          });
+          autoRunEnabled = false;
+          break;
+        }
 
-      if (stopped || autoRunStopFlag || !autoRunEnabled) {
-        logger.info('[auto-run] Stopped by user during countdown.');
+        // Check if all done after this batch
+        const remainingAfter = eligibleCount - offsetAfter;
+        if (remainingAfter <= 0) {
+          logger.info('[auto-run] All deals migrated after this batch. Done.');
+          updateState({
+            status: 'completed',
+            step: `✅ Автозапуск завершён: все ${eligibleCount} сделок перенесены`,
+            completedAt: new Date().toISOString(),
+          });
+          break;
+        }
+
+        // ── Wait for frontend to signal "continue" (client-side 60s countdown) ──
+        logger.info(`[auto-run] Batch done (+${transferred}). Waiting for frontend continue signal. Remaining: ${remainingAfter}`);
+        autoRunContinueFlag = false;
         updateState({
-          status: 'completed',
-          step: `⏹ Автозапуск остановлен пользователем. Перенесено: ${offsetAfter}/${eligible.length}`,
-          completedAt: new Date().toISOString(),
-          autoRunCountdown: 0,
+          status: 'auto-waiting',
+          step: `⏳ Пауза перед следующим пакетом. Перенесено: ${offsetAfter}/${eligibleCount}. Нажмите «Стоп» для отмены.`,
+          autoRunCountdown: 60,
         });
-        break;
+
+        // Poll every 500ms for stop or continue signal (no heavy work — just flag checks)
+        let stopped = false;
+        while (!autoRunContinueFlag) {
+          if (autoRunStopFlag || !autoRunEnabled) {
+            stopped = true;
+            break;
+          }
+          await new Promise(r => setTimeout(r, 500));
+        }
+
+        if (stopped || autoRunStopFlag || !autoRunEnabled) {
+          logger.info('[auto-run] Stopped by user during countdown.');
+          updateState({
+            status: 'completed',
+            step: `⏹ Автозапуск остановлен пользователем. Перенесено: ${offsetAfter}/${eligibleCount}`,
+            completedAt: new Date().toISOString(),
+            autoRunCountdown: 0,
+          });
+          break;
+        }
+        logger.info('[auto-run] Continue signal received, starting next batch.');
       }
-      logger.info('[auto-run] Continue signal received, starting next batch.');
+    } catch (err) {
+      logger.error('[auto-run] Fatal error:', err);
+      updateState({
+        status: 'error',
+        step: `❌ Автозапуск: критическая ошибка: ${err.message}`,
+        completedAt: new Date().toISOString(),
+      });
+    } finally {
+      autoRunEnabled = false;
+      autoRunStopFlag = false;
+      autoRunContinueFlag = false;
+      batchState.autoRunCountdown = 0;
     }
-  } catch (err) {
-    logger.error('[auto-run] Fatal error:', err);
-    updateState({
-      status: 'error',
-      step: `❌ Автозапуск: критическая ошибка: ${err.message}`,
-      completedAt: new Date().toISOString(),
-    });
-  } finally {
-    autoRunEnabled = false;
-    autoRunStopFlag = false;
-    autoRunContinueFlag = false;
-    batchState.autoRunCountdown = 0;
   }
-}
 
-function stopAutoRun() {
-  if (!autoRunEnabled) {
-    // Idempotent: double-click or stale state — just clean up flags
-    pauseRequestedFlag = false;
-    autoRunStopFlag = false;
-    return { ok: true, wasRunning: false,
+  function stopAutoRun() {
+    if (!autoRunEnabled) {
+      // Idempotent: double-click or stale state — just clean up flags
+      pauseRequestedFlag = false;
+      autoRunStopFlag = false;
+      return { ok: true, wasRunning: false,
+        transferred: batchState.stats?.totalTransferred || 0,
+        remaining: batchState.stats?.remainingLeads || 0,
+        lastStep: batchState.step || '' };
+    }
+    autoRunStopFlag = true;
+    const wasRunning = batchState.status === 'running';
+    if (wasRunning) {
+      pauseRequestedFlag = true;
+    }
+    logger.info('[auto-run] Stop requested by user, wasRunning=' + wasRunning);
+    return { ok: true, wasRunning,
       transferred: batchState.stats?.totalTransferred || 0,
       remaining: batchState.stats?.remainingLeads || 0,
       lastStep: batchState.step || '' };
   }
-  autoRunStopFlag = true;
-  const wasRunning = batchState.status === 'running';
-  if (wasRunning) {
-    pauseRequestedFlag = true;
+
+  function isAutoRunActive() {
+    return autoRunEnabled;
   }
-  logger.info('[auto-run] Stop requested by user, wasRunning=' + wasRunning);
-  return { ok: true, wasRunning,
-    transferred: batchState.stats?.totalTransferred || 0,
-    remaining: batchState.stats?.remainingLeads || 0,
-    lastStep: batchState.step || '' };
-}
 
-function isAutoRunActive() {
-  return autoRunEnabled;
-}
   // ─── Continue auto-run (called by frontend after client-side countdown) ─────
   function continueAutoRun() {
     if (!autoRunEnabled) {
@@ -1825,7 +2141,20 @@ function isAutoRunActive() {
     return { ok: true };
   }
 
+  return {
+    id,
+    getBatchConfig, setBatchConfig, getBatchState, loadBatchConfig,
+    runBatchMigration, rollbackBatch, getPendingRollback, resetOffset,
+    pauseBatch, retryLastBatch, startAutoRun, stopAutoRun, continueAutoRun, isAutoRunActive,
+  };
+}
 
+// ─── Default engine (batch tab, /batch-* routes) ──────────────────────────────
+const {
+  getBatchConfig, setBatchConfig, getBatchState, loadBatchConfig,
+  runBatchMigration, rollbackBatch, getPendingRollback, resetOffset,
+  pauseBatch, retryLastBatch, startAutoRun, stopAutoRun, continueAutoRun, isAutoRunActive,
+} = createBatchEngine();
 
-module.exports = { getBatchConfig, setBatchConfig, getBatchState, analyzeManagers, getStats, runBatchMigration, rollbackBatch, resetOffset, loadBatchConfig, loadAmoCache, runSingleDealsTransfer, pauseBatch, retryLastBatch, startAutoRun, stopAutoRun,
-    continueAutoRun, isAutoRunActive };
+module.exports = { getBatchConfig, setBatchConfig, getBatchState, analyzeManagers, getStats, runBatchMigration, rollbackBatch, getPendingRollback, resetOffset, retryQuarantine, loadBatchConfig, loadAmoCache, runSingleDealsTransfer, pauseBatch, retryLastBatch, startAutoRun, stopAutoRun,
+    continueAutoRun, isAutoRunActive, createBatchEngine };
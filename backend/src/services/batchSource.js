@@ -0,0 +1,210 @@
+/**
+ * batchSource.js
+ * Cursor-based source of lead batches for runBatchMigration / auto-run.
+ *
+ * The ordered list of lead ids for the selected managers (and pipeline) is prepared
+ * once per snapshot (fetchedAt/filteredAt) + managers + pipeline + mode and kept in
+ * memory, one list per source so parallel jobs don't evict each other's. The cursor —
+ * amo_entities row id of the last lead passed — lives in batch_config.json
+ * (batchConfig.cursor), so consecutive batches read only their own leads and related
+ * rows from SQLite. The migration-mode filter (fix-existing / fix-changed / new-only)
+ * is applied while reading, so leads becoming migrated between batches don't move the
+ * cursor. fix-changed has no cursor: its progress is the needs-fix flags themselves.
+ */
+const db = require('../db');
+const safety = require('../utils/safetyGuard');
+
+const prepared = new Map(); // key → { version, rowIds, ids } — source leads in row order
+const MAX_PREPARED = 16;
+
+// A delta sync can move leads in or out of the filtered list (responsible_user_id /
+// pipeline_id updated in place), so a list index is not kept across versions: the
+// cursor is a row id, and upserts keep row ids while new leads get larger ones.
+// The key uses the full-fetch time (baseFetchedAt), the list is reloaded on any new fetchedAt.
+function sourceKey(meta, cfg) {
+  const managers = (cfg.managerIds || []).map(Number).sort((a, b) => a - b);
+  const base = meta.baseFetchedAt || meta.fetchedAt || null;
+  const key = [base, meta.filteredAt || null, managers, cfg.migrationMode || 'all'];
+  // Whole-snapshot sources keep their old key, so saved cursors stay valid
+  if (cfg.pipelineId) key.push(Number(cfg.pipelineId));
+  return JSON.stringify(key);
+}
+
+/**
+ * Leads a fix-changed pass has to visit: flagged by a delta sync (db.listNeedsFix) or
+ * linked to a flagged contact/company. Read on every open, so leads a batch cleared
+ * drop out and newly flagged ones are picked up wherever they are in the list.
+ */
+function changedLeadIds() {
+  const flagged = db.listNeedsFix();
+  const ids = new Set(flagged.leads);
+  for (const type of ['contacts', 'companies']) {
+    for (const { leadId } of db.getAmoLinkedLeads(type, flagged[type])) ids.add(leadId);
+  }
+  return ids;
+}
+
+function modeMatcher(mode) {
+  if (mode === 'fix-existing') return (id) => safety.isMigrated('leads', id);
+  if (mode === 'fix-changed') {
+    const changed = changedLeadIds();
+    return (id) => changed.has(Number(id)) && safety.isMigrated('leads', id);
+  }
+  if (mode === 'new-only') return (id) => !safety.isMigrated('leads', id);
+  return () => true;
+}
+
+/**
+ * Leads with everything a transfer needs, via amo_entity_links and the entity_id
+ * index — cost depends on the number of leads, not on the snapshot size.
+ * @param {number[]} leadIds - AMO lead ids (result keeps snapshot order)
+ * @returns {{ leads, contacts, companies, links, tasks: { leads, contacts, companies }, notes: { leads, contacts } }}
+ *   links/tasks/notes are Map<amo id, ...>
+ */
+function loadLeadBundle(leadIds) {
+  const leads = leadIds.length ? db.queryAmoEntities('leads', { ids: leadIds }) : [];
+  const { byLead, contactIds, companyIds } = db.getAmoLeadLinks(leadIds);
+  return {
+    leads,
+    contacts:  contactIds.length ? db.queryAmoEntities('contacts',  { ids: contactIds }) : [],
+    companies: companyIds.length ? db.queryAmoEntities('companies', { ids: companyIds }) : [],
+    links: byLead,
+    tasks: {
+      leads:     db.groupAmoEntitiesByEntity('leadTasks',    leadIds),
+      contacts:  db.groupAmoEntitiesByEntity('contactTasks', contactIds),
+      companies: db.groupAmoEntitiesByEntity('companyTasks', companyIds),
+    },
+    notes: {
+      leads:    db.groupAmoEntitiesByEntity('leadNotes',    leadIds),
+      contacts: db.groupAmoEntitiesByEntity('contactNotes', contactIds),
+    },
+  };
+}
+
+/** First index in the ascending rowIds with a row id above `after`. */
+function positionAfter(rowIds, after) {
+  let lo = 0, hi = rowIds.length;
+  while (lo < hi) {
+    const mid = (lo + hi) >> 1;
+    if (rowIds[mid] <= after) lo = mid + 1; else hi = mid;
+  }
+  return lo;
+}
+
+/**
+ * Prepare (or reuse) the ordered lead list and resolve the cursor position.
+ * A cursor saved for another snapshot/manager set/mode is rebuilt from cfg.offset
+ * (offset = number of eligible leads already transferred, as before).
+ * @param {object} cfg - batchConfig ({ managerIds, pipelineId, migrationMode, offset, cursor })
+ * @returns {{ key, rowIds, ids, position, after, matches }} or null if no snapshot is cached
+ */
+function open(cfg) {
+  const meta = db.getAmoCacheMeta();
+  if (!meta) return null;
+  const key = sourceKey(meta, cfg);
+  const version = meta.fetchedAt || null;
+  let entry = prepared.get(key);
+  if (!entry || entry.version !== version) {
+    entry = { version, ...db.listAmoEntityKeys('leads', { responsibleUserIds: cfg.managerIds, pipelineId: cfg.pipelineId }) };
+    prepared.delete(key);
+    if (prepared.size >= MAX_PREPARED) prepared.delete(prepared.keys().next().value);
+    prepared.set(key, entry);
+  }
+  const matches = modeMatcher(cfg.migrationMode || 'all');
+  const { rowIds, ids } = entry;
+  const cursor = cfg.cursor && cfg.cursor.key === key ? cfg.cursor : null;
+
+  let position;
+  if ((cfg.migrationMode || 'all') === 'fix-changed') {
+    // Finished batches clear their flags (runBatchMigration), so scan from the start
+    position = 0;
+  } else if (cursor && cursor.after != null) {
+    position = positionAfter(rowIds, cursor.after);
+  } else if (cursor && cursor.position != null) {
+    // Cursor saved as a list index before the keyset cursor: used once, commit() rewrites it
+    position = Math.min(cursor.position, ids.length);
+  } else {
+    // Legacy / changed source: skip `offset` eligible leads from the start
+    let skip = cfg.offset || 0;
+    position = 0;
+    while (position < ids.length && skip > 0) {
+      if (matches(ids[position])) skip--;
+      position++;
+    }
+  }
+  const after = position === 0 ? 0 : (cursor && cursor.after != null ? cursor.after : rowIds[position - 1]);
+  return { key, rowIds, ids, position, after, matches };
+}
+
+/** Number of eligible leads at or after the cursor. */
+function countRemaining(src) {
+  let n = 0;
+  for (let i = src.position; i < src.ids.length; i++) if (src.matches(src.ids[i])) n++;
+  return n;
+}
+
+/**
+ * Totals for progress/auto-run without reading any lead rows.
+ * @returns {{ eligible, remaining }} eligible = already transferred (offset) + remaining
+ */
+function peek(cfg) {
+  const src = open(cfg);
+  if (!src) return { eligible: 0, remaining: 0 };
+  const remaining = countRemaining(src);
+  return { eligible: (cfg.offset || 0) + remaining, remaining };
+}
+
+/**
+ * Read the next batch at the cursor. Does not move the cursor — call commit() once
+ * the batch is done.
+ * @param {object} cfg - batchConfig
+ * @param {number} size - 0 = all remaining
+ * @returns {object|null} { key, from, after, nextAfter, eligible, remaining,
+ *   ...loadLeadBundle() } or null if no snapshot is cached; after/nextAfter are the
+ *   cursor (row id) before and after this batch
+ */
+function next(cfg, size) {
+  const src = open(cfg);
+  if (!src) return null;
+  const remaining = countRemaining(src);
+  const limit = size > 0 ? size : Infinity;
+
+  const leadIds = [];
+  let nextPosition = src.position;
+  while (nextPosition < src.ids.length && leadIds.length < limit) {
+    const id = src.ids[nextPosition++];
+    if (src.matches(id)) leadIds.push(id);
+  }
+
+  return {
+    key: src.key,
+    from: cfg.offset || 0,
+    after: src.after,
+    nextAfter: nextPosition > src.position ? src.rowIds[nextPosition - 1] : src.after,
+    eligible: (cfg.offset || 0) + remaining,
+    remaining,
+    ...loadLeadBundle(leadIds),
+  };
+}
+
+/** Move the cursor past a finished batch (caller saves batch_config.json). */
+function commit(cfg, batch) {
+  cfg.offset = batch.from + batch.leads.length;
+  cfg.cursor = { key: batch.key, after: batch.nextAfter };
+}
+
+/** Put the cursor back to a batch start (retry of the last batch). */
+function rewind(cfg, lastBatch) {
+  cfg.offset = lastBatch.from;
+  if (lastBatch.cursorKey == null) cfg.cursor = null;
+  else if (lastBatch.after != null) cfg.cursor = { key: lastBatch.cursorKey, after: lastBatch.after };
+  // lastBatch recorded before the keyset cursor (rollback journal on disk)
+  else cfg.cursor = { key: lastBatch.cursorKey, position: lastBatch.position };
+}
+
+function reset(cfg) {
+  cfg.offset = 0;
+  cfg.cursor = null;
+}
+
+module.exports = { peek, next, commit, rewind, reset, loadLeadBundle };
@@ -147,17 +147,49 @@ function transformMultitext(amoField, kommoFieldId, enumMap) {
   return { field_id: kommoFieldId, values };
 }
 
+// ─── Contact / company payloads ───────────────────────────────────────────────
+// AMO Email field id from the contacts mapping — looked up once, not per contact
+let _emailFieldId;
+function getEmailFieldId() {
+  if (_emailFieldId === undefined) {
+    const mapping = getFieldMapping().contacts || {};
+    _emailFieldId = Object.entries(mapping).find(([, v]) => v.amoFieldName === 'Email')?.[0] || null;
+  }
+  return _emailFieldId;
+}
+
+function contactEmail(amoContact) {
+  const emailFieldId = getEmailFieldId();
+  if (!emailFieldId) return null;
+  const emailField = amoContact.custom_fields_values?.find((f) => String(f.field_id) === emailFieldId);
+  return emailField?.values?.[0]?.value || null;
+}
+
+function contactPayload(amoContact, kommoUserId) {
+  const customFields = transformCustomFields(amoContact.custom_fields_values, 'contacts');
+  return {
+    name: amoContact.name || 'Unnamed',
+    responsible_user_id: kommoUserId,
+    custom_fields_values: customFields.length ? customFields : undefined,
+  };
+}
+
+function companyPayload(amoCompany, kommoUserId) {
+  const customFields = transformCustomFields(amoCompany.custom_fields_values, 'companies');
+  return {
+    name: amoCompany.name || 'Unknown Company',
+    responsible_user_id: kommoUserId,
+    custom_fields_values: customFields.length ? customFields : undefined,
+  };
+}
+
 // ─── Find or create Kommo contact ─────────────────────────────────────────────
 async function findOrCreateContact(amoContact, sessionId, kommoUserId) {
   // Check if already mapped in this session
   const existing = db.resolveKommoId(sessionId, 'contact', amoContact.id);
   if (existing) return existing;
 
-  // Check mapping table for email
-  const mapping = getFieldMapping().contacts || {};
-  const emailFieldId = Object.entries(mapping).find(([, v]) => v.amoFieldName === 'Email')?.[0];
-  const emailField = amoContact.custom_fields_values?.find((f) => String(f.field_id) === emailFieldId);
-  const email = emailField?.values?.[0]?.value;
+  const email = contactEmail(amoContact);
 
   // Try to find existing in Kommo by email
   let kommoContact = email ? await kommo.findContactByEmail(email) : null;
@@ -169,13 +201,7 @@ async function findOrCreateContact(amoContact, sessionId, kommoUserId) {
   }
 
   // Create new contact
-  const customFields = transformCustomFields(amoContact.custom_fields_values, 'contacts');
-
-  const payload = {
-    name: amoContact.name || 'Unnamed',
-    responsible_user_id: kommoUserId,
-    custom_fields_values: customFields.length ? customFields : undefined,
-  };
+  const payload = contactPayload(amoContact, kommoUserId);
 
   try {
     const created = await kommo.createContact(payload);
@@ -202,12 +228,7 @@ async function findOrCreateCompany(amoCompany, sessionId, kommoUserId) {
     return kommoCompany.id;
   }
 
-  const customFields = transformCustomFields(amoCompany.custom_fields_values, 'companies');
-  const payload = {
-    name: amoCompany.name || 'Unknown Company',
-    responsible_user_id: kommoUserId,
-    custom_fields_values: customFields.length ? customFields : undefined,
-  };
+  const payload = companyPayload(amoCompany, kommoUserId);
 
   try {
     const created = await kommo.createCompany(payload);
@@ -221,6 +242,122 @@ async function findOrCreateCompany(amoCompany, sessionId, kommoUserId) {
   }
 }
 
+// ─── Session pre-pass: contacts / companies in bulk ──────────────────────────
+const PREPASS_BATCH = 50;
+
+/**
+ * Map AMO records of one type to Kommo in bulk: a lookup table by key (email / name)
+ * instead of one search per record, then the missing ones created PREPASS_BATCH per
+ * request. Records sharing a key inside the session map to one Kommo record. A batch
+ * Kommo rejects, and records whose lookup failed, are left to the per-deal findOrCreate path.
+ * @returns {{ total, matched, created }}
+ */
+async function settleInBulk(sessionId, type, items, { keyOf, lookup, create, payloadOf }) {
+  const keys = [...new Set(items.map(keyOf).filter(Boolean))];
+  const found = keys.length > 0 ? await lookup(keys) : new Map();
+
+  const toCreate = [];
+  const firstByKey = new Map(); // key → index in toCreate
+  const sameKey = new Map();    // index in toCreate → later items with the same key
+  const matchedRows = [];
+  for (const item of items) {
+    const key = keyOf(item);
+    const hit = key ? found.get(key) : null;
+    if (key && !hit && found.has(key)) continue; // lookup failed: per-deal findOrCreate decides
+    if (hit) {
+      matchedRows.push({ entityType: type, amoId: item.id, kommoId: hit.id, status: 'skipped' });
+    } else if (key && firstByKey.has(key)) {
+      const i = firstByKey.get(key);
+      if (!sameKey.has(i)) sameKey.set(i, []);
+      sameKey.get(i).push(item);
+    } else {
+      if (key) firstByKey.set(key, toCreate.length);
+      toCreate.push(item);
+    }
+  }
+  db.setMappings(sessionId, matchedRows);
+
+  // Mappings are written per chunk, right after Kommo created it: a crash mid-loop must
+  // not leave Kommo records without a 'created' mapping (re-run duplicates, no rollback)
+  let created = 0;
+  for (let start = 0; start < toCreate.length; start += PREPASS_BATCH) {
+    const chunk = toCreate.slice(start, start + PREPASS_BATCH);
+    let result;
+    try {
+      result = await create(chunk.map(payloadOf));
+    } catch (err) {
+      db.log(sessionId, 'warn', `Bulk ${type} create failed (${chunk.length} records) — they will be created per deal: ${err.message}`);
+      continue;
+    }
+    const rows = [];
+    const shared = [];
+    result.forEach((k, i) => {
+      const idx = k.request_id != null && !isNaN(Number(k.request_id)) ? Number(k.request_id) : i;
+      if (idx >= chunk.length || !k.id) return;
+      rows.push({ entityType: type, amoId: chunk[idx].id, kommoId: k.id, status: 'created' });
+      for (const item of (sameKey.get(start + idx) || [])) {
+        shared.push({ entityType: type, amoId: item.id, kommoId: k.id, status: 'skipped' });
+      }
+    });
+    created += rows.length;
+    db.setMappings(sessionId, rows.concat(shared));
+  }
+  return { total: items.length, matched: matchedRows.length, created };
+}
+
+/**
+ * Before deals are copied: check which leads already exist in Kommo (amo_id field), then
+ * settle every contact and company the remaining deals link to — bulk lookup by email /
+ * company name and batch creation. copyDeal then finds them through resolveKommoId.
+ * @returns {object} ctx for copyDeal: { contacts, companies, amoIdField, existingLeads }
+ */
+async function prepareSession(sessionId, session, leads) {
+  const ctx = {
+    contacts: new Map(db.getCached(sessionId, 'contact').map((c) => [c.id, c])),
+    companies: new Map(db.getCached(sessionId, 'company').map((c) => [c.id, c])),
+    amoIdField: await getAmoIdFieldId(),
+    existingLeads: new Map(), // amo lead id → Kommo lead found by the amo_id field
+  };
+
+  const pending = leads.filter((l) => db.getMapping(sessionId, 'lead', l.id)?.status !== 'created');
+  if (ctx.amoIdField) {
+    const hits = await Promise.all(pending.map((l) => kommo.findLeadByAmoId(l.id, ctx.amoIdField)));
+    pending.forEach((l, i) => { if (hits[i]) ctx.existingLeads.set(l.id, hits[i]); });
+  }
+
+  const contactIds = new Set();
+  const companyIds = new Set();
+  for (const lead of pending) {
+    if (ctx.existingLeads.has(lead.id)) continue;
+    for (const c of lead._embedded?.contacts || []) contactIds.add(c.id);
+    const company = lead._embedded?.companies?.[0];
+    if (company) companyIds.add(company.id);
+  }
+  const unresolved = (type, ids, cache) => [...ids]
+    .map((id) => cache.get(id))
+    .filter((item) => item && !db.resolveKommoId(sessionId, type, item.id));
+
+  const lower = (v) => (typeof v === 'string' && v ? v.toLowerCase() : null);
+  const contacts = await settleInBulk(sessionId, 'contact', unresolved('contact', contactIds, ctx.contacts), {
+    keyOf: (c) => lower(contactEmail(c)),
+    lookup: kommo.findContactsByEmails,
+    create: kommo.createContacts,
+    payloadOf: (c) => contactPayload(c, session.kommo_user_id),
+  });
+  const companies = await settleInBulk(sessionId, 'company', unresolved('company', companyIds, ctx.companies), {
+    keyOf: (c) => lower(c.name),
+    lookup: kommo.findCompaniesByNames,
+    create: kommo.createCompanies,
+    payloadOf: (c) => companyPayload(c, session.kommo_user_id),
+  });
+
+  db.log(sessionId, 'info',
+    `Pre-pass: ${ctx.existingLeads.size} leads already in Kommo; ` +
+    `contacts ${contacts.matched} found + ${contacts.created} created of ${contacts.total}; ` +
+    `companies ${companies.matched} found + ${companies.created} created of ${companies.total}`);
+  return ctx;
+}
+
 // ─── Copy timeline ─────────────────────────────────────────────────────────────
 const NOTE_TYPE_MAP = {
   4: 4,  // common note
@@ -326,7 +463,7 @@ async function getAmoIdFieldId() {
 }
 
 // ─── Copy a single deal ────────────────────────────────────────────────────────
-async function copyDeal(amoLead, session, stageMapping, kommoUsers) {
+async function copyDeal(amoLead, session, stageMapping, kommoUsers, ctx) {
   const sessionId = session.id;
   const amoLeadId = amoLead.id;
 
@@ -345,10 +482,10 @@ async function copyDeal(amoLead, session, stageMapping, kommoUsers) {
     return { skipped: true, reason: 'already_copied', kommoId: existingMapping.kommo_id };
   }
 
-  // Check for duplicate in Kommo by amo_id field
-  const amoIdField = await getAmoIdFieldId();
+  // Check for duplicate in Kommo by amo_id field (looked up by the session pre-pass)
+  const amoIdField = ctx.amoIdField;
   if (amoIdField) {
-    const existing = await kommo.findLeadByAmoId(amoLeadId, amoIdField);
+    const existing = ctx.existingLeads.get(amoLeadId);
     if (existing) {
       db.setMapping(sessionId, 'lead', amoLeadId, existing.id, 'skipped');
       db.log(sessionId, 'info', `Lead ${amoLeadId} already exists in Kommo as ${existing.id} (amo_id field)`);
@@ -368,9 +505,7 @@ async function copyDeal(amoLead, session, stageMapping, kommoUsers) {
   // Resolve contacts
   const contactIds = [];
   const amoContacts = amoLead._embedded?.contacts || [];
-  const cachedContacts = amoContacts.length > 0
-    ? db.getCached(sessionId, 'contact').filter((c) => amoContacts.some((ac) => ac.id === c.id))
-    : [];
+  const cachedContacts = amoContacts.map((ac) => ctx.contacts.get(ac.id)).filter(Boolean);
 
   for (const amoContact of cachedContacts) {
     try {
@@ -385,7 +520,7 @@ async function copyDeal(amoLead, session, stageMapping, kommoUsers) {
   let kommoCompanyId = null;
   const amoCompanies = amoLead._embedded?.companies || [];
   if (amoCompanies.length > 0) {
-    const cachedCompany = db.getCacheItem(sessionId, 'company', amoCompanies[0].id);
+    const cachedCompany = ctx.companies.get(amoCompanies[0].id);
     if (cachedCompany) {
       kommoCompanyId = await findOrCreateCompany(cachedCompany, sessionId, session.kommo_user_id).catch(() => null);
     }
@@ -539,6 +674,10 @@ async function copySessionDeals(sessionId, userMapOverride = null) {
     const total = leads.length;
     let copied = 0, errors = 0, skipped = 0;
 
+    // Contacts / companies of all deals in bulk before the deals themselves
+    emitProgress(sessionId, { type: 'step', step: 'prepass', message: 'Сопоставляем контакты и компании с Kommo...' });
+    const ctx = await prepareSession(sessionId, session, leads);
+
     for (let i = 0; i < leads.length; i++) {
       const lead = leads[i];
       emitProgress(sessionId, {
@@ -551,7 +690,7 @@ async function copySessionDeals(sessionId, userMapOverride = null) {
       });
 
       try {
-        const result = await copyDeal(lead, session, stageMapping, kommoUsers);
+        const result = await copyDeal(lead, session, stageMapping, kommoUsers, ctx);
         if (result.skipped) {
           skipped++;
           emitProgress(sessionId, {
@@ -617,44 +756,44 @@ async function copySessionDeals(sessionId, userMapOverride = null) {
 }
 
 // ─── Preview data for session modal ──────────────────────────────────────────
-function getSessionPreview(sessionId) {
+/**
+ * One page of the preview: summary from COUNT queries, leads in fetch order after
+ * the `after` cursor (next_after → next page, null on the last one).
+ * `search` (name substring or AMO id) filters in SQLite, so it covers every cached lead.
+ */
+function getSessionPreview(sessionId, { after = 0, limit = 200, search = '' } = {}) {
   const session = db.getSession(sessionId);
   if (!session) return null;
 
-  const leads = db.getCached(sessionId, 'lead');
-  const contacts = db.getCached(sessionId, 'contact');
-  const companies = db.getCached(sessionId, 'company');
-  const mappings = db.getCreatedMappings(sessionId);
+  const leadStatuses = db.countMappingsByStatus(sessionId, 'lead');
+  const { rows, nextAfter } = db.getCachedPage(sessionId, 'lead', { after, limit, search });
   const logs = db.getSessionLog(sessionId, 50);
 
-  // Attach mapping status to each lead
-  const leadsWithStatus = leads.map((lead) => {
-    const mapping = db.getMapping(sessionId, 'lead', lead.id);
-    return {
-      id: lead.id,
-      name: lead.name,
-      price: lead.price,
-      status_id: lead.status_id,
-      stage_name: lead._embedded?.statuses?.[0]?.name,
-      contacts_count: lead._embedded?.contacts?.length || 0,
-      created_at: lead.created_at,
-      copy_status: mapping?.status || 'pending',
-      kommo_id: mapping?.kommo_id || null,
-      error: mapping?.error_msg || null,
-    };
-  });
+  const leadsWithStatus = rows.map(({ item: lead, status, kommo_id, error_msg }) => ({
+    id: lead.id,
+    name: lead.name,
+    price: lead.price,
+    status_id: lead.status_id,
+    stage_name: lead._embedded?.statuses?.[0]?.name,
+    contacts_count: lead._embedded?.contacts?.length || 0,
+    created_at: lead.created_at,
+    copy_status: status || 'pending',
+    kommo_id: kommo_id || null,
+    error: error_msg || null,
+  }));
 
   return {
     session,
     summary: {
-      total_leads: leads.length,
-      total_contacts: contacts.length,
-      total_companies: companies.length,
-      copied: mappings.filter((m) => m.entity_type === 'lead' && m.status === 'created').length,
-      skipped: mappings.filter((m) => m.entity_type === 'lead' && m.status === 'skipped').length,
-      errors: mappings.filter((m) => m.entity_type === 'lead' && m.status === 'error').length,
+      total_leads: db.countCached(sessionId, 'lead'),
+      total_contacts: db.countCached(sessionId, 'contact'),
+      total_companies: db.countCached(sessionId, 'company'),
+      copied: leadStatuses.created || 0,
+      skipped: leadStatuses.skipped || 0,
+      errors: leadStatuses.error || 0,
     },
     leads: leadsWithStatus,
+    next_after: nextAfter,
     logs,
   };
 }
@@ -0,0 +1,55 @@
+/**
+ * fieldSchemaCache.js
+ * In-memory cache of custom field schemas (fields + groups) of both CRMs.
+ *
+ *  - one request per (crm, kind, entity) is shared by concurrent callers
+ *  - entries live TTL_MS; Kommo entries are dropped by kommoApi on every field /
+ *    group create or patch, the field sync tab drops everything on «Обновить»
+ *  - { fresh: true } refetches before decisions that must see the live schema
+ *    (create-field checks whether the field already exists in Kommo)
+ */
+const TTL_MS = 10 * 60 * 1000;
+
+const entries = new Map(); // `${crm}:${kind}:${entity}` → { at, promise }
+
+function source(crm, kind) {
+  const api = crm === 'amo' ? require('./amoApi') : require('./kommoApi');
+  return kind === 'groups' ? api.getCustomFieldGroups : api.getCustomFields;
+}
+
+function get(crm, kind, entity, opts = {}) {
+  const key = `${crm}:${kind}:${entity}`;
+  const hit = entries.get(key);
+  if (hit && !opts.fresh && Date.now() - hit.at < TTL_MS) return hit.promise;
+
+  const promise = source(crm, kind)(entity);
+  const entry = { at: Date.now(), promise };
+  entries.set(key, entry);
+  // A failed request must not stay cached
+  promise.catch(() => { if (entries.get(key) === entry) entries.delete(key); });
+  return promise;
+}
+
+/** Custom fields of an entity. @param {'amo'|'kommo'} crm */
+function getFields(crm, entity, opts) {
+  return get(crm, 'fields', entity, opts);
+}
+
+/** Custom field groups of an entity. @param {'amo'|'kommo'} crm */
+function getGroups(crm, entity, opts) {
+  return get(crm, 'groups', entity, opts);
+}
+
+/**
+ * Drop cached schemas.
+ * @param {'amo'|'kommo'} [crm]  - both if omitted
+ * @param {string} [entity]      - all entities if omitted
+ */
+function invalidate(crm, entity) {
+  for (const key of [...entries.keys()]) {
+    const [c, , e] = key.split(':');
+    if ((!crm || c === crm) && (!entity || e === entity)) entries.delete(key);
+  }
+}
+
+module.exports = { getFields, getGroups, invalidate };
@@ -1,28 +1,15 @@
-const axios = require('axios');
-const config = require('../config');
 const logger = require('../utils/logger');
+const { getRateLimiter } = require('../utils/rateLimiter');
+const { createClient } = require('../utils/crmTransport');
+const metrics = require('../utils/metrics');
+const db = require('../db');
+const fieldSchemaCache = require('./fieldSchemaCache');
 
-const kommoClient = axios.create({
-  baseURL: config.kommo.baseUrl,
-  headers: {
-    Authorization: `Bearer ${config.kommo.token}`,
-    'Content-Type': 'application/json',
-  },
-  timeout: 30000,
-});
+// Shared keep-alive transport (same socket pool as kommoApiV2)
+const kommoClient = createClient('kommo');
 
-// Rate limiter: 300ms between requests (~3 req/sec, well below 7/sec limit)
-let lastRequestTime = 0;
-const MIN_INTERVAL = 300; // ms — conservative to avoid 429
-
-async function rateLimit() {
-  const now = Date.now();
-  const elapsed = now - lastRequestTime;
-  if (elapsed < MIN_INTERVAL) {
-    await new Promise((r) => setTimeout(r, MIN_INTERVAL - elapsed));
-  }
-  lastRequestTime = Date.now();
-}
+// Shared Kommo scheduler (token bucket, 7 req/s, several requests in flight) — same instance as kommoApiV2
+getRateLimiter('Kommo').attach(kommoClient);
 
 // 429 retry interceptor — wait Retry-After (or 2s) then retry up to 3 times
 kommoClient.interceptors.response.use(null, async (error) => {
@@ -34,6 +21,8 @@ kommoClient.interceptors.response.use(null, async (error) => {
     const retryAfter = parseInt(error.response.headers['retry-after'] || '2', 10);
     const delay = Math.max(retryAfter * 1000, 2000);
     logger.warn(`[kommoApi] 429 received, retry #${cfg.__retryCount} after ${delay}ms`);
+    metrics.countRetry('Kommo', '429');
+    metrics.addThrottleWait('Kommo', 'retry_after', delay);
     await new Promise(r => setTimeout(r, delay));
     return kommoClient(cfg);
   }
@@ -41,13 +30,11 @@ kommoClient.interceptors.response.use(null, async (error) => {
 });
 
 async function getPipelines() {
-  await rateLimit();
   const res = await kommoClient.get('/api/v4/leads/pipelines');
   return res.data._embedded?.pipelines || [];
 }
 
 async function getPipeline(pipelineId) {
-  await rateLimit();
   const res = await kommoClient.get(`/api/v4/leads/pipelines/${pipelineId}`);
   return res.data;
 }
@@ -64,7 +51,6 @@ async function syncPipelineStages(pipelineId, stages) {
   // Create one by one to avoid sort conflicts and get granular error info
   const created = [];
   for (const stage of stages) {
-    await rateLimit();
     try {
       const res = await kommoClient.post(`/api/v4/leads/pipelines/${pipelineId}/statuses`, [stage]);
       const s = res.data._embedded?.statuses?.[0];
@@ -80,180 +66,131 @@ async function syncPipelineStages(pipelineId, stages) {
 }
 
 async function createLead(lead) {
-  await rateLimit();
   const res = await kommoClient.post('/api/v4/leads', [lead]);
   return res.data._embedded?.leads?.[0] || null;
 }
 
-async function createLeadsBatch(leads) {
-  // Max 50 per request
-  const chunks = [];
-  for (let i = 0; i < leads.length; i += 50) chunks.push(leads.slice(i, i + 50));
-  const created = [];
-  for (const chunk of chunks) {
-    await rateLimit();
-    try {
-      const res = await kommoClient.post('/api/v4/leads', chunk);
-      created.push(...(res.data._embedded?.leads || []));
-      logger.info(`Kommo: created ${created.length} leads so far`);
-    } catch (e) {
-      if (e.response?.status === 400) {
-        logger.error('Kommo leads 400 details:', JSON.stringify(e.response?.data));
-        logger.error('Kommo leads 400 payload sample:', JSON.stringify(chunk[0]));
-        require('fs').writeFileSync('/tmp/kommo_400_payload.json', JSON.stringify({error: e.response?.data, payload: chunk[0]}, null, 2));
-        // Fallback: create without custom_fields_values, then PATCH separately
-        const stripped = chunk.map(l => {
-          const { custom_fields_values, ...rest } = l;
-          return rest;
-        });
-        await rateLimit();
-        let res2;
-        try {
-          res2 = await kommoClient.post('/api/v4/leads', stripped);
-        } catch (e2) {
-          logger.error('Kommo leads fallback 400 details:', JSON.stringify(e2.response?.data));
-          logger.error('Kommo leads fallback payload sample:', JSON.stringify(stripped[0]));
-          require('fs').writeFileSync('/tmp/kommo_400_fallback.json', JSON.stringify({error: e2.response?.data, payload: stripped[0]}, null, 2));
-          throw e2;
-        }
-        const fallbackLeads = res2.data._embedded?.leads || [];
-        logger.info(`Kommo: created ${fallbackLeads.length} leads (fallback, now patching custom fields)`);
-        for (let i = 0; i < fallbackLeads.length; i++) {
-          const cfv = chunk[i]?.custom_fields_values;
-          if (cfv && cfv.length > 0) {
-            try {
-              await rateLimit();
-              await updateLead(fallbackLeads[i].id, { custom_fields_values: cfv });
-              logger.info(`Kommo: patched custom fields for lead ${fallbackLeads[i].id}`);
-            } catch (patchErr) {
-              logger.error(`Kommo: PATCH lead ${fallbackLeads[i].id} custom fields failed: status=${patchErr.response?.status}`, JSON.stringify(patchErr.response?.data));
-            }
-          }
-        }
-        created.push(...fallbackLeads);
-      } else {
-        throw e;
-      }
+// ─── Create with error isolation ────────────────────────────────────────────
+// A 400 on a chunk is narrowed down to the offending records: Kommo's per-item
+// validation-errors (request_id = index in the request) when present, bisection otherwise.
+// Valid records are created in full, rejected ones go to the quarantine table.
+
+/** Map<index in request, errors[]> from a Kommo 400 body, or null if it has none. */
+function validationErrorsByIndex(err) {
+  const list = err.response?.data?.['validation-errors'];
+  if (!Array.isArray(list)) return null;
+  const byIndex = new Map();
+  for (const v of list) {
+    const idx = Number(v.request_id);
+    if (Number.isInteger(idx)) byIndex.set(idx, v.errors || v);
+  }
+  return byIndex.size > 0 ? byIndex : null;
+}
+
+/**
+ * POST items, isolating rejected ones. out[positions[i]] = created entity;
+ * rejected positions are appended to `rejected`.
+ */
+async function postIsolated(entity, items, positions, out, rejected) {
+  if (items.length === 0) return;
+  try {
+    const res = await kommoClient.post(`/api/v4/${entity}`, items);
+    (res.data._embedded?.[entity] || []).forEach((k, i) => {
+      const reqIdx = k.request_id != null && !isNaN(Number(k.request_id)) ? Number(k.request_id) : i;
+      if (positions[reqIdx] != null) out[positions[reqIdx]] = k;
+    });
+  } catch (e) {
+    if (e.response?.status !== 400) throw e;
+    const perItem = validationErrorsByIndex(e);
+    if (items.length === 1) {
+      rejected.push({ pos: positions[0], error: (perItem && perItem.get(0)) || e.response?.data || e.message });
+      return;
+    }
+    if (perItem) {
+      const keep = [], keepPos = [];
+      items.forEach((item, i) => {
+        if (perItem.has(i)) rejected.push({ pos: positions[i], error: perItem.get(i) });
+        else { keep.push(item); keepPos.push(positions[i]); }
+      });
+      if (keep.length < items.length) return postIsolated(entity, keep, keepPos, out, rejected);
+    }
+    const mid = items.length >> 1;
+    await postIsolated(entity, items.slice(0, mid), positions.slice(0, mid), out, rejected);
+    await postIsolated(entity, items.slice(mid), positions.slice(mid), out, rejected);
+  }
+}
+
+/**
+ * Create leads / contacts / companies in chunks of 50.
+ * @param {'leads'|'contacts'|'companies'} entity
+ * @param {object[]} items - Kommo payloads
+ * @param {Array<number|string>} [amoIds] - AMO ids aligned with items; rejected records are
+ *   quarantined under them (without ids they are only logged)
+ * @returns {Promise<Array<object|null>>} aligned with items — null for rejected records
+ */
+async function createEntitiesBatch(entity, items, amoIds) {
+  const created = new Array(items.length).fill(null);
+  const rejected = [];
+  for (let start = 0; start < items.length; start += 50) {
+    const chunk = items.slice(start, start + 50);
+    const positions = chunk.map((_, i) => start + i);
+    await postIsolated(entity, chunk, positions, created, rejected);
+    logger.info(`Kommo: created ${created.filter(Boolean).length} ${entity} so far`);
+  }
+  if (rejected.length > 0) {
+    const quarantined = [];
+    for (const { pos, error } of rejected) {
+      const amoId = amoIds ? amoIds[pos] : null;
+      logger.error(`Kommo ${entity}: record #${pos}${amoId != null ? ` (AMO#${amoId})` : ''} rejected: ${JSON.stringify(error)}`);
+      if (amoId != null) quarantined.push({ amoId, payload: items[pos], error });
     }
+    if (quarantined.length > 0) db.addQuarantine(entity, quarantined);
+    logger.warn(`Kommo ${entity}: ${rejected.length} of ${items.length} rejected, ${quarantined.length} quarantined`);
   }
   return created;
 }
 
+async function createLeadsBatch(leads, amoIds) {
+  return createEntitiesBatch('leads', leads, amoIds);
+}
+
 async function updateLead(leadId, data) {
-  await rateLimit();
   // Kommo API: PATCH /api/v4/leads with array [{id, ...fields}]
   const res = await kommoClient.patch('/api/v4/leads', [{ id: parseInt(leadId), ...data }]);
   return res.data._embedded?.leads?.[0] || null;
 }
 
 async function updateContact(contactId, data) {
-  await rateLimit();
   // Kommo API: PATCH /api/v4/contacts with array [{id, ...fields}]
   const res = await kommoClient.patch('/api/v4/contacts', [{ id: parseInt(contactId), ...data }]);
   return res.data._embedded?.contacts?.[0] || null;
 }
 
 async function updateCompany(companyId, data) {
-  await rateLimit();
   // Kommo API: PATCH /api/v4/companies with array [{id, ...fields}]
   const res = await kommoClient.patch('/api/v4/companies', [{ id: parseInt(companyId), ...data }]);
   return res.data._embedded?.companies?.[0] || null;
 }
 
 async function createContact(contact) {
-  await rateLimit();
   const res = await kommoClient.post('/api/v4/contacts', [contact]);
   return res.data._embedded?.contacts?.[0] || null;
 }
 
-async function createContactsBatch(contacts) {
-  const chunks = [];
-  for (let i = 0; i < contacts.length; i += 50) chunks.push(contacts.slice(i, i + 50));
-  const created = [];
-  for (const chunk of chunks) {
-    await rateLimit();
-    try {
-      const res = await kommoClient.post('/api/v4/contacts', chunk);
-      created.push(...(res.data._embedded?.contacts || []));
-      logger.info(`Kommo: created ${created.length} contacts so far`);
-    } catch (e) {
-      if (e.response?.status === 400) {
-        const errData = e.response?.data;
-        logger.error('Kommo contacts 400 details:', JSON.stringify(errData));
-        // Fallback: create WITHOUT custom_fields_values, then PATCH them separately
-        const stripped = chunk.map(c => ({ name: c.name }));
-        await rateLimit();
-        const res2 = await kommoClient.post('/api/v4/contacts', stripped);
-        const fallbackContacts = res2.data._embedded?.contacts || [];
-        logger.info(`Kommo: created ${fallbackContacts.length} contacts (fallback, now patching custom fields)`);
-        // PATCH each contact individually with its custom_fields_values
-        for (let i = 0; i < fallbackContacts.length; i++) {
-          const cfv = chunk[i]?.custom_fields_values;
-          if (cfv && cfv.length > 0) {
-            try {
-              await rateLimit();
-              await updateContact(fallbackContacts[i].id, { custom_fields_values: cfv });
-              logger.info(`Kommo: patched custom fields for contact ${fallbackContacts[i].id}`);
-            } catch (patchErr) {
-              logger.error(`Kommo: PATCH contact ${fallbackContacts[i].id} custom fields failed: status=${patchErr.response?.status}`, JSON.stringify(patchErr.response?.data));
-            }
-          }
-        }
-        created.push(...fallbackContacts);
-      } else {
-        throw e;
-      }
-    }
-  }
-  return created;
+async function createContactsBatch(contacts, amoIds) {
+  return createEntitiesBatch('contacts', contacts, amoIds);
 }
 
 async function createCompany(company) {
-  await rateLimit();
   const res = await kommoClient.post('/api/v4/companies', [company]);
   return res.data._embedded?.companies?.[0] || null;
 }
 
-async function createCompaniesBatch(companies) {
-  const chunks = [];
-  for (let i = 0; i < companies.length; i += 50) chunks.push(companies.slice(i, i + 50));
-  const created = [];
-  for (const chunk of chunks) {
-    await rateLimit();
-    try {
-      const res = await kommoClient.post('/api/v4/companies', chunk);
-      created.push(...(res.data._embedded?.companies || []));
-      logger.info(`Kommo: created ${created.length} companies so far`);
-    } catch (e) {
-      if (e.response?.status === 400) {
-        logger.error('Kommo companies 400 details:', JSON.stringify(e.response?.data));
-        const stripped = chunk.map(c => ({ name: c.name }));
-        await rateLimit();
-        const res2 = await kommoClient.post('/api/v4/companies', stripped);
-        const fallbackCompanies = res2.data._embedded?.companies || [];
-        for (let i = 0; i < fallbackCompanies.length; i++) {
-          const cfv = chunk[i]?.custom_fields_values;
-          if (cfv && cfv.length > 0) {
-            try {
-              await rateLimit();
-              await updateCompany(fallbackCompanies[i].id, { custom_fields_values: cfv });
-            } catch (patchErr) {
-              logger.error(`Kommo: PATCH company ${fallbackCompanies[i].id} failed: status=${patchErr.response?.status}`, JSON.stringify(patchErr.response?.data));
-            }
-          }
-        }
-        created.push(...fallbackCompanies);
-        logger.info(`Kommo: created ${created.length} companies (fallback)`);
-      } else {
-        throw e;
-      }
-    }
-  }
-  return created;
+async function createCompaniesBatch(companies, amoIds) {
+  return createEntitiesBatch('companies', companies, amoIds);
 }
 
 async function createTask(task) {
-  await rateLimit();
   const res = await kommoClient.post('/api/v4/tasks', [task]);
   return res.data._embedded?.tasks?.[0] || null;
 }
@@ -264,7 +201,6 @@ async function createTasksBatch(tasks) {
   const created = [];
   for (const chunk of chunks) {
     // ── Попытка 1: отправляем чанк целиком ──
-    await rateLimit();
     try {
       const res = await kommoClient.post('/api/v4/tasks', chunk);
       const embedded = res.data._embedded?.tasks || [];
@@ -278,7 +214,6 @@ async function createTasksBatch(tasks) {
 
     // ── Попытка 2: ждём 1 сек и повторяем чанк ──
     await new Promise(r => setTimeout(r, 1000));
-    await rateLimit();
     try {
       const res2 = await kommoClient.post('/api/v4/tasks', chunk);
       const embedded2 = res2.data._embedded?.tasks || [];
@@ -293,7 +228,6 @@ async function createTasksBatch(tasks) {
     // ── Попытка 3: отправляем по одной задаче ──
     for (let ti = 0; ti < chunk.length; ti++) {
       const singleTask = chunk[ti];
-      await rateLimit();
       try {
         const res3 = await kommoClient.post('/api/v4/tasks', [singleTask]);
         const embedded3 = res3.data._embedded?.tasks || [];
@@ -319,7 +253,6 @@ async function completeTasksBatch(taskIds) {
   const chunks = [];
   for (let i = 0; i < taskIds.length; i += 50) chunks.push(taskIds.slice(i, i + 50));
   for (const chunk of chunks) {
-    await rateLimit();
     try {
       const payload = chunk.map(id => ({ id, is_completed: true }));
       await kommoClient.patch('/api/v4/tasks', payload);
@@ -345,7 +278,6 @@ async function updateTasksBatch(updates) {
   const chunks = [];
   for (let i = 0; i < updates.length; i += 50) chunks.push(updates.slice(i, i + 50));
   for (const chunk of chunks) {
-    await rateLimit();
     try {
       const payload = chunk.map(u => {
         const o = { id: parseInt(u.id), task_type_id: u.task_type_id };
@@ -360,7 +292,6 @@ async function updateTasksBatch(updates) {
       logger.warn(`Kommo updateTasksBatch ошибка чанка: ${body}. Переключаемся на поштучный режим.`);
       // Fallback: update one by one
       for (const u of chunk) {
-        await rateLimit();
         try {
           const _singlePatch = { id: parseInt(u.id), task_type_id: u.task_type_id };
           if (u.text !== undefined) _singlePatch.text = u.text;
@@ -378,7 +309,6 @@ async function updateTasksBatch(updates) {
 }
 
 async function createNote(entityType, entityId, noteData) {
-  await rateLimit();
   const payload = [{ ...noteData, entity_id: entityId }];
   const res = await kommoClient.post(`/api/v4/${entityType}/notes`, payload);
   return res.data._embedded?.notes?.[0] || null;
@@ -390,7 +320,6 @@ async function createNotesBatch(entityType, notes) {
   const created = [];
   for (const chunk of chunks) {
     // ── Попытка 1: отправляем чанк целиком ──
-    await rateLimit();
     try {
       try { require('fs').writeFileSync(`/tmp/notes_chunk_${entityType}.json`, JSON.stringify(chunk, null, 2)); } catch(_){}
       logger.info(`[debug] notes chunk[0] entity_id: ${chunk[0]?.entity_id} (${typeof chunk[0]?.entity_id}), sample: ${JSON.stringify(chunk[0])?.slice(0,200)}`);
@@ -406,7 +335,6 @@ async function createNotesBatch(entityType, notes) {
 
     // ── Попытка 2: ждём 1 сек и повторяем чанк целиком ──
     await new Promise(r => setTimeout(r, 1000));
-    await rateLimit();
     try {
       const res2 = await kommoClient.post(`/api/v4/${entityType}/notes`, chunk);
       const embedded2 = res2.data._embedded?.notes || [];
@@ -421,7 +349,6 @@ async function createNotesBatch(entityType, notes) {
     // ── Попытка 3: отправляем по одной заметке ──
     for (let ni = 0; ni < chunk.length; ni++) {
       const singleNote = chunk[ni];
-      await rateLimit();
       try {
         const res3 = await kommoClient.post(`/api/v4/${entityType}/notes`, [singleNote]);
         const embedded3 = res3.data._embedded?.notes || [];
@@ -444,7 +371,6 @@ async function createNotesBatch(entityType, notes) {
 
 async function linkContactToLead(leadId, contactId) {
   // Kommo API: PATCH /api/v4/leads with _embedded.contacts
-  await rateLimit();
   const res = await kommoClient.patch('/api/v4/leads', [
     { id: parseInt(leadId), _embedded: { contacts: [{ id: parseInt(contactId) }] } },
   ]);
@@ -453,7 +379,6 @@ async function linkContactToLead(leadId, contactId) {
 
 async function linkCompanyToLead(leadId, companyId) {
   // Kommo API: PATCH /api/v4/leads with _embedded.companies  
-  await rateLimit();
   const res = await kommoClient.patch('/api/v4/leads', [
     { id: parseInt(leadId), _embedded: { companies: [{ id: parseInt(companyId) }] } },
   ]);
@@ -461,7 +386,6 @@ async function linkCompanyToLead(leadId, companyId) {
 }
 
 async function getCustomFields(entityType = 'leads') {
-  await rateLimit();
   const res = await kommoClient.get(`/api/v4/${entityType}/custom_fields`, { params: { limit: 250 } });
   return res.data._embedded?.custom_fields || [];
 }
@@ -471,7 +395,6 @@ async function getCustomFields(entityType = 'leads') {
  * Необходимо для сопоставления групп при переносе полей из AMO.
  */
 async function getCustomFieldGroups(entityType = 'leads') {
-  await rateLimit();
   const res = await kommoClient.get(`/api/v4/${entityType}/custom_fields/groups`, {
     params: { limit: 250 }
   });
@@ -479,14 +402,14 @@ async function getCustomFieldGroups(entityType = 'leads') {
 }
 
 async function createCustomFieldGroup(entityType, groupData) {
-  await rateLimit();
   const res = await kommoClient.post(`/api/v4/${entityType}/custom_fields/groups`, [groupData]);
+  fieldSchemaCache.invalidate('kommo', entityType);
   return res.data._embedded?.custom_field_groups?.[0] || null;
 }
 
 async function createCustomField(entityType, fieldData) {
-  await rateLimit();
   const res = await kommoClient.post(`/api/v4/${entityType}/custom_fields`, [fieldData]);
+  fieldSchemaCache.invalidate('kommo', entityType);
   return res.data._embedded?.custom_fields?.[0] || null;
 }
 
@@ -494,10 +417,10 @@ async function createCustomFieldsBatch(entityType, fields) {
   const created = [];
   const BATCH = 50;
   for (let i = 0; i < fields.length; i += BATCH) {
-    await rateLimit();
     const chunk = fields.slice(i, i + BATCH);
     const res = await kommoClient.post(`/api/v4/${entityType}/custom_fields`, chunk);
     created.push(...(res.data._embedded?.custom_fields || []));
+    fieldSchemaCache.invalidate('kommo', entityType);
   }
   return created;
 }
@@ -506,11 +429,11 @@ async function createCustomFieldsBatch(entityType, fields) {
  * Обновить кастомное поле в Kommo (например, добавить варианты списка).
  */
 async function patchCustomField(entityType, fieldId, patchData) {
-  await rateLimit();
   const res = await kommoClient.patch(
     `/api/v4/${entityType}/custom_fields/${fieldId}`,
     patchData
   );
+  fieldSchemaCache.invalidate('kommo', entityType);
   return res.data || null;
 }
 
@@ -518,53 +441,71 @@ async function patchCustomField(entityType, fieldId, patchData) {
  * Delete a lead (for rollback)
  */
 async function deleteLead(leadId) {
-  await rateLimit();
   await kommoClient.delete(`/api/v4/leads`, { data: [{ id: leadId }] });
 }
 
+// Kommo accepts up to 250 entities in one PATCH
+const BULK_PATCH_MAX = 250;
+
 async function deleteLeadsBatch(leadIds) {
   // Kommo API does not support DELETE for leads (405).
   // Instead, move leads to "Closed - lost" (status_id: 143) to archive them.
   if (!leadIds.length) return;
-  const chunks = [];
-  for (let i = 0; i < leadIds.length; i += 50) chunks.push(leadIds.slice(i, i + 50));
-  for (const chunk of chunks) {
-    await rateLimit();
+  for (let i = 0; i < leadIds.length; i += BULK_PATCH_MAX) {
+    const chunk = leadIds.slice(i, i + BULK_PATCH_MAX);
     await kommoClient.patch('/api/v4/leads', chunk.map((id) => ({ id, status_id: 143 })));
     logger.info(`Kommo: archived ${chunk.length} leads to Closed-lost (rollback)`);
   }
 }
 
-async function deleteContactsBatch(contactIds) {
-  // Kommo API: try individual DELETE since batch DELETE may not be supported.
-  if (!contactIds.length) return;
-  let deleted = 0;
-  for (const id of contactIds) {
-    await rateLimit();
+/** Close tasks for a rollback (Kommo API v4 has no task DELETE). Throws on failure. */
+async function closeTasksBatch(taskIds) {
+  if (!taskIds.length) return;
+  for (let i = 0; i < taskIds.length; i += BULK_PATCH_MAX) {
+    const chunk = taskIds.slice(i, i + BULK_PATCH_MAX);
+    await kommoClient.patch('/api/v4/tasks', chunk.map((id) => ({ id, is_completed: true, result: { text: 'Откат миграции' } })));
+    logger.info(`Kommo: closed ${chunk.length} tasks (rollback)`);
+  }
+}
+
+// Contacts / companies: individual DELETE (no bulk endpoint). Requests are issued together
+// and paced by the shared Kommo limiter; 404 counts as already deleted.
+async function deleteEach(entity, ids) {
+  const failed = [];
+  await Promise.all(ids.map(async (id) => {
     try {
-      await kommoClient.delete(`/api/v4/contacts/${id}`);
-      deleted++;
+      await kommoClient.delete(`/api/v4/${entity}/${id}`);
     } catch (e) {
-      logger.warn(`Kommo: could not delete contact ${id}: HTTP ${e.response?.status}`);
+      if (e.response?.status === 404) return;
+      failed.push(id);
+      logger.warn(`Kommo: could not delete ${entity} ${id}: HTTP ${e.response?.status}`);
     }
-  }
-  logger.info(`Kommo: deleted ${deleted}/${contactIds.length} contacts (rollback)`);
+  }));
+  logger.info(`Kommo: deleted ${ids.length - failed.length}/${ids.length} ${entity} (rollback)`);
+  return { deleted: ids.length - failed.length, failed };
+}
+
+async function deleteContactsBatch(contactIds) {
+  if (!contactIds.length) return { deleted: 0, failed: [] };
+  return deleteEach('contacts', contactIds);
 }
 
 async function deleteCompaniesBatch(companyIds) {
-  // Kommo API: individual DELETE per company.
-  if (!companyIds.length) return;
-  let deleted = 0;
-  for (const id of companyIds) {
-    await rateLimit();
+  if (!companyIds.length) return { deleted: 0, failed: [] };
+  return deleteEach('companies', companyIds);
+}
+
+/** Delete notes of one entity (rollback of a single deal). Returns ids that failed. */
+async function deleteEntityNotes(entityType, entityId, noteIds) {
+  const failed = [];
+  await Promise.all(noteIds.map(async (noteId) => {
     try {
-      await kommoClient.delete(`/api/v4/companies/${id}`);
-      deleted++;
+      await kommoClient.delete(`/api/v4/${entityType}/${entityId}/notes/${noteId}`);
     } catch (e) {
-      logger.warn(`Kommo: could not delete company ${id}: HTTP ${e.response?.status}`);
+      if (e.response?.status !== 404) failed.push(noteId);
     }
-  }
-  logger.info(`Kommo: deleted ${deleted}/${companyIds.length} companies (rollback)`);
+  }));
+  return failed;
 }
 
 async function getActiveTasksCount(kommoLeadIds) {
@@ -577,7 +518,6 @@ async function getActiveTasksCount(kommoLeadIds) {
   for (let i = 0; i < kommoLeadIds.length; i += chunkSize) {
     const chunk = kommoLeadIds.slice(i, i + chunkSize);
     try {
-      await rateLimit();
       const params = new URLSearchParams();
       for (const id of chunk) params.append('filter[entity_id][]', String(id));
       params.append('filter[entity_type]', 'leads');
@@ -629,5 +569,7 @@ module.exports = {
   deleteLeadsBatch,
   deleteContactsBatch,
   deleteCompaniesBatch,
+  closeTasksBatch,
+  deleteEntityNotes,
   getActiveTasksCount,
 };
@@ -2,21 +2,13 @@
  * Kommo CRM API client — for deal copying.
  * All calls are rate-limited and auto-retried.
  */
-const axios = require('axios');
-const config = require('../config');
 const logger = require('../utils/logger');
-const { createRateLimiter } = require('../utils/rateLimiter');
+const { getRateLimiter } = require('../utils/rateLimiter');
+const { createClient } = require('../utils/crmTransport');
 
-const { execute } = createRateLimiter('Kommo');
+const { execute } = getRateLimiter('Kommo');
 
-const client = axios.create({
-  baseURL: `${config.kommo.baseUrl}/api/v4`,
-  headers: {
-    Authorization: `Bearer ${config.kommo.token}`,
-    'Content-Type': 'application/json',
-  },
-  timeout: 30000,
-});
+const client = createClient('kommo', '/api/v4');
 
 // Generic paginated fetcher
 async function fetchAllPages(endpoint, params = {}) {
@@ -127,6 +119,81 @@ async function createCompany(data) {
   return created;
 }
 
+/**
+ * Create multiple companies in one request (batch).
+ */
+async function createCompanies(items) {
+  if (!items.length) return [];
+  const res = await execute(
+    () => client.post('/companies', items),
+    `createCompanies(${items.length})`
+  );
+  return res.data?._embedded?.companies || [];
+}
+
+// ─── Bulk lookup (session pre-pass) ───────────────────────────────────────────
+/**
+ * Resolve many lookup keys against one collection by paging through it (250 per request)
+ * instead of one search per key. Paging stops when every key is found, at the last page,
+ * or once it has cost as many requests as keys are still unresolved — those are then
+ * searched one by one, so the lookup never costs more than twice the per-key search.
+ * A page that still fails after the limiter's retries ends the lookup: keys not found
+ * by then map to null (unknown) and are left to the per-deal findOrCreate* path.
+ * @param {'contacts'|'companies'} entity
+ * @param {string[]} keys - lower-cased
+ * @param {function} keysOf - Kommo entity → lower-cased keys it matches
+ * @param {function} findOne - key → Kommo entity | null (per-key search)
+ * @returns {Promise<Map<string, object|null>>} key → Kommo entity, null = lookup failed
+ */
+async function lookupByKeys(entity, keys, keysOf, findOne) {
+  const found = new Map();
+  const pending = new Set(keys);
+  let pages = 0;
+  let exhausted = false;
+  while (pending.size > 0 && pages < pending.size) {
+    const page = ++pages;
+    let res;
+    try {
+      res = await execute(
+        () => client.get(`/${entity}`, { params: { page, limit: 250 } }),
+        `lookup ${entity} page ${page}`
+      );
+    } catch (err) {
+      logger.warn(`Kommo: lookup ${entity} page ${page} failed, ${pending.size} keys left to per-record search: ${err.message}`);
+      for (const key of pending) found.set(key, null);
+      return found;
+    }
+    const items = res.data?._embedded?.[entity] || [];
+    for (const item of items) {
+      for (const key of keysOf(item)) {
+        if (pending.delete(key)) found.set(key, item);
+      }
+    }
+    if (items.length < 250) { exhausted = true; break; }
+  }
+  const searched = exhausted ? 0 : pending.size;
+  if (searched > 0) {
+    const rest = [...pending];
+    const hits = await Promise.all(rest.map((key) => findOne(key)));
+    rest.forEach((key, i) => { if (hits[i]) found.set(key, hits[i]); });
+  }
+  logger.info(`Kommo: lookup ${entity}: ${found.size}/${keys.length} matched (${pages} pages, ${searched} searches)`);
+  return found;
+}
+
+/** email (lower-cased) → Kommo contact having it in any field — as findContactByEmail. */
+async function findContactsByEmails(emails) {
+  const emailsOf = (c) => (c.custom_fields_values || []).flatMap(
+    (f) => (f.values || []).map((v) => (typeof v.value === 'string' ? v.value.toLowerCase() : null)).filter(Boolean)
+  );
+  return lookupByKeys('contacts', emails, emailsOf, findContactByEmail);
+}
+
+/** name (lower-cased) → Kommo company with that name — as findCompanyByName. */
+async function findCompaniesByNames(names) {
+  return lookupByKeys('companies', names, (c) => (c.name ? [c.name.toLowerCase()] : []), findCompanyByName);
+}
+
 // ─── Leads ────────────────────────────────────────────────────────────────────
 /**
  * Check if lead with given amo_id already exists in Kommo
@@ -281,6 +348,9 @@ module.exports = {
   createContacts,
   findCompanyByName,
   createCompany,
+  createCompanies,
+  findContactsByEmails,
+  findCompaniesByNames,
   findLeadByAmoId,
   createLead,
   linkLeadEntities,
@@ -0,0 +1,257 @@
+/**
+ * migrationJobs.js
+ * Parallel batch migration: the cached AMO snapshot is partitioned by manager or by
+ * pipeline and every partition runs as its own batch engine
+ * (batchMigrationService.createBatchEngine) — own config/cursor file in
+ * backups/batch_jobs, state, SSE channel and rollback journal.
+ *
+ * Jobs run concurrently in this process. The CRM request budget stays the shared
+ * per-CRM rate limiter, so parallel jobs overlap transforms, SQLite reads and waiting
+ * on CRM responses instead of exceeding the limit. Contacts / companies referenced by
+ * several partitions are claimed in the migration index (safetyGuard.claimIds) and
+ * created exactly once.
+ */
+const path = require('path');
+const fs = require('fs-extra');
+const config = require('../config');
+const db = require('../db');
+const logger = require('../utils/logger');
+const progressStream = require('./progressStream');
+const { createBatchEngine } = require('./batchMigrationService');
+
+const JOBS_DIR = path.resolve(config.backupDir, 'batch_jobs');
+const DEFAULT_PARALLEL = 3;
+const MAX_PARALLEL = 8;
+
+const jobs = new Map(); // job id → { id, by, managerIds, pipelineId, engine, status, batches, error, ... }
+let maxParallel = DEFAULT_PARALLEL;
+let stopRequested = false;
+
+// ─── Partitions ───────────────────────────────────────────────────────────────
+/** { managerIds } | { pipelineId } → partition with a stable id (= job id, config file name). */
+function normalizePartition(p) {
+  if (p && Array.isArray(p.managerIds) && p.managerIds.length > 0) {
+    const managerIds = [...new Set(p.managerIds.map(Number))].sort((a, b) => a - b);
+    return { id: `managers-${managerIds.join('-')}`, by: 'managers', managerIds, pipelineId: null };
+  }
+  if (p && p.pipelineId) {
+    const pipelineId = Number(p.pipelineId);
+    return { id: `pipeline-${pipelineId}`, by: 'pipeline', managerIds: [], pipelineId };
+  }
+  throw new Error('Партиция должна содержать managerIds или pipelineId');
+}
+
+/**
+ * Partitions of the cached snapshot with their lead counts — one per manager or per pipeline.
+ * @param {'managers'|'pipeline'} by
+ * @returns {Array<{ id, by, managerIds, pipelineId, leads }>}
+ */
+function listPartitions(by = 'managers') {
+  if (by === 'pipeline') {
+    return db.countAmoEntitiesByPipeline('leads')
+      .filter(r => r.pipelineId != null)
+      .map(r => ({ ...normalizePartition({ pipelineId: r.pipelineId }), leads: r.cnt }));
+  }
+  return db.countAmoEntitiesByResponsible('leads')
+    .filter(r => r.uid != null)
+    .map(r => ({ ...normalizePartition({ managerIds: [r.uid] }), leads: r.cnt }));
+}
+
+// ─── Jobs ─────────────────────────────────────────────────────────────────────
+function getJob(part) {
+  let job = jobs.get(part.id);
+  if (!job) {
+    job = {
+      ...part,
+      engine: createBatchEngine(part.id, { configFile: path.join(JOBS_DIR, `${part.id}.json`) }),
+      status: 'idle', // idle | queued | running | paused | done | error | stopped | rolling_back
+      pauseRequested: false,
+      stageMapping: null,
+      batches: 0,
+      error: null,
+      startedAt: null,
+      completedAt: null,
+    };
+    jobs.set(part.id, job);
+  }
+  return job;
+}
+
+// Jobs of earlier runs (config files survive a restart) — for progress and rollback
+function restoreJobs() {
+  if (!fs.existsSync(JOBS_DIR)) return;
+  for (const file of fs.readdirSync(JOBS_DIR)) {
+    if (!file.endsWith('.json')) continue;
+    try {
+      getJob(normalizePartition(fs.readJsonSync(path.join(JOBS_DIR, file))));
+    } catch (e) {
+      logger.warn(`[jobs] Skipping ${file}: ${e.message}`);
+    }
+  }
+}
+
+function setStatus(job, status, patch = {}) {
+  Object.assign(job, { status }, patch);
+  progressStream.notify('jobs');
+}
+
+function isActive() {
+  for (const job of jobs.values()) {
+    if (job.status === 'queued' || job.status === 'running' || job.status === 'rolling_back') return true;
+  }
+  return false;
+}
+
+/** One partition: batches back to back until nothing remains, pause / stop or an error. */
+async function runJob(job) {
+  const { engine } = job;
+  setStatus(job, 'running', { pauseRequested: false, error: null, startedAt: new Date().toISOString(), completedAt: null });
+  try {
+    for (;;) {
+      const offsetBefore = engine.getBatchConfig().offset;
+      await engine.runBatchMigration(job.stageMapping);
+      job.batches++;
+      const st = engine.getBatchState();
+      if (st.status === 'error') {
+        const last = st.errors[st.errors.length - 1];
+        setStatus(job, 'error', { error: last ? last.message : 'Ошибка пакета' });
+        break;
+      }
+      if (st.status === 'paused' || job.pauseRequested || stopRequested) {
+        setStatus(job, stopRequested ? 'stopped' : 'paused');
+        break;
+      }
+      // No progress (nothing eligible) also ends the job — never spin on an empty source
+      if (!(st.stats.remainingLeads > 0) || engine.getBatchConfig().offset === offsetBefore) {
+        setStatus(job, 'done');
+        break;
+      }
+    }
+  } catch (e) {
+    logger.error(`[jobs] ${job.id}: ${e.message}`);
+    setStatus(job, 'error', { error: e.message });
+  }
+  job.completedAt = new Date().toISOString();
+  progressStream.notify('jobs');
+}
+
+// Start queued jobs while fewer than maxParallel are running
+function pump() {
+  if (stopRequested) return;
+  const all = [...jobs.values()];
+  let free = maxParallel - all.filter(j => j.status === 'running').length;
+  for (const job of all) {
+    if (free <= 0) break;
+    if (job.status !== 'queued') continue;
+    free--;
+    runJob(job).finally(pump);
+  }
+}
+
+/**
+ * Queue one job per partition and start up to maxParallel of them.
+ * A job continues from its saved cursor, so starting again after pause / stop / restart resumes.
+ * @param {object} opts - { by: 'managers'|'pipeline', partitions?: Array<id | {managerIds} | {pipelineId}>,
+ *   batchSize?, migrationMode?, maxParallel? }; no partitions = every partition of `by`
+ * @param {object} stageMapping - stage_mapping.json
+ */
+function startJobs(opts = {}, stageMapping) {
+  if (isActive()) throw new Error('Параллельные задания уже выполняются');
+  const by = opts.by === 'pipeline' ? 'pipeline' : 'managers';
+  const all = listPartitions(by);
+  const parts = Array.isArray(opts.partitions) && opts.partitions.length > 0
+    ? opts.partitions.map(p => (typeof p === 'string' ? all.find(x => x.id === p) : normalizePartition(p))).filter(Boolean)
+    : all;
+  if (parts.length === 0) throw new Error('Нет партиций для переноса. Загрузите данные из amo CRM.');
+
+  maxParallel = Math.min(Math.max(Number(opts.maxParallel) || DEFAULT_PARALLEL, 1), MAX_PARALLEL);
+  stopRequested = false;
+  for (const part of parts) {
+    const job = getJob(part);
+    const updates = { managerIds: job.managerIds, pipelineId: job.pipelineId, stageMapping };
+    if (opts.batchSize !== undefined) updates.batchSize = Number(opts.batchSize);
+    if (opts.migrationMode) updates.migrationMode = opts.migrationMode;
+    job.engine.setBatchConfig(updates);
+    setStatus(job, 'queued', { stageMapping, batches: 0, error: null });
+  }
+  logger.info(`[jobs] Started ${parts.length} ${by} partitions, maxParallel=${maxParallel}`);
+  pump();
+  return getJobs();
+}
+
+/** Pause one job: a queued job is dropped from the queue, a running one stops at its next checkpoint. */
+function pauseJob(id) {
+  const job = jobs.get(id);
+  if (!job) throw new Error(`Задание ${id} не найдено`);
+  if (job.status === 'queued') {
+    setStatus(job, 'paused');
+  } else if (job.status === 'running') {
+    job.pauseRequested = true;
+    if (job.engine.getBatchState().status === 'running') job.engine.pauseBatch();
+  } else {
+    throw new Error('Задание не выполняется');
+  }
+  return { ok: true };
+}
+
+/** Stop all jobs: queued ones are not started, running ones pause at their next checkpoint. */
+function stopAll() {
+  stopRequested = true;
+  for (const job of jobs.values()) {
+    if (job.status === 'queued') setStatus(job, 'stopped');
+    if (job.status === 'running' && job.engine.getBatchState().status === 'running') {
+      job.pauseRequested = true;
+      try { job.engine.pauseBatch(); } catch {}
+    }
+  }
+  return { ok: true };
+}
+
+/**
+ * Roll back the last batch of a job (same rules as the batch tab: only what that batch created).
+ * Checks throw synchronously; the returned promise settles when the rollback ends.
+ */
+function rollbackJob(id) {
+  const job = jobs.get(id);
+  if (!job) throw new Error(`Задание ${id} не найдено`);
+  if (job.status === 'running' || job.status === 'queued' || job.status === 'rolling_back') {
+    throw new Error('Задание выполняется — сначала поставьте на паузу');
+  }
+  setStatus(job, 'rolling_back');
+  return job.engine.rollbackBatch().finally(() => {
+    setStatus(job, job.engine.getBatchState().status === 'error' ? 'error' : 'idle');
+  });
+}
+
+/** Jobs summary for the UI / SSE channel 'jobs' (per-job detail: channel of the job id). */
+function getJobs() {
+  return {
+    active: isActive(),
+    maxParallel,
+    jobs: [...jobs.values()].map((job) => {
+      const st = job.engine.getBatchState();
+      const cfg = job.engine.getBatchConfig();
+      return {
+        id: job.id,
+        by: job.by,
+        managerIds: job.managerIds,
+        pipelineId: job.pipelineId,
+        status: job.status,
+        step: st.step,
+        batches: job.batches,
+        offset: cfg.offset,
+        stats: st.stats,
+        errors: st.errors.length,
+        warnings: st.warnings.length,
+        error: job.error,
+        startedAt: job.startedAt,
+        completedAt: job.completedAt,
+      };
+    }),
+  };
+}
+
+restoreJobs();
+progressStream.register('jobs', getJobs);
+
+module.exports = { listPartitions, startJobs, pauseJob, stopAll, rollbackJob, getJobs };
@@ -242,7 +242,7 @@ async function migrateCompanies(amoCompanies) {
 
   if (companiesToCreate.length > 0) {
     const toCreate = companiesToCreate.map((c) => transformCompany(c));
-    const created = await kommoApi.createCompaniesBatch(toCreate);
+    const created = await kommoApi.createCompaniesBatch(toCreate, companiesToCreate.map(c => c.id));
     const pairs = [];
     created.forEach((kommo, idx) => {
       if (kommo && companiesToCreate[idx]) {
@@ -275,7 +275,7 @@ async function migrateContacts(amoContacts) {
 
   if (contactsToCreate.length > 0) {
     const toCreate = contactsToCreate.map((c) => transformContact(c));
-    const created = await kommoApi.createContactsBatch(toCreate);
+    const created = await kommoApi.createContactsBatch(toCreate, contactsToCreate.map(c => c.id));
     const pairs = [];
     created.forEach((kommo, idx) => {
       if (kommo && contactsToCreate[idx]) {
@@ -312,7 +312,7 @@ async function migrateLeads(amoLeads, contactIdMap, companyIdMap) {
     return transformed;
   });
 
-  const created = leadsToCreate.length > 0 ? await kommoApi.createLeadsBatch(toCreate) : [];
+  const created = leadsToCreate.length > 0 ? await kommoApi.createLeadsBatch(toCreate, leadsToCreate.map(l => l.id)) : [];
   const leadPairs = [];
 
   // Link contacts and companies
@@ -0,0 +1,106 @@
+/**
+ * noteSource.js
+ * Notes for migration served from the AMO snapshot instead of refetching them per batch.
+ *
+ *  - entity in the snapshot, unchanged since fetchedAt → notes from amo_entities
+ *  - entity changed in AMO after fetchedAt (updated_at) → notes refetched and written back
+ *  - entity not in the snapshot (companies, leads outside it) → AMO API
+ * The changed-entity list is requested account-wide at most once per CHANGES_TTL,
+ * so its cost does not depend on the batch size.
+ */
+const db = require('../db');
+const amoApi = require('./amoApi');
+const logger = require('../utils/logger');
+const counters = require('../utils/migrationCounters');
+
+const CHANGES_TTL = 60 * 1000;
+const NOTE_TYPES = { leads: 'leadNotes', contacts: 'contactNotes' }; // cached note types per entity
+
+let snapshotFetchedAt = null;
+let changes = {};          // entityType → { at, ids: Map<id, updated_at> }
+let refreshed = new Map(); // `${entityType}:${id}` → unix sec of the last refetch
+
+function fetchNotes(entityType, ids) {
+  if (entityType === 'leads') return amoApi.getLeadNotesByEntityIds(ids);
+  if (entityType === 'contacts') return amoApi.getContactNotesByEntityIds(ids);
+  return amoApi.getCompanyNotesByEntityIds(ids);
+}
+
+async function changedSince(entityType, since) {
+  const cached = changes[entityType];
+  if (cached && Date.now() - cached.at < CHANGES_TTL) return cached.ids;
+  const ids = await amoApi.getUpdatedEntityIds(entityType, since);
+  changes[entityType] = { at: Date.now(), ids };
+  return ids;
+}
+
+/**
+ * Notes of the given entities (all note types — callers apply their own type filter).
+ * @param {'leads'|'contacts'|'companies'} entityType
+ * @param {number[]} entityIds - AMO ids
+ * @param {object} [opts] - { cached: Map<entityId, note[]> } notes already read from the store
+ * @returns {Promise<{ notes: object[], stats: { cached, refreshed, fetched } }>} stats count entities
+ */
+async function getNotesForEntities(entityType, entityIds, opts = {}) {
+  const ids = [...new Set(entityIds.map(Number))];
+  const stats = { cached: 0, refreshed: 0, fetched: 0 };
+  if (ids.length === 0) return { notes: [], stats };
+
+  const noteType = NOTE_TYPES[entityType];
+  const meta = db.getAmoCacheMeta();
+  if (!noteType || !meta || !meta.fetchedAt) {
+    stats.fetched = ids.length;
+    return { notes: await fetchNotes(entityType, ids), stats };
+  }
+
+  // New snapshot — forget refresh bookkeeping of the previous one
+  if (snapshotFetchedAt !== meta.fetchedAt) {
+    snapshotFetchedAt = meta.fetchedAt;
+    changes = {};
+    refreshed = new Map();
+  }
+  const since = Math.floor(Date.parse(meta.fetchedAt) / 1000);
+  const covered = new Set(db.listAmoEntityIds(entityType, { ids }));
+
+  let changed = new Map();
+  if (covered.size > 0) {
+    try {
+      changed = await changedSince(entityType, since);
+    } catch (e) {
+      logger.warn(`[notes] ${entityType}: change check failed, serving snapshot: ${e.message}`);
+    }
+  }
+
+  const fromCache = [];
+  const toRefresh = [];
+  const misses = [];
+  for (const id of ids) {
+    if (!covered.has(id)) misses.push(id);
+    else if (changed.has(id) && changed.get(id) > (refreshed.get(`${entityType}:${id}`) || since)) toRefresh.push(id);
+    else fromCache.push(id);
+  }
+
+  const notes = [];
+  const cachedGroups = opts.cached || db.groupAmoEntitiesByEntity(noteType, fromCache);
+  for (const id of fromCache) notes.push(...(cachedGroups.get(id) || []));
+
+  if (toRefresh.length > 0 || misses.length > 0) {
+    const fetched = await fetchNotes(entityType, [...toRefresh, ...misses]);
+    notes.push(...fetched);
+    if (toRefresh.length > 0) {
+      const refreshSet = new Set(toRefresh);
+      db.replaceAmoChildren(noteType, toRefresh, fetched.filter(n => refreshSet.has(Number(n.entity_id))));
+      counters.invalidate();
+      const now = Math.floor(Date.now() / 1000);
+      for (const id of toRefresh) refreshed.set(`${entityType}:${id}`, now);
+    }
+  }
+
+  stats.cached = fromCache.length;
+  stats.refreshed = toRefresh.length;
+  stats.fetched = misses.length;
+  logger.info(`[notes] ${entityType}: snapshot ${stats.cached}, refreshed ${stats.refreshed}, API ${stats.fetched} entities`);
+  return { notes, stats };
+}
+
+module.exports = { getNotesForEntities };
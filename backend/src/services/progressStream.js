@@ -0,0 +1,166 @@
+/**
+ * progressStream.js
+ * Server-Sent Events channel for live state (batchState, fetchState) instead of polling.
+ *
+ *  - a channel is a getter of in-memory state: register('batch', () => batchState)
+ *  - clients get a full snapshot on connect, then compact deltas — ops against the
+ *    previously sent state: { p: [path], v } replace, { p, a } array append, { p, d: 1 } delete
+ *  - updates are coalesced: state is diffed at most every THROTTLE_MS, and only while
+ *    someone is listening; notify() shortens the wait for status transitions
+ *  - every event has an id "<boot>-<seq>"; a reconnect with Last-Event-ID replays the
+ *    missed deltas from a ring buffer, or falls back to a fresh snapshot if they are gone
+ *    or the id is from before a server restart (seq starts over on every boot)
+ */
+const crypto = require('crypto');
+const logger = require('../utils/logger');
+
+const THROTTLE_MS  = 500;   // min interval between deltas of one channel
+const SAMPLE_MS    = 1000;  // picks up in-place mutations nobody notified about
+const RING_SIZE    = 500;   // events kept for Last-Event-ID replay
+const HEARTBEAT_MS = 20000;
+
+const channels = new Map(); // name → { getState, sent, lastFlush, timer }
+const clients = new Set();  // { res, channels: Set<name> }
+const ring = [];            // { id, channel, data }
+let seq = 0;
+const BOOT_ID = Date.now().toString(36) + crypto.randomBytes(3).toString('hex');
+let sampler = null;
+
+function clone(value) {
+  return value === undefined ? null : JSON.parse(JSON.stringify(value));
+}
+
+function isPlainObject(v) {
+  return v !== null && typeof v === 'object' && !Array.isArray(v);
+}
+
+/** Ops turning `prev` into `next` (both JSON-cloned). */
+function diff(prev, next, path = [], ops = []) {
+  if (isPlainObject(prev) && isPlainObject(next)) {
+    for (const key of Object.keys(next)) diff(prev[key], next[key], [...path, key], ops);
+    for (const key of Object.keys(prev)) if (!(key in next)) ops.push({ p: [...path, key], d: 1 });
+    return ops;
+  }
+  if (Array.isArray(prev) && Array.isArray(next) && next.length >= prev.length) {
+    if (next.length === prev.length) {
+      if (JSON.stringify(prev) !== JSON.stringify(next)) ops.push({ p: path, v: next });
+      return ops;
+    }
+    // Append-only arrays (warnings, createdIds.*) — send only the tail
+    if (JSON.stringify(prev) === JSON.stringify(next.slice(0, prev.length))) {
+      ops.push({ p: path, a: next.slice(prev.length) });
+    } else {
+      ops.push({ p: path, v: next });
+    }
+    return ops;
+  }
+  if (JSON.stringify(prev) !== JSON.stringify(next)) ops.push({ p: path, v: next === undefined ? null : next });
+  return ops;
+}
+
+/** seq of an event id sent by this process, or null (other boot / malformed). */
+function parseEventId(raw) {
+  const m = /^([0-9a-z]+)-(\d+)$/.exec(String(raw || ''));
+  return m && m[1] === BOOT_ID ? Number(m[2]) : null;
+}
+
+function write(client, id, channel, data) {
+  try {
+    client.res.write(`id: ${BOOT_ID}-${id}\nevent: ${channel}\ndata: ${JSON.stringify(data)}\n\n`);
+  } catch (e) {
+    logger.warn(`[stream] write failed: ${e.message}`);
+  }
+}
+
+function hasListeners(name) {
+  for (const c of clients) if (c.channels.has(name)) return true;
+  return false;
+}
+
+function flush(name) {
+  const ch = channels.get(name);
+  if (!ch) return;
+  if (ch.timer) { clearTimeout(ch.timer); ch.timer = null; }
+  ch.lastFlush = Date.now();
+  if (!hasListeners(name)) { ch.sent = null; return; }
+
+  const next = clone(ch.getState());
+  let data;
+  if (ch.sent == null) {
+    data = { type: 'snapshot', state: next };
+  } else {
+    const ops = diff(ch.sent, next);
+    if (ops.length === 0) return;
+    data = { type: 'delta', ops };
+  }
+  ch.sent = next;
+  const id = ++seq;
+  ring.push({ id, channel: name, data });
+  if (ring.length > RING_SIZE) ring.shift();
+  for (const c of clients) if (c.channels.has(name)) write(c, id, name, data);
+}
+
+/** Schedule a coalesced update of a channel (at most one per THROTTLE_MS). */
+function notify(name) {
+  const ch = channels.get(name);
+  if (!ch || ch.timer || clients.size === 0) return;
+  const wait = Math.max(0, ch.lastFlush + THROTTLE_MS - Date.now());
+  ch.timer = setTimeout(() => flush(name), wait);
+}
+
+function register(name, getState) {
+  channels.set(name, { getState, sent: null, lastFlush: 0, timer: null });
+}
+
+function startSampler() {
+  if (sampler) return;
+  sampler = setInterval(() => { for (const name of channels.keys()) notify(name); }, SAMPLE_MS);
+  if (sampler.unref) sampler.unref();
+}
+
+function stopSampler() {
+  if (sampler && clients.size === 0) { clearInterval(sampler); sampler = null; }
+}
+
+/**
+ * Attach an SSE response. Channels: ?channels=batch,fetch (default: all registered).
+ * Last-Event-ID (header, or ?lastEventId for manual reconnects) replays missed deltas.
+ */
+function subscribe(req, res) {
+  const wanted = String(req.query.channels || '').split(',').map(s => s.trim()).filter(s => channels.has(s));
+  const client = { res, channels: new Set(wanted.length ? wanted : channels.keys()) };
+
+  res.setHeader('Content-Type', 'text/event-stream');
+  res.setHeader('Cache-Control', 'no-cache');
+  res.setHeader('Connection', 'keep-alive');
+  res.setHeader('X-Accel-Buffering', 'no');
+  res.flushHeaders();
+  res.write(`retry: 3000\n\n`);
+
+  // Bring the new client to the channel's last sent state: replay or snapshot
+  const lastId = parseEventId(req.headers['last-event-id'] || req.query.lastEventId);
+  const canReplay = lastId != null && lastId > 0 && lastId <= seq &&
+    (ring.length > 0 && ring[0].id <= lastId + 1);
+  for (const name of client.channels) {
+    const ch = channels.get(name);
+    if (canReplay && ch.sent != null) {
+      for (const ev of ring) if (ev.id > lastId && ev.channel === name) write(client, ev.id, name, ev.data);
+    } else if (ch.sent != null) {
+      write(client, seq, name, { type: 'snapshot', state: ch.sent });
+    }
+  }
+
+  clients.add(client);
+  startSampler();
+  // Channels nobody listened to have no sent state yet — first flush sends the snapshot
+  for (const name of client.channels) if (channels.get(name).sent == null) flush(name);
+
+  const heartbeat = setInterval(() => res.write(': heartbeat\n\n'), HEARTBEAT_MS);
+  req.on('close', () => {
+    clearInterval(heartbeat);
+    clients.delete(client);
+    stopSampler();
+  });
+}
+
+module.exports = { register, notify, subscribe };
@@ -0,0 +1,140 @@
+/**
+ * rollbackEngine.js
+ * Bulk, resumable rollback of entities created in Kommo — NEVER touches AMO data.
+ *
+ *  - entities are removed in the largest requests Kommo accepts (PATCH 250 for leads/tasks),
+ *    single-item DELETEs (contacts, companies, notes) are issued together and paced by
+ *    the shared Kommo rate limiter
+ *  - migration index pairs are dropped through the Kommo → AMO reverse index (safetyGuard)
+ *  - progress is written to a journal after every chunk, so an interrupted rollback
+ *    (restart, network error) resumes from the first unfinished chunk
+ */
+const path = require('path');
+const fs = require('fs-extra');
+const config = require('../config');
+const kommoApi = require('./kommoApi');
+const db = require('../db');
+const safety = require('../utils/safetyGuard');
+const logger = require('../utils/logger');
+
+const JOURNAL_DIR = path.resolve(config.backupDir, 'rollback');
+
+// Step kinds in the order they are rolled back: children first, then leads, then their relations.
+// index   — migration index sections the Kommo ids are removed from
+// mapping — id_mapping.entity_type for session rollbacks
+// run     — processes one chunk, resolves to the ids that failed
+const KINDS = {
+  tasks: {
+    size: 250, mapping: 'task', index: ['tasks_leads', 'tasks_contacts', 'tasks_companies'],
+    run: async (ids) => { await kommoApi.closeTasksBatch(ids); return []; },
+  },
+  notes: {
+    // Kommo has no bulk note delete; without a parent the notes stay on the archived lead
+    size: 250, mapping: 'note', index: ['notes_leads', 'notes_contacts', 'notes_companies'],
+    run: async (ids, step) => (step.parent
+      ? kommoApi.deleteEntityNotes(step.parent.entityType, step.parent.entityId, ids)
+      : []),
+  },
+  leads: {
+    size: 250, mapping: 'lead', index: ['leads'],
+    run: async (ids) => { await kommoApi.deleteLeadsBatch(ids); return []; },
+  },
+  contacts: {
+    size: 50, mapping: 'contact', index: ['contacts'],
+    run: async (ids) => (await kommoApi.deleteContactsBatch(ids)).failed,
+  },
+  companies: {
+    size: 50, mapping: 'company', index: ['companies'],
+    run: async (ids) => (await kommoApi.deleteCompaniesBatch(ids)).failed,
+  },
+};
+const ORDER = Object.keys(KINDS);
+
+function journalPath(scope) {
+  return path.join(JOURNAL_DIR, `${String(scope).replace(/[^\w-]/g, '_')}.json`);
+}
+
+async function saveJournal(journal) {
+  journal.updatedAt = new Date().toISOString();
+  const file = journalPath(journal.scope);
+  await fs.ensureDir(JOURNAL_DIR);
+  await fs.writeJson(file + '.tmp', journal);
+  await fs.move(file + '.tmp', file, { overwrite: true });
+}
+
+/** Unfinished journal of a scope (interrupted rollback) or null. */
+function pending(scope) {
+  const file = journalPath(scope);
+  if (!fs.existsSync(file)) return null;
+  try {
+    const journal = fs.readJsonSync(file);
+    return journal.status === 'done' ? null : journal;
+  } catch (e) {
+    logger.error(`[rollback] Cannot read journal ${file}: ${e.message}`);
+    return null;
+  }
+}
+
+/**
+ * Create the journal of a new rollback.
+ * @param {string} scope - 'batch' | batch job id | `session-${id}` — one rollback per scope at a time
+ * @param {object} plan - { ids: { tasks, notes, leads, contacts, companies }, sessionId?, parents?, meta? }
+ *   parents: { notes: { entityType, entityId } } when notes belong to one known entity
+ */
+async function begin(scope, plan) {
+  const steps = ORDER
+    .filter(kind => plan.ids[kind] && plan.ids[kind].length > 0)
+    .map(kind => ({ kind, ids: plan.ids[kind].map(Number), done: 0, failed: [], parent: plan.parents?.[kind] || null }));
+  const journal = {
+    scope,
+    status: 'running',
+    sessionId: plan.sessionId || null,
+    meta: plan.meta || null,
+    startedAt: new Date().toISOString(),
+    steps,
+  };
+  await saveJournal(journal);
+  return journal;
+}
+
+/**
+ * Run (or resume) a journal to the end.
+ * @param {object} journal - from begin() or pending()
+ * @param {function} [onProgress] - ({ kind, done, total }) after every chunk
+ * @returns {Promise<{ processed: object, failed: object }>} per kind
+ */
+async function run(journal, onProgress) {
+  const processed = {};
+  const failed = {};
+  for (const step of journal.steps) {
+    const kind = KINDS[step.kind];
+    while (step.done < step.ids.length) {
+      const chunk = step.ids.slice(step.done, step.done + kind.size);
+      let chunkFailed;
+      try {
+        chunkFailed = await kind.run(chunk, step);
+      } catch (e) {
+        journal.error = `${step.kind}: ${e.message}`;
+        await saveJournal(journal);
+        throw e;
+      }
+      const failedSet = new Set(chunkFailed.map(Number));
+      const ok = chunk.filter(id => !failedSet.has(id));
+      for (const entity of kind.index) safety.unregisterByKommoIds(entity, ok);
+      if (journal.sessionId) db.rollbackMappingsByKommo(journal.sessionId, kind.mapping, ok);
+      step.failed.push(...failedSet);
+      step.done += chunk.length;
+      await saveJournal(journal);
+      if (onProgress) onProgress({ kind: step.kind, done: step.done, total: step.ids.length });
+    }
+    processed[step.kind] = step.ids.length - step.failed.length;
+    failed[step.kind] = step.failed;
+  }
+  journal.status = 'done';
+  journal.error = null;
+  await saveJournal(journal);
+  logger.info(`[rollback] ${journal.scope}: done ${JSON.stringify(processed)}`);
+  return { processed, failed };
+}
+
+module.exports = { begin, run, pending };
@@ -0,0 +1,366 @@
+/**
+ * snapshotStore.js
+ * Compressed, content-addressed snapshots of AMO entity collections (backups/snapshots).
+ *
+ *  - every record is stored once, keyed by a hash of its JSON: a snapshot only writes
+ *    records that no earlier snapshot holds, unchanged ones are shared
+ *  - per entity type the ascending (id, hash) list is cut into chunks at boundaries chosen
+ *    by the ids themselves, so a change touches only its own chunk; chunks are stored
+ *    content-addressed like records and the manifest keeps just { first, last, count, hash }
+ *    per chunk — an unchanged collection costs well under a byte per record
+ *  - new objects go to a pack file (one per snapshot) as independently compressed blocks
+ *    of up to BLOCK_RECORDS objects, streamed to disk block by block
+ *  - objects.idx (append-only, one line per block: "pack offset length hash,hash,...")
+ *    locates the block holding an object, so a restore of one type or id range
+ *    decompresses only the chunks and blocks it needs
+ *  - the manifest is written last: a snapshot interrupted before it leaves only
+ *    unreferenced objects behind
+ *
+ * Blocks are gzip; zstd is used instead where this Node's zlib has it (≥ 22.15).
+ */
+const path = require('path');
+const crypto = require('crypto');
+const zlib = require('zlib');
+const fs = require('fs-extra');
+const config = require('../config');
+const logger = require('../utils/logger');
+
+const SNAPSHOT_DIR = path.resolve(config.backupDir, 'snapshots');
+const PACK_DIR = path.join(SNAPSHOT_DIR, 'packs');
+const INDEX_FILE = path.join(SNAPSHOT_DIR, 'objects.idx');
+const MANIFEST_EXT = '.snapshot.json.gz';
+
+const HASH_LEN = 24;              // hex chars of sha1 kept (96 bits)
+const BLOCK_RECORDS = 512;
+const BLOCK_BYTES = 1 << 20;      // raw size at which a block is closed early
+const CHUNK_SPAN = 256;           // average entries per id/hash chunk
+const CHUNK_MAX = CHUNK_SPAN * 4;
+
+const CODECS = {
+  gz: { compress: (buf) => zlib.gzipSync(buf), decompress: (buf) => zlib.gunzipSync(buf) },
+};
+if (typeof zlib.zstdCompressSync === 'function') {
+  CODECS.zst = { compress: (buf) => zlib.zstdCompressSync(buf), decompress: (buf) => zlib.zstdDecompressSync(buf) };
+}
+const CODEC = CODECS.zst ? 'zst' : 'gz';
+
+let objects = null;            // hash → { pack, offset, length }, loaded from INDEX_FILE on first use
+let queue = Promise.resolve(); // snapshots are written one at a time
+
+function hashOf(str) {
+  return crypto.createHash('sha1').update(str).digest('hex').slice(0, HASH_LEN);
+}
+
+// Chunk boundary after this id — depends on the id only, so inserting or removing a
+// record moves no boundary but its own
+function isBoundary(id) {
+  return parseInt(crypto.createHash('md5').update(String(id)).digest('hex').slice(0, 8), 16) % CHUNK_SPAN === 0;
+}
+
+function compareIds(a, b) {
+  const na = Number(a), nb = Number(b);
+  return (Number.isNaN(na) || Number.isNaN(nb)) ? String(a).localeCompare(String(b)) : na - nb;
+}
+
+function codecOf(pack) {
+  const codec = CODECS[path.extname(pack).slice(1)];
+  if (!codec) throw new Error(`Snapshot pack ${pack}: codec not available in this Node version`);
+  return codec;
+}
+
+async function loadObjects() {
+  if (objects) return objects;
+  const map = new Map();
+  if (await fs.pathExists(INDEX_FILE)) {
+    const text = await fs.readFile(INDEX_FILE, 'utf8');
+    // a torn last line (crash mid-append) is cut off so the next append starts clean
+    if (text.length > 0 && !text.endsWith('\n')) {
+      await fs.truncate(INDEX_FILE, Buffer.byteLength(text.slice(0, text.lastIndexOf('\n') + 1)));
+    }
+    for (const line of text.split('\n').slice(0, -1)) {
+      const [pack, offset, length, hashes] = line.split(' ');
+      if (!hashes) continue;
+      const loc = { pack, offset: Number(offset), length: Number(length) };
+      for (const h of hashes.split(',')) map.set(h, loc);
+    }
+  }
+  objects = map;
+  return objects;
+}
+
+// ─── Write ────────────────────────────────────────────────────────────────────
+/**
+ * Pack writer: objects are buffered into a block; a full block is compressed and
+ * written, waiting on the stream when it is behind. Objects already in the store
+ * (or already added) are skipped.
+ */
+function openPack(pack, index) {
+  const stream = fs.createWriteStream(path.join(PACK_DIR, pack));
+  const codec = CODECS[CODEC];
+  const added = new Set();
+  const blocks = []; // { offset, length, hashes }
+  let lines = [];
+  let rawBytes = 0;
+  let offset = 0;
+  // Listen from the start: a write error (ENOSPC, EACCES) must reject flush/close so the
+  // caller aborts and removes the pack, instead of crashing the process as unhandled
+  let failure = null;
+  const waiting = new Set(); // reject callbacks of pending drain/end waits
+  stream.on('error', (e) => {
+    failure = failure || e;
+    for (const reject of waiting) reject(e);
+    waiting.clear();
+  });
+
+  // Waits for the callback given to start(done); rejects on a stream error meanwhile
+  function until(start) {
+    if (failure) return Promise.reject(failure);
+    return new Promise((resolve, reject) => {
+      waiting.add(reject);
+      start((err) => {
+        waiting.delete(reject);
+        if (err) reject(err); else resolve();
+      });
+    });
+  }
+
+  async function flush() {
+    if (failure) throw failure;
+    if (lines.length === 0) return;
+    const block = codec.compress(Buffer.from(lines.map(([h, json]) => `${h}\t${json}\n`).join('')));
+    blocks.push({ offset, length: block.length, hashes: lines.map(([h]) => h) });
+    offset += block.length;
+    lines = [];
+    rawBytes = 0;
+    if (!stream.write(block)) await until((done) => stream.once('drain', done));
+  }
+
+  return {
+    /** Store a JSON string, returns its hash. */
+    async put(json) {
+      const hash = hashOf(json);
+      if (index.has(hash) || added.has(hash)) return hash;
+      added.add(hash);
+      lines.push([hash, json]);
+      rawBytes += json.length;
+      if (lines.length >= BLOCK_RECORDS || rawBytes >= BLOCK_BYTES) await flush();
+      return hash;
+    },
+    get count() { return added.size; },
+    async close() {
+      await flush();
+      await until((done) => stream.end(done));
+      return { blocks, bytes: offset };
+    },
+    abort() { stream.destroy(); },
+  };
+}
+
+/**
+ * Store a snapshot of entity collections.
+ * @param {string} name - snapshot name prefix (e.g. 'full_backup')
+ * @param {object} collections - { [type]: Array<{ id }> }
+ * @param {object} meta - non-record data kept in the manifest as is
+ * @returns {Promise<{ id, filePath, stats, records, newObjects, bytes }>}
+ */
+function createSnapshot(name, collections, meta = {}) {
+  const run = queue.then(() => writeSnapshot(name, collections, meta));
+  queue = run.catch(() => {});
+  return run;
+}
+
+async function writeSnapshot(name, collections, meta) {
+  const started = Date.now();
+  await fs.ensureDir(PACK_DIR);
+  const index = await loadObjects();
+  const created = new Date().toISOString();
+  const id = `${name}_${created.replace(/[:.]/g, '-')}`;
+  const pack = `${id}.${CODEC}`;
+  const writer = openPack(pack, index);
+
+  const types = {};
+  const stats = {};
+  let records = 0;
+  try {
+    for (const [type, items] of Object.entries(collections)) {
+      const list = [...(items || [])].sort((a, b) => compareIds(a.id, b.id));
+      const chunks = [];
+      let ids = [], hashes = [];
+      const closeChunk = async () => {
+        if (ids.length === 0) return;
+        const hash = await writer.put(JSON.stringify({ ids, hashes }));
+        chunks.push({ first: ids[0], last: ids[ids.length - 1], count: ids.length, hash });
+        ids = [];
+        hashes = [];
+      };
+      for (const item of list) {
+        ids.push(item.id);
+        hashes.push(await writer.put(JSON.stringify(item)));
+        if (isBoundary(item.id) || ids.length >= CHUNK_MAX) await closeChunk();
+      }
+      await closeChunk();
+      types[type] = chunks;
+      stats[type] = list.length;
+      records += list.length;
+    }
+  } catch (err) {
+    writer.abort();
+    await fs.remove(path.join(PACK_DIR, pack));
+    throw err;
+  }
+
+  const fresh = writer.count;
+  const { blocks, bytes } = await writer.close();
+  if (blocks.length > 0) {
+    await fs.appendFile(INDEX_FILE, blocks.map((b) => `${pack} ${b.offset} ${b.length} ${b.hashes.join(',')}\n`).join(''));
+    for (const b of blocks) {
+      const loc = { pack, offset: b.offset, length: b.length };
+      for (const h of b.hashes) index.set(h, loc);
+    }
+  } else {
+    await fs.remove(path.join(PACK_DIR, pack));
+  }
+
+  const manifest = { version: 1, id, name, created, meta, stats, bytes, types };
+  const filePath = path.join(SNAPSHOT_DIR, id + MANIFEST_EXT);
+  await fs.writeFile(filePath + '.tmp', zlib.gzipSync(JSON.stringify(manifest)));
+  await fs.rename(filePath + '.tmp', filePath);
+
+  logger.info(`Snapshot ${id}: ${records} records, ${fresh} new objects (${(bytes / 1024).toFixed(1)} KB ${CODEC}), ${Date.now() - started} ms`);
+  return { id, filePath, stats, records, newObjects: fresh, bytes };
+}
+
+// ─── Read ─────────────────────────────────────────────────────────────────────
+function manifestPath(ref) {
+  const file = path.basename(String(ref));
+  return path.join(SNAPSHOT_DIR, file.endsWith(MANIFEST_EXT) ? file : file + MANIFEST_EXT);
+}
+
+function isSnapshotFile(filePath) {
+  return String(filePath).endsWith(MANIFEST_EXT);
+}
+
+async function readManifest(ref) {
+  const filePath = manifestPath(ref);
+  if (!await fs.pathExists(filePath)) throw new Error(`Snapshot not found: ${ref}`);
+  return JSON.parse(zlib.gunzipSync(await fs.readFile(filePath)).toString('utf8'));
+}
+
+/** hash → parsed object, reading every needed block once. */
+async function fetchObjects(hashes, label) {
+  const index = await loadObjects();
+  const blocks = new Map(); // "pack offset" → { pack, offset, length, hashes: Set }
+  for (const hash of hashes) {
+    const loc = index.get(hash);
+    if (!loc) throw new Error(`Snapshot ${label}: object ${hash} missing from the object store`);
+    const key = `${loc.pack} ${loc.offset}`;
+    if (!blocks.has(key)) blocks.set(key, { ...loc, hashes: new Set() });
+    blocks.get(key).hashes.add(hash);
+  }
+
+  const byPack = new Map();
+  for (const block of blocks.values()) {
+    if (!byPack.has(block.pack)) byPack.set(block.pack, []);
+    byPack.get(block.pack).push(block);
+  }
+  const found = new Map();
+  for (const [pack, list] of byPack) {
+    const codec = codecOf(pack);
+    const fd = await fs.open(path.join(PACK_DIR, pack), 'r');
+    try {
+      for (const block of list) {
+        const buf = Buffer.alloc(block.length);
+        await fs.read(fd, buf, 0, block.length, block.offset);
+        for (const line of codec.decompress(buf).toString('utf8').split('\n')) {
+          const tab = line.indexOf('\t');
+          if (tab < 0) continue;
+          const hash = line.slice(0, tab);
+          if (block.hashes.has(hash)) found.set(hash, JSON.parse(line.slice(tab + 1)));
+        }
+      }
+    } finally {
+      await fs.close(fd);
+    }
+  }
+  return found;
+}
+
+/**
+ * Restore records from a snapshot without unpacking the rest of it.
+ * @param {string} ref - snapshot id or manifest file name
+ * @param {object} [opts]
+ * @param {string[]} [opts.types] - entity types to restore (default: all)
+ * @param {number} [opts.from] - lowest id, inclusive
+ * @param {number} [opts.to] - highest id, inclusive
+ * @param {Array} [opts.ids] - explicit ids (instead of a range)
+ * @returns {Promise<{ meta, created, [type]: object[] }>}
+ */
+async function restoreSnapshot(ref, opts = {}) {
+  const manifest = await readManifest(ref);
+  const types = opts.types?.length ? opts.types : Object.keys(manifest.types);
+  const wanted = opts.ids ? opts.ids.map(String) : null;
+  const inRange = (id) => (opts.from == null || compareIds(id, opts.from) >= 0)
+    && (opts.to == null || compareIds(id, opts.to) <= 0);
+  const chunkWanted = (c) => (wanted
+    ? wanted.some((id) => compareIds(id, c.first) >= 0 && compareIds(id, c.last) <= 0)
+    : (opts.from == null || compareIds(c.last, opts.from) >= 0) && (opts.to == null || compareIds(c.first, opts.to) <= 0));
+
+  const chunksOf = {};
+  for (const type of types) {
+    if (!manifest.types[type]) throw new Error(`Snapshot ${manifest.id} has no "${type}"`);
+    chunksOf[type] = manifest.types[type].filter(chunkWanted);
+  }
+  const chunks = await fetchObjects(new Set(Object.values(chunksOf).flat().map((c) => c.hash)), manifest.id);
+
+  const wantedSet = wanted ? new Set(wanted) : null;
+  const picked = {};
+  for (const type of types) {
+    picked[type] = [];
+    for (const { hash } of chunksOf[type]) {
+      const { ids, hashes } = chunks.get(hash);
+      ids.forEach((id, i) => {
+        if (wantedSet ? wantedSet.has(String(id)) : inRange(id)) picked[type].push(hashes[i]);
+      });
+    }
+  }
+  const records = await fetchObjects(new Set(Object.values(picked).flat()), manifest.id);
+
+  const result = { meta: manifest.meta, created: manifest.created };
+  for (const type of types) result[type] = picked[type].map((h) => records.get(h));
+  return result;
+}
+
+/** Snapshots, newest first: { id, file, path, size, created, stats }. size = manifest + its own pack. */
+async function listSnapshots() {
+  if (!await fs.pathExists(SNAPSHOT_DIR)) return [];
+  const files = (await fs.readdir(SNAPSHOT_DIR)).filter((f) => f.endsWith(MANIFEST_EXT));
+  const list = [];
+  for (const file of files) {
+    const filePath = path.join(SNAPSHOT_DIR, file);
+    try {
+      const manifest = await readManifest(file);
+      const stat = await fs.stat(filePath);
+      list.push({
+        id: manifest.id,
+        file,
+        path: filePath,
+        size: stat.size + (manifest.bytes || 0),
+        created: manifest.created,
+        stats: manifest.stats,
+        snapshot: true,
+      });
+    } catch (err) {
+      logger.warn(`Snapshot ${file} unreadable: ${err.message}`);
+    }
+  }
+  return list.sort((a, b) => new Date(b.created) - new Date(a.created));
+}
+
+module.exports = {
+  SNAPSHOT_DIR,
+  createSnapshot,
+  restoreSnapshot,
+  readManifest,
+  listSnapshots,
+  isSnapshotFile,
+};
@@ -0,0 +1,74 @@
+/**
+ * crmTransport.js
+ * One HTTP transport for all CRM clients (amoApi / amoApiV2 / kommoApi / kommoApiV2).
+ *
+ *  - pooled keep-alive agents: TCP + TLS sessions are reused across requests and across
+ *    the v1 / v2 clients of the same account instead of a handshake per request
+ *  - per-host socket cap (MAX_SOCKETS) — a little above the scheduler's in-flight limit,
+ *    so 429 retries never queue behind the pool; idle sockets are trimmed to MAX_FREE
+ *  - compressed responses (gzip / br / deflate), decompressed as the body streams in
+ * Clients keep their own interceptors: v1 attaches the rate limiter, v2 calls execute().
+ */
+const http = require('http');
+const https = require('https');
+const axios = require('axios');
+const config = require('../config');
+
+const MAX_SOCKETS = 8;        // per host
+const MAX_FREE    = 4;        // idle keep-alive sockets kept per host
+const KEEP_ALIVE_MS = 1000;   // TCP keep-alive probe delay
+const IDLE_TIMEOUT  = 60000;  // ms — idle socket is closed after this
+const REQUEST_TIMEOUT = 30000;
+
+const agentOpts = {
+  keepAlive: true,
+  keepAliveMsecs: KEEP_ALIVE_MS,
+  maxSockets: MAX_SOCKETS,
+  maxFreeSockets: MAX_FREE,
+  timeout: IDLE_TIMEOUT,
+  scheduling: 'lifo', // reuse the most recently used socket, let the rest idle out
+};
+const httpAgent  = new http.Agent(agentOpts);
+const httpsAgent = new https.Agent(agentOpts);
+
+/**
+ * axios instance for a CRM on the shared transport.
+ * @param {'amo'|'kommo'} crm
+ * @param {string} [basePath] - appended to the account URL, e.g. '/api/v4'
+ */
+function createClient(crm, basePath = '') {
+  const { baseUrl, token } = config[crm];
+  return axios.create({
+    baseURL: `${baseUrl}${basePath}`,
+    headers: {
+      Authorization: `Bearer ${token}`,
+      'Content-Type': 'application/json',
+      'Accept-Encoding': 'gzip, br, deflate',
+    },
+    timeout: REQUEST_TIMEOUT,
+    decompress: true,
+    httpAgent,
+    httpsAgent,
+  });
+}
+
+function countSockets(map) {
+  let n = 0;
+  for (const list of Object.values(map)) n += list.length;
+  return n;
+}
+
+/** Open / idle sockets and queued requests of the shared pool (for /api/health). */
+function getTransportStats() {
+  const stats = {};
+  for (const [name, agent] of [['http', httpAgent], ['https', httpsAgent]]) {
+    stats[name] = {
+      active: countSockets(agent.sockets),
+      idle: countSockets(agent.freeSockets),
+      queued: countSockets(agent.requests),
+    };
+  }
+  return { maxSocketsPerHost: MAX_SOCKETS, ...stats };
+}
+
+module.exports = { createClient, getTransportStats };
@@ -70,101 +70,144 @@ function transformLead(amoLead, stageMapping, fieldMapping, userMapping) {
   return lead;
 }
 
-/**
- * Transform custom fields from AMO to Kommo format
- */
-function transformCustomFields(amoValues, fieldMapping) {
-  if (!amoValues || !amoValues.length || !fieldMapping) return [];
-  const result = [];
-  for (const field of amoValues) {
-    const mapped = fieldMapping[field.field_id];
-    if (!mapped) { logger.warn(`[transformCustomFields] поле AMO #${field.field_id} ("${field.field_name || field.field_code || '?'}") не найдено в маппинге — пропускаем`); continue; }
-    const { kommoFieldId, enumMap, kommoFieldType, amoFieldType, fieldType, transferMode } = mapped;
+// ─── Compiled field plans ─────────────────────────────────────────────────────
+// A field mapping ({ amoFieldId: { kommoFieldId, enumMap, kommoFieldType, ... } }) is compiled
+// once into per-field converters; plans are cached per mapping object (loadFieldMapping result).
+const planCache = new WeakMap();
 
-    // Priority: kommoFieldType → amoFieldType → fieldType (legacy mapping key) → 'text'
-    const kType = kommoFieldType || amoFieldType || fieldType || 'text';
+// "2026-02-24T06:46:00.000Z" → "2026-02-24T06:46:00+00:00" (Kommo rejects milliseconds)
+function toKommoIso(raw) {
+  const d = (typeof raw === 'number' || /^\d+$/.test(String(raw)))
+    ? new Date(parseInt(raw, 10) * 1000)
+    : new Date(raw);
+  const t = d.getTime();
+  if (Number.isNaN(t)) return null;
+  return d.toISOString().slice(0, 19) + '+00:00';
+}
 
-    let values;
-    switch (kType) {
-      case 'multitext': // phone, email — enum_code is category (WORK/HOME/MOB)
-        values = (field.values || []).map(v => ({
-          value: v.value,
-          ...(v.enum_code ? { enum_code: v.enum_code } : {}),
-        })).filter(v => v.value);
-        break;
-
-      case 'select':
-      case 'radiobutton': {
-        // Kommo select/radiobutton requires enum_id — NEVER send text (NotSupportedChoice).
-        // If AMO field is multiselect mapped to Kommo select → take only FIRST valid enum_id.
-        values = [];
-        for (const v of (field.values || [])) {
+/** values[] of one AMO field → Kommo values[] for the given Kommo field type. */
+function compileConverter(kType, enumMap) {
+  switch (kType) {
+    case 'multitext': // phone, email — enum_code is category (WORK/HOME/MOB)
+      return (values) => {
+        const out = [];
+        for (const v of values) {
+          if (!v.value) continue;
+          out.push(v.enum_code ? { value: v.value, enum_code: v.enum_code } : { value: v.value });
+        }
+        return out;
+      };
+
+    case 'select':
+    case 'radiobutton':
+      // Kommo select/radiobutton requires enum_id — NEVER send text (NotSupportedChoice).
+      // If AMO field is multiselect mapped to Kommo select → take only FIRST valid enum_id.
+      return (values) => {
+        for (const v of values) {
           const kEnumId = enumMap && enumMap[v.enum_id];
-          if (kEnumId) {
-            values.push({ enum_id: kEnumId });
-            break; // select/radiobutton takes exactly 1 value
-          }
+          if (kEnumId) return [{ enum_id: kEnumId }];
         }
-        break;
-      }
+        return [];
+      };
 
-      case 'multiselect': {
-        // Kommo multiselect — collect all matched enum_ids.
-        values = [];
-        for (const v of (field.values || [])) {
+    case 'multiselect':
+      // Kommo multiselect — collect all matched enum_ids.
+      return (values) => {
+        const out = [];
+        for (const v of values) {
           const kEnumId = enumMap && enumMap[v.enum_id];
-          if (kEnumId) {
-            values.push({ enum_id: kEnumId });
-          }
+          if (kEnumId) out.push({ enum_id: kEnumId });
         }
-        break;
-      }
+        return out;
+      };
 
-      case 'checkbox':
-        // Kommo checkbox expects boolean true/false (NOT string "1"/"0")
-        values = (field.values || []).map(v => ({ value: Boolean(v.value) }));
-        break;
-
-      case 'birthday':
-      case 'date':
-      case 'date_time':
-        // AMO can send either unix timestamp (number) or ISO string with ms.
-        // Kommo requires strict ISO 8601: "2026-02-24T06:46:00+00:00" (no milliseconds).
-        values = (field.values || [])
-          .filter(v => v.value != null && v.value !== '')
-          .map(v => {
-            let iso;
-            const raw = v.value;
-            if (typeof raw === 'number' || /^\d+$/.test(String(raw))) {
-              // Unix timestamp (seconds) → ISO
-              iso = new Date(parseInt(raw, 10) * 1000).toISOString();
-            } else {
-              // Already ISO string — just parse and re-format
-              iso = new Date(raw).toISOString();
-            }
-            if (!iso || iso === 'Invalid Date') return null;
-            // Strip milliseconds: "2026-02-24T06:46:00.000Z" → "2026-02-24T06:46:00+00:00"
-            return { value: iso.replace(/\.\d{3}Z$/, '+00:00').replace(/Z$/, '+00:00') };
-          })
-          .filter(Boolean);
-        break;
-
-      default: // text, numeric, url, textarea — send value as plain string
-        values = (field.values || [])
-          .map(v => {
-            // For select-type AMO fields mapped to text in Kommo — use text value
-            if (v.value == null || v.value === '' || v.value === false) return null;
-            return { value: String(v.value) };
-          })
-          .filter(Boolean);
-        break;
-    }
+    case 'checkbox':
+      // Kommo checkbox expects boolean true/false (NOT string "1"/"0")
+      return (values) => values.map(v => ({ value: Boolean(v.value) }));
 
-    if (values && values.length > 0) {
-      result.push({ field_id: kommoFieldId, values });
-    }
+    case 'birthday':
+    case 'date':
+    case 'date_time':
+      // AMO can send either unix timestamp (number) or ISO string with ms.
+      return (values) => {
+        const out = [];
+        for (const v of values) {
+          if (v.value == null || v.value === '') continue;
+          const iso = toKommoIso(v.value);
+          if (iso) out.push({ value: iso });
+        }
+        return out;
+      };
+
+    default: // text, numeric, url, textarea — send value as plain string
+      return (values) => {
+        const out = [];
+        for (const v of values) {
+          if (v.value == null || v.value === '' || v.value === false) continue;
+          out.push({ value: String(v.value) });
+        }
+        return out;
+      };
+  }
+}
+
+/**
+ * Compile a field mapping into a transform plan (cached per mapping object).
+ * plan.transform(amoValues) → Kommo custom_fields_values; unmapped AMO fields are
+ * counted in plan.unmapped (Map fieldId → { name, count }) instead of logged one by one.
+ */
+function compileFieldPlan(fieldMapping) {
+  if (!fieldMapping) return null;
+  const cached = planCache.get(fieldMapping);
+  if (cached) return cached;
+
+  const converters = new Map();
+  for (const [amoFieldId, mapped] of Object.entries(fieldMapping)) {
+    if (!mapped) continue;
+    const { kommoFieldId, enumMap, kommoFieldType, amoFieldType, fieldType } = mapped;
+    // Priority: kommoFieldType → amoFieldType → fieldType (legacy mapping key) → 'text'
+    const kType = kommoFieldType || amoFieldType || fieldType || 'text';
+    converters.set(Number(amoFieldId), { kommoFieldId, convert: compileConverter(kType, enumMap) });
   }
-  return result;
+
+  const unmapped = new Map();
+  const plan = {
+    unmapped,
+    transform(amoValues) {
+      const result = [];
+      if (!amoValues || !amoValues.length) return result;
+      for (const field of amoValues) {
+        const conv = converters.get(Number(field.field_id));
+        if (!conv) {
+          const u = unmapped.get(field.field_id);
+          if (u) u.count++;
+          else unmapped.set(field.field_id, { name: field.field_name || field.field_code || '?', count: 1 });
+          continue;
+        }
+        const values = conv.convert(field.values || []);
+        if (values.length > 0) result.push({ field_id: conv.kommoFieldId, values });
+      }
+      return result;
+    },
+    /** Log one aggregated line for unmapped fields seen since the last flush, then reset. */
+    flushUnmapped(label = 'transformCustomFields') {
+      if (unmapped.size === 0) return;
+      const parts = [...unmapped].map(([id, u]) => `#${id} "${u.name}" ×${u.count}`);
+      logger.warn(`[${label}] поля AMO не найдены в маппинге — пропущены: ${parts.join(', ')}`);
+      unmapped.clear();
+    },
+  };
+  planCache.set(fieldMapping, plan);
+  return plan;
+}
+
+/**
+ * Transform custom fields from AMO to Kommo format (compiled plan of the mapping).
+ * Unmapped fields are aggregated — see transformMany / plan.flushUnmapped().
+ */
+function transformCustomFields(amoValues, fieldMapping) {
+  if (!amoValues || !amoValues.length || !fieldMapping) return [];
+  return compileFieldPlan(fieldMapping).transform(amoValues);
 }
 
 /**
@@ -204,6 +247,25 @@ function transformCompany(amoCompany, fieldMapping, userMapping) {
   return obj;
 }
 
+/**
+ * Transform a whole array of AMO leads / contacts / companies in one pass and log
+ * unmapped custom fields once, aggregated into counts.
+ * @param {'leads'|'contacts'|'companies'} entityType
+ * @param {object[]} amoItems
+ * @param {object} fieldMapping - mapping for this entity type (may be null)
+ * @param {object} [userMapping]
+ * @param {object} [stageMapping] - leads only
+ */
+function transformMany(entityType, amoItems, fieldMapping, userMapping, stageMapping) {
+  let out;
+  if (entityType === 'leads') out = amoItems.map(l => transformLead(l, stageMapping || {}, fieldMapping, userMapping));
+  else if (entityType === 'contacts') out = amoItems.map(c => transformContact(c, fieldMapping, userMapping));
+  else out = amoItems.map(c => transformCompany(c, fieldMapping, userMapping));
+  const plan = compileFieldPlan(fieldMapping);
+  if (plan) plan.flushUnmapped(`transform ${entityType}`);
+  return out;
+}
+
 /**
  * AMO → Kommo task type mapping (AMO task_type_id → Kommo task_type_id).
  * Standard types 1 (Follow-up) and 2 (Meeting) are the same in both systems.
@@ -315,6 +377,8 @@ module.exports = {
   transformCompany,
   transformTask,
   transformCustomFields,
+  transformMany,
+  compileFieldPlan,
   buildStageMapping,
   AMO_STAGE_MAP,
   AMO_TO_KOMMO_TASK_TYPE,
@@ -0,0 +1,517 @@
+/**
+ * fieldMatcher.js
+ * Сопоставление кастомных полей AMO ↔ Kommo для /fields-analysis и create-field.
+ *
+ * Словари (FIELD_ALIASES, ENUM_VALUE_ALIASES) разворачиваются один раз в обратные
+ * индексы alias → кластер. Для каждого Kommo-поля токены, кластер и нормализованные
+ * enum-значения считаются один раз (WeakMap по объекту поля — схемы полей кэшируются
+ * в fieldSchemaCache, поэтому между запросами переиспользуются и они).
+ * Кросс-языковой поиск берёт кандидатов из индекса кластер → тип → поля Kommo
+ * вместо перебора всех полей; порядок и score — как у прежнего полного перебора.
+ */
+'use strict';
+
+const ENUM_TYPES = ['select', 'multiselect', 'radiobutton'];
+
+// Пары типов, которые считаются «мягко совместимыми»:
+// при несовпадении типа поле показывается как matched/partial, а не missing.
+const SOFT_TYPE_COMPAT = [
+  ['text','textarea'], ['text','url'], ['textarea','url'],
+  ['select','radiobutton'],
+  ['select','multiselect'], ['radiobutton','multiselect'],
+  ['date','date_time'],
+];
+
+// ── Кросс-языковые кластеры значений перечислений ───────────────────────────
+// Если AMO-значение и Kommo-значение попадают в один кластер — они считаются
+// семантически эквивалентными (не нужно добавлять в Kommo).
+const ENUM_VALUE_ALIASES = [
+  // Пол / Gender
+  ['м', 'мужской', 'мужчина', 'male', 'man', 'boy', 'm'],
+  ['ж', 'женский', 'женщина', 'female', 'woman', 'girl', 'f'],
+  // Роль / Relationship
+  ['мама', 'мать', 'mother', 'mom'],
+  ['папа', 'отец', 'father', 'dad'],
+  ['бабушка', 'grandmother', 'grandma'],
+  ['дедушка', 'grandfather', 'grandpa'],
+  ['няня', 'nanny', 'babysitter'],
+  ['опекун', 'guardian'],
+  // Да / Нет
+  ['да', 'yes', 'true', 'верно'],
+  ['нет', 'no', 'false', 'неверно'],
+  // Источники трафика
+  ['вконтакте', 'вк', 'vk', 'vkontakte'],
+  ['instagram', 'инстаграм', 'инста'],
+  ['facebook', 'фейсбук', 'fb'],
+  ['telegram', 'телеграм', 'tg'],
+  ['whatsapp', 'вотсап', 'wa', 'whats app'],
+  ['viber', 'вайбер'],
+  ['рекомендация', 'recommendation', 'referral', 'сарафанное радио'],
+  ['другое', 'other', 'иное', 'прочее', 'другая'],
+  ['с сайта', 'landing', 'лендинг', 'website', 'сайт'],
+  ['blogger', 'блогер', 'блогеры', 'инфлюенсер'],
+  // Роль / Relationship (ребенок = student himself OR infant как причина отказа)
+  ['ребенок', 'ребёнок', 'child', 'student himself', 'kid', 'сам ученик', 'infant'],
+  // Продукты
+  ['репетиторство', 'репетиторство рф', 'репетиторство мш', 'tutoring', 'tutor', 'репетитор'],
+  ['школа рф', 'school'],
+  ['лагерь', 'camp', 'summer camp'],
+  ['международная школа', 'international school'],
+  // Качество лида
+  ['целевой', 'qualified', 'a (целевой)'],
+  ['не срочный', 'b (не срочный)', 'potential'],
+  ['не целевой', 'c (не целевой)', 'unqualified'],
+  // ── Причина закрытия / Cause of loss ──────────────────────────────
+  ['слишком дорого', 'too expensive', 'дорого', 'цена высокая'],
+  ['не устроили условия', 'the terms were not acceptable', 'условия не устроили', 'условия не подошли'],
+  ['выбрали других', 'chose others', 'выбрали конкурента', 'выбрали конкурентов'],
+  ['нет подходящей услуги', 'there is no suitable product', 'no suitable product', 'нет нужного продукта'],
+  ['нет ответа', 'no answer', 'no response', 'не отвечает'],
+  ['негатив не звонить', 'негатив, не звонить', 'negative feedback, do not call', 'negative feedback do not call', 'не звонить'],
+  ['работа сотрудничество спам', 'работа, сотрудничество, спам', 'spam', 'спам', 'рассылка'],
+  ['текущий ученик', 'current student', 'действующий клиент', 'текущий клиент'],
+  ['дубль', 'duplicate', 'дублирует', 'дубликат'],
+  ['не оставляли заявку', 'did not submit an application', 'не подавали заявку', 'не подавал заявку'],
+  ['это организация', 'this is an organisation', 'this is an organization', 'организация'],
+  ['пропала потребность', 'no longer needed', 'lost interest', 'потребность отпала'],
+  // Месяцы
+  ['январь', 'january', 'jan'],
+  ['февраль', 'february', 'feb'],
+  ['март', 'march', 'mar'],
+  ['апрель', 'april', 'apr'],
+  ['май', 'may'],
+  ['июнь', 'june', 'jun'],
+  ['июль', 'july', 'jul'],
+  ['август', 'august', 'aug'],
+  ['сентябрь', 'september', 'sep'],
+  ['октябрь', 'october', 'oct'],
+  ['ноябрь', 'november', 'nov'],
+  ['декабрь', 'december', 'dec'],
+];
+
+// ── Кросс-языковой словарь синонимов ────────────────────────────────────────
+// ВАЖНО: каждый кластер должен быть достаточно специфичен.
+// Матчинг только по ТОЧНОМУ совпадению токена с одним из алиасов кластера.
+const FIELD_ALIASES = [
+  // Контактные
+  ['телефон','phone','тел','tel','mobile','моб','мобильный','сотовый','cell','phones'],
+  ['email','почта','e-mail','mail','эл почта','электронная почта','emails'],
+  ['сайт','website','site','веб','web','www','homepage'],
+  ['skype','скайп'],
+  ['instagram','инстаграм','инста'],
+  ['facebook','фейсбук','fb'],
+  ['вконтакте','вк','vk','vkontakte'],
+  ['telegram','телеграм','tg'],
+  ['whatsapp','вотсап','wa'],
+  ['viber','вайбер'],
+  // Персональные
+  ['имя','name','наименование','название','fullname'],
+  ['фамилия','lastname','surname'],
+  ['день рождения','birthday','birthdate','дата рождения'],
+  ['пол','gender','sex','male female','malefemale','пол контакта'],
+  ['возраст','age'],
+  // Профессиональные
+  ['должность','position','jobtitle','профессия','occupation'],
+  ['отдел','department','dept','division'],
+  ['компания','company','организация','organization','фирма','firm'],
+  // Адресные
+  ['адрес','address','addr'],
+  ['город','city','town'],
+  ['страна','country'],
+  ['регион','region','область','край','province','state'],
+  ['индекс','zip','postal','postcode','почтовый'],
+  ['улица','street'],
+  // Финансовые
+  ['бюджет','budget','сумма','amount','стоимость','cost','price','цена','sum'],
+  ['скидка','discount'],
+  ['налог','tax','ндс','vat','nds'],
+  ['счёт','счет','invoice','bill','оплата','payment'],
+  ['выручка','revenue','доход','income'],
+  // UTM — КАЖДОЕ ПОЛЕ ОТДЕЛЬНЫМ КЛАСТЕРОМ
+  ['utm source','utm_source','utmsource','источник рекламы','рекламный источник','источник трафика'],
+  ['utm medium','utm_medium','utmmedium','канал рекламы','рекламный канал','тип трафика'],
+  ['utm campaign','utm_campaign','utmcampaign','рекламная кампания','кампания'],
+  ['utm content','utm_content','utmcontent','содержание объявления','содержание рекламы'],
+  ['utm term','utm_term','utmterm','ключевое слово','ключевые слова'],
+  // Источник сделки/лида (ОТДЕЛЬНО от utm)
+  ['источник','source','leadsource','trafficsource','источник лида','источник сделки'],
+  // Продукт / услуга
+  ['продукт','product','товар','услуга','service','item','goods'],
+  // Канал (общий) — ОТДЕЛЬНО от utm-medium
+  ['канал','channel','маркетинговый канал'],
+  // Даты
+  ['дата создания','created','createdat','дата добавления'],
+  ['дата обновления','updated','updatedat','изменён','modified'],
+  ['дата закрытия','closed','closing','closedate','дата завершения','deadline'],
+  ['дата','date'],
+  // Качество и оценки — ОТДЕЛЬНЫЕ КЛАСТЕРЫ
+  ['качество лида','lead quality','лид скор','lead score'],
+  ['качество','quality','оценка качества'],
+  ['лид','lead','потенциальный клиент'],
+  ['рейтинг','rating','score','оценка'],
+  // Общие
+  ['описание','description','desc','подробности','details'],
+  ['комментарий','comment','notes','заметки','примечание','remarks'],
+  ['тег','tag','метка','label','теги'],
+  ['статус','status','состояние','stage'],
+  ['приоритет','priority','важность'],
+  ['ответственный','owner','responsible','manager','менеджер','assigned'],
+  // Реквизиты
+  ['инн','inn'],
+  ['кпп','kpp'],
+  ['огрн','ogrn'],
+  ['бик','bik'],
+  // Ссылки
+  ['ссылка','link','url','href'],
+  // Авто
+  ['автомобиль','car','vehicle','транспорт','transport'],
+  ['vin','вин'],
+  // Трекинг (общий)
+  ['трекинг','tracking','отслеживание','аналитика'],
+  // Квалификация лида
+  ['квалифицирован','qualified','is qualified','квалификация лида','квалифицирован контакт'],
+  // Ученик / Student
+  ['ученик','student','учащийся','pupil'],
+  // Роль / Relationship (кем является контакт по отношению к ученику)
+  ['роль','role','relationship','роль в семье','relationship to student','relationship to the student'],
+  // Пробное занятие — дата и время
+  ['дата и время пробного урока','date and time of demo','дата пробного урока','trial lesson datetime','demo datetime','date and time of the demo','дата время пробный'],
+  // Пробное занятие — запись
+  ['записан на пробное','registered for demo','registered for the demo','registered demo','записан пробный','запись на пробный урок'],
+  // Пробное занятие — посещение
+  ['был на пробном','attended demo','attended the demo','посещение пробного','был на пробном занятии'],
+  // Оценка после пробного урока
+  ['оценка после пробного','grade after demo','grade received after demo','grade recived after demo','оценка пробного урока'],
+  // Проверка качества сделки
+  ['прошла проверку','deal reviewed','the deal has been reviewed','проверка сделки','deal has been reviewed'],
+  // Комментарий проверяющего
+  ['кто проверил','who reviewed','quality control comment','контроль качества комментарий'],
+  // Отписка от рассылки
+  ['отписался','unsubscribed','отписалась','отписан от рассылки','unsubscribe'],
+  // Причина закрытия / потери
+  ['причина закрытия','cause of loss','причина отказа','loss reason','причина потери'],
+  // Комментарий к причине закрытия
+  ['комментарий к причине','cause of loss commentary','ответственный за закрытие'],
+];
+
+// Кросс-языковой маппинг групп AMO → Kommo
+const AMO_KOMMO_GROUP_NAME_MAP = {
+  'основное':      'main',
+  'main':          'основное',
+  'статистика':    'statistics',
+  'statistics':    'статистика',
+  'без группы':    'main',
+  'general':       'основное',
+  'счета/покупки': 'invoices',
+  'покупки':       'invoices',
+  'all leads':     'все сделки',
+  'все сделки':    'all leads',
+};
+
+/** Типы полей, совместимые при сопоставлении */
+const TYPE_COMPAT = {
+  text:          ['text','textarea','url','multitext'],
+  textarea:      ['text','textarea'],
+  url:           ['url','text'],
+  multitext:     ['multitext','text'],
+  numeric:       ['numeric'],
+  select:        ['select','radiobutton'],
+  radiobutton:   ['select','radiobutton'],
+  multiselect:   ['multiselect','select'],
+  checkbox:      ['checkbox'],
+  date:          ['date','date_time'],
+  date_time:     ['date','date_time'],
+  tracking_data: ['tracking_data'],
+  smart_address: ['smart_address'],
+  chained_lists: ['chained_lists'],
+};
+
+// ─── Обратные индексы словарей ───────────────────────────────────────────────
+// alias → индекс ПЕРВОГО кластера, где он встречается (как прежний перебор по порядку)
+const FIELD_ALIAS_INDEX = new Map();
+FIELD_ALIASES.forEach((cluster, i) => {
+  for (const alias of cluster) if (!FIELD_ALIAS_INDEX.has(alias)) FIELD_ALIAS_INDEX.set(alias, i);
+});
+
+// enum-значение → все кластеры, где оно встречается
+const ENUM_ALIAS_INDEX = new Map();
+ENUM_VALUE_ALIASES.forEach((cluster, i) => {
+  for (const alias of cluster) {
+    const list = ENUM_ALIAS_INDEX.get(alias);
+    if (list) list.push(i); else ENUM_ALIAS_INDEX.set(alias, [i]);
+  }
+});
+
+const SOFT_TYPE_PAIRS = new Set(SOFT_TYPE_COMPAT.flatMap(([x, y]) => [`${x}|${y}`, `${y}|${x}`]));
+function isSoftTypeCompat(a, b) {
+  return a === b || SOFT_TYPE_PAIRS.has(`${a}|${b}`);
+}
+
+/** Нормализует enum-значение: lower, убирает пунктуацию, схлопывает пробелы */
+function normEnumVal(v) {
+  return (v || '').toLowerCase()
+    .replace(/[,;.()\[\]\/#!?«»"'`]/g, ' ')
+    .replace(/\s+/g, ' ')
+    .trim();
+}
+
+/** Нормализует строку → массив токенов */
+function normalizeTokens(str) {
+  return (str || '')
+    .toLowerCase()
+    .replace(/[_\-\.\/ ,;:@#*+(\)[\]]/g, ' ')
+    .replace(/[^а-яёa-z0-9\s]/g, '')
+    .split(/\s+/)
+    .filter(t => t.length > 0);
+}
+
+/**
+ * findAliasCluster — СТРОГИЙ поиск кластера, возвращает его индекс или -1.
+ * Только ТОЧНОЕ совпадение токена ИЛИ полного нормализованного имени с alias.
+ * Никаких вхождений substr (alias.includes(tok)) — это вызывало багги.
+ * При нескольких подходящих кластерах побеждает первый по порядку FIELD_ALIASES.
+ */
+function findAliasCluster(tokens, fullNorm) {
+  // Полное нормализованное имя как единая фраза
+  if (fullNorm && FIELD_ALIAS_INDEX.has(fullNorm)) return FIELD_ALIAS_INDEX.get(fullNorm);
+  let best = -1;
+  for (const tok of tokens) {
+    const i = FIELD_ALIAS_INDEX.get(tok);
+    if (i !== undefined && (best < 0 || i < best)) best = i;
+  }
+  return best;
+}
+
+// ─── Предрасчёт по полю ───────────────────────────────────────────────────────
+const nameInfoCache = new WeakMap(); // field → { cluster, penalizable }
+const enumInfoCache = new WeakMap(); // Kommo field → { values: Set, clusters: Set }
+
+/**
+ * Токены имени → кластер и признак «длинное имя, в кластер попал один токен»
+ * (для штрафа в findCrossLangMatch).
+ */
+function nameInfo(field) {
+  let info = nameInfoCache.get(field);
+  if (info) return info;
+  const tokens = normalizeTokens(field.name);
+  const full = tokens.join(' ');
+  const cluster = findAliasCluster(tokens, full);
+  let penalizable = false;
+  if (cluster >= 0) {
+    const aliases = FIELD_ALIASES[cluster];
+    const matchCount = tokens.filter(t => aliases.includes(t)).length;
+    penalizable = !aliases.includes(full) && tokens.length > 2 && matchCount < 2;
+  }
+  info = { cluster, penalizable };
+  nameInfoCache.set(field, info);
+  return info;
+}
+
+function enumInfo(kommoField) {
+  let info = enumInfoCache.get(kommoField);
+  if (info) return info;
+  const values = new Set();
+  const clusters = new Set();
+  for (const e of (kommoField.enums || [])) {
+    const norm = normEnumVal(e.value);
+    if (!norm) continue;
+    values.add(norm);
+    for (const i of (ENUM_ALIAS_INDEX.get(norm) || [])) clusters.add(i);
+  }
+  info = { values, clusters };
+  enumInfoCache.set(kommoField, info);
+  return info;
+}
+
+/**
+ * Возвращает true, если AMO-значение семантически эквивалентно
+ * хотя бы одному значению Kommo-поля (enumInfo: нормализованные значения + их кластеры).
+ */
+function enumValueSemanticMatch(amoVal, kInfo) {
+  const aNorm = normEnumVal(amoVal);
+  if (!aNorm) return false;
+
+  // 1. Точное совпадение (нормализованное)
+  if (kInfo.values.has(aNorm)) return true;
+
+  // 2. Кросс-языковой кластер — полная нормализованная строка
+  const inKommoCluster = (alias) => (ENUM_ALIAS_INDEX.get(alias) || []).some(i => kInfo.clusters.has(i));
+  if (inKommoCluster(aNorm)) return true;
+
+  // 3. Кросс-языковой кластер — по токенам AMO-значения
+  // (срабатывает только если токен длинный >= 4 символа, чтобы не было ложных совпадений)
+  return aNorm.split(/\s+/).some(tok => tok.length >= 4 && inKommoCluster(tok));
+}
+
+function chainedName(v) {
+  return (v.value || v.name || '').toLowerCase().trim();
+}
+
+/**
+ * compareFields — сравнивает поле AMO с полем Kommo и возвращает статус совпадения.
+ * Статусы: 'synced' (полностью совпадает), 'matched' (совпадает основное),
+ *          'different' (отличия есть), 'missing' (поле не найдено в Kommo).
+ */
+function compareFields(amoField, kommoField, mappingEntry) {
+  if (!kommoField) return { status: 'missing', differences: [] };
+
+  const typesMatch = amoField.type === kommoField.type;
+  if (!typesMatch && !isSoftTypeCompat(amoField.type, kommoField.type)) {
+    // Принципиально несовместимые типы → создать новое поле
+    return { status: 'missing', differences: ['type'], typeConflict: true };
+  }
+
+  const diffs = [];
+  if (!typesMatch) diffs.push('type'); // мягко совместимые — отличие фиксируем, но не конфликт
+
+  // Видимость через API — не для системных (is_predefined) полей AMO.
+  if (!amoField.is_predefined && !!amoField.is_api_only !== !!kommoField.is_api_only) {
+    diffs.push('is_api_only');
+  }
+
+  // Enum-поля (select/multiselect/radiobutton): проверяем что все AMO-значения
+  // семантически присутствуют в Kommo (с кросс-языковым сравнением).
+  // Если в AMO есть значения без семантического эквивалента в Kommo → partial.
+  if (ENUM_TYPES.includes(amoField.type)) {
+    const kInfo = enumInfo(kommoField);
+    const missingInKommo = (amoField.enums || []).filter(
+      e => e.value && !enumValueSemanticMatch(e.value, kInfo)
+    );
+    if (missingInKommo.length > 0) {
+      return {
+        status: 'partial',
+        differences: ['enums'],
+        missingEnums: missingInKommo,
+        missingCount: missingInKommo.length,
+      };
+    }
+    // Все AMO-значения есть в Kommo — enums не является различием
+  }
+
+  // Вложенные списки (chained_lists): аналогично — ищем значения AMO, которых нет в Kommo
+  if (amoField.type === 'chained_lists') {
+    const aItems = amoField.nested_values || amoField.enums || amoField.values || [];
+    const kItems = kommoField.nested_values || kommoField.enums || kommoField.values || [];
+    const kTop = new Map();
+    for (const kv of kItems) if (!kTop.has(chainedName(kv))) kTop.set(chainedName(kv), kv);
+    const missingTop = aItems.filter(v => {
+      const nm = chainedName(v);
+      return nm && !kTop.has(nm);
+    });
+    // Проверяем вложенные уровни для совпадающих вершин
+    let missingNested = 0;
+    aItems.forEach(av => {
+      const kv = kTop.get(chainedName(av));
+      if (kv) {
+        const kNestedSet = new Set((kv.nested || []).map(chainedName));
+        missingNested += (av.nested || []).filter(n => {
+          const nm = chainedName(n);
+          return nm && !kNestedSet.has(nm);
+        }).length;
+      }
+    });
+    if (missingTop.length > 0 || missingNested > 0) {
+      return {
+        status: 'partial',
+        differences: ['nested'],
+        missingEnums: missingTop,
+        missingCount: missingTop.length + missingNested,
+      };
+    }
+  }
+
+  // exactMatch: true — значит поля полностью идентичны.
+  // Финальный статус 'synced' определяется не здесь, а в fields-analysis
+  // (только если поле уже подтверждено/создано через маппинг).
+  if (diffs.length === 0) return { status: 'matched', differences: [], exactMatch: true };
+  return { status: 'matched', differences: diffs };
+}
+
+// ─── Индекс полей Kommo одной сущности ───────────────────────────────────────
+/**
+ * Индекс для двухпроходного матчинга: по code, по имени, по id
+ * и обратный индекс кластер → тип → поля (в исходном порядке Kommo).
+ * @param {Array} kommoFields
+ */
+function buildKommoFieldIndex(kommoFields) {
+  const byCode = new Map();
+  const byName = new Map();
+  const byId = new Map();
+  const byCluster = new Map(); // cluster → Map<type, [{ field, pos, penalizable }]>
+  kommoFields.forEach((f, pos) => {
+    if (f.code) byCode.set(f.code.toUpperCase(), f);
+    byName.set((f.name || '').toLowerCase().trim(), f);
+    byId.set(f.id, f);
+    const { cluster, penalizable } = nameInfo(f);
+    if (cluster < 0) return;
+    let byType = byCluster.get(cluster);
+    if (!byType) { byType = new Map(); byCluster.set(cluster, byType); }
+    const list = byType.get(f.type);
+    const entry = { field: f, pos, penalizable };
+    if (list) list.push(entry); else byType.set(f.type, [entry]);
+  });
+  return { byCode, byName, byId, byCluster };
+}
+
+/**
+ * findCrossLangMatch — строгий кросс-языковой матчинг.
+ * Возвращает { field, via: 'translation', score } или null.
+ *
+ * ПРАВИЛА (чтобы не было ложных совпадений):
+ * 1. Оба поля должны попасть в один и тот же кластер FIELD_ALIASES
+ * 2. Оба поля должны иметь совместимые типы
+ * 3. Матчинг — только через точное совпадение токена или полного имени с alias
+ * 4. Kommo-поля из usedIds (уже занятые) пропускаются
+ *
+ * Порог: score >= 80 (чтобы отсечь совпадения вида "источник" vs все поля с токеном "source")
+ * Если у поля несколько токенов и только часть из них совпадает с кластером — штраф.
+ * При равном score побеждает поле, стоящее раньше в списке Kommo.
+ *
+ * @param {object} amoField
+ * @param {object} index - buildKommoFieldIndex()
+ * @param {Set} [usedIds] - занятые Kommo id
+ */
+function findCrossLangMatch(amoField, index, usedIds = new Set()) {
+  const amo = nameInfo(amoField);
+  if (amo.cluster < 0) return null;
+  const byType = index.byCluster.get(amo.cluster);
+  if (!byType) return null;
+
+  const compatTypes = TYPE_COMPAT[amoField.type] || [amoField.type];
+  let best = null;
+  let bestPos = Infinity;
+
+  for (const type of new Set(compatTypes)) {
+    for (const { field: kf, pos, penalizable } of (byType.get(type) || [])) {
+      if (usedIds.has(kf.id)) continue;
+
+      // Базовый score = 100 при совпадении кластера
+      let score = 100;
+      // Бонус за точное совпадение типа (важен при нескольких кандидатах в кластере)
+      const exactType = kf.type === amoField.type;
+      if (exactType) score += 30;
+      // Штраф если поле длинное (>2 токенов), но только один из них попал в кластер.
+      // Применяем ТОЛЬКО если тип не совпадает точно (чтобы не штрафовать верные пары)
+      // -25 (не -20) чтобы итоговый score 75 < 80 отсекал ложные совпадения вида
+      // "Комментарий" (1 токен) → "Комментарий для отложенных" (3 токена, 1 в кластере)
+      if (!exactType && amo.penalizable) score -= 25;
+      if (!exactType && penalizable) score -= 25;
+
+      if (score < 80) continue;
+      if (!best || score > best.score || (score === best.score && pos < bestPos)) {
+        best = { field: kf, via: 'translation', score };
+        bestPos = pos;
+      }
+    }
+  }
+  return best;
+}
+
+module.exports = {
+  ENUM_TYPES,
+  AMO_KOMMO_GROUP_NAME_MAP,
+  normalizeTokens,
+  compareFields,
+  buildKommoFieldIndex,
+  findCrossLangMatch,
+};
@@ -0,0 +1,221 @@
+/**
+ * metrics.js
+ * In-process metrics for tuning batch size / concurrency, exposed in Prometheus text
+ * format by GET /api/metrics and summarised per batch in batchState.metrics.
+ *
+ *  - crm_request_duration_seconds{crm,method,endpoint,status} — every CRM API request
+ *    (recorded by the rate limiter; numeric path segments are folded into :id)
+ *  - crm_throttle_wait_seconds_total{crm,cause} — time spent waiting for a scheduler slot
+ *    (queue) or sleeping on Retry-After / 5xx backoff before a retry
+ *  - crm_retries_total{crm,reason} — retried requests: 429 | 5xx | network
+ *  - migration_phase_duration_seconds{run,phase} — phase spans of batch / single runs
+ */
+'use strict';
+
+const HTTP_BUCKETS  = [0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30];
+const PHASE_BUCKETS = [0.1, 0.5, 1, 5, 15, 60, 300, 900, 3600];
+
+const registry = [];
+
+function labelKey(names, labels) {
+  return names.map(n => String(labels[n] ?? '')).join('\u0000');
+}
+
+function fmtLabels(names, labels, extra = '') {
+  const parts = names.map(n => `${n}="${String(labels[n] ?? '').replace(/\\/g, '\\\\').replace(/"/g, '\\"')}"`);
+  if (extra) parts.push(extra);
+  return parts.length ? `{${parts.join(',')}}` : '';
+}
+
+function counter(name, help, labelNames) {
+  const series = new Map(); // labelKey → { labels, value }
+  const metric = {
+    inc(labels, v = 1) {
+      const key = labelKey(labelNames, labels);
+      let s = series.get(key);
+      if (!s) series.set(key, (s = { labels, value: 0 }));
+      s.value += v;
+    },
+    render() {
+      const out = [`# HELP ${name} ${help}`, `# TYPE ${name} counter`];
+      for (const s of series.values()) out.push(`${name}${fmtLabels(labelNames, s.labels)} ${s.value}`);
+      return out;
+    },
+  };
+  registry.push(metric);
+  return metric;
+}
+
+function histogram(name, help, labelNames, buckets) {
+  const series = new Map(); // labelKey → { labels, counts[], sum, count }
+  const metric = {
+    observe(labels, v) {
+      const key = labelKey(labelNames, labels);
+      let s = series.get(key);
+      if (!s) series.set(key, (s = { labels, counts: new Array(buckets.length).fill(0), sum: 0, count: 0 }));
+      for (let i = 0; i < buckets.length; i++) if (v <= buckets[i]) s.counts[i]++;
+      s.sum += v;
+      s.count++;
+    },
+    render() {
+      const out = [`# HELP ${name} ${help}`, `# TYPE ${name} histogram`];
+      for (const s of series.values()) {
+        buckets.forEach((b, i) => out.push(`${name}_bucket${fmtLabels(labelNames, s.labels, `le="${b}"`)} ${s.counts[i]}`));
+        out.push(`${name}_bucket${fmtLabels(labelNames, s.labels, 'le="+Inf"')} ${s.count}`);
+        out.push(`${name}_sum${fmtLabels(labelNames, s.labels)} ${s.sum}`);
+        out.push(`${name}_count${fmtLabels(labelNames, s.labels)} ${s.count}`);
+      }
+      return out;
+    },
+  };
+  registry.push(metric);
+  return metric;
+}
+
+const requestDuration = histogram('crm_request_duration_seconds', 'CRM API request latency', ['crm', 'method', 'endpoint', 'status'], HTTP_BUCKETS);
+const throttleWait    = counter('crm_throttle_wait_seconds_total', 'Time CRM requests waited for the rate limiter or before a retry', ['crm', 'cause']);
+const retries         = counter('crm_retries_total', 'Retried CRM requests', ['crm', 'reason']);
+const phaseDuration   = histogram('migration_phase_duration_seconds', 'Wall time of migration phases', ['run', 'phase'], PHASE_BUCKETS);
+
+// Plain running totals per CRM — per-run summaries are differences of two snapshots
+const totals = {};
+function totalsOf(crm) {
+  if (!totals[crm]) totals[crm] = { requests: 0, errors: 0, requestMs: 0, waitMs: 0, retries: { 429: 0, '5xx': 0, network: 0 } };
+  return totals[crm];
+}
+
+/** '/api/v4/leads/123/notes?x=1' | 'https://host/api/v4/tasks' → '/leads/:id/notes' | '/tasks' */
+function endpointOf(url, baseURL) {
+  const full = `${baseURL || ''}${url || ''}`.split('?')[0];
+  const at = full.indexOf('/api/v4');
+  const p = at >= 0 ? full.slice(at + 7) : full.replace(/^https?:\/\/[^/]+/, '');
+  return p.replace(/\/\d+(?=\/|$)/g, '/:id') || '/';
+}
+
+/**
+ * One finished CRM request.
+ * @param {string} crm - 'AMO' | 'Kommo'
+ * @param {object} cfg - axios request config (method, url, baseURL)
+ * @param {number|string} status - HTTP status or 'error' (no response)
+ * @param {number} ms
+ */
+function observeRequest(crm, cfg, status, ms) {
+  requestDuration.observe({
+    crm,
+    method: (cfg?.method || 'get').toUpperCase(),
+    endpoint: endpointOf(cfg?.url, cfg?.baseURL),
+    status,
+  }, ms / 1000);
+  const t = totalsOf(crm);
+  t.requests++;
+  t.requestMs += ms;
+  if (status === 'error' || status >= 400) t.errors++;
+}
+
+/** @param {'queue'|'retry_after'|'backoff'} cause */
+function addThrottleWait(crm, cause, ms) {
+  if (ms <= 0) return;
+  throttleWait.inc({ crm, cause }, ms / 1000);
+  totalsOf(crm).waitMs += ms;
+}
+
+/** @param {'429'|'5xx'|'network'} reason */
+function countRetry(crm, reason) {
+  retries.inc({ crm, reason });
+  totalsOf(crm).retries[reason]++;
+}
+
+function snapshotTotals() {
+  return JSON.parse(JSON.stringify(totals));
+}
+
+function diffTotals(before) {
+  const out = {};
+  for (const [crm, t] of Object.entries(totals)) {
+    const b = before[crm] || { requests: 0, errors: 0, requestMs: 0, waitMs: 0, retries: {} };
+    out[crm] = {
+      requests: t.requests - b.requests,
+      errors: t.errors - b.errors,
+      requestMs: Math.round(t.requestMs - b.requestMs),
+      throttleWaitMs: Math.round(t.waitMs - b.waitMs),
+      retries: Object.fromEntries(Object.entries(t.retries).map(([k, v]) => [k, v - (b.retries[k] || 0)])),
+    };
+  }
+  return out;
+}
+
+/**
+ * Span tracker for one run (a batch, a single-deals transfer, ...).
+ * Phase times are wall clock and may overlap (concurrent stages, transform inside a
+ * phase); CRM counters cover everything the process did while the run was active.
+ * @param {string} kind - 'batch' | 'single'
+ */
+function startRun(kind) {
+  const startedAt = new Date().toISOString();
+  const started = Date.now();
+  const before = snapshotTotals();
+  const phases = {};
+  const open = new Set();
+
+  /** Start a span; returns end(). Spans of the same name add up. */
+  function phase(name) {
+    const t0 = Date.now();
+    let ended = false;
+    const end = () => {
+      if (ended) return;
+      ended = true;
+      open.delete(end);
+      const ms = Date.now() - t0;
+      phases[name] = (phases[name] || 0) + ms;
+      phaseDuration.observe({ run: kind, phase: name }, ms / 1000);
+    };
+    open.add(end);
+    return end;
+  }
+
+  /** Time fn() (sync or async) as a span. */
+  function measure(name, fn) {
+    const end = phase(name);
+    let res;
+    try {
+      res = fn();
+    } catch (e) {
+      end();
+      throw e;
+    }
+    if (res && typeof res.then === 'function') return res.finally(end);
+    end();
+    return res;
+  }
+
+  /** Close open spans and return the run summary. */
+  function finish() {
+    for (const end of [...open]) end();
+    return { kind, startedAt, wallMs: Date.now() - started, phases: { ...phases }, crm: diffTotals(before) };
+  }
+
+  return { phase, measure, finish };
+}
+
+// Live scheduler state as gauges (required lazily — rateLimiter requires this module)
+const LIMITER_GAUGES = [
+  ['crm_limiter_queued', 'Requests waiting for a scheduler slot', 'queued'],
+  ['crm_limiter_in_flight', 'Requests in flight', 'inFlight'],
+  ['crm_limiter_rate', 'Current adaptive rate limit, req/s', 'rateLimit'],
+];
+
+function renderLimiterGauges() {
+  const stats = Object.values(require('./rateLimiter').getRateLimiterStats());
+  return LIMITER_GAUGES.flatMap(([name, help, field]) => [
+    `# HELP ${name} ${help}`,
+    `# TYPE ${name} gauge`,
+    ...stats.map(s => `${name}${fmtLabels(['crm'], { crm: s.name })} ${s[field]}`),
+  ]);
+}
+
+/** Prometheus text exposition of every metric. */
+function render() {
+  return [...registry.flatMap(m => m.render()), ...renderLimiterGauges()].join('\n') + '\n';
+}
+
+module.exports = { observeRequest, addThrottleWait, countRetry, startRun, render };
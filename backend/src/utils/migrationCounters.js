@@ -0,0 +1,212 @@
+/**
+ * migrationCounters.js
+ * Materialized dashboard counters — stats endpoints read them in O(1) instead of
+ * rescanning the AMO snapshot and the migration index on every poll.
+ *
+ *  - snapshot counts (incl. transferable notes) and pending counts are computed once
+ *    per snapshot version (full fetch / delta / filter) and kept in memory
+ *  - pending is then maintained by safetyGuard: every pair added to / removed from
+ *    the migration index moves the counter of its section by the number of those
+ *    AMO ids that are in the snapshot (one indexed COUNT per batch)
+ *  - the "this session" baseline (batch-reset) is stored in the same file
+ *  - everything is persisted to migration_counters.json, debounced; index counts are
+ *    saved with it, so counters left stale by a crash are recomputed on load
+ */
+'use strict';
+
+const fs     = require('fs-extra');
+const path   = require('path');
+const config = require('../config');
+const db     = require('../db');
+const logger = require('./logger');
+
+const COUNTERS_FILE   = path.resolve(config.backupDir, 'migration_counters.json');
+const BASELINE_LEGACY = path.resolve(config.backupDir, 'session_baseline.json');
+const FLUSH_MS = 1000;
+
+// Note types excluded from dashboard counts (not transferable via API)
+const SKIP_NOTE_TYPES = [10, 11, 'amomail_message', 'extended_service_message', 'lead_auto_created', 'attachment', 'link_followed'];
+const NOTE_FILTER = { excludeNoteTypes: SKIP_NOTE_TYPES };
+
+// Dashboard key → snapshot entity type, migration index section, row filter
+const KEYS = {
+  leads:        { type: 'leads',        section: 'leads' },
+  contacts:     { type: 'contacts',     section: 'contacts' },
+  companies:    { type: 'companies',    section: 'companies' },
+  leadTasks:    { type: 'leadTasks',    section: 'tasks_leads' },
+  contactTasks: { type: 'contactTasks', section: 'tasks_contacts' },
+  companyTasks: { type: 'companyTasks', section: 'tasks_companies' },
+  leadNotes:    { type: 'leadNotes',    section: 'notes_leads',    filter: NOTE_FILTER },
+  contactNotes: { type: 'contactNotes', section: 'notes_contacts', filter: NOTE_FILTER },
+};
+const BY_SECTION = new Map(Object.entries(KEYS).map(([key, k]) => [k.section, key]));
+
+let safety = null;
+function getSafety() {
+  if (!safety) safety = require('./safetyGuard');
+  return safety;
+}
+
+// { version, cache, pending, indexCounts, eligible, baseline }
+let state = null;
+let dirty = false;    // snapshot changed outside meta (e.g. notes refreshed) — recompute on next read
+let flushTimer = null;
+
+function zeros() {
+  return Object.fromEntries(Object.keys(KEYS).map(key => [key, 0]));
+}
+
+function load() {
+  if (state) return state;
+  state = { version: null, cache: null, pending: null, indexCounts: null, eligible: null, baseline: zeros() };
+  try {
+    if (fs.existsSync(COUNTERS_FILE)) {
+      state = { ...state, ...fs.readJsonSync(COUNTERS_FILE) };
+    } else if (fs.existsSync(BASELINE_LEGACY)) {
+      state.baseline = { ...state.baseline, ...fs.readJsonSync(BASELINE_LEGACY) };
+    }
+  } catch (e) {
+    logger.warn('[counters] Cannot read migration counters:', e.message);
+  }
+  return state;
+}
+
+function flush() {
+  if (flushTimer) { clearTimeout(flushTimer); flushTimer = null; }
+  if (!state) return;
+  try {
+    fs.ensureDirSync(path.dirname(COUNTERS_FILE));
+    fs.writeJsonSync(COUNTERS_FILE, state);
+  } catch (e) {
+    logger.warn('[counters] Cannot save migration counters:', e.message);
+  }
+}
+
+function scheduleFlush() {
+  if (flushTimer) return;
+  flushTimer = setTimeout(flush, FLUSH_MS);
+  if (flushTimer.unref) flushTimer.unref();
+}
+
+process.on('exit', flush);
+
+function snapshotVersion(meta) {
+  return JSON.stringify([meta.fetchedAt || null, meta.filteredAt || null, meta.counts || null]);
+}
+
+function sameCounts(a, b) {
+  if (!a || !b) return false;
+  for (const { section } of Object.values(KEYS)) if ((a[section] || 0) !== (b[section] || 0)) return false;
+  return true;
+}
+
+/** Full recount — once per snapshot version, or when the index changed behind our back. */
+function recompute(meta) {
+  const s = load();
+  const guard = getSafety();
+  const c = meta.counts || {};
+  const cache = {};
+  const pending = {};
+  for (const [key, { type, section, filter }] of Object.entries(KEYS)) {
+    cache[key] = filter ? db.countAmoEntities(type, filter) : (c[type] || 0);
+    pending[key] = db.listAmoEntityIds(type, filter).filter(id => !guard.isMigrated(section, id)).length;
+  }
+  s.version = snapshotVersion(meta);
+  s.cache = cache;
+  s.pending = pending;
+  s.indexCounts = guard.getIndexCounts();
+  s.eligible = null;
+  dirty = false;
+  scheduleFlush();
+}
+
+/** Snapshot meta with counters brought up to date, or null if no snapshot is cached. */
+function ensureFresh() {
+  const meta = db.getAmoCacheMeta();
+  if (!meta) return null;
+  const s = load();
+  if (dirty || !s.cache || !s.pending || s.version !== snapshotVersion(meta) ||
+      !sameCounts(s.indexCounts, getSafety().getIndexCounts())) {
+    recompute(meta);
+  }
+  return meta;
+}
+
+/** The snapshot rows changed without a meta update (notes refreshed, …). */
+function invalidate() {
+  dirty = true;
+}
+
+/**
+ * Index hook (safetyGuard): pairs were added (delta = -1) or removed (delta = +1).
+ * @param {string} section - migration index section ('leads', 'tasks_leads', ...)
+ * @param {string[]} amoIds - AMO ids that actually entered / left the index
+ */
+function onIndexChange(section, amoIds, delta) {
+  const s = load();
+  if (amoIds.length === 0 || !s.pending || dirty) return;
+  const key = BY_SECTION.get(section);
+  if (key) {
+    const { type, filter } = KEYS[key];
+    const inSnapshot = db.countAmoEntities(type, { ...filter, ids: amoIds });
+    s.pending[key] = Math.max(0, s.pending[key] + delta * inSnapshot);
+  }
+  s.indexCounts = getSafety().getIndexCounts();
+  scheduleFlush();
+}
+
+// ─── Readers ──────────────────────────────────────────────────────────────────
+function getCacheStats() {
+  const meta = ensureFresh();
+  if (!meta) return null;
+  return { ...load().cache, fetchedAt: meta.fetchedAt || null };
+}
+
+function getPendingStats() {
+  if (!ensureFresh()) return null;
+  return { ...load().pending };
+}
+
+/** Index counts minus the session baseline — migrated since the last batch-reset. */
+function getMigrationTotals() {
+  const counts = getSafety().getIndexCounts();
+  const base = load().baseline;
+  const totals = {};
+  for (const [key, { section }] of Object.entries(KEYS)) {
+    totals[key] = Math.max(0, (counts[section] || 0) - (base[key] || 0));
+  }
+  return totals;
+}
+
+/** Snapshot leads of the given managers — counted once per snapshot version + manager set. */
+function getEligibleLeads(managerIds) {
+  if (!ensureFresh()) return 0;
+  const s = load();
+  const key = JSON.stringify((managerIds || []).map(Number).sort((a, b) => a - b));
+  if (!s.eligible || s.eligible.key !== key) {
+    s.eligible = { key, count: db.countAmoEntities('leads', { responsibleUserIds: managerIds }) };
+    scheduleFlush();
+  }
+  return s.eligible.count;
+}
+
+/** Snapshot current index counts as the new zero ("Сбросить счётчик"). */
+function saveBaseline() {
+  const counts = getSafety().getIndexCounts();
+  const s = load();
+  s.baseline = Object.fromEntries(Object.entries(KEYS).map(([key, { section }]) => [key, counts[section] || 0]));
+  flush();
+  return s.baseline;
+}
+
+module.exports = {
+  NOTE_FILTER,
+  invalidate,
+  onIndexChange,
+  getCacheStats,
+  getPendingStats,
+  getMigrationTotals,
+  getEligibleLeads,
+  saveBaseline,
+  flush,
+};
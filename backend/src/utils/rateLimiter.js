@@ -2,11 +2,22 @@
  * Rate limiter + retry with exponential backoff for CRM API calls.
  * AMO CRM: max 7 req/sec
  * Kommo CRM: max 7 req/sec
+ *
+ * One shared scheduler per CRM (getRateLimiter('AMO') / getRateLimiter('Kommo')):
+ * v1 clients (amoApi/kommoApi) attach it via axios interceptors, v2 clients call execute().
+ * Token bucket paces request starts; up to MAX_CONCURRENT requests may be in flight at once.
+ * On 429 the rate is halved and the bucket paused for Retry-After, then recovers on successes.
+ * Every request's latency, queue wait and retries are recorded in utils/metrics.
  */
 const logger = require('./logger');
+const metrics = require('./metrics');
 
-const MAX_RPS     = 7;
-const MIN_INTERVAL = Math.ceil(1000 / MAX_RPS); // ~143ms
+const MAX_RPS        = Number(process.env.CRM_MAX_RPS) || 7; // env override — offline benchmark only
+const MIN_RPS        = 1;
+const BURST          = 1;    // bucket capacity — AMO/Kommo count requests per rolling second
+const MAX_CONCURRENT = 4;    // requests in flight at once per CRM
+const RECOVERY_STEP  = 0.05; // +req/s per successful response after a 429
+const STATS_WINDOW   = 10000; // ms — window for achieved req/s
 const MAX_RETRIES  = 4;
 const BASE_DELAY   = 1000; // 1s
 
@@ -14,23 +25,112 @@ function sleep(ms) {
   return new Promise((resolve) => setTimeout(resolve, ms));
 }
 
+function parseRetryAfter(err, fallback) {
+  const raw = err?.response?.headers?.['retry-after'];
+  const sec = parseInt(raw || String(fallback), 10);
+  return Number.isFinite(sec) && sec > 0 ? sec : fallback;
+}
+
 /**
  * Creates a rate-limited, auto-retry axios wrapper for one CRM.
  * @param {string} name - 'AMO' or 'Kommo' for logging
+ * @param {object} [opts] - { maxRps, maxConcurrent, burst }
  */
-function createRateLimiter(name) {
-  let lastRequestTime = 0;
-  let queue = Promise.resolve();
-
-  async function throttle() {
-    await queue;
-    queue = queue.then(async () => {
-      const now = Date.now();
-      const wait = MIN_INTERVAL - (now - lastRequestTime);
-      if (wait > 0) await sleep(wait);
-      lastRequestTime = Date.now();
+function createRateLimiter(name, opts = {}) {
+  const maxRps        = opts.maxRps || MAX_RPS;
+  const maxConcurrent = opts.maxConcurrent || MAX_CONCURRENT;
+  const burst         = opts.burst || BURST;
+
+  let rate        = maxRps;
+  let tokens      = burst;
+  let lastRefill  = Date.now();
+  let pausedUntil = 0;
+  let inFlight    = 0;
+  let timer       = null;
+  const waiters   = [];
+  const starts    = []; // timestamps of request starts within STATS_WINDOW
+  const counters  = { started: 0, completed: 0, throttled: 0, failed: 0 };
+
+  function refill(now) {
+    tokens = Math.min(burst, tokens + ((now - lastRefill) / 1000) * rate);
+    lastRefill = now;
+  }
+
+  function pump() {
+    if (timer) return;
+    const now = Date.now();
+    refill(now);
+    while (waiters.length && inFlight < maxConcurrent && tokens >= 1 && now >= pausedUntil) {
+      tokens -= 1;
+      inFlight++;
+      counters.started++;
+      starts.push(now);
+      waiters.shift()(makeRelease());
+    }
+    if (!waiters.length || inFlight >= maxConcurrent) return;
+    // Wake up when the pause ends or the next token is ready
+    const waitToken = tokens >= 1 ? 0 : Math.ceil(((1 - tokens) / rate) * 1000);
+    const wait = Math.max(waitToken, pausedUntil - now, 1);
+    timer = setTimeout(() => { timer = null; pump(); }, wait);
+  }
+
+  function makeRelease() {
+    let released = false;
+    return () => {
+      if (released) return;
+      released = true;
+      inFlight--;
+      pump();
+    };
+  }
+
+  /**
+   * Wait for a token and a free in-flight slot.
+   * @returns {Promise<Function>} release() — must be called when the request finishes
+   */
+  function acquire() {
+    const queuedAt = Date.now();
+    return new Promise((resolve) => {
+      waiters.push((release) => {
+        metrics.addThrottleWait(name, 'queue', Date.now() - queuedAt);
+        resolve(release);
+      });
+      pump();
     });
-    await queue;
+  }
+
+  /** Feedback: successful response — slowly restore the rate after a 429. */
+  function onSuccess() {
+    counters.completed++;
+    if (rate < maxRps) rate = Math.min(maxRps, rate + RECOVERY_STEP);
+  }
+
+  /** Feedback: 429 — halve the rate and hold the bucket for Retry-After seconds. */
+  function onThrottled(retryAfterSec) {
+    counters.throttled++;
+    rate = Math.max(MIN_RPS, rate / 2);
+    tokens = 0;
+    pausedUntil = Math.max(pausedUntil, Date.now() + retryAfterSec * 1000);
+    logger.warn(`[${name}] rate reduced to ${rate.toFixed(2)} req/s, paused ${retryAfterSec}s`);
+  }
+
+  /** Run fn() in a scheduler slot (no retry). */
+  async function schedule(fn) {
+    const release = await acquire();
+    const t0 = Date.now();
+    try {
+      const res = await fn();
+      onSuccess();
+      metrics.observeRequest(name, res?.config, res?.status ?? 200, Date.now() - t0);
+      return res;
+    } catch (err) {
+      if (err.response?.status === 429) onThrottled(parseRetryAfter(err, 5));
+      else counters.failed++;
+      metrics.observeRequest(name, err.config, err.response?.status || 'error', Date.now() - t0);
+      throw err;
+    } finally {
+      release();
+    }
   }
 
   /**
@@ -41,19 +141,17 @@ function createRateLimiter(name) {
   async function execute(fn, label = '') {
     let attempt = 0;
     while (true) {
-      await throttle();
       try {
-        return await fn();
+        return await schedule(fn);
       } catch (err) {
         const status = err.response?.status;
         attempt++;
 
-        // 429 Too Many Requests — use Retry-After header if available
+        // 429 Too Many Requests — scheduler already paused for Retry-After, just re-queue
         if (status === 429) {
-          const retryAfter = parseInt(err.response?.headers?.['retry-after'] || '5', 10);
-          const delay = retryAfter * 1000;
+          const retryAfter = parseRetryAfter(err, 5);
           logger.warn(`[${name}] 429 rate limit${label ? ` (${label})` : ''}. Retry in ${retryAfter}s (attempt ${attempt})`);
-          await sleep(delay);
+          metrics.countRetry(name, '429');
           continue;
         }
 
@@ -61,6 +159,8 @@ function createRateLimiter(name) {
         if (status >= 500 && attempt <= MAX_RETRIES) {
           const delay = BASE_DELAY * Math.pow(2, attempt - 1);
           logger.warn(`[${name}] ${status} server error${label ? ` (${label})` : ''}. Retry in ${delay}ms (attempt ${attempt}/${MAX_RETRIES})`);
+          metrics.countRetry(name, '5xx');
+          metrics.addThrottleWait(name, 'backoff', delay);
           await sleep(delay);
           continue;
         }
@@ -69,6 +169,8 @@ function createRateLimiter(name) {
         if (!status && attempt <= MAX_RETRIES) {
           const delay = BASE_DELAY * Math.pow(2, attempt - 1);
           logger.warn(`[${name}] Network error ${err.code || err.message}${label ? ` (${label})` : ''}. Retry in ${delay}ms (attempt ${attempt}/${MAX_RETRIES})`);
+          metrics.countRetry(name, 'network');
+          metrics.addThrottleWait(name, 'backoff', delay);
           await sleep(delay);
           continue;
         }
@@ -80,7 +182,70 @@ function createRateLimiter(name) {
     }
   }
 
-  return { execute };
+  /**
+   * Route every request of an axios instance through this scheduler.
+   * Must be attached BEFORE the client's own 429-retry interceptor so the slot
+   * is released (and the rate adapted) before the retry re-enters the queue.
+   */
+  function attach(client) {
+    client.interceptors.request.use(async (cfg) => {
+      cfg.__release = await acquire();
+      cfg.__startedAt = Date.now();
+      return cfg;
+    });
+    client.interceptors.response.use((res) => {
+      if (res.config?.__release) res.config.__release();
+      onSuccess();
+      metrics.observeRequest(name, res.config, res.status, Date.now() - (res.config?.__startedAt || Date.now()));
+      return res;
+    }, (error) => {
+      const cfg = error.config;
+      if (cfg?.__release) cfg.__release();
+      if (error.response?.status === 429) onThrottled(parseRetryAfter(error, 2));
+      else counters.failed++;
+      if (cfg) metrics.observeRequest(name, cfg, error.response?.status || 'error', Date.now() - (cfg.__startedAt || Date.now()));
+      return Promise.reject(error);
+    });
+    return client;
+  }
+
+  function getStats() {
+    const now = Date.now();
+    while (starts.length && now - starts[0] > STATS_WINDOW) starts.shift();
+    return {
+      name,
+      queued: waiters.length,
+      inFlight,
+      maxConcurrent,
+      rateLimit: Math.round(rate * 100) / 100,
+      maxRps,
+      achievedRps: Math.round((starts.length / (STATS_WINDOW / 1000)) * 100) / 100,
+      pausedMs: Math.max(0, pausedUntil - now),
+      ...counters,
+    };
+  }
+
+  return { execute, schedule, acquire, attach, getStats };
+}
+
+// ─── Shared per-CRM schedulers ───────────────────────────────────────────────
+const limiters = new Map();
+
+/**
+ * Returns the process-wide scheduler for a CRM — v1 and v2 clients share it,
+ * so the 7 req/s budget is counted once per account.
+ * @param {string} name - 'AMO' or 'Kommo'
+ */
+function getRateLimiter(name) {
+  if (!limiters.has(name)) limiters.set(name, createRateLimiter(name));
+  return limiters.get(name);
+}
+
+/** Live queue depth / in-flight / achieved req/s for every CRM scheduler. */
+function getRateLimiterStats() {
+  const out = {};
+  for (const [name, limiter] of limiters) out[name] = limiter.getStats();
+  return out;
 }
 
-module.exports = { createRateLimiter };
+module.exports = { createRateLimiter, getRateLimiter, getRateLimiterStats };
@@ -28,8 +28,17 @@ try {
   config = { backupDir: path.resolve(__dirname, '../../backups') };
 }
 
+// Индекс хранится в SQLite (таблица migration_index, WAL); JSON — только для разового импорта
 const INDEX_FILE   = path.resolve(config.backupDir, 'migration_index.json');
-const BLOCKED_LOG  = path.resolve(config.backupDir, 'blocked_attempts.json');
+const BLOCKED_LOG  = path.resolve(config.backupDir, 'blocked_attempts.log');          // NDJSON, дописывается пачками
+const BLOCKED_SUMMARY = path.resolve(config.backupDir, 'blocked_attempts_summary.json'); // счётчики + последние записи
+const BLOCKED_LEGACY  = path.resolve(config.backupDir, 'blocked_attempts.json');
+
+const BLOCKED_RECENT_MAX  = 500;              // сколько последних записей держим в памяти / summary
+const BLOCKED_FLUSH_MS    = 1000;             // как часто сбрасываем буфер на диск
+const BLOCKED_FLUSH_BATCH = 200;              // или сразу, если накопилось столько записей
+const BLOCKED_ROTATE_SIZE = 5 * 1024 * 1024;  // ротация лога при 5 МБ
+const BLOCKED_ROTATE_KEEP = 3;                // blocked_attempts.log.1 … .3
 
 // ─── Ошибка безопасности ──────────────────────────────────────────────────────
 class SafetyError extends Error {
@@ -43,34 +52,202 @@ class SafetyError extends Error {
 }
 
 // ─── Индекс миграции (AMO id → Kommo id) ─────────────────────────────────────
-function loadIndex() {
+// Источник истины — таблица migration_index в SQLite: новые пары дописываются
+// транзакцией (без перезаписи всего файла). В памяти — Map на каждую сущность,
+// загружается один раз при первом обращении; проверки дублей — O(1).
+let db = null;
+let indexMaps = null; // Map<entity, Map<amoId, kommoId>>
+let reverseMaps = new Map(); // Map<entity, Map<kommoId, amoId[]>> — строится лениво для отката
+
+function getDb() {
+  if (!db) db = require('../db');
+  return db;
+}
+
+// Материализованные счётчики дашборда (pending) — сдвигаются при каждом изменении индекса
+let counters = null;
+function getCounters() {
+  if (!counters) counters = require('./migrationCounters');
+  return counters;
+}
+
+// Разовый импорт старого migration_index.json; файл переименовывается,
+// чтобы сброс индекса не откатывался повторным импортом после рестарта.
+function importLegacyIndexFile() {
+  if (!fs.existsSync(INDEX_FILE)) return;
   try {
-    if (fs.existsSync(INDEX_FILE)) return fs.readJsonSync(INDEX_FILE);
+    if (getDb().countIndexPairs() === 0) {
+      getDb().replaceIndex(fs.readJsonSync(INDEX_FILE));
+      logger.info('[safetyGuard] migration_index.json импортирован в SQLite');
+    }
+    fs.moveSync(INDEX_FILE, INDEX_FILE + '.imported', { overwrite: true });
   } catch (e) {
-    logger.warn('[safetyGuard] Cannot read migration index:', e.message);
+    logger.error('[safetyGuard] Cannot import migration index:', e.message);
   }
-  return { leads: {}, contacts: {}, companies: {} };
 }
 
+function getIndexMaps() {
+  if (indexMaps) return indexMaps;
+  importLegacyIndexFile();
+  const maps = new Map();
+  try {
+    for (const { entity, amo_id, kommo_id } of getDb().getIndexPairs()) {
+      if (!maps.has(entity)) maps.set(entity, new Map());
+      maps.get(entity).set(amo_id, kommo_id);
+    }
+  } catch (e) {
+    // Без индекса защита от дублей не работает — перенос останавливается
+    throw new SafetyError(`Индекс миграции недоступен: ${e.message}`, 'INDEX_UNAVAILABLE');
+  }
+  indexMaps = maps;
+  reverseMaps = new Map();
+  return indexMaps;
+}
+
+function entityMap(entity) {
+  const maps = indexMaps || getIndexMaps();
+  let m = maps.get(entity);
+  if (!m) { m = new Map(); maps.set(entity, m); }
+  return m;
+}
+
+/** Обратный индекс Kommo id → AMO id[] (откат); строится один раз на сущность. */
+function reverseMap(entity) {
+  let r = reverseMaps.get(entity);
+  if (r) return r;
+  r = new Map();
+  for (const [amoId, kommoId] of entityMap(entity)) {
+    const list = r.get(kommoId);
+    if (list) list.push(amoId); else r.set(kommoId, [amoId]);
+  }
+  reverseMaps.set(entity, r);
+  return r;
+}
+
+/** Kommo id для перенесённого объекта или null. */
+function getKommoId(entity, amoId) {
+  return entityMap(entity).get(String(amoId)) || null;
+}
+
+function isMigrated(entity, amoId) {
+  return entityMap(entity).has(String(amoId));
+}
+
+/** Количество пар по каждой секции индекса: { leads: n, contacts: n, tasks_leads: n, ... } */
+function getIndexCounts() {
+  const counts = {};
+  for (const [entity, m] of getIndexMaps()) counts[entity] = m.size;
+  return counts;
+}
+
+/**
+ * Снимок индекса в старом формате { entity: { amoId: kommoId } }.
+ * O(n) — для точечных проверок использовать getKommoId/isMigrated.
+ */
+function loadIndex() {
+  const idx = { leads: {}, contacts: {}, companies: {} };
+  for (const [entity, m] of getIndexMaps()) idx[entity] = Object.fromEntries(m);
+  return idx;
+}
+
+/** Полная замена индекса (сброс / восстановление). */
 function saveIndex(idx) {
   try {
-    fs.ensureDirSync(path.dirname(INDEX_FILE));
-    fs.writeJsonSync(INDEX_FILE, idx, { spaces: 2 });
+    getDb().replaceIndex(idx);
+    indexMaps = null;
+    reverseMaps = new Map();
   } catch (e) {
     logger.error('[safetyGuard] Cannot save migration index:', e.message);
   }
 }
 
 // ─── Лог заблокированных попыток ─────────────────────────────────────────────
-function logBlockedAttempt(entity, amoId, kommoId, reason) {
+// Записи копятся в памяти и дописываются на диск пачкой (не чаще раза в секунду),
+// лог ротируется по размеру. Статистика и последние записи — из памяти/summary,
+// без перечитывания лога.
+let blockedSummary = null; // { total, byEntity: {}, recent: [] }
+let blockedBuffer  = [];
+let blockedTimer   = null;
+let blockedFlushing = false;
+
+function getBlockedSummary() {
+  if (blockedSummary) return blockedSummary;
+  blockedSummary = { total: 0, byEntity: {}, recent: [] };
+  try {
+    if (fs.existsSync(BLOCKED_SUMMARY)) {
+      blockedSummary = { ...blockedSummary, ...fs.readJsonSync(BLOCKED_SUMMARY) };
+    } else if (fs.existsSync(BLOCKED_LEGACY)) {
+      // Старый формат: JSON-массив последних 500 записей
+      const list = fs.readJsonSync(BLOCKED_LEGACY);
+      blockedSummary.recent = list.slice(-BLOCKED_RECENT_MAX);
+      blockedSummary.total  = list.length;
+      for (const r of list) blockedSummary.byEntity[r.entity] = (blockedSummary.byEntity[r.entity] || 0) + 1;
+    }
+  } catch (e) {
+    logger.warn('[safetyGuard] Cannot read blocked attempts summary:', e.message);
+  }
+  return blockedSummary;
+}
+
+function rotateBlockedLog() {
   try {
-    fs.ensureDirSync(path.dirname(BLOCKED_LOG));
-    const list = fs.existsSync(BLOCKED_LOG) ? fs.readJsonSync(BLOCKED_LOG) : [];
-    list.push({ timestamp: new Date().toISOString(), entity, amoId, kommoId, reason });
-    // Ограничиваем 500 записями, удаляем самые старые
-    const trimmed = list.length > 500 ? list.slice(list.length - 500) : list;
-    fs.writeJsonSync(BLOCKED_LOG, trimmed, { spaces: 2 });
-  } catch {}
+    if (!fs.existsSync(BLOCKED_LOG) || fs.statSync(BLOCKED_LOG).size < BLOCKED_ROTATE_SIZE) return;
+    for (let i = BLOCKED_ROTATE_KEEP - 1; i >= 1; i--) {
+      const from = `${BLOCKED_LOG}.${i}`;
+      if (fs.existsSync(from)) fs.moveSync(from, `${BLOCKED_LOG}.${i + 1}`, { overwrite: true });
+    }
+    fs.moveSync(BLOCKED_LOG, `${BLOCKED_LOG}.1`, { overwrite: true });
+  } catch (e) {
+    logger.warn('[safetyGuard] Cannot rotate blocked attempts log:', e.message);
+  }
+}
+
+/** Сбросить буфер на диск одной записью. sync=true — при завершении процесса. */
+function flushBlockedAttempts(sync = false) {
+  if (blockedTimer) { clearTimeout(blockedTimer); blockedTimer = null; }
+  if (blockedBuffer.length === 0 || (blockedFlushing && !sync)) return Promise.resolve();
+  const batch = blockedBuffer;
+  blockedBuffer = [];
+  const lines = batch.map(r => JSON.stringify(r)).join('\n') + '\n';
+  const summary = JSON.stringify(getBlockedSummary());
+  try { fs.ensureDirSync(path.dirname(BLOCKED_LOG)); } catch {}
+  if (sync) {
+    try {
+      fs.appendFileSync(BLOCKED_LOG, lines);
+      fs.writeFileSync(BLOCKED_SUMMARY, summary);
+    } catch {}
+    return Promise.resolve();
+  }
+  blockedFlushing = true;
+  return fs.appendFile(BLOCKED_LOG, lines)
+    .then(() => fs.writeFile(BLOCKED_SUMMARY, summary))
+    .then(() => rotateBlockedLog())
+    .catch(e => logger.warn('[safetyGuard] Cannot write blocked attempts log:', e.message))
+    .finally(() => {
+      blockedFlushing = false;
+      if (blockedBuffer.length > 0) scheduleBlockedFlush();
+    });
+}
+
+function scheduleBlockedFlush() {
+  if (blockedBuffer.length >= BLOCKED_FLUSH_BATCH) { flushBlockedAttempts(); return; }
+  if (blockedTimer) return;
+  blockedTimer = setTimeout(() => { blockedTimer = null; flushBlockedAttempts(); }, BLOCKED_FLUSH_MS);
+  if (blockedTimer.unref) blockedTimer.unref();
+}
+
+process.on('exit', () => flushBlockedAttempts(true));
+
+function logBlockedAttempt(entity, amoId, kommoId, reason) {
+  const record = { timestamp: new Date().toISOString(), entity, amoId, kommoId, reason };
+  const summary = getBlockedSummary();
+  summary.total++;
+  summary.byEntity[entity] = (summary.byEntity[entity] || 0) + 1;
+  summary.recent.push(record);
+  // Ограничиваем 500 записями, удаляем самые старые
+  if (summary.recent.length > BLOCKED_RECENT_MAX) summary.recent.splice(0, summary.recent.length - BLOCKED_RECENT_MAX);
+  blockedBuffer.push(record);
+  scheduleBlockedFlush();
 }
 
 // ─── Регистрация успешно перенесённых объектов ────────────────────────────────
@@ -81,10 +258,7 @@ function logBlockedAttempt(entity, amoId, kommoId, reason) {
  * @param {number|string} kommoId
  */
 function registerMigrated(entity, amoId, kommoId) {
-  const idx = loadIndex();
-  if (!idx[entity]) idx[entity] = {};
-  idx[entity][String(amoId)] = String(kommoId);
-  saveIndex(idx);
+  registerMigratedBatch(entity, [{ amoId, kommoId }]);
 }
 
 /**
@@ -93,14 +267,69 @@ function registerMigrated(entity, amoId, kommoId) {
  * @param {Array<{amoId, kommoId}>} pairs
  */
 function registerMigratedBatch(entity, pairs) {
-  const idx = loadIndex();
-  if (!idx[entity]) idx[entity] = {};
-  for (const { amoId, kommoId } of pairs) {
-    if (amoId && kommoId) {
-      idx[entity][String(amoId)] = String(kommoId);
-    }
+  const valid = (pairs || []).filter(p => p && p.amoId && p.kommoId);
+  if (valid.length === 0) return;
+  const m = entityMap(entity);
+  try {
+    // Сначала на диск (транзакция), потом в память — после сбоя индекс не теряет пары
+    getDb().addIndexPairs(entity, valid);
+  } catch (e) {
+    // Пары только в памяти пропали бы при рестарте и сущности создались бы повторно —
+    // память не трогаем, перенос останавливается (isSafetyError у вызывающих)
+    logger.error('[safetyGuard] Cannot save migration index:', e.message);
+    throw new SafetyError(`Индекс миграции недоступен: ${e.message}`, 'INDEX_UNAVAILABLE', { entity, count: valid.length });
+  }
+  const r = reverseMaps.get(entity);
+  const added = [];
+  for (const { amoId, kommoId } of valid) {
+    const a = String(amoId), k = String(kommoId);
+    const prev = m.get(a);
+    m.set(a, k);
+    if (prev == null) added.push(a);
+    if (!r) continue;
+    if (prev != null && prev !== k) dropReverse(r, prev, a);
+    const list = r.get(k);
+    if (!list) r.set(k, [a]); else if (!list.includes(a)) list.push(a);
   }
-  saveIndex(idx);
+  try { getCounters().onIndexChange(entity, added, -1); } catch (e) {
+    logger.warn('[safetyGuard] Cannot update migration counters:', e.message);
+  }
+  for (const { amoId } of valid) releaseKey(`${entity}:${amoId}`);
+}
+
+function dropReverse(r, kommoId, amoId) {
+  const list = r.get(kommoId);
+  if (!list) return;
+  const rest = list.filter(x => x !== amoId);
+  if (rest.length) r.set(kommoId, rest); else r.delete(kommoId);
+}
+
+/**
+ * Удалить пары из индекса (откат пакета).
+ * @param {string} entity
+ * @param {Array<number|string>} kommoIds — Kommo id удалённых объектов
+ * @returns {number} сколько пар удалено
+ */
+function unregisterByKommoIds(entity, kommoIds) {
+  const m = entityMap(entity);
+  const r = reverseMap(entity);
+  const amoIds = [];
+  for (const kommoId of kommoIds || []) {
+    const list = r.get(String(kommoId));
+    if (list) amoIds.push(...list);
+  }
+  if (amoIds.length === 0) return 0;
+  getDb().removeIndexPairs(entity, amoIds);
+  const removed = [];
+  for (const a of amoIds) {
+    const k = m.get(a);
+    m.delete(a);
+    if (k != null) { dropReverse(r, k, a); removed.push(a); }
+  }
+  try { getCounters().onIndexChange(entity, removed, 1); } catch (e) {
+    logger.warn('[safetyGuard] Cannot update migration counters:', e.message);
+  }
+  return amoIds.length;
 }
 
 // ─── Фильтрация уже перенесённых объектов ────────────────────────────────────
@@ -112,14 +341,13 @@ function registerMigratedBatch(entity, pairs) {
  * @returns {{ toCreate: Array, skipped: Array<{item, kommoId, reason}> }}
  */
 function filterNotMigrated(entity, items, getAmoId) {
-  const idx = loadIndex();
-  const entityIdx = idx[entity] || {};
+  const entityIdx = entityMap(entity);
   const toCreate  = [];
   const skipped   = [];
 
   for (const item of items) {
     const amoId  = String(getAmoId(item));
-    const kommoId = entityIdx[amoId];
+    const kommoId = entityIdx.get(amoId);
     if (kommoId) {
       const reason = `${entity} AMO#${amoId} уже перенесён → Kommo#${kommoId}`;
       skipped.push({ item, amoId, kommoId, reason });
@@ -136,6 +364,54 @@ function filterNotMigrated(entity, items, getAmoId) {
   return { toCreate, skipped };
 }
 
+// ─── Захват объектов параллельными заданиями ─────────────────────────────────
+// Несколько пакетных заданий (migrationJobs) работают в одном процессе. Общий контакт
+// или компания двух менеджеров не должны создаваться дважды: перед filterNotMigrated
+// задание захватывает AMO id раздела, второе задание ждёт, пока первое не
+// зарегистрирует пары (registerMigratedBatch снимает захват) или не отпустит их,
+// и затем видит объект уже перенесённым — связывает, а не создаёт.
+const claims = new Map(); // `${entity}:${amoId}` → { owner, entity, done: Promise, resolve }
+
+function releaseKey(key) {
+  const c = claims.get(key);
+  if (!c) return;
+  claims.delete(key);
+  c.resolve();
+}
+
+/**
+ * Захватить AMO id раздела индекса. Ждёт, пока чужие захваты этих id не будут сняты;
+ * повторный захват тем же владельцем не блокирует.
+ * @param {string} entity — раздел индекса ('contacts', 'tasks_leads', ...)
+ * @param {Array<number|string>} amoIds
+ * @param {string} owner — id задания
+ */
+async function claimIds(entity, amoIds, owner) {
+  const keys = [...new Set((amoIds || []).map(id => `${entity}:${id}`))];
+  for (;;) {
+    const busy = keys.map(k => claims.get(k)).filter(c => c && c.owner !== owner);
+    if (busy.length === 0) break;
+    await Promise.all(busy.map(c => c.done));
+  }
+  for (const key of keys) {
+    if (claims.has(key)) continue;
+    let resolve;
+    const done = new Promise(r => { resolve = r; });
+    claims.set(key, { owner, entity, done, resolve });
+  }
+}
+
+/**
+ * Снять захваты владельца (объекты, которые не удалось создать, этап / пакет закончен).
+ * @param {string} owner
+ * @param {string} [entity] — только этот раздел
+ */
+function releaseClaims(owner, entity) {
+  for (const [key, c] of [...claims]) {
+    if (c.owner === owner && (!entity || c.entity === entity)) releaseKey(key);
+  }
+}
+
 // ─── Защита enum-значений: только аддитивное добавление ──────────────────────
 /**
  * Вернуть только те значения из newEnums, которых ещё нет в существующих enums Kommo.
@@ -242,28 +518,22 @@ function validateRollbackIds(entity, idsToDelete, createdIds) {
 
 // ─── Статистика ───────────────────────────────────────────────────────────────
 function getSafetyStats() {
-  const idx = loadIndex();
-  let blockedAttempts = 0;
-  try {
-    const list = fs.existsSync(BLOCKED_LOG) ? fs.readJsonSync(BLOCKED_LOG) : [];
-    blockedAttempts = list.length;
-  } catch {}
+  const counts = getIndexCounts();
+  const blocked = getBlockedSummary();
 
   return {
-    migratedLeads:     Object.keys(idx.leads    || {}).length,
-    migratedContacts:  Object.keys(idx.contacts || {}).length,
-    migratedCompanies: Object.keys(idx.companies|| {}).length,
-    blockedAttempts,
-    indexFile:   INDEX_FILE,
+    migratedLeads:     counts.leads     || 0,
+    migratedContacts:  counts.contacts  || 0,
+    migratedCompanies: counts.companies || 0,
+    blockedAttempts:         blocked.total,
+    blockedAttemptsByEntity: { ...blocked.byEntity },
+    indexFile:   'migration.db (migration_index)',
     blockedFile: BLOCKED_LOG,
   };
 }
 
 function getBlockedAttempts(limit = 50) {
-  try {
-    const list = fs.existsSync(BLOCKED_LOG) ? fs.readJsonSync(BLOCKED_LOG) : [];
-    return list.slice(-limit).reverse();
-  } catch { return []; }
+  return getBlockedSummary().recent.slice(-limit).reverse();
 }
 
 /**
@@ -282,8 +552,16 @@ module.exports = {
   // Регистрация
   registerMigrated,
   registerMigratedBatch,
+  unregisterByKommoIds,
+  // Индекс
+  getKommoId,
+  isMigrated,
+  getIndexCounts,
   // Фильтрация
   filterNotMigrated,
+  // Захват параллельными заданиями
+  claimIds,
+  releaseClaims,
   // Enum protection
   prepareAdditiveEnumPatch,
   // Блокировки
@@ -293,6 +571,7 @@ module.exports = {
   // Статистика
   getSafetyStats,
   getBlockedAttempts,
+  flushBlockedAttempts,
   resetIndex,
   loadIndex,
 };
@@ -1,5 +1,6 @@
 import { useState, useEffect, useCallback, useRef } from 'react';
 import * as api from './api';
+import { subscribeProgress } from './progressStream';
 import { getCopyTotals, createBackupNow } from './api';
 import './App.css';
 import FieldSync from './FieldSync';
@@ -80,7 +81,7 @@ export default function App() {
   });
   const [migrationMode, setMigrationMode] = useState(() =>
     localStorage.getItem('migration_mode') || 'all'
-  ); // 'all' | 'fix-existing' | 'new-only'
+  ); // 'all' | 'fix-existing' | 'fix-changed' | 'new-only'
   const [batchLoading, setBatchLoading] = useState(false);
   // Crash detection: if server restarts while running, status goes idle without completing
   const prevBatchStatusRef = useRef(null);
@@ -276,17 +277,17 @@ export default function App() {
     }
   }, [fetchSt?.status]);
 
-  // Auto-poll while amo data is loading
-  useEffect(() => {
-    if (fetchSt?.status !== 'loading') return;
-    const iv = setInterval(() => {
-      api.getAmoFetchStatus().then(s => {
-        setFetchSt(s);
-        if (s.status !== 'loading') clearInterval(iv);
-      }).catch(() => {});
-    }, 1500);
-    return () => clearInterval(iv);
-  }, [fetchSt?.status]);
+  // Live batch / fetch state pushed by the server (replaces polling of batch-status / fetch-status)
+  useEffect(() => subscribeProgress((channel, state) => {
+    if (channel === 'fetch') {
+      setFetchSt(state);
+      return;
+    }
+    // Server confirmed the continue signal of the auto-run countdown
+    if (['running', 'idle', 'completed', 'error'].includes(state.status)) continueSignalSentRef.current = false;
+    // batch-status adds file-based stats (cacheStats, migrationTotals...) on top of batchState
+    setBatchStatusData(prev => ({ ...(prev || {}), ...state }));
+  }), []);
 
   // Auto-refresh when running
   useEffect(() => {
@@ -297,102 +298,71 @@ export default function App() {
     }
   }, [status?.status]);
 
-  // Poll batch status (only when running/rolling_back) + pure client countdown (auto-waiting)
+  // Auto-waiting: pure client-side countdown 60→0, then signal server
   useEffect(() => {
-    const st = batchStatus?.status;
-    if (st !== 'running' && st !== 'rolling_back' && st !== 'auto-waiting') return;
-
-    // ── auto-waiting: pure client-side countdown 60→0, then signal server ──
-    if (st === 'auto-waiting') {
-      // If continue was already sent, skip countdown — wait for server to switch to 'running'
-      if (continueSignalSentRef.current) {
-        let polling = true;
-        const waitForRunning = async () => {
-          while (polling) {
-            try {
-              const d = await api.getBatchStatus();
-              if (!polling) break;
-              setBatchStatusData(d);
-              if (d.status === 'running' || d.status === 'idle' || d.status === 'completed' || d.status === 'error') {
-                continueSignalSentRef.current = false;
-                break;
-              }
-            } catch {}
-            await new Promise(r => setTimeout(r, 1000));
-          }
-        };
-        waitForRunning();
-        return () => { polling = false; };
-      }
-      let cancelled = false;
-      const countdownTimer = setInterval(() => {
-        if (cancelled) return;
-        setBatchStatusData(prev => {
-          if (!prev || prev.status !== 'auto-waiting') return prev;
-          const next = (prev.autoRunCountdown || 60) - 1;
-          if (next <= 0) {
-            // Countdown done — tell server to start next batch
-            continueSignalSentRef.current = true;
-            api.continueAutoRun().then(() => {
-              // After continue, fetch fresh status to transition to 'running'
-              api.getBatchStatus().then(d => {
-                if (!cancelled) setBatchStatusData(d);
-              }).catch(() => {});
+    if (batchStatus?.status !== 'auto-waiting') return;
+    // If continue was already sent, skip countdown — the stream brings 'running'
+    if (continueSignalSentRef.current) return;
+    let cancelled = false;
+    const countdownTimer = setInterval(() => {
+      if (cancelled) return;
+      setBatchStatusData(prev => {
+        if (!prev || prev.status !== 'auto-waiting') return prev;
+        const next = (prev.autoRunCountdown || 60) - 1;
+        if (next <= 0) {
+          // Countdown done — tell server to start next batch
+          continueSignalSentRef.current = true;
+          api.continueAutoRun().then(() => {
+            // After continue, fetch fresh status to transition to 'running'
+            api.getBatchStatus().then(d => {
+              if (!cancelled) setBatchStatusData(d);
             }).catch(() => {});
-            return { ...prev, autoRunCountdown: 0, status: 'running', step: '🔄 Запуск следующего пакета...' };
-          }
-          return { ...prev, autoRunCountdown: next };
-        });
-      }, 1000);
-      return () => { cancelled = true; clearInterval(countdownTimer); };
-    }
-
-    // ── running/rolling_back: poll server for progress ──
-    let polling = true;
-    const poll = async () => {
-      while (polling) {
-        try {
-          const d = await api.getBatchStatus();
-          if (!polling) break;
-          if (prevBatchStatusRef.current === 'running' && d.status === 'idle') {
-            setCrashDetected(true);
-          }
-          prevBatchStatusRef.current = d.status;
-          // Auto-dismiss crash banner when normal operation resumes
-          if (d.status === 'running' || d.status === 'auto-waiting') {
-            setCrashDetected(false);
-          }
-          // Sync counters instantly from embedded stats
-          if (d.stats) {
-            setBatchStats(prev => ({
-              ...(prev || {}),
-              ...d.stats,
-              alreadyMigrated: d.stats.totalTransferred,
-            }));
-          }
-          setBatchStatusData(d);
-          // Save batch results whenever we have them (persists during auto-waiting)
-          if (d.createdIds) {
-            setLastBatchResult({
-              createdIds: d.createdIds,
-              warnings: d.warnings || [],
-              errors: d.errors || [],
-            });
-          }
-          // Terminal states: fetch full stats and stop polling
-          if (d.status !== 'running' && d.status !== 'rolling_back') {
-            api.getBatchStats().then(setBatchStats).catch(() => {});
-            break;
-          }
-        } catch {}
-        await new Promise(r => setTimeout(r, 2000));
-      }
-    };
-    poll();
+          }).catch(() => {});
+          return { ...prev, autoRunCountdown: 0, status: 'running', step: '🔄 Запуск следующего пакета...' };
+        }
+        return { ...prev, autoRunCountdown: next };
+      });
+    }, 1000);
+    return () => { cancelled = true; clearInterval(countdownTimer); };
+  }, [batchStatus?.status]);
 
-    return () => { polling = false; };
+  // Batch status transitions (the state itself arrives via the stream)
+  useEffect(() => {
+    const st = batchStatus?.status;
+    if (!st) return;
+    const prev = prevBatchStatusRef.current;
+    if (prev === 'running' && st === 'idle') setCrashDetected(true);
+    // Auto-dismiss crash banner when normal operation resumes
+    if (st === 'running' || st === 'auto-waiting') setCrashDetected(false);
+    prevBatchStatusRef.current = st;
+    // Terminal states: fetch full stats once
+    if ((prev === 'running' || prev === 'rolling_back') && st !== 'running' && st !== 'rolling_back') {
+      api.getBatchStats().then(setBatchStats).catch(() => {});
+      api.getBatchStatus().then(d => { if (d) setBatchStatusData(d); }).catch(() => {});
+    }
   }, [batchStatus?.status]);
 
+  // Sync counters instantly from embedded stats while a batch runs
+  useEffect(() => {
+    const s = batchStatus?.stats;
+    if (!s || (batchStatus?.status !== 'running' && batchStatus?.status !== 'rolling_back')) return;
+    setBatchStats(prev => ({
+      ...(prev || {}),
+      ...s,
+      alreadyMigrated: s.totalTransferred,
+    }));
+  }, [batchStatus?.stats]);
+
+  // Save batch results whenever we have them (persists during auto-waiting)
+  useEffect(() => {
+    if (!batchStatus?.createdIds) return;
+    setLastBatchResult({
+      createdIds: batchStatus.createdIds,
+      warnings: batchStatus.warnings || [],
+      errors: batchStatus.errors || [],
+    });
+  }, [batchStatus?.createdIds, batchStatus?.warnings, batchStatus?.errors]);
+
   const handleStart = async () => {
     if (!confirm('Запустить миграцию данных из amo CRM в Kommo CRM?')) return;
     setLoading(true);
@@ -422,7 +392,8 @@ export default function App() {
     setLoading(false);
   };
 
-  const handleAmoFetch = async () => {
+  // mode: 'full' — перезагрузка воронки, 'delta' — только изменения с последней загрузки
+  const handleAmoFetch = async (mode = 'full') => {
     // Подгружаем маппинги менеджеров если ещё не загружены
     let mapping = managerMapping;
     if (mapping.length === 0) {
@@ -445,12 +416,15 @@ export default function App() {
       ? `${mappedAmoIds.length} менеджер(а) из вкладки Менеджеры`
       : 'все менеджеры (маппинг не настроен)';
 
-    if (!confirm(`Загрузить данные из amo CRM?\nВоронка: ${pipeLabel}\nМенеджеры: ${mgrLabel}\n\nЭто может занять несколько минут.`)) return;
+    const confirmText = mode === 'delta'
+      ? `Загрузить изменения из amo CRM с ${new Date(fetchSt?.updatedAt).toLocaleString('ru-RU')}?\nВоронка: ${pipeLabel}\nМенеджеры: ${mgrLabel}`
+      : `Загрузить данные из amo CRM?\nВоронка: ${pipeLabel}\nМенеджеры: ${mgrLabel}\n\nЭто может занять несколько минут.`;
+    if (!confirm(confirmText)) return;
     setLoading(true);
     setMessage('');
     try {
-      await api.triggerAmoFetch(selectedAmoPipeline, mappedAmoIds);
-      setMessage('⏳ Загрузка данных из amo CRM запущена...');
+      await api.triggerAmoFetch(selectedAmoPipeline, mappedAmoIds, mode);
+      setMessage(mode === 'delta' ? '⏳ Загрузка изменений из amo CRM запущена...' : '⏳ Загрузка данных из amo CRM запущена...');
       const s = await api.getAmoFetchStatus();
       setFetchSt(s);
     } catch (e) {
@@ -762,6 +736,30 @@ export default function App() {
     setBatchLoading(false);
   };
 
+  const quarantineTotal = Object.values(batchStats?.quarantine || {}).reduce((a, b) => a + b, 0);
+
+  const handleRetryQuarantine = async () => {
+    if (!confirm(`Повторить создание ${quarantineTotal} записей из карантина (отклонены Kommo при создании)?`)) return;
+    setBatchLoading(true);
+    setMessage('');
+    try {
+      const r = await api.retryQuarantine();
+      const { relinked, followUp, ...byEntity } = r.summary || {};
+      const created = Object.values(byEntity).reduce((a, x) => a + (x.created || 0), 0);
+      const left = Object.values(r.counts || {}).reduce((a, b) => a + b, 0);
+      const links = (relinked?.contacts || 0) + (relinked?.companies || 0);
+      const extra = (links ? `, привязок ${links}` : '') +
+        (followUp ? `, задач ${followUp.tasks}, заметок ${followUp.notes}` : '');
+      const errs = (relinked?.errors?.length || 0) + (followUp?.errors?.length || 0);
+      setMessage(`${errs ? '⚠️' : '✅'} Карантин: создано ${created}${extra}, осталось ${left}${errs ? `, ошибок ${errs}` : ''}`);
+      const s = await api.getBatchStats().catch(() => null);
+      if (s) setBatchStats(s);
+    } catch (e) {
+      setMessage('❌ ' + (e.response?.data?.error || e.message));
+    }
+    setBatchLoading(false);
+  };
+
   const isRunning = status?.status === 'running' || status?.status === 'rolling_back';
   const progressPct = status?.progress?.total > 0
     ? Math.round((status.progress.current / status.progress.total) * 100)
@@ -1023,15 +1021,26 @@ export default function App() {
 
             {/* Load data button */}
             <div className="batch-row">
-              <button className="btn btn-secondary" onClick={handleAmoFetch}
+              <button className="btn btn-secondary" onClick={() => handleAmoFetch('full')}
                 disabled={loading || fetchSt?.status === 'loading'}>
                 {fetchSt?.status === 'loading'
                   ? `⏳ ${fetchSt.progress?.step || 'Загрузка...'}`
                   : '⬇️ Загрузить данные'}
               </button>
+              {fetchSt?.status === 'done' && (
+                <button className="btn btn-secondary" onClick={() => handleAmoFetch('delta')}
+                  disabled={loading} title="Только сделки, контакты, компании, задачи и заметки, изменённые после последней загрузки">
+                  🔄 Загрузить изменения
+                </button>
+              )}
               {fetchSt?.status === 'done' && (
                 <span style={{ color: '#10b981', fontSize: 13 }}>
                   ✅ Данные загружены: {new Date(fetchSt.updatedAt).toLocaleString('ru-RU')}
+                  {fetchSt.progress?.delta?.needsFix?.leads > 0 && (
+                    <span style={{ color: '#f59e0b', marginLeft: 8 }}>
+                      ⚠️ Изменено после переноса: {fetchSt.progress.delta.needsFix.leads} сделок — нужен проход в режиме «Изменённые»
+                    </span>
+                  )}
                 </span>
               )}
               {fetchSt?.status === 'error' && (
@@ -1167,7 +1176,7 @@ export default function App() {
             )}
 
             {/* Fix mode progress counter */}
-            {(migrationMode === 'fix-existing' || (batchStatus?.fixStats?.processed > 0)) && (
+            {(migrationMode === 'fix-existing' || migrationMode === 'fix-changed' || (batchStatus?.fixStats?.processed > 0)) && (
               <div style={{ marginTop: 8, padding: '8px 12px', background: 'rgba(245,158,11,0.1)', border: '1px solid rgba(245,158,11,0.35)', borderRadius: 6, display: 'flex', alignItems: 'center', gap: 12 }}>
                 <span style={{ color: '#fbbf24', fontSize: 13 }}>
                   🔧 Режим Фикс — обработано:{' '}
@@ -1202,12 +1211,12 @@ export default function App() {
               </div>
               <div className="batch-size-wrap" style={{ marginLeft: 16 }}>
                 <label className="batch-size-label">Режим:</label>
-                {[['all','Все'],['fix-existing','Фикс'],['new-only','Новые']].map(([val,lbl]) => (
+                {[['all','Все'],['fix-existing','Фикс'],['fix-changed','Изменённые'],['new-only','Новые']].map(([val,lbl]) => (
                   <button key={val}
                     className={`batch-size-btn${migrationMode === val ? ' active' : ''}`}
                     onClick={() => { setMigrationMode(val); localStorage.setItem('migration_mode', val); }}
                     disabled={batchStatus?.status === 'running'}
-                    title={val === 'all' ? 'Стандартный перенос всех сделок' : val === 'fix-existing' ? 'Только уже перенесённые — PATCH типов задач' : 'Только ещё не перенесённые сделки'}>
+                    title={val === 'all' ? 'Стандартный перенос всех сделок' : val === 'fix-existing' ? 'Только уже перенесённые — PATCH типов задач' : val === 'fix-changed' ? 'Перенесённые, изменённые в AMO после переноса (дельта-синхронизация)' : 'Только ещё не перенесённые сделки'}>
                     {lbl}
                   </button>
                 ))}
@@ -1263,6 +1272,14 @@ export default function App() {
                 style={{ background: 'rgba(168,85,247,0.15)', borderColor: 'rgba(168,85,247,0.5)', color: '#c4b5fd' }}>
                 🔄 Повтор пакета
               </button>
+              {quarantineTotal > 0 && (
+                <button className="btn btn-secondary" onClick={handleRetryQuarantine}
+                  disabled={batchLoading || batchStatus?.status === 'running'}
+                  title="Записи, отклонённые Kommo при создании (ошибки валидации) — повторить создание"
+                  style={{ background: 'rgba(239,68,68,0.15)', borderColor: 'rgba(239,68,68,0.5)', color: '#fca5a5' }}>
+                  ☣ Карантин ({quarantineTotal}) — повторить
+                </button>
+              )}
             </div>
 
             {/* Auto-run countdown banner */}
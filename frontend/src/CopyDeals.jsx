@@ -56,18 +56,38 @@ function WarningModal({ message, onConfirm, onCancel }) {
 function DealsPreviewModal({ sessionId, onClose }) {
   const [data, setData] = useState(null);
   const [loading, setLoading] = useState(true);
+  const [loadingMore, setLoadingMore] = useState(false);
   const [search, setSearch] = useState('');
+  const [query, setQuery] = useState(''); // search sent to the server (debounced)
+  const queryRef = useRef('');
 
   useEffect(() => {
-    api.getSessionPreview(sessionId)
-      .then(setData)
-      .catch(() => setData(null))
-      .finally(() => setLoading(false));
-  }, [sessionId]);
+    const t = setTimeout(() => setQuery(search.trim()), 300);
+    return () => clearTimeout(t);
+  }, [search]);
+
+  // Search runs on the server over all cached leads; pages are per query
+  useEffect(() => {
+    let cancelled = false;
+    queryRef.current = query;
+    api.getSessionPreview(sessionId, 0, query)
+      .then(d => { if (!cancelled) setData(d); })
+      .catch(() => { if (!cancelled) setData(null); })
+      .finally(() => { if (!cancelled) setLoading(false); });
+    return () => { cancelled = true; };
+  }, [sessionId, query]);
+
+  const loadMore = () => {
+    if (!data?.next_after || loadingMore) return;
+    setLoadingMore(true);
+    const q = query;
+    api.getSessionPreview(sessionId, data.next_after, q)
+      .then(page => { if (queryRef.current === q) setData(d => ({ ...page, leads: [...d.leads, ...page.leads] })); })
+      .catch(() => {})
+      .finally(() => setLoadingMore(false));
+  };
 
-  const filtered = data?.leads?.filter(l =>
-    !search || l.name?.toLowerCase().includes(search.toLowerCase()) || String(l.id).includes(search)
-  ) || [];
+  const leads = data?.leads || [];
 
   const copyStatusColor = { pending: '#94a3b8', created: '#10b981', skipped: '#f59e0b', error: '#ef4444', rolled_back: '#6b7280' };
 
@@ -111,7 +131,7 @@ function DealsPreviewModal({ sessionId, onClose }) {
                 </tr>
               </thead>
               <tbody>
-                {filtered.map(lead => (
+                {leads.map(lead => (
                   <tr key={lead.id} style={{ borderBottom: '1px solid #f1f5f9' }}>
                     <td style={{ padding: '8px', color: '#6b7280', fontFamily: 'monospace', border: '1px solid #f1f5f9' }}>{lead.id}</td>
                     <td style={{ padding: '8px', border: '1px solid #f1f5f9' }}>
@@ -129,12 +149,19 @@ function DealsPreviewModal({ sessionId, onClose }) {
                     </td>
                   </tr>
                 ))}
-                {filtered.length === 0 && (
+                {leads.length === 0 && (
                   <tr><td colSpan={6} style={{ textAlign: 'center', padding: 24, color: '#6b7280' }}>Нет данных</td></tr>
                 )}
               </tbody>
             </table>
           )}
+          {data?.next_after && (
+            <div style={{ textAlign: 'center', padding: 12 }}>
+              <button onClick={loadMore} disabled={loadingMore} style={{ padding: '6px 16px', border: '1px solid #d1d5db', borderRadius: 8, background: '#fff', cursor: 'pointer', fontSize: 13 }}>
+                {loadingMore ? 'Загрузка...' : (query ? `Показать ещё (найдено ${data.leads.length})` : `Показать ещё (загружено ${data.leads.length} из ${data.summary.total_leads})`)}
+              </button>
+            </div>
+          )}
         </div>
       </div>
     </div>
@@ -364,11 +364,12 @@ export default function FieldSync({ pipelines, isActive = true, cacheRefreshKey
   }, [cacheRefreshKey]);
 
   // ── Загрузка данных ──
-  const loadAnalysis = useCallback(async () => {
+  // refresh=true — перечитать схемы полей обеих CRM (иначе сервер отдаёт их из кэша)
+  const loadAnalysis = useCallback(async (refresh = false) => {
     setLoading(true);
     setError('');
     try {
-      const result = await api.getFieldsAnalysis();
+      const result = await api.getFieldsAnalysis(refresh);
       setData(result);
       addLog('✅ Данные загружены. Всего полей: ' + result.summary.total);
     } catch (e) {
@@ -568,7 +569,7 @@ export default function FieldSync({ pipelines, isActive = true, cacheRefreshKey
           <p className="fs-subtitle">Перенос кастомных полей из AMO CRM в Kommo CRM с визуальным сравнением</p>
         </div>
         <div className="fs-header-actions">
-          <button className="btn btn-primary" onClick={loadAnalysis} disabled={loading}>
+          <button className="btn btn-primary" onClick={() => loadAnalysis(true)} disabled={loading}>
             {loading ? '⏳ Загрузка...' : '🔄 Загрузить/Обновить'}
           </button>
           {data && (
@@ -820,7 +821,7 @@ export default function FieldSync({ pipelines, isActive = true, cacheRefreshKey
           <div className="fs-empty-icon">🔧</div>
           <div className="fs-empty-title">Данные не загружены</div>
           <div className="fs-empty-desc">Нажмите «Загрузить/Обновить» чтобы получить и сравнить кастомные поля из обоих аккаунтов.</div>
-          <button className="btn btn-primary" onClick={loadAnalysis} style={{ marginTop: 16 }}>
+          <button className="btn btn-primary" onClick={() => loadAnalysis(true)} style={{ marginTop: 16 }}>
             🔄 Загрузить
           </button>
         </div>
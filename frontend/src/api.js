@@ -22,14 +22,15 @@ export const saveStageMappingDB = (amoPipelineId, kommoPipelineId, stages) =>
 
 // AMO data loading
 export const getAmoFetchStatus = () => api.get('/amo/fetch-status').then(r => r.data);
-export const triggerAmoFetch = (pipelineId, managerIds) =>
-  api.post('/amo/fetch', { pipelineId: pipelineId || null, managerIds: managerIds || [] }).then(r => r.data);
+export const triggerAmoFetch = (pipelineId, managerIds, mode = 'full') =>
+  api.post('/amo/fetch', { pipelineId: pipelineId || null, managerIds: managerIds || [], mode }).then(r => r.data);
 export const getAmoEntities = (type, page = 1, limit = 50, search = '', managersOnly = false, managerIds = []) =>
   api.get('/amo/entities', { params: { type, page, limit, search, managersOnly: managersOnly ? '1' : '0', managerIds: managerIds.join(',') } }).then(r => r.data);
 export const getAmoStats = () => api.get('/amo/stats').then(r => r.data);
 
 // Fields sync
-export const getFieldsAnalysis = () => api.get('/migration/fields-analysis').then(r => r.data);
+export const getFieldsAnalysis = (refresh = false) =>
+  api.get('/migration/fields-analysis', { params: refresh ? { refresh: 1 } : {} }).then(r => r.data);
 export const createField = (entity, amoFieldId, status) =>
   api.post('/migration/create-field', { entityType: entity, amoFieldId, fieldStatus: status }).then(r => r.data);
 export const skipField = (entity, amoFieldId) =>
@@ -49,7 +50,11 @@ export const pauseBatch = () => api.post('/migration/batch-pause').then(r => r.d
 export const rollbackBatch = () => api.post('/migration/batch-rollback').then(r => r.data);
 export const resetBatchOffset = () => api.post('/migration/batch-reset').then(r => r.data);
 export const retryBatch = () => api.post('/migration/batch-retry').then(r => r.data);
+// Live batchState / fetchState (SSE) — see progressStream.js
+export const progressStreamUrl = (channels = 'batch,fetch') => `${API_BASE}/migration/stream?channels=${channels}`;
 export const filterCacheUnprocessed = () => api.post('/migration/filter-cache-unprocessed').then(r => r.data);
+export const getQuarantine = (entity) => api.get('/migration/quarantine', { params: { entity } }).then(r => r.data);
+export const retryQuarantine = () => api.post('/migration/quarantine/retry').then(r => r.data);
 
 // ── Manager matching ─────────────────────────────────────────────────────────
 export const getAmoManagers = () => api.get('/managers').then(r => r.data);
@@ -62,8 +67,8 @@ export const deleteManagerMatch = (amoUserId) => api.delete(`/managers/match/${a
 export const getManagers = () => api.get('/managers').then(r => r.data);
 export const getSessions = () => api.get('/sessions').then(r => r.data);
 export const getSession  = (id) => api.get(`/sessions/${id}`).then(r => r.data);
-export const getSessionPreview = (id) => api.get(`/sessions/${id}/preview`).then(r => r.data);
-export const getSessionLog = (id, limit = 100) => api.get(`/sessions/${id}/log`, { params: { limit } }).then(r => r.data);
+export const getSessionPreview = (id, after = 0, search = '') => api.get(`/sessions/${id}/preview`, { params: { after, search: search || undefined } }).then(r => r.data);
+export const getSessionLog = (id, limit = 100, before = null) => api.get(`/sessions/${id}/log`, { params: { limit, before } }).then(r => r.data);
 export const fetchSessionDeals = (params) => api.post('/sessions/fetch', params).then(r => r.data);
 export const startCopySession  = (id, userMap = null) => api.post(`/copy/${id}/start`, { user_map: userMap }).then(r => r.data);
 export const rollbackLastDeal  = (id) => api.post(`/sessions/${id}/rollback-last`).then(r => r.data);
@@ -0,0 +1,44 @@
+import { progressStreamUrl } from './api';
+
+// Delta ops from the server: { p: [path], v } replace, { p, a } append to array, { p, d: 1 } delete.
+// Only objects along the changed paths are copied, so unchanged parts keep their identity.
+function applyOp(node, path, op) {
+  if (path.length === 0) {
+    if (op.a) return [...(Array.isArray(node) ? node : []), ...op.a];
+    return op.v;
+  }
+  const [key, ...rest] = path;
+  const copy = Array.isArray(node) ? [...node] : { ...(node || {}) };
+  if (rest.length === 0 && op.d) {
+    delete copy[key];
+    return copy;
+  }
+  copy[key] = applyOp(copy[key], rest, op);
+  return copy;
+}
+
+export function applyDelta(state, ops) {
+  return ops.reduce((acc, op) => applyOp(acc, op.p, op), state);
+}
+
+/**
+ * Subscribe to live state channels. EventSource reconnects on its own and sends
+ * Last-Event-ID, so the server replays missed deltas (or sends a fresh snapshot).
+ * @param {(channel: 'batch'|'fetch', state: object) => void} onState - full state after every event
+ * @returns {() => void} unsubscribe
+ */
+export function subscribeProgress(onState, channels = ['batch', 'fetch']) {
+  const es = new EventSource(progressStreamUrl(channels.join(',')));
+  const live = {};
+  for (const channel of channels) {
+    es.addEventListener(channel, (evt) => {
+      let msg;
+      try { msg = JSON.parse(evt.data); } catch { return; }
+      if (msg.type === 'snapshot') live[channel] = msg.state;
+      else if (live[channel]) live[channel] = applyDelta(live[channel], msg.ops);
+      else return; // delta before any snapshot — wait for the next snapshot
+      onState(channel, live[channel]);
+    });
+  }
+  return () => es.close();
+}